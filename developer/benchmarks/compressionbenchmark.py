@@ -0,0 +1,389 @@
+#
+# A reproducible benchmark and regression check for the Compression module.
+#
+# This runs CompressionContext.Compress and Decompress, through the real Compression class, over a corpus of payloads like the ones we
+# actually relay: Moonraker JSON-RPC frames, OctoPrint packed JS and CSS, gcode, Bambu MQTT reports, and MJPEG multipart headers.
+# Each payload is a list of messages, and each one is run in two modes:
+#   - oneshot: every message gets its own context with its known size, like a normal http response.
+#   - stream: all of the messages go through one context with an unknown size, like a websocket or a chunked response.
+# And each mode is run with and without the pre-trained dictionary from ZStandardDictionary.
+#
+# The corpus is generated from a fixed seed, so the ratios are exactly the same run to run. Real files can be added with --corpus-dir,
+# each file is one payload, named by its file name.
+#
+# Results are printed (or written with --output) as JSON. If a --baseline results file is given, the run is compared to it and the
+# process exits with 1 if any ratio or throughput regressed more than the allowed amount, so it can be used to catch regressions before a release.
+# Throughput depends on the machine, so only compare results from the same machine.
+#
+# The allocation numbers come from tracemalloc, so they only include the python allocations, like the output buffers, not the memory
+# zstandard allocates internally.
+#
+# Run from the repo root:
+#   python developer/benchmarks/compressionbenchmark.py [--output results.json] [--baseline baseline.json] [--policy fixed|adaptive]
+#
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+# Allow this to be run as a script from the repo root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# pylint: disable=wrong-import-position
+from octoeverywhere.buffer import Buffer # noqa: E402
+from octoeverywhere.compression import Compression, CompressionContext # noqa: E402
+from octoeverywhere.compressionpolicy import CompressionPolicyManager # noqa: E402
+from octoeverywhere.zstandarddictionary import ZStandardDictionary # noqa: E402
+
+
+c_ModeOneShot = "oneshot"
+c_ModeStream = "stream"
+
+# In stream mode, large messages are split into chunks of this size, like the body reads of a chunked response.
+c_StreamChunkSizeBytes = 256 * 1024
+
+
+#
+# Corpus
+#
+
+def _MakeMoonrakerJsonRpcFrames(rand:random.Random) -> List[bytes]:
+    frames = []
+    for i in range(500):
+        status = {
+            "toolhead": {"position": [round(rand.uniform(0, 250), 3), round(rand.uniform(0, 250), 3), round(rand.uniform(0, 10), 3), round(rand.uniform(0, 5000), 2)], "print_time": round(i * 0.25, 3)},
+            "extruder": {"temperature": round(rand.uniform(209, 211), 2), "target": 210.0, "power": round(rand.random(), 3)},
+            "heater_bed": {"temperature": round(rand.uniform(59, 61), 2), "target": 60.0, "power": round(rand.random(), 3)},
+            "display_status": {"progress": round(i / 500, 4), "message": None},
+        }
+        frames.append(json.dumps({"jsonrpc": "2.0", "method": "notify_status_update", "params": [status, round(1000 + i * 0.25, 3)]}).encode("utf-8"))
+    return frames
+
+
+def _MakeBambuMqttReports(rand:random.Random) -> List[bytes]:
+    reports = []
+    for i in range(100):
+        report = {"print": {
+            "command": "push_status", "sequence_id": str(2000 + i), "msg": 0,
+            "gcode_state": "RUNNING", "mc_percent": i, "mc_remaining_time": 100 - i, "layer_num": i * 3, "total_layer_num": 300,
+            "nozzle_temper": round(rand.uniform(219, 221), 2), "nozzle_target_temper": 220, "bed_temper": round(rand.uniform(64, 66), 2), "bed_target_temper": 65,
+            "chamber_temper": round(rand.uniform(30, 35), 1), "fan_gear": rand.randint(0, 65535), "spd_lvl": 2, "spd_mag": 100, "wifi_signal": f"-{rand.randint(30, 70)}dBm",
+            "gcode_file": "/data/Metadata/plate_1.gcode", "subtask_name": "benchy", "print_error": 0, "hms": [],
+            "ams": {"ams": [{"id": str(a), "humidity": str(rand.randint(1, 5)), "temp": str(round(rand.uniform(20, 30), 1)), "tray": [
+                {"id": str(t), "remain": rand.randint(0, 100), "tray_type": rand.choice(["PLA", "PETG", "ABS"]), "tray_color": f"{rand.randint(0, 0xFFFFFF):06X}FF", "nozzle_temp_max": "240", "nozzle_temp_min": "190"}
+                for t in range(4)]} for a in range(2)], "tray_now": str(rand.randint(0, 7))},
+            "lights_report": [{"node": "chamber_light", "mode": "on"}], "upgrade_state": {"status": "IDLE", "progress": ""},
+        }}
+        reports.append(json.dumps(report).encode("utf-8"))
+    return reports
+
+
+def _MakePackedJs(rand:random.Random, sizeBytes:int) -> bytes:
+    names = ["OctoPrint", "viewModel", "ko", "observable", "computed", "self", "data", "settings", "printerState", "temperature", "files", "control", "terminal", "gcodeViewer", "ajax", "deferred", "callback", "element", "options"]
+    parts = ["// source: plugin/octoeverywhere/static/js/packed_libs.js\n"]
+    total = 0
+    i = 0
+    while total < sizeBytes:
+        a = rand.choice(names)
+        b = rand.choice(names)
+        fn = f"$(function(){{function {a}{i}ViewModel(parameters){{var self=this;self.{b}=parameters[{rand.randint(0, 5)}];self.{a}Enabled=ko.observable({rand.choice(['true', 'false'])});" \
+             f"self.on{b.capitalize()}Update=function(data){{if(!data||data.{a}===undefined){{return;}}self.{a}Enabled(data.{a}>{rand.randint(0, 1000)});}};}}" \
+             f"OCTOPRINT_VIEWMODELS.push({{construct:{a}{i}ViewModel,dependencies:[\"{b}ViewModel\",\"settingsViewModel\"],elements:[\"#{a}_{i}\"]}});}});\n"
+        parts.append(fn)
+        total += len(fn)
+        i += 1
+    return "".join(parts).encode("utf-8")[:sizeBytes]
+
+
+def _MakePackedCss(rand:random.Random, sizeBytes:int) -> bytes:
+    selectors = ["#navbar", ".btn", ".btn-primary", "#control", ".tab-content", "#temp", ".progress", ".bar", "#files", ".gcode_files", ".entry", "#terminal-output"]
+    props = ["margin:0", "padding:4px 8px", "color:#333", "background-color:#f5f5f5", "border:1px solid #ccc", "display:block", "font-size:12px", "line-height:20px", "width:100%"]
+    parts = []
+    total = 0
+    while total < sizeBytes:
+        rule = rand.choice(selectors) + " " + rand.choice(selectors) + "{" + ";".join(rand.sample(props, 4)) + "}\n"
+        parts.append(rule)
+        total += len(rule)
+    return "".join(parts).encode("utf-8")[:sizeBytes]
+
+
+def _MakeGcode(rand:random.Random, sizeBytes:int) -> bytes:
+    parts = ["; generated by PrusaSlicer 2.7.1\nM140 S60\nM104 S210\nG28\nG90\nM83\n"]
+    total = 0
+    x = 100.0
+    y = 100.0
+    layer = 0
+    while total < sizeBytes:
+        if rand.random() < 0.002:
+            layer += 1
+            line = f";LAYER_CHANGE\n;Z:{layer * 0.2:.1f}\nG1 Z{layer * 0.2:.3f} F7800\n"
+        else:
+            x = min(250.0, max(0.0, x + rand.uniform(-5, 5)))
+            y = min(250.0, max(0.0, y + rand.uniform(-5, 5)))
+            line = f"G1 X{x:.3f} Y{y:.3f} E{rand.uniform(0.01, 0.2):.5f}\n"
+        parts.append(line)
+        total += len(line)
+    return "".join(parts).encode("utf-8")[:sizeBytes]
+
+
+def _MakeMjpegHeaders(rand:random.Random) -> List[bytes]:
+    headers = []
+    for i in range(500):
+        headers.append(f"--boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: {rand.randint(40000, 120000)}\r\nX-Timestamp: {1700000000 + i / 15:.6f}\r\n\r\n".encode("ascii"))
+    return headers
+
+
+def _Chunk(data:bytes, chunkSizeBytes:int) -> List[bytes]:
+    return [data[i:i + chunkSizeBytes] for i in range(0, len(data), chunkSizeBytes)]
+
+
+# Returns the payloads by name. Each payload is a list of messages and the content type a stream of it would have.
+def BuildCorpus(corpusDir:Optional[str]=None) -> Dict[str, Dict[str, Any]]:
+    rand = random.Random(20211217)
+    corpus:Dict[str, Dict[str, Any]] = {
+        "moonraker_jsonrpc": {"content_type": "application/json", "messages": _MakeMoonrakerJsonRpcFrames(rand)},
+        "octoprint_packed_js": {"content_type": "application/javascript", "messages": [_MakePackedJs(rand, 4 * 1024 * 1024)]},
+        "octoprint_packed_css": {"content_type": "text/css", "messages": [_MakePackedCss(rand, 300 * 1024)]},
+        "gcode": {"content_type": "application/octet-stream", "messages": [_MakeGcode(rand, 2 * 1024 * 1024)]},
+        "bambu_mqtt_report": {"content_type": "application/json", "messages": _MakeBambuMqttReports(rand)},
+        "mjpeg_headers": {"content_type": "multipart/x-mixed-replace", "messages": _MakeMjpegHeaders(rand)},
+    }
+    if corpusDir is not None:
+        for fileName in sorted(os.listdir(corpusDir)):
+            filePath = os.path.join(corpusDir, fileName)
+            if os.path.isfile(filePath) is False:
+                continue
+            with open(filePath, "rb") as f:
+                corpus["file_" + fileName] = {"content_type": None, "messages": _Chunk(f.read(), c_StreamChunkSizeBytes)}
+    return corpus
+
+
+#
+# Benchmark
+#
+
+# Stops the compressors from using the pre-trained dict. The compressors hold the dict, so the pools are cleared on the way in and out.
+class _NoPreTrainedDict:
+    def __init__(self, compression:Compression) -> None:
+        self.Compression = compression
+        self.Dict:Any = None
+
+
+    def __enter__(self) -> "_NoPreTrainedDict":
+        self.Dict = ZStandardDictionary.Get().PreTrainedDict
+        ZStandardDictionary.Get().PreTrainedDict = None
+        self._ClearPools()
+        return self
+
+
+    def __exit__(self, t:Any, v:Any, tb:Any) -> None:
+        ZStandardDictionary.Get().PreTrainedDict = self.Dict
+        self._ClearPools()
+
+
+    def _ClearPools(self) -> None:
+        with self.Compression.ZStandardCompressorPoolLock:
+            self.Compression.ZStandardCompressorPool = {}
+            self.Compression.ZStandardCompressorPoolCount = 0
+        with self.Compression.ZStandardDecompressorPoolLock:
+            self.Compression.ZStandardDecompressorPool = []
+
+
+# Compresses and decompresses all of the messages once, and returns the compressed size and the time each side took.
+def _RunOnce(compression:Compression, logger:logging.Logger, messages:List[Buffer], contentType:Optional[str], mode:str) -> Dict[str, Any]:
+    compressedBytes = 0
+    compressSec = 0.0
+    decompressSec = 0.0
+    compressionType = None
+    if mode == c_ModeOneShot:
+        for message in messages:
+            with CompressionContext(logger) as compressContext:
+                compressContext.SetTotalCompressedSizeOfData(len(message))
+                compressContext.SetContentType(contentType)
+                startSec = time.perf_counter()
+                result = compression.Compress(compressContext, message)
+                compressSec += time.perf_counter() - startSec
+            compressedBytes += len(result.Bytes)
+            compressionType = result.CompressionType
+            with CompressionContext(logger) as decompressContext:
+                startSec = time.perf_counter()
+                out = compression.Decompress(decompressContext, result.Bytes, len(message), True, result.CompressionType)
+                decompressSec += time.perf_counter() - startSec
+            if len(out) != len(message):
+                raise Exception("Compression benchmark round trip size mismatch.")
+    else:
+        with CompressionContext(logger) as compressContext, CompressionContext(logger) as decompressContext:
+            compressContext.SetContentType(contentType)
+            for message in messages:
+                startSec = time.perf_counter()
+                result = compression.Compress(compressContext, message)
+                compressSec += time.perf_counter() - startSec
+                compressedBytes += len(result.Bytes)
+                compressionType = result.CompressionType
+                startSec = time.perf_counter()
+                # The stream is never ended with a frame end, so it must always be read as a stream.
+                out = compression.Decompress(decompressContext, result.Bytes, len(message), False, result.CompressionType)
+                decompressSec += time.perf_counter() - startSec
+                if len(out) != len(message):
+                    raise Exception("Compression benchmark round trip size mismatch.")
+    return {"compressed_bytes": compressedBytes, "compress_sec": compressSec, "decompress_sec": decompressSec, "compression_type": compressionType}
+
+
+# Runs one payload in one mode. The payload is repeated until it has run for at least minDurationSec, then one more run is traced for the allocations.
+def RunCase(compression:Compression, logger:logging.Logger, name:str, payload:Dict[str, Any], mode:str, useDict:bool, minDurationSec:float=0.5, minIterations:int=1) -> Dict[str, Any]:
+    messages = [Buffer(m) for m in payload["messages"]]
+    # Large messages are read and sent in chunks when they are streamed.
+    if mode == c_ModeStream:
+        messages = [Buffer(c) for m in payload["messages"] for c in _Chunk(m, c_StreamChunkSizeBytes)]
+    uncompressedBytes = sum(len(m) for m in messages)
+    iterations = 0
+    compressSec = 0.0
+    decompressSec = 0.0
+    compressedBytes = 0
+    compressionType = None
+    while iterations < minIterations or compressSec + decompressSec < minDurationSec:
+        run = _RunOnce(compression, logger, messages, payload["content_type"], mode)
+        iterations += 1
+        compressSec += run["compress_sec"]
+        decompressSec += run["decompress_sec"]
+        compressedBytes = run["compressed_bytes"]
+        compressionType = run["compression_type"]
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        _RunOnce(compression, logger, messages, payload["content_type"], mode)
+        after = tracemalloc.take_snapshot()
+        _, peakBytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, "filename")
+    allocatedBlocks = sum(s.count_diff for s in stats if s.count_diff > 0)
+    allocatedBytes = sum(s.size_diff for s in stats if s.size_diff > 0)
+
+    uncompressedMb = (uncompressedBytes * iterations) / (1024.0 * 1024.0)
+    return {
+        "payload": name,
+        "mode": mode,
+        "dictionary": useDict,
+        "messages": len(messages),
+        "compression_type": compressionType,
+        "iterations": iterations,
+        "uncompressed_bytes": uncompressedBytes,
+        "compressed_bytes": compressedBytes,
+        "ratio": round(uncompressedBytes / max(compressedBytes, 1), 4),
+        "compress_mb_sec": round(uncompressedMb / max(compressSec, 0.000001), 2),
+        "decompress_mb_sec": round(uncompressedMb / max(decompressSec, 0.000001), 2),
+        "compress_us_per_msg": round((compressSec * 1000000.0) / (len(messages) * iterations), 2),
+        "py_peak_alloc_bytes": peakBytes,
+        "py_retained_alloc_blocks": allocatedBlocks,
+        "py_retained_alloc_bytes": allocatedBytes,
+    }
+
+
+# Runs the full benchmark and returns the results.
+def RunBenchmark(corpusDir:Optional[str]=None, policy:str="fixed", minDurationSec:float=0.5, payloadNames:Optional[List[str]]=None) -> Dict[str, Any]:
+    logger = logging.getLogger("compressionbenchmark")
+    # The adaptive policy depends on the device calibration and what it has measured so far, so the default fixed policy is used for reproducible runs.
+    CompressionPolicyManager.SetEnabled(policy == "adaptive")
+    Compression.Init(logger, tempfile.mkdtemp())
+    compression = Compression.Get()
+    corpus = BuildCorpus(corpusDir)
+    if payloadNames is not None:
+        corpus = {k: v for k, v in corpus.items() if k in payloadNames}
+
+    results:List[Dict[str, Any]] = []
+    for useDict in (True, False):
+        # Without zstandard, there's no dictionary to compare against.
+        if useDict is False and compression.CanUseZStandardLib is False:
+            continue
+        # The adaptive policy precomputes its dicts per level, which needs the pre-trained dict.
+        if useDict is False and policy == "adaptive":
+            continue
+        for name, payload in corpus.items():
+            for mode in (c_ModeOneShot, c_ModeStream):
+                if useDict:
+                    results.append(RunCase(compression, logger, name, payload, mode, useDict, minDurationSec))
+                else:
+                    with _NoPreTrainedDict(compression):
+                        results.append(RunCase(compression, logger, name, payload, mode, useDict, minDurationSec))
+
+    zstdVersion = None
+    try:
+        #pylint: disable=import-outside-toplevel
+        import zstandard as zstd
+        zstdVersion = zstd.__version__
+    except Exception:
+        pass
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "zstandard": zstdVersion,
+            "uses_zstandard": compression.CanUseZStandardLib,
+            "policy": policy,
+            "policy_stats": compression.GetPolicyStats(),
+        },
+        "results": results,
+    }
+
+
+# Compares a run to a baseline and returns a description of each regression.
+# Ratios are deterministic for the generated corpus, so they get a tight tolerance, throughput is noisy so it gets its own.
+def FindRegressions(baseline:Dict[str, Any], current:Dict[str, Any], maxRatioRegression:float=0.02, maxThroughputRegression:float=0.25) -> List[str]:
+    regressions:List[str] = []
+    baselineCases = {(r["payload"], r["mode"], r["dictionary"]): r for r in baseline.get("results", [])}
+    for result in current.get("results", []):
+        key = (result["payload"], result["mode"], result["dictionary"])
+        base = baselineCases.get(key, None)
+        if base is None:
+            continue
+        caseName = f"{result['payload']} {result['mode']} dict:{result['dictionary']}"
+        if result["ratio"] < base["ratio"] * (1.0 - maxRatioRegression):
+            regressions.append(f"{caseName} ratio {base['ratio']} -> {result['ratio']}")
+        for field in ("compress_mb_sec", "decompress_mb_sec"):
+            if result[field] < base[field] * (1.0 - maxThroughputRegression):
+                regressions.append(f"{caseName} {field} {base[field]} -> {result[field]}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the Compression module over a corpus of representative payloads.")
+    parser.add_argument("--output", help="Write the JSON results to this file rather than stdout.")
+    parser.add_argument("--baseline", help="A results file to compare against. Exits with 1 if anything regressed.")
+    parser.add_argument("--corpus-dir", help="A dir of extra files to add to the corpus.")
+    parser.add_argument("--payload", action="append", help="Only run this payload, can be given more than once.")
+    parser.add_argument("--policy", choices=["fixed", "adaptive"], default="fixed")
+    parser.add_argument("--min-sec", type=float, default=0.5, help="The min time to run each case.")
+    parser.add_argument("--max-ratio-regression", type=float, default=0.02)
+    parser.add_argument("--max-throughput-regression", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = RunBenchmark(args.corpus_dir, args.policy, args.min_sec, args.payload)
+    resultsJson = json.dumps(results, indent=2)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(resultsJson)
+    else:
+        print(resultsJson)
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = FindRegressions(baseline, results, args.max_ratio_regression, args.max_throughput_regression)
+        for r in regressions:
+            print("REGRESSION: " + r, file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+#
+# Builds the trained zstandard dictionaries for each platform and traffic class, and evaluates them against the current pre-trained dictionary.
+#
+# The pre-trained dictionary in ZStandardDictionary is shared by every platform, but the traffic we relay is very different between them,
+# OctoPrint is sockjs json and packed js, Moonraker is json-rpc and the Mainsail / Fluidd bundles, Bambu is mqtt json reports and Elegoo is sdcp json.
+# This trains one dictionary per platform and traffic class from captured local traffic, so each can be tuned to what that platform sends.
+#
+# The corpus dir must be laid out as <corpus-dir>/<platform>/<traffic class>/<sample files>, where each file is one message or response body.
+# That's the layout ZStandardDictionary.SubmitData writes when capturing, using the platform name as the prefix. The platforms and traffic classes
+# are the ones in ZStandardDictionary. Every sample is anonymized before it's used, so the ip addresses, serial numbers, access codes and
+# such in the captures never end up in a dictionary.
+#
+# Each platform and traffic class is split into a training set and a held out evaluation set. The dictionary is trained on the training set, and then
+# the evaluation set is compressed with no dictionary, the current pre-trained dictionary, and the new dictionary, in two modes:
+#   - oneshot: every sample is compressed on its own with its known size, like a normal http response.
+#   - stream: all of the samples go through one stream and are flushed after each one, like a websocket.
+# A new dictionary is only accepted if it beats the current dictionary in both modes by at least --min-gain.
+#
+# The results are printed (or written with --output) as JSON. With --write, the accepted dictionaries are written to octoeverywhere/zstandarddictionaries.py,
+# and with --dict-dir the raw dictionaries are written as files, which is what the service needs. The service must know a dict id before it will
+# accept it in the handshake, so the service must be updated with the new dictionaries before a plugin release ships them.
+#
+# The dict ids are built from --version, the platform, and the traffic class, so bump --version every time the dictionaries are rebuilt.
+#
+# --synthetic uses a generated corpus rather than captures, which is only useful to try out the pipeline. It can't be used with --write.
+#
+# Run from the repo root:
+#   python developer/benchmarks/dictionarybuilder.py --corpus-dir captures --version 2 [--output results.json] [--write] [--dict-dir dicts]
+#
+import os
+import re
+import sys
+import json
+import time
+import base64
+import argparse
+import platform
+from typing import Any, Dict, List, Tuple
+
+# Allow this to be run as a script from the repo root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# pylint: disable=wrong-import-position
+from octoeverywhere.zstandarddictionary import ZStandardDictionary # noqa: E402
+
+import compressionbenchmark # noqa: E402
+
+
+c_TrafficClasses = [ZStandardDictionary.c_TrafficClassJson, ZStandardDictionary.c_TrafficClassWeb]
+
+# Every Nth sample is held out for the evaluation.
+c_EvaluateEveryN = 5
+
+# zstandard can't train a useful dictionary from only a few samples.
+c_MinTrainingSamples = 20
+
+c_ModeOneShot = "oneshot"
+c_ModeStream = "stream"
+
+c_DictionariesModulePath = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "octoeverywhere", "zstandarddictionaries.py")
+
+
+#
+# Anonymization
+#
+
+# The json keys that hold something that identifies the printer or the user. Their string values are replaced.
+c_SensitiveJsonKeys = [
+    "serial", "sn", "dev_id", "device_id", "printer_id", "mainboardid", "mainboard_id", "access_code", "accesscode", "api_key", "apikey",
+    "token", "password", "passwd", "secret", "ssid", "bssid", "hostname", "host", "name", "printer_name", "machine_name", "user", "username",
+    "email", "filename", "gcode_file", "subtask_name", "path",
+]
+
+# Each pattern and what it's replaced with, applied in order.
+c_AnonymizePatterns:List[Tuple[Any, bytes]] = [
+    # The sensitive json string values, the key is kept.
+    (re.compile(rb'("(?:' + b"|".join(re.escape(k.encode("utf-8")) for k in c_SensitiveJsonKeys) + rb')"\s*:\s*")[^"]*(")', re.IGNORECASE), rb"\1redacted\2"),
+    (re.compile(rb"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}"), b"user@example.com"),
+    (re.compile(rb"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b"), b"00000000-0000-0000-0000-000000000000"),
+    (re.compile(rb"\b(?:[0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2}\b"), b"00:00:00:00:00:00"),
+    (re.compile(rb"\b(?:\d{1,3}\.){3}\d{1,3}\b"), b"192.168.1.2"),
+    # Long hex or base64 like runs are keys, tokens, and serial numbers.
+    (re.compile(rb"\b[0-9a-fA-F]{16,}\b"), b"0000000000000000"),
+    (re.compile(rb"\b[A-Za-z0-9+/_-]{32,}={0,2}"), b"REDACTEDTOKENREDACTEDTOKENREDACTED"),
+]
+
+
+# Removes anything that could identify a printer or user from a captured sample.
+def Anonymize(data:bytes) -> bytes:
+    for pattern, replacement in c_AnonymizePatterns:
+        data = pattern.sub(replacement, data)
+    return data
+
+
+#
+# Corpus
+#
+
+# Returns the samples by (platform, traffic class).
+def LoadCorpus(corpusDir:str) -> Dict[Tuple[str, str], List[bytes]]:
+    corpus:Dict[Tuple[str, str], List[bytes]] = {}
+    platforms = sorted(set(ZStandardDictionary.c_ServerHostPlatforms.values()))
+    for platformName in platforms:
+        for trafficClass in c_TrafficClasses:
+            folderPath = os.path.join(corpusDir, platformName, trafficClass)
+            if os.path.isdir(folderPath) is False:
+                continue
+            samples:List[bytes] = []
+            for fileName in sorted(os.listdir(folderPath)):
+                filePath = os.path.join(folderPath, fileName)
+                if os.path.isfile(filePath) is False:
+                    continue
+                with open(filePath, "rb") as f:
+                    data = f.read()
+                if len(data) > 0:
+                    samples.append(Anonymize(data))
+            if len(samples) > 0:
+                corpus[(platformName, trafficClass)] = samples
+    return corpus
+
+
+# Returns a generated corpus from the compression benchmark payloads, which is only useful to try out the pipeline.
+def BuildSyntheticCorpus() -> Dict[Tuple[str, str], List[bytes]]:
+    payloads = compressionbenchmark.BuildCorpus()
+    # The big bundles are split up, since a dictionary is trained on many samples.
+    def split(data:bytes) -> List[bytes]:
+        return [data[i:i + 16 * 1024] for i in range(0, len(data), 16 * 1024)]
+    return {
+        (ZStandardDictionary.c_PlatformMoonraker, ZStandardDictionary.c_TrafficClassJson): payloads["moonraker_jsonrpc"]["messages"],
+        (ZStandardDictionary.c_PlatformBambu, ZStandardDictionary.c_TrafficClassJson): payloads["bambu_mqtt_report"]["messages"],
+        (ZStandardDictionary.c_PlatformOctoPrint, ZStandardDictionary.c_TrafficClassWeb):
+            split(payloads["octoprint_packed_js"]["messages"][0]) + split(payloads["octoprint_packed_css"]["messages"][0]),
+    }
+
+
+def SplitSamples(samples:List[bytes]) -> Tuple[List[bytes], List[bytes]]:
+    training = [s for i, s in enumerate(samples) if i % c_EvaluateEveryN != c_EvaluateEveryN - 1]
+    evaluation = [s for i, s in enumerate(samples) if i % c_EvaluateEveryN == c_EvaluateEveryN - 1]
+    return (training, evaluation)
+
+
+#
+# Build and evaluate
+#
+
+# The dict id is unique per version, platform, and traffic class. The pre-trained dict is id 1, so these never collide with it.
+def GetDictId(version:int, platformName:str, trafficClass:str) -> int:
+    serverHost = min(k for k, v in ZStandardDictionary.c_ServerHostPlatforms.items() if v == platformName)
+    return version * 1000 + serverHost * 10 + c_TrafficClasses.index(trafficClass) + 1
+
+
+def Train(samples:List[bytes], dictId:int, dictSizeBytes:int, steps:int) -> Any:
+    #pylint: disable=import-outside-toplevel
+    import zstandard as zstd
+    # The dicts are used at the default level, so they are tuned for it.
+    return zstd.train_dictionary(dictSizeBytes, samples, dict_id=dictId, level=3, steps=steps, threads=-1) #pyright: ignore[reportArgumentType]
+
+
+# Compresses the samples and returns the compressed size and the time it took.
+def _CompressOnce(samples:List[bytes], dictData:Any, mode:str) -> Tuple[int, float]:
+    #pylint: disable=import-outside-toplevel
+    import zstandard as zstd
+    compressedBytes = 0
+    startSec = time.perf_counter()
+    if mode == c_ModeOneShot:
+        compressor = zstd.ZstdCompressor(level=3, dict_data=dictData)
+        for sample in samples:
+            compressedBytes += len(compressor.compress(sample))
+    else:
+        output = _CountingWriter()
+        compressor = zstd.ZstdCompressor(level=3, dict_data=dictData)
+        with compressor.stream_writer(output, closefd=False) as writer: #pyright: ignore[reportArgumentType]
+            for sample in samples:
+                writer.write(sample)
+                writer.flush()
+        compressedBytes = output.Bytes
+    return (compressedBytes, time.perf_counter() - startSec)
+
+
+class _CountingWriter:
+    def __init__(self) -> None:
+        self.Bytes = 0
+
+
+    def write(self, data:bytes) -> int:
+        self.Bytes += len(data)
+        return len(data)
+
+
+    def flush(self) -> None:
+        pass
+
+
+def Evaluate(samples:List[bytes], dictData:Any, mode:str, minDurationSec:float) -> Dict[str, Any]:
+    uncompressedBytes = sum(len(s) for s in samples)
+    iterations = 0
+    totalSec = 0.0
+    compressedBytes = 0
+    while iterations == 0 or totalSec < minDurationSec:
+        compressedBytes, durationSec = _CompressOnce(samples, dictData, mode)
+        totalSec += durationSec
+        iterations += 1
+    return {
+        "compressed_bytes": compressedBytes,
+        "ratio": round(uncompressedBytes / max(compressedBytes, 1), 4),
+        "compress_mb_sec": round((uncompressedBytes * iterations / (1024.0 * 1024.0)) / max(totalSec, 0.000001), 2),
+    }
+
+
+def BuildAndEvaluate(corpus:Dict[Tuple[str, str], List[bytes]], version:int, dictSizeBytes:int, steps:int, minGain:float, minDurationSec:float) -> Dict[str, Any]:
+    #pylint: disable=import-outside-toplevel
+    import zstandard as zstd
+    currentDict = zstd.ZstdCompressionDict(base64.b64decode(ZStandardDictionary.c_Dict1), dict_type=zstd.DICT_TYPE_FULLDICT)
+    results:List[Dict[str, Any]] = []
+    for (platformName, trafficClass), samples in sorted(corpus.items()):
+        training, evaluation = SplitSamples(samples)
+        result:Dict[str, Any] = {
+            "platform": platformName,
+            "traffic_class": trafficClass,
+            "training_samples": len(training),
+            "evaluation_samples": len(evaluation),
+            "evaluation_bytes": sum(len(s) for s in evaluation),
+            "accepted": False,
+        }
+        results.append(result)
+        if len(training) < c_MinTrainingSamples or len(evaluation) == 0:
+            result["error"] = f"Not enough samples, at least {c_MinTrainingSamples} training samples are needed."
+            continue
+        dictId = GetDictId(version, platformName, trafficClass)
+        try:
+            startSec = time.perf_counter()
+            trainedDict = Train(training, dictId, dictSizeBytes, steps)
+            result["train_sec"] = round(time.perf_counter() - startSec, 2)
+        except Exception as e:
+            result["error"] = f"Training failed. {e}"
+            continue
+        result["dict_id"] = dictId
+        result["dict_bytes"] = len(trainedDict.as_bytes())
+        result["dict"] = trainedDict
+        gains = []
+        for mode in (c_ModeOneShot, c_ModeStream):
+            none = Evaluate(evaluation, None, mode, minDurationSec)
+            current = Evaluate(evaluation, currentDict, mode, minDurationSec)
+            trained = Evaluate(evaluation, trainedDict, mode, minDurationSec)
+            gain = trained["ratio"] / max(current["ratio"], 0.000001)
+            gains.append(gain)
+            result[mode] = {"no_dict": none, "current_dict": current, "trained_dict": trained, "gain_vs_current": round(gain, 4)}
+        result["accepted"] = min(gains) >= 1.0 + minGain
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "zstandard": zstd.__version__,
+            "version": version,
+            "dict_size_bytes": dictSizeBytes,
+            "min_gain": minGain,
+        },
+        "results": results,
+    }
+
+
+# Writes the accepted dicts to the generated module.
+def WriteDictionariesModule(results:List[Dict[str, Any]]) -> None:
+    with open(c_DictionariesModulePath, encoding="utf-8") as f:
+        source = f.read()
+    header = source[:source.index("c_TrainedDictionaries")]
+    lines = [header + "c_TrainedDictionaries:List[Tuple[int, str, str, str]] = ["]
+    for result in results:
+        if result["accepted"]:
+            dictBase64 = base64.b64encode(result["dict"].as_bytes()).decode("ascii")
+            lines.append(f"    ({result['dict_id']}, \"{result['platform']}\", \"{result['traffic_class']}\", \"{dictBase64}\"), #pylint: disable=line-too-long")
+    lines.append("]\n")
+    with open(c_DictionariesModulePath, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) if len(lines) > 2 else header + "c_TrainedDictionaries:List[Tuple[int, str, str, str]] = []\n")
+
+
+def WriteDictionaryFiles(results:List[Dict[str, Any]], dictDir:str) -> None:
+    os.makedirs(dictDir, exist_ok=True)
+    for result in results:
+        if result["accepted"]:
+            with open(os.path.join(dictDir, f"{result['dict_id']}-{result['platform']}-{result['traffic_class']}.zdict"), "wb") as f:
+                f.write(result["dict"].as_bytes())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Builds the trained zstandard dictionaries for each platform and traffic class.")
+    parser.add_argument("--corpus-dir", help="The captured samples, laid out as <platform>/<traffic class>/<files>.")
+    parser.add_argument("--synthetic", action="store_true", help="Use a generated corpus to try out the pipeline.")
+    parser.add_argument("--version", type=int, default=1, help="The dictionary version, which is part of the dict ids.")
+    parser.add_argument("--dict-size", type=int, default=112640, help="The max size of each dictionary.")
+    parser.add_argument("--steps", type=int, default=100, help="The number of steps the trainer uses to optimize its params.")
+    parser.add_argument("--min-gain", type=float, default=0.05, help="How much better than the current dictionary a new one must be.")
+    parser.add_argument("--min-sec", type=float, default=0.2, help="The min time to run each evaluation.")
+    parser.add_argument("--output", help="Write the JSON results to this file rather than stdout.")
+    parser.add_argument("--write", action="store_true", help="Write the accepted dictionaries to octoeverywhere/zstandarddictionaries.py.")
+    parser.add_argument("--dict-dir", help="Write the accepted dictionaries to this dir as files.")
+    args = parser.parse_args()
+
+    if (args.corpus_dir is None) == (args.synthetic is False):
+        parser.error("Either --corpus-dir or --synthetic must be given.")
+    if args.synthetic and args.write:
+        parser.error("The synthetic corpus can't be used to write the dictionaries.")
+
+    corpus:Dict[Tuple[str, str], List[bytes]] = BuildSyntheticCorpus() if args.synthetic else LoadCorpus(args.corpus_dir)
+    if len(corpus) == 0:
+        parser.error("No samples were found in the corpus dir.")
+    report = BuildAndEvaluate(corpus, args.version, args.dict_size, args.steps, args.min_gain, args.min_sec)
+
+    if args.write:
+        WriteDictionariesModule(report["results"])
+    if args.dict_dir is not None:
+        WriteDictionaryFiles(report["results"], args.dict_dir)
+
+    # The dict objects aren't part of the JSON output.
+    for result in report["results"]:
+        result.pop("dict", None)
+    reportJson = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(reportJson)
+    else:
+        print(reportJson)
+
+
+if __name__ == "__main__":
+    main()
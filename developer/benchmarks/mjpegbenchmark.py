@@ -0,0 +1,206 @@
+#
+# A micro benchmark of the MJPEG frame extraction the QuickCam backends use.
+#
+# This feeds a MJPEG stream, like the image2pipe output ffmpeg gives the RTSP backend, through:
+#   - legacy: the old RTSP backend logic, which read each chunk as new bytes, appended it to a pending bytearray, and sliced the frames out.
+#   - extractor: the MjpegFrameExtractor, which reads into a preallocated arena and returns the frames as views of it.
+#
+# The stream is read in the same chunk size the RTSP backend reads stdout with. The copy of the stream into the read buffer is the same for both,
+# so it's not counted, the copied bytes are only the copies each algorithm makes on top of that. Like the QuickCam, the last couple of frames
+# are kept alive while the next ones are extracted.
+#
+# The stream is generated from a fixed seed, or a recorded stream can be given with --input, like the output of:
+#   ffmpeg -i rtsp://<camera> -filter:v fps=15 -f image2pipe - > recording.mjpeg
+#
+# Run from the repo root:
+#   python developer/benchmarks/mjpegbenchmark.py [--input recording.mjpeg] [--frames 300] [--frame-kb 40] [--min-sec 1.0] [--output results.json]
+#
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+from typing import Any, Callable, Dict, List, Optional
+
+# Allow this to be run as a script from the repo root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# pylint: disable=wrong-import-position
+from octoeverywhere.buffer import Buffer # noqa: E402
+from octoeverywhere.Webcam.mjpegframeextractor import MjpegFrameExtractor # noqa: E402
+
+
+# The same start sequence and read size the RTSP backend uses.
+c_JpegStartSequence = b"\xff\xd8\xff\xfe\x00\x10"
+c_JpegEndSequence = b"\xff\xd9"
+c_ReadSizeBytes = 64 * 1024
+c_MaxPendingBytes = 2 * 1024 * 1024
+
+# How many of the most recent frames are kept alive, like the current QuickCam image and a frame being sent.
+c_HeldFrames = 2
+
+
+# Makes a stream of jpeg like frames. The frame data has no 0xff bytes, so only the markers can match.
+def MakeStream(frameCount:int, frameSizeBytes:int, seed:int=1) -> bytes:
+    rand = random.Random(seed)
+    frames = []
+    for _ in range(frameCount):
+        size = int(frameSizeBytes * rand.uniform(0.8, 1.2))
+        body = rand.randbytes(size).replace(b"\xff", b"\x00")
+        frames.append(c_JpegStartSequence + body + c_JpegEndSequence)
+    return b"".join(frames)
+
+
+# The frame extraction the RTSP backend used before the MjpegFrameExtractor.
+class LegacyExtractor:
+
+    def __init__(self) -> None:
+        self.Buffer:Optional[bytearray] = None
+        self.SearchedIndex = 0
+        self.CopiedBytes = 0
+
+
+    def _IsFullJpeg(self, buffer:Any) -> bool:
+        return len(buffer) > len(c_JpegStartSequence) and buffer.startswith(c_JpegStartSequence) and buffer.endswith(c_JpegEndSequence)
+
+
+    # Takes one chunk read from the stream, and returns an image if there's one.
+    def OnRead(self, buffer:bytes) -> Optional[Buffer]:
+        if self.Buffer is None and self._IsFullJpeg(buffer):
+            return Buffer(buffer)
+        if self.Buffer is None:
+            self.Buffer = bytearray(buffer)
+        else:
+            self.Buffer.extend(buffer)
+        self.CopiedBytes += len(buffer)
+        buffLen = len(self.Buffer)
+        if buffLen <= len(c_JpegStartSequence):
+            return None
+        if self._IsFullJpeg(self.Buffer):
+            img = self.Buffer
+            self.Buffer = None
+            self.SearchedIndex = 0
+            return Buffer(img)
+        newImageStart = self.Buffer.find(c_JpegEndSequence, self.SearchedIndex)
+        if newImageStart == -1:
+            self.SearchedIndex = max(0, buffLen - len(c_JpegEndSequence) + 1)
+            if buffLen > c_MaxPendingBytes:
+                self.Buffer = None
+                self.SearchedIndex = 0
+            return None
+        newImageStart += len(c_JpegEndSequence)
+        imgBuffer = self.Buffer[:newImageStart]
+        self.CopiedBytes += newImageStart
+        if self._IsFullJpeg(imgBuffer) is False:
+            self.Buffer = None
+            self.SearchedIndex = 0
+            return None
+        self.Buffer = self.Buffer[newImageStart:]
+        self.CopiedBytes += len(self.Buffer)
+        self.SearchedIndex = 0
+        return Buffer(imgBuffer)
+
+
+def _RunLegacy(stream:bytes) -> Dict[str, Any]:
+    extractor = LegacyExtractor()
+    held:List[Buffer] = []
+    frames = 0
+    frameBytes = 0
+    pos = 0
+    startSec = time.perf_counter()
+    while pos < len(stream):
+        chunk = stream[pos:pos + c_ReadSizeBytes]
+        pos += len(chunk)
+        img = extractor.OnRead(chunk)
+        if img is not None:
+            frames += 1
+            frameBytes += len(img)
+            held = (held + [img])[-c_HeldFrames:]
+    durationSec = time.perf_counter() - startSec
+    return {"Frames": frames, "FrameBytes": frameBytes, "CopiedBytes": extractor.CopiedBytes, "DurationSec": durationSec}
+
+
+def _RunExtractor(stream:bytes) -> Dict[str, Any]:
+    extractor = MjpegFrameExtractor(logging.getLogger("mjpegbenchmark"), c_MaxPendingBytes, startOfImage=c_JpegStartSequence)
+    held:List[Buffer] = []
+    pos = 0
+
+    def readFunc(arena:bytearray, offset:int, size:int) -> int:
+        nonlocal pos
+        count = min(size, len(stream) - pos)
+        arena[offset:offset + count] = stream[pos:pos + count]
+        pos += count
+        return count
+
+    startSec = time.perf_counter()
+    while True:
+        img = extractor.TakeMarkerFrame()
+        if img is not None:
+            held = (held + [img])[-c_HeldFrames:]
+            continue
+        if extractor.ReadInto(readFunc, c_ReadSizeBytes) == 0:
+            break
+    durationSec = time.perf_counter() - startSec
+    stats = extractor.GetStats()
+    return {"Frames": stats["Frames"], "FrameBytes": stats["FrameBytes"], "CopiedBytes": stats["CopiedBytes"], "DurationSec": durationSec,
+            "ArenasAllocated": stats["ArenasAllocated"], "ArenasRecycled": stats["ArenasRecycled"]}
+
+
+# Runs the case until at least minSec has passed and returns the results of all of the runs.
+def _RunCase(run:Callable[[bytes], Dict[str, Any]], stream:bytes, minSec:float) -> Dict[str, Any]:
+    runs = 0
+    totalSec = 0.0
+    result:Dict[str, Any] = {}
+    while runs == 0 or totalSec < minSec:
+        result = run(stream)
+        totalSec += result.pop("DurationSec")
+        runs += 1
+    frames = result["Frames"]
+    result["FramesPerSec"] = round(frames * runs / max(totalSec, 1e-9), 1)
+    result["CopiedBytesPerFrame"] = round(result["CopiedBytes"] / frames, 1) if frames > 0 else 0.0
+    result["Runs"] = runs
+    return result
+
+
+def RunBenchmark(stream:bytes, minSec:float) -> Dict[str, Any]:
+    legacy = _RunCase(_RunLegacy, stream, minSec)
+    extractor = _RunCase(_RunExtractor, stream, minSec)
+    return {
+        "Machine": platform.machine(),
+        "Python": platform.python_version(),
+        "StreamBytes": len(stream),
+        "ReadSizeBytes": c_ReadSizeBytes,
+        "legacy": legacy,
+        "extractor": extractor,
+        "Speedup": round(extractor["FramesPerSec"] / max(legacy["FramesPerSec"], 1e-9), 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the MJPEG frame extraction used by the QuickCam backends.")
+    parser.add_argument("--input", help="A recorded MJPEG stream to use rather than a generated one.")
+    parser.add_argument("--frames", type=int, default=300, help="The number of frames to generate.")
+    parser.add_argument("--frame-kb", type=int, default=40, help="The average size of the generated frames.")
+    parser.add_argument("--min-sec", type=float, default=1.0, help="The min time to run each case.")
+    parser.add_argument("--output", help="Write the JSON results to this file rather than stdout.")
+    args = parser.parse_args()
+
+    if args.input is not None:
+        with open(args.input, "rb") as f:
+            stream = f.read()
+    else:
+        stream = MakeStream(args.frames, args.frame_kb * 1024)
+
+    resultsJson = json.dumps(RunBenchmark(stream, args.min_sec), indent=2)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(resultsJson)
+    else:
+        print(resultsJson)
+
+
+if __name__ == "__main__":
+    main()
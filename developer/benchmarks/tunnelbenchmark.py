@@ -0,0 +1,978 @@
+#
+# An end to end benchmark of the tunnel, from the OctoEverywhere server connection to the local printer servers.
+#
+# This runs the real OctoServerCon -> OctoSession -> OctoWebStream path against:
+#   - A local fake OctoEverywhere server, which speaks the websocket, handshake, and OctoStreamMessage protocol.
+#   - A local fake printer, which serves canned Moonraker or OctoPrint http, websocket, and webcam payloads.
+#
+# The fake server plays the part of the browser, it opens web streams for each workload and measures them as they come back.
+# The plugin side runs in its own process and the fake printer runs in another, so the thread count and RSS are only from the plugin.
+#
+# The handshake is the real one, including the RSA challenge. Since the fake server doesn't have the OctoEverywhere private key, a key pair
+# is made for the run and the plugin process is given the public key. That's only done in the plugin process this benchmark starts.
+#
+# The output is one JSON object, so runs can be saved and compared between commits.
+#
+# Run from the repo root:
+#   python developer/benchmarks/tunnelbenchmark.py [--printer moonraker] [--workloads dashboard,download,api,webcam,websocket] [--engine threaded] [--output result.json]
+#
+import os
+import sys
+import json
+import time
+import queue
+import base64
+import random
+import socket
+import struct
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import collections
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import rsa
+import octoflatbuffers
+
+# Allow this to be run as a script from the repo root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# pylint: disable=wrong-import-position
+from octoeverywhere.sentry import Sentry # noqa: E402
+from octoeverywhere.deviceid import DeviceId # noqa: E402
+from octoeverywhere.sendbufferpool import SendBufferPool # noqa: E402
+from octoeverywhere.compression import Compression # noqa: E402
+from octoeverywhere.httpsessions import HttpSessions # noqa: E402
+from octoeverywhere.serverauth import ServerAuthHelper # noqa: E402
+from octoeverywhere.octoservercon import OctoServerCon # noqa: E402
+from octoeverywhere.sendscheduler import SendScheduler # noqa: E402
+from octoeverywhere.commandhandler import CommandHandler # noqa: E402
+from octoeverywhere.octohttprequest import OctoHttpRequest # noqa: E402
+from octoeverywhere.Webcam.webcamhelper import WebcamHelper # noqa: E402
+from octoeverywhere.octostreammsgbuilder import OctoStreamMsgBuilder # noqa: E402
+from octoeverywhere.WebStream.webstreamworkerpool import WebStreamWorkerPool # noqa: E402
+from octoeverywhere.WebStream.asyncwebstreamengine import AsyncWebStreamEngine # noqa: E402
+from octoeverywhere.Proto import WebStreamMsg # noqa: E402
+from octoeverywhere.Proto import HandshakeAck # noqa: E402
+from octoeverywhere.Proto import HandshakeSyn # noqa: E402
+from octoeverywhere.Proto import MessageContext # noqa: E402
+from octoeverywhere.Proto import HttpInitialContext # noqa: E402
+from octoeverywhere.Proto.PathTypes import PathTypes # noqa: E402
+from octoeverywhere.Proto.ServerHost import ServerHost # noqa: E402
+from octoeverywhere.Proto.MessagePriority import MessagePriority # noqa: E402
+from octoeverywhere.Proto.DataCompression import DataCompression # noqa: E402
+from octoeverywhere.Proto.WebSocketDataTypes import WebSocketDataTypes # noqa: E402
+from octoeverywhere.Proto.OctoStreamMessage import OctoStreamMessage # noqa: E402
+
+
+c_PrinterMoonraker = "moonraker"
+c_PrinterOctoPrint = "octoprint"
+
+c_WorkloadDashboard = "dashboard"
+c_WorkloadDownload = "download"
+c_WorkloadApi = "api"
+c_WorkloadWebcam = "webcam"
+c_WorkloadWebsocket = "websocket"
+c_AllWorkloads = [c_WorkloadDashboard, c_WorkloadDownload, c_WorkloadApi, c_WorkloadWebcam, c_WorkloadWebsocket]
+
+c_EngineWorkerPool = "workerpool"
+
+c_MjpegBoundary = "benchmarkframe"
+
+
+#
+# Canned payloads
+#
+
+# The files a cold load of the web interface fetches, as (path, content type, size). The sizes are close to what the real frontends load.
+# The api calls the frontends make on load are served by the fake printer with json bodies of the same size.
+c_DashboardFiles = {
+    c_PrinterMoonraker: [
+        ("/", "text/html", 2 * 1024),
+        ("/assets/index.js", "application/javascript", 900 * 1024),
+        ("/assets/vendor.js", "application/javascript", 650 * 1024),
+        ("/assets/Dashboard.js", "application/javascript", 180 * 1024),
+        ("/assets/Settings.js", "application/javascript", 120 * 1024),
+        ("/assets/History.js", "application/javascript", 60 * 1024),
+        ("/assets/Files.js", "application/javascript", 90 * 1024),
+        ("/assets/index.css", "text/css", 220 * 1024),
+        ("/assets/vendor.css", "text/css", 90 * 1024),
+        ("/fonts/roboto-latin-400.woff2", "font/woff2", 16 * 1024),
+        ("/fonts/roboto-latin-500.woff2", "font/woff2", 16 * 1024),
+        ("/fonts/materialdesignicons.woff2", "font/woff2", 390 * 1024),
+        ("/img/logo.svg", "image/svg+xml", 3 * 1024),
+        ("/img/icons/favicon-32x32.png", "image/png", 2 * 1024),
+        ("/config.json", "application/json", 1024),
+        ("/server/info", "application/json", 1024),
+        ("/printer/info", "application/json", 1024),
+        ("/machine/system_info", "application/json", 6 * 1024),
+        ("/server/config", "application/json", 24 * 1024),
+        ("/server/database/item?namespace=mainsail", "application/json", 18 * 1024),
+        ("/server/files/list?root=gcodes", "application/json", 120 * 1024),
+        ("/server/history/list?limit=50", "application/json", 60 * 1024),
+        ("/server/webcams/list", "application/json", 1024),
+        ("/printer/objects/list", "application/json", 3 * 1024),
+        ("/machine/update/status", "application/json", 8 * 1024),
+    ],
+    c_PrinterOctoPrint: [
+        ("/", "text/html", 90 * 1024),
+        ("/static/webassets/packed_libs.js", "application/javascript", 1400 * 1024),
+        ("/static/webassets/packed_core.js", "application/javascript", 520 * 1024),
+        ("/static/webassets/packed_plugins.js", "application/javascript", 700 * 1024),
+        ("/static/webassets/packed_client.js", "application/javascript", 80 * 1024),
+        ("/static/webassets/packed_libs.css", "text/css", 150 * 1024),
+        ("/static/webassets/packed_core.css", "text/css", 200 * 1024),
+        ("/static/webassets/packed_plugins.css", "text/css", 60 * 1024),
+        ("/static/css/fontawesome.woff2", "font/woff2", 75 * 1024),
+        ("/static/img/tentacle-20x20.png", "image/png", 1024),
+        ("/static/img/apple-touch-icon.png", "image/png", 12 * 1024),
+        ("/api/login?passive=true", "application/json", 1024),
+        ("/api/settings", "application/json", 70 * 1024),
+        ("/api/printerprofiles", "application/json", 2 * 1024),
+        ("/api/files?recursive=true", "application/json", 110 * 1024),
+        ("/api/connection", "application/json", 1024),
+        ("/api/printer", "application/json", 1024),
+        ("/api/job", "application/json", 1024),
+        ("/api/timelapse?unrendered=true", "application/json", 4 * 1024),
+        ("/api/system/commands", "application/json", 2 * 1024),
+        ("/plugin/pluginmanager/plugins", "application/json", 40 * 1024),
+    ],
+}
+
+# The small api call the frontends poll.
+c_ApiPath = {
+    c_PrinterMoonraker: "/printer/objects/query?print_stats&toolhead&extruder&heater_bed&display_status",
+    c_PrinterOctoPrint: "/api/printer?history=false",
+}
+
+# The large file download, a gcode file.
+c_DownloadPath = {
+    c_PrinterMoonraker: "/server/files/gcodes/benchmark.gcode",
+    c_PrinterOctoPrint: "/downloads/files/local/benchmark.gcode",
+}
+
+c_WebcamStreamPath = "/webcam/?action=stream"
+
+c_WebsocketPath = {
+    c_PrinterMoonraker: "/websocket",
+    c_PrinterOctoPrint: "/sockjs/websocket",
+}
+
+c_Vocabulary = ["function", "return", "const", "this", "props", "state", "value", "length", "index", "data", "printer", "extruder",
+                "temperature", "target", "power", "toolhead", "position", "status", "webcam", "settings", "files", "history",
+                "component", "render", "update", "null", "undefined", "true", "false", "object", "string", "number"]
+
+
+# Builds text that compresses about as well as minified javascript and json do. It's seeded, so every run serves the same bytes.
+def _BuildText(size:int, seed:int) -> bytes:
+    rand = random.Random(seed)
+    parts:List[str] = []
+    length = 0
+    while length < size:
+        part = rand.choice(c_Vocabulary) + rand.choice([".", "(", ")", "{", "}", ",", ":", ";", "=", " ", "[", "]"]) + str(rand.randint(0, 999))
+        parts.append(part)
+        length += len(part)
+    return "".join(parts).encode("utf-8")[:size]
+
+
+# Builds gcode like text for the download.
+def _BuildGcode(size:int) -> bytes:
+    rand = random.Random(size)
+    # Build a unique block and repeat it, building all of it line by line is slow for big files.
+    lines:List[str] = []
+    length = 0
+    while length < min(size, 4 * 1024 * 1024):
+        line = f"G1 X{rand.uniform(0, 250):.3f} Y{rand.uniform(0, 250):.3f} E{rand.uniform(0, 2):.5f}\n"
+        lines.append(line)
+        length += len(line)
+    block = "".join(lines).encode("utf-8")
+    return (block * (size // len(block) + 1))[:size]
+
+
+# Builds a payload for the content type. Images and fonts are already compressed, so they get random bytes.
+def _BuildPayload(contentType:str, size:int, seed:int) -> bytes:
+    if contentType.startswith("image/png") or contentType.startswith("font/") or contentType.startswith("image/jpeg"):
+        return random.Random(seed).randbytes(size)
+    return _BuildText(size, seed)
+
+
+#
+# A minimal RFC 6455 websocket, used for both the fake OctoEverywhere server and the fake printer websocket.
+# The messages are read from a file like object, so the http server's buffered reader can be used after the upgrade.
+#
+class _ServerWebsocket:
+
+    c_Guid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    c_OpContinuation = 0x0
+    c_OpText = 0x1
+    c_OpBinary = 0x2
+    c_OpClose = 0x8
+    c_OpPing = 0x9
+    c_OpPong = 0xA
+
+
+    @staticmethod
+    def GetAcceptKey(key:str) -> str:
+        return base64.b64encode(hashlib.sha1((key + _ServerWebsocket.c_Guid).encode("utf-8")).digest()).decode("utf-8")
+
+
+    # Reads the upgrade request from a raw socket and accepts it.
+    @staticmethod
+    def Accept(sock:socket.socket) -> "_ServerWebsocket":
+        reader = sock.makefile("rb")
+        key = None
+        while True:
+            line = reader.readline(64 * 1024)
+            if len(line) == 0:
+                raise Exception("The websocket connection closed during the upgrade.")
+            line = line.strip()
+            if len(line) == 0:
+                break
+            if line.lower().startswith(b"sec-websocket-key:"):
+                key = line.split(b":", 1)[1].strip().decode("utf-8")
+        if key is None:
+            raise Exception("The websocket upgrade is missing the key.")
+        sock.sendall(_ServerWebsocket.BuildUpgradeResponse(key))
+        return _ServerWebsocket(reader, sock)
+
+
+    @staticmethod
+    def BuildUpgradeResponse(key:str) -> bytes:
+        return ("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: " + _ServerWebsocket.GetAcceptKey(key) + "\r\n\r\n").encode("utf-8")
+
+
+    def __init__(self, reader:Any, sock:socket.socket) -> None:
+        self.Reader = reader
+        self.Sock = sock
+        self.SendLock = threading.Lock()
+        self.IsClosed = False
+
+
+    # Returns the next message as (opcode, data), or None when the socket closes.
+    def ReadMessage(self) -> Optional[Tuple[int, bytes]]:
+        messageOpCode = -1
+        parts:List[bytes] = []
+        while True:
+            header = self._ReadExact(2)
+            if header is None:
+                return None
+            isFin = (header[0] & 0x80) != 0
+            opCode = header[0] & 0x0F
+            isMasked = (header[1] & 0x80) != 0
+            length = header[1] & 0x7F
+            if length == 126:
+                lengthBytes = self._ReadExact(2)
+                if lengthBytes is None:
+                    return None
+                length = struct.unpack("!H", lengthBytes)[0]
+            elif length == 127:
+                lengthBytes = self._ReadExact(8)
+                if lengthBytes is None:
+                    return None
+                length = struct.unpack("!Q", lengthBytes)[0]
+            mask = self._ReadExact(4) if isMasked else None
+            payload = self._ReadExact(length)
+            if payload is None:
+                return None
+            if mask is not None and length > 0:
+                payload = _Unmask(payload, mask)
+
+            if opCode == _ServerWebsocket.c_OpPing:
+                self.Send(_ServerWebsocket.c_OpPong, payload)
+                continue
+            if opCode == _ServerWebsocket.c_OpPong:
+                continue
+            if opCode == _ServerWebsocket.c_OpClose:
+                self.Close()
+                return None
+            if opCode != _ServerWebsocket.c_OpContinuation:
+                messageOpCode = opCode
+            parts.append(payload)
+            if isFin:
+                return (messageOpCode, parts[0] if len(parts) == 1 else b"".join(parts))
+
+
+    def Send(self, opCode:int, data:bytes) -> None:
+        length = len(data)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opCode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opCode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opCode, 127, length)
+        with self.SendLock:
+            self.Sock.sendall(header + data if length < 4096 else header)
+            if length >= 4096:
+                self.Sock.sendall(data)
+
+
+    def Close(self) -> None:
+        if self.IsClosed:
+            return
+        self.IsClosed = True
+        try:
+            self.Sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.Sock.close()
+
+
+    def _ReadExact(self, size:int) -> Optional[bytes]:
+        if size == 0:
+            return b""
+        try:
+            data = self.Reader.read(size)
+        except (OSError, ValueError):
+            return None
+        if data is None or len(data) != size:
+            return None
+        return data
+
+
+# Unmasks the frame payload, doing the xor as one big int so it's fast for big messages.
+def _Unmask(payload:bytes, mask:bytes) -> bytes:
+    length = len(payload)
+    fullMask = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, "little") ^ int.from_bytes(fullMask, "little")).to_bytes(length, "little")
+
+
+#
+# The fake printer
+#
+
+# Allow a burst of connections, since the dashboard opens a lot of them at once.
+class _BenchmarkHttpServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+# Serves the canned payloads for the dashboard, api, download, and webcam, and echos json-rpc over the websocket.
+class _FakePrinterRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Set in the printer process before the server starts.
+    Payloads:Dict[str, Tuple[str, bytes]] = {}
+    ResponseDelaySec = 0.0
+    WebcamFps = 15
+    WebcamFrameBytes = 60 * 1024
+
+
+    def do_GET(self) -> None:
+        if self.headers.get("Upgrade", "").lower() == "websocket":
+            self._HandleWebsocket()
+            return
+        if self.path.startswith(c_WebcamStreamPath):
+            self._HandleMjpegStream()
+            return
+        if _FakePrinterRequestHandler.ResponseDelaySec > 0:
+            time.sleep(_FakePrinterRequestHandler.ResponseDelaySec)
+        payload = _FakePrinterRequestHandler.Payloads.get(self.path, None)
+        if payload is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        contentType, body = payload
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        view = memoryview(body)
+        for i in range(0, len(body), 256 * 1024):
+            self.wfile.write(view[i:i + 256 * 1024])
+
+
+    def _HandleMjpegStream(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace;boundary=" + c_MjpegBoundary)
+        self.end_headers()
+        frame = random.Random(1).randbytes(_FakePrinterRequestHandler.WebcamFrameBytes)
+        intervalSec = 1.0 / _FakePrinterRequestHandler.WebcamFps
+        nextFrameSec = time.time()
+        try:
+            while True:
+                header = f"--{c_MjpegBoundary}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(frame)}\r\n\r\n".encode("utf-8")
+                self.wfile.write(header + frame + b"\r\n")
+                self.wfile.flush()
+                nextFrameSec += intervalSec
+                time.sleep(max(0.0, nextFrameSec - time.time()))
+        except (OSError, ValueError):
+            # The viewer closed the stream.
+            self.close_connection = True
+
+
+    def _HandleWebsocket(self) -> None:
+        key = self.headers.get("Sec-WebSocket-Key", "")
+        self.wfile.write(_ServerWebsocket.BuildUpgradeResponse(key))
+        self.wfile.flush()
+        self.close_connection = True
+        ws = _ServerWebsocket(self.rfile, self.connection)
+        # Echo each json-rpc request back in a response about the size of a status update.
+        padding = _BuildText(1024, 7).decode("utf-8")
+        while True:
+            msg = ws.ReadMessage()
+            if msg is None:
+                return
+            opCode, data = msg
+            try:
+                ws.Send(opCode, json.dumps({"jsonrpc": "2.0", "result": {"request": data.decode("utf-8"), "status": padding}}).encode("utf-8"))
+            except OSError:
+                return
+
+
+    def log_message(self, format:str, *args:Any) -> None: #pylint: disable=redefined-builtin
+        pass
+
+
+def _PrinterProcessWorker(printer:str, downloadBytes:int, responseDelaySec:float, webcamFps:int, webcamFrameBytes:int, portQueue:Any) -> None:
+    payloads:Dict[str, Tuple[str, bytes]] = {}
+    for i, (path, contentType, size) in enumerate(c_DashboardFiles[printer]):
+        payloads[path] = (contentType, _BuildPayload(contentType, size, i))
+    payloads[c_ApiPath[printer]] = ("application/json", _BuildText(900, 99))
+    payloads[c_DownloadPath[printer]] = ("application/octet-stream", _BuildGcode(downloadBytes))
+    _FakePrinterRequestHandler.Payloads = payloads
+    _FakePrinterRequestHandler.ResponseDelaySec = responseDelaySec
+    _FakePrinterRequestHandler.WebcamFps = webcamFps
+    _FakePrinterRequestHandler.WebcamFrameBytes = webcamFrameBytes
+    server = _BenchmarkHttpServer(("127.0.0.1", 0), _FakePrinterRequestHandler)
+    portQueue.put(server.server_address[1])
+    server.serve_forever()
+
+
+#
+# The plugin
+#
+
+def _GetProcStatusKb(name:str) -> int:
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith(name):
+                    return int(line.split()[1])
+    except Exception:
+        pass
+    return 0
+
+
+# Runs the plugin side of the tunnel, and answers stats requests from the benchmark over the pipe.
+def _PluginProcessWorker(printer:str, engine:str, serverPort:int, printerPort:int, publicKeyPem:str, conn:Any) -> None:
+    logger = logging.getLogger("tunnelbenchmark")
+    logger.setLevel(logging.WARNING)
+    Sentry.SetLogger(logger)
+    storageDir = tempfile.mkdtemp()
+    HttpSessions.Init(logger)
+    SendBufferPool.Init(logger)
+    DeviceId.Init(logger)
+    Compression.Init(logger, storageDir)
+    WebcamHelper.Init(logger, None, storageDir) #pyright: ignore[reportArgumentType]
+    CommandHandler.Init(logger, None, None, None) #pyright: ignore[reportArgumentType]
+    if engine == AsyncWebStreamEngine.c_EngineAsyncio:
+        AsyncWebStreamEngine.SelectedEngine = AsyncWebStreamEngine.c_EngineAsyncio
+        AsyncWebStreamEngine.Init(logger)
+    elif engine == c_EngineWorkerPool:
+        WebStreamWorkerPool.SetEnabled(True)
+        WebStreamWorkerPool.Init(logger)
+    OctoHttpRequest.SetLocalHostAddress("127.0.0.1")
+    OctoHttpRequest.SetLocalOctoPrintPort(printerPort)
+    OctoHttpRequest.SetLocalHttpProxyPort(printerPort)
+
+    # The fake server has the private key for this run's key pair.
+    ServerAuthHelper.c_ServerPublicKey = publicKeyPem
+
+    serverHostType = ServerHost.Moonraker if printer == c_PrinterMoonraker else ServerHost.OctoPrint
+    serverCon = OctoServerCon(None, f"ws://127.0.0.1:{serverPort}/octoclientws", False, False, "benchmarkprinterid", "benchmarkprivatekey", logger, #pyright: ignore[reportArgumentType]
+                              None, None, "benchmark", 24 * 60 * 60, 0, serverHostType, False, False) #pyright: ignore[reportArgumentType]
+    threading.Thread(target=serverCon.RunBlocking, name="OctoServerCon", daemon=True).start()
+
+    # Sample the thread count, so each workload can report its peak.
+    peakThreads = [threading.active_count()]
+    def sample() -> None:
+        while True:
+            peakThreads[0] = max(peakThreads[0], threading.active_count())
+            time.sleep(0.005)
+    threading.Thread(target=sample, name="ThreadSampler", daemon=True).start()
+
+    while True:
+        if conn.recv() != "stats":
+            return
+        stats:Dict[str, Any] = {
+            "threads": threading.active_count(),
+            "peak_threads": peakThreads[0],
+            "rss_kb": _GetProcStatusKb("VmRSS:"),
+            "peak_rss_kb": _GetProcStatusKb("VmHWM:"),
+            "send_queue": SendScheduler.GetStats(),
+            "http_sessions": HttpSessions.GetStats(),
+        }
+        if serverCon.Ws is not None:
+            stats["websocket_send"] = serverCon.Ws.GetSendStats()
+        peakThreads[0] = threading.active_count()
+        conn.send(stats)
+
+
+#
+# The fake OctoEverywhere server
+#
+
+# The results of one web stream, as seen by the server.
+class _StreamResult:
+
+    def __init__(self, streamId:int, isWebsocket:bool) -> None:
+        self.Id = streamId
+        self.IsWebsocket = isWebsocket
+        self.OpenSec = time.time()
+        self.FirstDataSec = 0.0
+        self.DoneSec = 0.0
+        self.StatusCode = 0
+        self.WireBytes = 0
+        self.BodyBytes = 0
+        self.Done = threading.Event()
+        # For websockets, the arrival time of each message.
+        self.WsMessages:"queue.Queue[float]" = queue.Queue()
+
+
+# Accepts the plugin's connection, does the handshake, and opens web streams over it.
+class FakeOctoEverywhereServer:
+
+    def __init__(self, logger:logging.Logger, privateKey:rsa.PrivateKey) -> None:
+        self.Logger = logger
+        self.PrivateKey = privateKey
+        self.ListenSocket = socket.create_server(("127.0.0.1", 0))
+        self.Port = self.ListenSocket.getsockname()[1]
+        self.Ws:Optional[_ServerWebsocket] = None
+        self.HandshakeComplete = threading.Event()
+        self.ConnectedSec = 0.0
+        self.HandshakeSec = 0.0
+        self.Lock = threading.Lock()
+        self.NextStreamId = 1
+        self.Streams:Dict[int, _StreamResult] = {}
+
+
+    def Start(self) -> None:
+        threading.Thread(target=self._AcceptLoop, name="FakeServerAccept", daemon=True).start()
+
+
+    # Opens an http web stream for a GET of the path.
+    def OpenHttpStream(self, path:str, priority:int=MessagePriority.Normal) -> _StreamResult:
+        return self._OpenStream(path, priority, False)
+
+
+    def OpenWebsocketStream(self, path:str, priority:int=MessagePriority.Normal) -> _StreamResult:
+        return self._OpenStream(path, priority, True)
+
+
+    def SendWebsocketText(self, result:_StreamResult, text:str) -> None:
+        builder = octoflatbuffers.Builder(len(text) + 256)
+        dataOffset = builder.CreateByteVector(text.encode("utf-8")) #pyright: ignore[reportUnknownMemberType]
+        WebStreamMsg.Start(builder)
+        WebStreamMsg.AddStreamId(builder, result.Id)
+        WebStreamMsg.AddIsControlFlagsOnly(builder, False)
+        WebStreamMsg.AddWebsocketDataType(builder, WebSocketDataTypes.Text)
+        WebStreamMsg.AddData(builder, dataOffset)
+        self._SendWebStreamMsg(builder, WebStreamMsg.End(builder))
+
+
+    # Tells the plugin to close the stream, like the server does when the browser goes away.
+    def CloseStream(self, result:_StreamResult) -> None:
+        builder = octoflatbuffers.Builder(256)
+        WebStreamMsg.Start(builder)
+        WebStreamMsg.AddStreamId(builder, result.Id)
+        WebStreamMsg.AddIsCloseMsg(builder, True)
+        WebStreamMsg.AddIsControlFlagsOnly(builder, True)
+        self._SendWebStreamMsg(builder, WebStreamMsg.End(builder))
+        with self.Lock:
+            self.Streams.pop(result.Id, None)
+        if result.DoneSec == 0.0:
+            result.DoneSec = time.time()
+        result.Done.set()
+
+
+    def _OpenStream(self, path:str, priority:int, isWebsocket:bool) -> _StreamResult:
+        with self.Lock:
+            streamId = self.NextStreamId
+            self.NextStreamId += 1
+            result = _StreamResult(streamId, isWebsocket)
+            self.Streams[streamId] = result
+        builder = octoflatbuffers.Builder(1024)
+        pathOffset = builder.CreateString(path) #pyright: ignore[reportUnknownMemberType]
+        methodOffset = builder.CreateString("GET") #pyright: ignore[reportUnknownMemberType]
+        octoHostOffset = builder.CreateString("benchmark.octoeverywhere.com") #pyright: ignore[reportUnknownMemberType]
+        HttpInitialContext.Start(builder)
+        HttpInitialContext.AddPath(builder, pathOffset)
+        HttpInitialContext.AddPathType(builder, PathTypes.Relative)
+        HttpInitialContext.AddMethod(builder, methodOffset)
+        HttpInitialContext.AddOctoHost(builder, octoHostOffset)
+        httpInitialContextOffset = HttpInitialContext.End(builder)
+        WebStreamMsg.Start(builder)
+        WebStreamMsg.AddStreamId(builder, streamId)
+        WebStreamMsg.AddIsOpenMsg(builder, True)
+        # A websocket open has no data, the messages come after it.
+        WebStreamMsg.AddIsControlFlagsOnly(builder, isWebsocket)
+        WebStreamMsg.AddIsWebsocketStream(builder, isWebsocket)
+        WebStreamMsg.AddIsDataTransmissionDone(builder, isWebsocket is False)
+        WebStreamMsg.AddMsgPriority(builder, priority)
+        WebStreamMsg.AddHttpInitialContext(builder, httpInitialContextOffset)
+        result.OpenSec = time.time()
+        self._SendWebStreamMsg(builder, WebStreamMsg.End(builder))
+        return result
+
+
+    def _SendWebStreamMsg(self, builder:octoflatbuffers.Builder, webStreamMsgOffset:int) -> None:
+        self._SendContext(builder, MessageContext.MessageContext.WebStreamMsg, webStreamMsgOffset)
+
+
+    def _SendContext(self, builder:octoflatbuffers.Builder, contextType:int, contextOffset:int) -> None:
+        buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, contextType, contextOffset)
+        ws = self.Ws
+        if ws is None:
+            raise Exception("The plugin isn't connected.")
+        ws.Send(_ServerWebsocket.c_OpBinary, bytes(buffer.GetBytesLike()[msgStartOffsetBytes:msgStartOffsetBytes + msgSizeBytes]))
+
+
+    def _AcceptLoop(self) -> None:
+        while True:
+            sock, _ = self.ListenSocket.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._ConnectionThread, args=(sock,), name="FakeServerConnection", daemon=True).start()
+
+
+    def _ConnectionThread(self, sock:socket.socket) -> None:
+        try:
+            ws = _ServerWebsocket.Accept(sock)
+            self.ConnectedSec = time.time()
+            self.Ws = ws
+            while True:
+                msg = ws.ReadMessage()
+                if msg is None:
+                    self.Logger.info("The plugin disconnected from the fake server.")
+                    return
+                self._HandleMessage(msg[1])
+        except Exception as e:
+            self.Logger.error("Fake server connection failed. %s", e)
+
+
+    def _HandleMessage(self, data:bytes) -> None:
+        octoStreamMsg = OctoStreamMessage.GetRootAs(data, 4) #pyright: ignore[reportUnknownMemberType]
+        context = octoStreamMsg.Context()
+        if context is None:
+            return
+        contextType = octoStreamMsg.ContextType()
+        if contextType == MessageContext.MessageContext.HandshakeSyn:
+            syn = HandshakeSyn.HandshakeSyn()
+            syn.Init(context.Bytes, context.Pos)
+            self._SendHandshakeAck(syn)
+            return
+        if contextType != MessageContext.MessageContext.WebStreamMsg:
+            return
+        msg = WebStreamMsg.WebStreamMsg()
+        msg.Init(context.Bytes, context.Pos)
+        with self.Lock:
+            result = self.Streams.get(msg.StreamId(), None)
+        if result is None:
+            return
+        now = time.time()
+        dataLength = msg.DataLength()
+        if result.FirstDataSec == 0.0:
+            result.FirstDataSec = now
+        if msg.StatusCode() != 0:
+            result.StatusCode = msg.StatusCode()
+        result.WireBytes += dataLength
+        result.BodyBytes += msg.OriginalDataSize() if msg.DataCompression() != DataCompression.None_ else dataLength
+        if result.IsWebsocket and dataLength > 0:
+            result.WsMessages.put(now)
+        if msg.IsCloseMsg():
+            result.DoneSec = now
+            with self.Lock:
+                self.Streams.pop(result.Id, None)
+            result.Done.set()
+
+
+    def _SendHandshakeAck(self, syn:HandshakeSyn.HandshakeSyn) -> None:
+        challenge = rsa.decrypt(bytes(syn.RsaChallengeAsByteArray()), self.PrivateKey).decode("utf-8") #pyright: ignore[reportArgumentType]
+        builder = octoflatbuffers.Builder(1024)
+        octoKeyOffset = builder.CreateString("benchmarkoctokey") #pyright: ignore[reportUnknownMemberType]
+        challengeOffset = builder.CreateString(challenge) #pyright: ignore[reportUnknownMemberType]
+        # Accept all of the trained zstandard dicts the plugin has, the bodies are never decompressed here.
+        dictIdsOffset:Optional[int] = None
+        if syn.ZStandardDictIdsLength() > 0:
+            HandshakeAck.StartZStandardDictIdsVector(builder, syn.ZStandardDictIdsLength())
+            for i in reversed(range(syn.ZStandardDictIdsLength())):
+                builder.PrependUint32(syn.ZStandardDictIds(i)) #pyright: ignore[reportUnknownMemberType]
+            dictIdsOffset = builder.EndVector() #pyright: ignore[reportUnknownMemberType]
+        HandshakeAck.Start(builder)
+        HandshakeAck.AddAccepted(builder, True)
+        HandshakeAck.AddOctokey(builder, octoKeyOffset)
+        HandshakeAck.AddRsaChallengeResult(builder, challengeOffset)
+        # Accept all of the features the plugin supports.
+        HandshakeAck.AddFeatureFlags(builder, syn.FeatureFlags())
+        if dictIdsOffset is not None:
+            HandshakeAck.AddZStandardDictIds(builder, dictIdsOffset)
+        self._SendContext(builder, MessageContext.MessageContext.HandshakeAck, HandshakeAck.End(builder))
+        self.HandshakeSec = time.time()
+        self.HandshakeComplete.set()
+
+
+#
+# Workloads
+#
+
+def _Percentile(values:List[float], percent:float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * percent / 100.0))
+    return values[index]
+
+
+def _Ms(sec:float) -> float:
+    return round(sec * 1000.0, 2)
+
+
+# Opens a stream for each path, keeping up to concurrency open at once, and waits for them to complete.
+def _RunRequests(server:FakeOctoEverywhereServer, paths:List[str], concurrency:int, priority:int=MessagePriority.Normal, timeoutSec:float=120.0) -> List[_StreamResult]:
+    pending:Deque[str] = collections.deque(paths)
+    results:List[_StreamResult] = []
+    lock = threading.Lock()
+    def worker() -> None:
+        while True:
+            with lock:
+                if len(pending) == 0:
+                    return
+                path = pending.popleft()
+            result = server.OpenHttpStream(path, priority)
+            result.Done.wait(timeoutSec)
+            with lock:
+                results.append(result)
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(min(concurrency, len(paths)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _SummarizeRequests(results:List[_StreamResult], durationSec:float) -> Dict[str, Any]:
+    completed = [r for r in results if r.Done.is_set() and r.DoneSec > 0]
+    latenciesSec = [r.DoneSec - r.OpenSec for r in completed]
+    ttfbSec = [r.FirstDataSec - r.OpenSec for r in completed if r.FirstDataSec > 0]
+    bodyBytes = sum(r.BodyBytes for r in results)
+    wireBytes = sum(r.WireBytes for r in results)
+    durationSec = max(durationSec, 0.001)
+    return {
+        "requests": len(results),
+        "completed": len(completed),
+        "ok_status": sum(1 for r in completed if r.StatusCode == 200),
+        "duration_sec": round(durationSec, 3),
+        "requests_per_sec": round(len(completed) / durationSec, 2),
+        "mb_per_sec": round(bodyBytes / (1024.0 * 1024.0) / durationSec, 2),
+        "wire_mb_per_sec": round(wireBytes / (1024.0 * 1024.0) / durationSec, 2),
+        "body_bytes": bodyBytes,
+        "wire_bytes": wireBytes,
+        "ttfb_ms_p50": _Ms(_Percentile(ttfbSec, 50)),
+        "ttfb_ms_p99": _Ms(_Percentile(ttfbSec, 99)),
+        "latency_ms_p50": _Ms(_Percentile(latenciesSec, 50)),
+        "latency_ms_p99": _Ms(_Percentile(latenciesSec, 99)),
+    }
+
+
+# A cold load of the web interface, all of the files and api calls at once, like a browser with http2 to the OctoEverywhere server.
+def RunDashboardWorkload(server:FakeOctoEverywhereServer, args:Any) -> Dict[str, Any]:
+    paths = [path for path, _, _ in c_DashboardFiles[args.printer]]
+    loadTimesSec:List[float] = []
+    allResults:List[_StreamResult] = []
+    startSec = time.time()
+    for _ in range(args.dashboard_loads):
+        loadStartSec = time.time()
+        results = _RunRequests(server, paths, concurrency=len(paths), priority=MessagePriority.High)
+        loadTimesSec.append(time.time() - loadStartSec)
+        allResults.extend(results)
+    result = _SummarizeRequests(allResults, time.time() - startSec)
+    result["loads"] = args.dashboard_loads
+    result["load_ms_p50"] = _Ms(_Percentile(loadTimesSec, 50))
+    result["load_ms_max"] = _Ms(max(loadTimesSec))
+    return result
+
+
+def RunDownloadWorkload(server:FakeOctoEverywhereServer, args:Any) -> Dict[str, Any]:
+    startSec = time.time()
+    results = _RunRequests(server, [c_DownloadPath[args.printer]] * args.downloads, concurrency=args.downloads, priority=MessagePriority.Low, timeoutSec=600.0)
+    result = _SummarizeRequests(results, time.time() - startSec)
+    result["complete_bodies"] = sum(1 for r in results if r.BodyBytes == args.download_mb * 1024 * 1024)
+    return result
+
+
+def RunApiWorkload(server:FakeOctoEverywhereServer, args:Any) -> Dict[str, Any]:
+    startSec = time.time()
+    results = _RunRequests(server, [c_ApiPath[args.printer]] * args.api_requests, concurrency=args.api_concurrency)
+    return _SummarizeRequests(results, time.time() - startSec)
+
+
+# Watches the webcam stream with a number of viewers for a while, then closes the streams like the viewers left.
+def RunWebcamWorkload(server:FakeOctoEverywhereServer, args:Any) -> Dict[str, Any]:
+    results = [server.OpenHttpStream(c_WebcamStreamPath, MessagePriority.High) for _ in range(args.webcam_viewers)]
+    time.sleep(args.webcam_sec)
+    for r in results:
+        server.CloseStream(r)
+    durationSec = float(args.webcam_sec)
+    frameBytes = args.webcam_frame_kb * 1024 + len(f"--{c_MjpegBoundary}\r\nContent-Type: image/jpeg\r\nContent-Length: {args.webcam_frame_kb * 1024}\r\n\r\n\r\n")
+    ttfbSec = [r.FirstDataSec - r.OpenSec for r in results if r.FirstDataSec > 0]
+    bodyBytes = sum(r.BodyBytes for r in results)
+    return {
+        "viewers": args.webcam_viewers,
+        "duration_sec": durationSec,
+        "ok_status": sum(1 for r in results if r.StatusCode == 200),
+        "mb_per_sec": round(bodyBytes / (1024.0 * 1024.0) / durationSec, 2),
+        "wire_mb_per_sec": round(sum(r.WireBytes for r in results) / (1024.0 * 1024.0) / durationSec, 2),
+        # Frames are counted from the bytes, since every frame is the same size.
+        "frames_per_sec_per_viewer": round(bodyBytes / frameBytes / durationSec / max(1, len(results)), 2),
+        "source_fps": args.webcam_fps,
+        "ttfb_ms_p50": _Ms(_Percentile(ttfbSec, 50)),
+        "ttfb_ms_p99": _Ms(_Percentile(ttfbSec, 99)),
+    }
+
+
+# Json-rpc round trips over websockets, one request at a time per websocket, like a frontend querying the printer.
+def RunWebsocketWorkload(server:FakeOctoEverywhereServer, args:Any) -> Dict[str, Any]:
+    roundTripsSec:List[float] = []
+    lock = threading.Lock()
+    failures = [0]
+    def worker() -> None:
+        result = server.OpenWebsocketStream(c_WebsocketPath[args.printer])
+        for i in range(args.ws_messages):
+            sentSec = time.time()
+            server.SendWebsocketText(result, json.dumps({"jsonrpc": "2.0", "method": "printer.objects.query", "id": i}))
+            try:
+                arrivedSec = result.WsMessages.get(timeout=10.0)
+            except queue.Empty:
+                with lock:
+                    failures[0] += 1
+                break
+            with lock:
+                roundTripsSec.append(arrivedSec - sentSec)
+        server.CloseStream(result)
+    startSec = time.time()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.ws_streams)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    durationSec = max(time.time() - startSec, 0.001)
+    return {
+        "websockets": args.ws_streams,
+        "messages": len(roundTripsSec),
+        "failed_websockets": failures[0],
+        "duration_sec": round(durationSec, 3),
+        "messages_per_sec": round(len(roundTripsSec) / durationSec, 2),
+        "round_trip_ms_p50": _Ms(_Percentile(roundTripsSec, 50)),
+        "round_trip_ms_p99": _Ms(_Percentile(roundTripsSec, 99)),
+    }
+
+
+c_WorkloadRunners:Dict[str, Callable[[FakeOctoEverywhereServer, Any], Dict[str, Any]]] = {
+    c_WorkloadDashboard: RunDashboardWorkload,
+    c_WorkloadDownload: RunDownloadWorkload,
+    c_WorkloadApi: RunApiWorkload,
+    c_WorkloadWebcam: RunWebcamWorkload,
+    c_WorkloadWebsocket: RunWebsocketWorkload,
+}
+
+
+def _GetGitCommit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return None
+
+
+# Starts the fake printer, the fake server, and the plugin, then runs each workload and returns the results.
+def RunTunnelBenchmark(args:Any) -> Dict[str, Any]:
+    logger = logging.getLogger("tunnelbenchmark")
+    workloads = [w.strip() for w in args.workloads.split(",") if len(w.strip()) > 0]
+    for w in workloads:
+        if w not in c_WorkloadRunners:
+            raise Exception(f"Unknown workload {w}, the options are {','.join(c_AllWorkloads)}")
+
+    portQueue:Any = multiprocessing.Queue()
+    printerProcess = multiprocessing.Process(target=_PrinterProcessWorker, daemon=True,
+                                             args=(args.printer, args.download_mb * 1024 * 1024, args.printer_delay_ms / 1000.0, args.webcam_fps, args.webcam_frame_kb * 1024, portQueue))
+    printerProcess.start()
+    printerPort = portQueue.get(timeout=60)
+
+    # A small key is fine, this is only used for the benchmark's handshake.
+    publicKey, privateKey = rsa.newkeys(1024)
+    server = FakeOctoEverywhereServer(logger, privateKey)
+    server.Start()
+
+    parentConn, childConn = multiprocessing.Pipe()
+    pluginProcess = multiprocessing.Process(target=_PluginProcessWorker, daemon=True,
+                                            args=(args.printer, args.engine, server.Port, printerPort, publicKey.save_pkcs1().decode("utf-8"), childConn))
+    startSec = time.time()
+    pluginProcess.start()
+    try:
+        if server.HandshakeComplete.wait(60) is False:
+            raise Exception("The plugin didn't complete the handshake with the fake server.")
+        parentConn.send("stats")
+        idleStats = parentConn.recv()
+        output:Dict[str, Any] = {
+            "git_commit": _GetGitCommit(),
+            "printer": args.printer,
+            "engine": args.engine,
+            "connect_ms": _Ms(server.HandshakeSec - startSec),
+            "idle": {k: idleStats[k] for k in ("threads", "rss_kb")},
+            "workloads": {},
+        }
+        for w in workloads:
+            result = c_WorkloadRunners[w](server, args)
+            parentConn.send("stats")
+            stats = parentConn.recv()
+            result["peak_threads"] = stats["peak_threads"]
+            result["threads_after"] = stats["threads"]
+            result["rss_kb"] = stats["rss_kb"]
+            result["peak_rss_kb"] = stats["peak_rss_kb"]
+            output["workloads"][w] = result
+            # Let the streams finish closing, so they don't count against the next workload.
+            time.sleep(0.5)
+        parentConn.send("stats")
+        stats = parentConn.recv()
+        output["plugin"] = {k: stats[k] for k in ("send_queue", "http_sessions", "websocket_send") if k in stats}
+        return output
+    finally:
+        parentConn.send("exit")
+        pluginProcess.terminate()
+        printerProcess.terminate()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the tunnel end to end against a fake OctoEverywhere server and a fake printer.")
+    parser.add_argument("--printer", choices=[c_PrinterMoonraker, c_PrinterOctoPrint], default=c_PrinterMoonraker)
+    parser.add_argument("--engine", choices=[AsyncWebStreamEngine.c_EngineThreaded, AsyncWebStreamEngine.c_EngineAsyncio, c_EngineWorkerPool], default=AsyncWebStreamEngine.c_EngineThreaded)
+    parser.add_argument("--workloads", default=",".join(c_AllWorkloads), help="A comma separated list of: "+", ".join(c_AllWorkloads))
+    parser.add_argument("--printer-delay-ms", type=int, default=2, help="The time the fake printer takes to handle each request.")
+    parser.add_argument("--dashboard-loads", type=int, default=5)
+    parser.add_argument("--download-mb", type=int, default=64)
+    parser.add_argument("--downloads", type=int, default=1)
+    parser.add_argument("--api-requests", type=int, default=2000)
+    parser.add_argument("--api-concurrency", type=int, default=32)
+    parser.add_argument("--webcam-viewers", type=int, default=2)
+    parser.add_argument("--webcam-sec", type=int, default=5)
+    parser.add_argument("--webcam-fps", type=int, default=15)
+    parser.add_argument("--webcam-frame-kb", type=int, default=60)
+    parser.add_argument("--ws-streams", type=int, default=16)
+    parser.add_argument("--ws-messages", type=int, default=200)
+    parser.add_argument("--output", help="Also write the results to this file.")
+    args = parser.parse_args()
+    result = RunTunnelBenchmark(args)
+    text = json.dumps(result)
+    print(text)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#
+# A micro benchmark of the webcam quality tiers.
+#
+# For each source resolution and each tier, this measures the CPU time it takes to make the tier's frame and the bytes it saves, using:
+#   - draft: the WebcamDownscaler, which has libjpeg reduce the image while decoding it, and only resizes the already reduced image.
+#   - full: decoding the full image and resizing it, which is what a plain PIL resize would do.
+#
+# The CPU time is the thread time, so it's the cost of one frame on one core. To get the cost on a Pi class device, run this on the device.
+# The frames are generated from a fixed seed, or a recorded jpeg can be given with --input, like a snapshot from the camera.
+#
+# Run from the repo root:
+#   python developer/benchmarks/webcamtierbenchmark.py [--input snapshot.jpg] [--sources 1080,2160] [--frames 10] [--output results.json]
+#
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+from typing import Any, Dict, List, Optional
+
+# Allow this to be run as a script from the repo root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# pylint: disable=wrong-import-position
+from PIL import Image # noqa: E402
+from octoeverywhere.buffer import Buffer # noqa: E402
+from octoeverywhere.Webcam.webcamquality import WebcamDownscaler, WebcamQuality # noqa: E402
+
+
+# Makes a jpeg that looks a bit like a camera frame, smooth areas with some noise, so it compresses like one.
+def MakeJpeg(height:int, seed:int=1, quality:int=85) -> bytes:
+    width = height * 16 // 9
+    rand = random.Random(seed)
+    # Draw a small noisy image and scale it up, which is much faster than making the full size image pixel by pixel.
+    small = Image.new("RGB", (max(1, width // 8), max(1, height // 8)))
+    small.putdata([(rand.randrange(256), rand.randrange(256), rand.randrange(256)) for _ in range(small.width * small.height)])
+    img = small.resize((width, height), WebcamDownscaler.GetResampleFilter("BICUBIC"))
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=quality)
+    return out.getvalue()
+
+
+# The plain resize, which decodes the full image.
+def FullDecodeDownscale(jpeg:bytes, maxHeight:int) -> Optional[bytes]:
+    with Image.open(io.BytesIO(jpeg)) as img:
+        if img.height <= maxHeight:
+            return None
+        width = max(1, int(round(img.width * maxHeight / img.height)))
+        scaled = img.convert("RGB").resize((width, maxHeight), WebcamDownscaler.GetResampleFilter("BILINEAR"))
+        out = io.BytesIO()
+        scaled.save(out, format="JPEG", quality=WebcamDownscaler.c_JpegQuality)
+        return out.getvalue()
+
+
+def _RunTier(frames:List[bytes], maxHeight:int) -> Dict[str, Any]:
+    result:Dict[str, Any] = {}
+    sourceBytes = sum(len(f) for f in frames)
+    for name in ("draft", "full"):
+        cpuSec = 0.0
+        outBytes = 0
+        for frame in frames:
+            startSec = time.thread_time()
+            if name == "draft":
+                scaled, _ = WebcamDownscaler.Downscale(Buffer(frame), maxHeight)
+                out = None if scaled is None else bytes(scaled.Get())
+            else:
+                out = FullDecodeDownscale(frame, maxHeight)
+            cpuSec += time.thread_time() - startSec
+            outBytes += len(frame) if out is None else len(out)
+        result[name] = {
+            "CpuMsPerFrame": round(cpuSec * 1000.0 / len(frames), 2),
+            "BytesPerFrame": outBytes // len(frames),
+            "BytesSavedPerFrame": (sourceBytes - outBytes) // len(frames),
+        }
+    result["CpuSpeedup"] = round(result["full"]["CpuMsPerFrame"] / max(result["draft"]["CpuMsPerFrame"], 1e-9), 2)
+    return result
+
+
+def RunBenchmark(sources:Dict[str, List[bytes]]) -> Dict[str, Any]:
+    results:Dict[str, Any] = {}
+    for sourceName, frames in sources.items():
+        sourceResult:Dict[str, Any] = {"SourceBytesPerFrame": sum(len(f) for f in frames) // len(frames)}
+        for quality in WebcamQuality:
+            if quality == WebcamQuality.Full:
+                continue
+            sourceResult[str(quality)] = _RunTier(frames, quality.value)
+        results[sourceName] = sourceResult
+    return {
+        "Machine": platform.machine(),
+        "Python": platform.python_version(),
+        "Sources": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the webcam quality tier downscaling.")
+    parser.add_argument("--input", help="A recorded jpeg to use rather than generated ones.")
+    parser.add_argument("--sources", default="1080,2160", help="The heights of the generated source frames.")
+    parser.add_argument("--frames", type=int, default=10, help="The number of frames to generate for each source.")
+    parser.add_argument("--output", help="Write the JSON results to this file rather than stdout.")
+    args = parser.parse_args()
+
+    sources:Dict[str, List[bytes]] = {}
+    if args.input is not None:
+        with open(args.input, "rb") as f:
+            sources[os.path.basename(args.input)] = [f.read()] * args.frames
+    else:
+        for height in args.sources.split(","):
+            sources[f"{height}p"] = [MakeJpeg(int(height), seed=i) for i in range(args.frames)]
+
+    resultsJson = json.dumps(RunBenchmark(sources), indent=2)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(resultsJson)
+    else:
+        print(resultsJson)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+#
+# A side by side benchmark of the threaded and asyncio web stream engines.
+#
+# This opens a lot of web streams at once against a local http server, using the real OctoStream message building, and reports the
+# throughput, request latency, thread count, and peak RSS for each engine. Each engine is run in its own process, and the http server
+# runs in another process, so the thread count and RSS are only from that engine.
+#
+# Run from the repo root:
+#   python developer/benchmarks/webstreamenginebenchmark.py [--streams 500] [--body-kb 256] [--server-delay-ms 20]
+#
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+import octoflatbuffers
+
+# Allow this to be run as a script from the repo root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+# pylint: disable=wrong-import-position
+from octoeverywhere.buffer import Buffer # noqa: E402
+from octoeverywhere.sentry import Sentry # noqa: E402
+from octoeverywhere.httpsessions import HttpSessions # noqa: E402
+from octoeverywhere.sendbufferpool import SendBufferPool, SendCopyStats # noqa: E402
+from octoeverywhere.commandhandler import CommandHandler # noqa: E402
+from octoeverywhere.octohttprequest import OctoHttpRequest # noqa: E402
+from octoeverywhere.Webcam.webcamhelper import WebcamHelper # noqa: E402
+from octoeverywhere.octostreammsgbuilder import OctoStreamMsgBuilder # noqa: E402
+from octoeverywhere.WebStream.octowebstream import OctoWebStream # noqa: E402
+from octoeverywhere.WebStream.asyncwebstreamengine import AsyncWebStreamEngine # noqa: E402
+from octoeverywhere.Proto import WebStreamMsg # noqa: E402
+from octoeverywhere.Proto import HttpInitialContext # noqa: E402
+from octoeverywhere.Proto import MessageContext # noqa: E402
+from octoeverywhere.Proto.PathTypes import PathTypes # noqa: E402
+from octoeverywhere.Proto.OctoStreamMessage import OctoStreamMessage # noqa: E402
+
+
+_BodyCache:Dict[int, bytes] = {}
+
+
+def _GetBody(size:int) -> bytes:
+    body = _BodyCache.get(size, None)
+    if body is None:
+        body = bytes(i % 251 for i in range(size))
+        _BodyCache[size] = body
+    return body
+
+
+# Allow a burst of connections, since all of the streams open at once.
+class _BenchmarkHttpServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+# Serves /body/<size> with a body of that many bytes. The content type isn't compressed, so the bytes the streams send can be checked directly.
+# The server can add a delay before each response, which acts like the time OctoPrint or Moonraker takes to handle a request.
+class _BodyRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ResponseDelaySec = 0.0
+
+    def do_GET(self) -> None:
+        if _BodyRequestHandler.ResponseDelaySec > 0:
+            time.sleep(_BodyRequestHandler.ResponseDelaySec)
+        if self.path.startswith("/body/") is False:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        size = int(self.path[len("/body/"):])
+        body = _GetBody(size)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format:str, *args:Any) -> None: #pylint: disable=redefined-builtin
+        pass
+
+
+# Acts like the OctoSession, decoding each message the streams send.
+class RecordingOctoSession:
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        self.StreamStartSec:Dict[int, float] = {}
+        self.StreamDoneSec:Dict[int, float] = {}
+        self.StreamDataBytes:Dict[int, int] = {}
+        self.StreamStatusCode:Dict[int, int] = {}
+        self.AllDone = threading.Event()
+        self.ExpectedStreams = 0
+
+
+    def WebStreamClosed(self, streamId:int) -> None:
+        pass
+
+
+    def OnSessionError(self, backoffModifierSec:int) -> None:
+        pass
+
+
+    def Send(self, buffer:Buffer, msgStartOffsetBytes:int, msgSize:int, streamId:int=0, priority:int=0) -> None:
+        data = bytes(buffer.GetBytesLike()[msgStartOffsetBytes:msgStartOffsetBytes + msgSize])
+        octoStreamMsg = OctoStreamMessage.GetRootAs(data, 4) #pyright: ignore[reportUnknownMemberType]
+        context = octoStreamMsg.Context()
+        if context is None:
+            return
+        msg = WebStreamMsg.WebStreamMsg()
+        msg.Init(context.Bytes, context.Pos)
+        streamId = msg.StreamId()
+        with self.Lock:
+            self.StreamDataBytes[streamId] = self.StreamDataBytes.get(streamId, 0) + msg.DataLength()
+            if msg.StatusCode() != 0:
+                self.StreamStatusCode[streamId] = msg.StatusCode()
+            if msg.IsCloseMsg():
+                self.StreamDoneSec[streamId] = time.time()
+                if len(self.StreamDoneSec) >= self.ExpectedStreams:
+                    self.AllDone.set()
+        # Like the websocket, let the buffer owner know the send is done.
+        buffer.OnSendComplete()
+
+
+# Builds an open message like the server sends for a GET request.
+def BuildOpenMsg(streamId:int, path:str) -> WebStreamMsg.WebStreamMsg:
+    builder = octoflatbuffers.Builder(1024)
+    pathOffset = builder.CreateString(path) #pyright: ignore[reportUnknownMemberType]
+    methodOffset = builder.CreateString("GET") #pyright: ignore[reportUnknownMemberType]
+    octoHostOffset = builder.CreateString("benchmark.octoeverywhere.com") #pyright: ignore[reportUnknownMemberType]
+    HttpInitialContext.Start(builder)
+    HttpInitialContext.AddPath(builder, pathOffset)
+    HttpInitialContext.AddPathType(builder, PathTypes.Relative)
+    HttpInitialContext.AddMethod(builder, methodOffset)
+    HttpInitialContext.AddOctoHost(builder, octoHostOffset)
+    httpInitialContextOffset = HttpInitialContext.End(builder)
+    WebStreamMsg.Start(builder)
+    WebStreamMsg.AddStreamId(builder, streamId)
+    WebStreamMsg.AddIsOpenMsg(builder, True)
+    WebStreamMsg.AddIsControlFlagsOnly(builder, False)
+    WebStreamMsg.AddIsDataTransmissionDone(builder, True)
+    WebStreamMsg.AddHttpInitialContext(builder, httpInitialContextOffset)
+    webStreamMsgOffset = WebStreamMsg.End(builder)
+    buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, MessageContext.MessageContext.WebStreamMsg, webStreamMsgOffset)
+    data = bytes(buffer.GetBytesLike()[msgStartOffsetBytes:msgStartOffsetBytes + msgSizeBytes])
+    context = OctoStreamMessage.GetRootAs(data, 4).Context() #pyright: ignore[reportUnknownMemberType]
+    msg = WebStreamMsg.WebStreamMsg()
+    msg.Init(context.Bytes, context.Pos) #pyright: ignore[reportOptionalMemberAccess]
+    return msg
+
+
+def _Percentile(values:List[float], percent:float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * percent / 100.0))
+    return values[index]
+
+
+def _GetPeakRssKb() -> int:
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except Exception:
+        pass
+    return 0
+
+
+_InitLock = threading.Lock()
+_HasInit = False
+
+
+# The engines need these singletons to exist.
+def _EnsureInit(logger:logging.Logger) -> None:
+    global _HasInit #pylint: disable=global-statement
+    with _InitLock:
+        if _HasInit:
+            return
+        _HasInit = True
+        Sentry.SetLogger(logger)
+        HttpSessions.Init(logger)
+        SendBufferPool.Init(logger)
+        WebcamHelper.Init(logger, None, tempfile.mkdtemp()) #pyright: ignore[reportArgumentType]
+        CommandHandler.Init(logger, None, None, None) #pyright: ignore[reportArgumentType]
+
+
+def _ServerProcessWorker(responseDelaySec:float, portQueue:Any) -> None:
+    _BodyRequestHandler.ResponseDelaySec = responseDelaySec
+    server = _BenchmarkHttpServer(("127.0.0.1", 0), _BodyRequestHandler)
+    portQueue.put(server.server_address[1])
+    server.serve_forever()
+
+
+# Opens streamCount web streams at once against a local http server, using either engine, and returns the throughput and latency stats.
+def RunEngineBenchmark(engine:str, streamCount:int=100, bodySizeBytes:int=64 * 1024, serverDelaySec:float=0.02) -> Dict[str, Any]:
+    logger = logging.getLogger("webstreamenginebenchmark")
+    _EnsureInit(logger)
+    portQueue:Any = multiprocessing.Queue()
+    serverProcess = multiprocessing.Process(target=_ServerProcessWorker, args=(serverDelaySec, portQueue), daemon=True)
+    serverProcess.start()
+    OctoHttpRequest.SetLocalOctoPrintPort(portQueue.get(timeout=10))
+    OctoHttpRequest.SetLocalHostAddress("127.0.0.1")
+    asyncEngine:Optional[AsyncWebStreamEngine] = None
+    if engine == AsyncWebStreamEngine.c_EngineAsyncio:
+        asyncEngine = AsyncWebStreamEngine(logger)
+    try:
+        session = RecordingOctoSession()
+        session.ExpectedStreams = streamCount
+        peakThreads = threading.active_count()
+        startSec = time.time()
+        for i in range(streamCount):
+            streamId = i + 1
+            openMsg = BuildOpenMsg(streamId, "/body/"+str(bodySizeBytes))
+            session.StreamStartSec[streamId] = time.time()
+            if asyncEngine is not None:
+                asyncEngine.CreateWebStream(logger, streamId, session).OnIncomingServerMessage(openMsg) #pyright: ignore[reportArgumentType]
+            else:
+                stream = OctoWebStream(name="OctoWebStreamPumper", args=(logger, streamId, session))
+                stream.start()
+                stream.OnIncomingServerMessage(openMsg)
+            peakThreads = max(peakThreads, threading.active_count())
+        while session.AllDone.wait(0.01) is False:
+            peakThreads = max(peakThreads, threading.active_count())
+            if time.time() - startSec > 300:
+                break
+        durationSec = time.time() - startSec
+
+        latenciesSec = [session.StreamDoneSec[s] - session.StreamStartSec[s] for s in session.StreamDoneSec]
+        totalBytes = sum(session.StreamDataBytes.values())
+        result = {
+            "engine": engine,
+            "streams": streamCount,
+            "body_size_bytes": bodySizeBytes,
+            "server_delay_ms": int(serverDelaySec * 1000.0),
+            "completed_streams": len(session.StreamDoneSec),
+            "complete_bodies": sum(1 for s in session.StreamDataBytes.values() if s == bodySizeBytes),
+            "ok_status": sum(1 for s in session.StreamStatusCode.values() if s == 200),
+            "duration_sec": round(durationSec, 3),
+            "throughput_mb_sec": round((totalBytes / (1024.0 * 1024.0)) / max(durationSec, 0.001), 2),
+            "latency_ms_p50": round(_Percentile(latenciesSec, 50) * 1000.0, 2),
+            "latency_ms_p99": round(_Percentile(latenciesSec, 99) * 1000.0, 2),
+            "peak_threads": peakThreads,
+            "peak_rss_kb": _GetPeakRssKb(),
+        }
+        if asyncEngine is not None:
+            result["async_stats"] = asyncEngine.GetStats()
+        bufferPool = SendBufferPool.Get()
+        if bufferPool is not None:
+            result["buffer_pool_stats"] = bufferPool.GetStats()
+        result["send_copy_stats"] = SendCopyStats.GetStats()
+        return result
+    finally:
+        serverProcess.terminate()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compares the threaded and asyncio web stream engines.")
+    parser.add_argument("--engine", help="Only run this engine, in this process.")
+    parser.add_argument("--streams", type=int, default=500)
+    parser.add_argument("--body-kb", type=int, default=256)
+    parser.add_argument("--server-delay-ms", type=int, default=20)
+    args = parser.parse_args()
+    if args.engine is not None:
+        print(json.dumps(RunEngineBenchmark(args.engine, streamCount=args.streams, bodySizeBytes=args.body_kb * 1024, serverDelaySec=args.server_delay_ms / 1000.0)))
+        return
+    for engineName in (AsyncWebStreamEngine.c_EngineThreaded, AsyncWebStreamEngine.c_EngineAsyncio):
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--engine", engineName, "--streams", str(args.streams), "--body-kb", str(args.body_kb), "--server-delay-ms", str(args.server_delay_ms)], check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,14 @@
 import logging
 import threading
 import time
-from typing import Optional, Dict
+from typing import Optional
 
 from octoeverywhere.sentry import Sentry
 from octoeverywhere.compat import Compat
 from octoeverywhere.octohttprequest import OctoHttpRequest
 from octoeverywhere.octohttprequest import PathTypes
 from octoeverywhere.httpresult import HttpResult, HttpResultOrNone
+from octoeverywhere.slipstreamcache import SlipstreamCache
 from octoeverywhere.WebStream.octoheaderimpl import HeaderHelper
 from octoeverywhere.WebStream.octoheaderimpl import BaseProtocol
 from octoeverywhere.octostreammsgbuilder import OctoStreamMsgBuilder
@@ -17,6 +18,7 @@ from octoeverywhere.interfaces import ISlipstreamHandler
 
 
 # This class caches the web relay resources, since some of them can take a bit to load.
+# The cache is also kept on disk by the SlipstreamCache, so after a restart the cache can be served right away while it's refreshed in the background.
 class Slipstream(ISlipstreamHandler):
 
     # Helpful for debugging slipstream.
@@ -51,7 +53,6 @@ class Slipstream(ISlipstreamHandler):
 
     MaxCacheFileSizeBytes = 20 * 1024 * 1024
     MaxCachedBodySendBytes = 20 * 1024 * 1024
-    MaxTotalCacheBytes = 100 * 1024 * 1024
 
 
     @staticmethod
@@ -70,7 +71,8 @@ class Slipstream(ISlipstreamHandler):
 
         self.Lock = threading.Lock()
         self.IsRefreshing = False
-        self.Cache:Dict[str, HttpResult] = {}
+        # This loads anything cached on disk from the last run, so it can be served before the refresh finishes.
+        self.Cache = SlipstreamCache(logger, Compression.Get().LocalFileStoragePath)
 
 
     # If available for the given URL, this will returned the cached and ready to go OctoHttpResult.
@@ -102,16 +104,13 @@ class Slipstream(ISlipstreamHandler):
             path = Slipstream.IndexCachePath
             posOfQuestionMark = -1
 
-        # We have our path, check if it's in the map
-        with self.Lock:
-            if path in self.Cache:
-                # We must make a copy of the returned object because the HTTP system will call free on it when it's done, which clears the buffer.
-                # This copy is a new HttpResult object, but it shares a pointer to the same buffer, so there's no much overhead.
-                self.Logger.debug("Slipstream returning cached content for %s", path)
-                return self.Cache[path].CreateReplayCopy()
-
-        # Otherwise return cache miss.
-        return None
+        # We have our path, check if it's in the cache.
+        # The cache returns a copy of the result because the HTTP system will call free on it when it's done, which clears the buffer.
+        # This copy is a new HttpResult object, but it shares a pointer to the same buffer, so there's no much overhead.
+        result = self.Cache.Get(path)
+        if result is not None:
+            self.Logger.debug("Slipstream returning cached content for %s", path)
+        return result
 
 
     # !!! Interface Function For Slipstream in Compat Layer !!!
@@ -169,18 +168,13 @@ class Slipstream(ISlipstreamHandler):
             if indexBodyStr is None:
                 return
 
-            # Add the index to the cache so it's ready now.
-            self._TryStoreCacheResult(Slipstream.IndexCachePath, indexResult)
-
         # Set this to None to ensure it's not used anymore.
         indexResult = None
 
         # Elegoo also often redirects to a sub page that's the index as well, so cache that too.
         resultRedirectIndex = self._GetCacheReadyOctoHttpResult(Slipstream.IndexRedirectCachePath)
         if resultRedirectIndex is not None:
-            # Add it to our cache.
-            with resultRedirectIndex:
-                self._TryStoreCacheResult(Slipstream.IndexRedirectCachePath, resultRedirectIndex)
+            resultRedirectIndex.Free()
             resultRedirectIndex = None
 
         # Now process the index to see if there's more we should cache.
@@ -202,25 +196,21 @@ class Slipstream(ISlipstreamHandler):
             result = self._GetCacheReadyOctoHttpResult(fullPath)
             if result is None:
                 continue
-
-            # Add it to our cache.
-            with result:
-                self._TryStoreCacheResult(fullPath, result)
+            result.Free()
 
         # Finally, try to see if we can find any sub JS files.
         self._TryToFindSubJsFiles()
 
-        size = 0
-        with self.Lock:
-            size = len(self.Cache)
+        size = len(self.Cache.GetUrls())
 
         self.Logger.debug("Slipstream took %s to fully update the cache of %s files.", time.time() - start, size)
 
 
-    # On success returns the fully ready OctoHttpResult object.
+    # On success, stores the fully ready OctoHttpResult object in the cache and returns a copy of it.
     # On failure, returns None
     def _GetCacheReadyOctoHttpResult(self, url:str) -> HttpResultOrNone:
         success = False
+        removeCacheOnFailure = True
         octoHttpResult:HttpResultOrNone = None
         try:
             # Take the starting time.
@@ -232,11 +222,27 @@ class Slipstream(ISlipstreamHandler):
             # x-forwarded-for-host header, so it doesn't matter. Only the APIs use them to generate the correct links.
             headers = HeaderHelper.GatherRequestHeaders(self.Logger, None, BaseProtocol.Http)
 
+            # If we have this cached, send the validators we have, so if it hasn't changed we don't need to read or compress it again.
+            headers.update(self.Cache.GetRevalidationHeaders(url))
+
             # Make the call using our helper.
             octoHttpResult = OctoHttpRequest.MakeHttpCall(self.Logger, url, PathTypes.Relative, "GET", headers)
 
+            # If the server can't be reached, like while it's still starting, keep anything we loaded from disk.
+            if octoHttpResult is None:
+                self.Logger.error("Slipstream failed to make the http request for "+url)
+                removeCacheOnFailure = False
+                return None
+
+            # If the server says the file hasn't changed, the cached result is still good.
+            if octoHttpResult.StatusCode == 304 and self.Cache.OnNotModified(url):
+                self._DebugLog("Slipstream cache is still valid for "+url)
+                cacheResult = self.Cache.Get(url)
+                success = cacheResult is not None
+                return cacheResult
+
             # Check for success
-            if octoHttpResult is None or octoHttpResult.StatusCode != 200:
+            if octoHttpResult.StatusCode != 200:
                 self.Logger.error("Slipstream failed to make the http request for "+url)
                 return None
 
@@ -281,22 +287,24 @@ class Slipstream(ISlipstreamHandler):
                 self.Logger.error("Slipstream read a a body of different size then the content length. url:"+url+" body:"+str(len(buffer))+" cl:"+str(contentLength))
                 return None
 
+            # If the body is the same as the one we have cached, there's no need to compress it again.
+            bodyHash = SlipstreamCache.GetBodyHash(buffer)
+            if self.Cache.TryRefreshIfBodyHashMatches(url, bodyHash, octoHttpResult.StatusCode, dict(octoHttpResult.Headers)):
+                self._DebugLog("Slipstream cache body is unchanged for "+url)
+                cacheResult = self.Cache.Get(url)
+                success = cacheResult is not None
+                return cacheResult
+
             # Do the compression.
-            ogSize = len(buffer)
+            # Since this is done once in the background and sent many times, this uses the higher precompress level.
             compressStart = time.time()
-            compressResult = None
-            with CompressionContext(self.Logger) as compressionContext:
-                # It's important to set the full compression size, because the compression system will use
-                # it to better optimize the compression and know that we will be sending the full data.
-                compressionContext.SetTotalCompressedSizeOfData(len(buffer))
-                compressResult = Compression.Get().Compress(compressionContext, buffer)
-                buffer = compressResult.Bytes
+            buffer, compressionType, ogSize = SlipstreamCache.Precompress(self.Logger, buffer)
             if len(buffer) > Slipstream.MaxCachedBodySendBytes:
                 self.Logger.info("Slipstream refusing to cache %s because the compressed body is %d bytes and the max is %d bytes.", url, len(buffer), Slipstream.MaxCachedBodySendBytes)
                 return None
 
             # Set the buffer into the response so the http request logic can use it.
-            octoHttpResult.SetFullBodyBuffer(buffer, compressResult.CompressionType, ogSize)
+            octoHttpResult.SetFullBodyBuffer(buffer, compressionType, ogSize)
 
             # We must create a copy, since we free the original octoHttpResult before we return.
             cacheResult = octoHttpResult.CreateReplayCopy()
@@ -305,7 +313,8 @@ class Slipstream(ISlipstreamHandler):
             compressDuration = time.time() - compressStart
             self._DebugLog("Slipstream Cached [request:"+str(format(requestDuration, '.3f'))+", compression:"+str(format(compressDuration, '.3f'))+"] ["+str(ogSize)+"->"+str(len(buffer))+" "+format(((len(buffer)/ogSize)*100), '.3f')+"%] "+url)
 
-            # Return the result on success.
+            # Store it, which also writes it to disk, and return the result on success.
+            self.Cache.Store(url, cacheResult, bodyHash)
             success = True
             return cacheResult
 
@@ -320,40 +329,13 @@ class Slipstream(ISlipstreamHandler):
             except Exception:
                 pass
             # On all exits, if not successful, remove this entry from the cache so it doesn't get stale.
-            if success is False:
+            if success is False and removeCacheOnFailure:
                 self.RemoveCacheIfExists(url)
         return None
 
 
     def RemoveCacheIfExists(self, url:str):
-        with self.Lock:
-            if url in self.Cache:
-                del self.Cache[url]
-
-
-    def _TryStoreCacheResult(self, url:str, result:HttpResult) -> bool:
-        # Figure out how big this new result is.
-        bodySize = self._GetCachedBodySize(result)
-        if bodySize == 0:
-            return False
-        with self.Lock:
-            # Accumulate the current cache size EXCEPT this URL.
-            currentSize = 0
-            for key, value in self.Cache.items():
-                if key == url:
-                    continue
-                currentSize += self._GetCachedBodySize(value)
-            if currentSize + bodySize > Slipstream.MaxTotalCacheBytes:
-                self.Logger.info("Slipstream refusing to store %s because cache would grow to %d bytes; max is %d bytes.", url, currentSize + bodySize, Slipstream.MaxTotalCacheBytes)
-                return False
-            # Always cache a copy of the reply so it doesn't hang open any underlying request connections.
-            self.Cache[url] = result.CreateReplayCopy()
-        return True
-
-
-    def _GetCachedBodySize(self, result:HttpResult) -> int:
-        buffer = result.FullBodyBuffer
-        return 0 if buffer is None else len(buffer)
+        self.Cache.Remove(url)
 
 
     def _GetDecodedBody(self, octoHttpResult:HttpResult) -> Optional[str]:
@@ -402,13 +384,15 @@ class Slipstream(ISlipstreamHandler):
     # The runtime js file has some sub js files that will be loaded.
     # We try to find them best effort.
     def _TryToFindSubJsFiles(self):
-        # Under lock, try to grab the runtime js file and decode it to text.
+        # Try to grab the runtime js file and decode it to text.
         runTimeJs:Optional[str] = None
-        with self.Lock:
-            for (k, v) in self.Cache.items():
-                if k.find(Slipstream.JsRuntimeFilePrefix) != -1:
-                    runTimeJs = self._GetDecodedBody(v)
-                    break
+        for url in self.Cache.GetUrls():
+            if url.find(Slipstream.JsRuntimeFilePrefix) != -1:
+                result = self.Cache.Get(url)
+                if result is not None:
+                    with result:
+                        runTimeJs = self._GetDecodedBody(result)
+                break
 
         if runTimeJs is None:
             return
@@ -451,8 +435,7 @@ class Slipstream(ISlipstreamHandler):
                 result = self._GetCacheReadyOctoHttpResult(urlPath)
                 if result is None:
                     continue
-                # Add it to our cache.
-                self._TryStoreCacheResult(urlPath, result)
+                result.Free()
 
         except Exception as e:
             self._DebugLog("Slipstream failed to parse runtime js file for sub js files. e:"+str(e))
@@ -6,6 +6,8 @@ import threading
 from http.server import HTTPServer, BaseHTTPRequestHandler
 
 from octoeverywhere.sentry import Sentry
+from octoeverywhere.tunnelperfstats import TunnelPerfStats
+from octoeverywhere.tunnelperfreport import TunnelPerfReport
 
 from linux_host.config import Config
 
@@ -108,6 +110,19 @@ class LocalWebApi:
             pass
 
         def do_GET(self):
+            # The perf path returns the tunnel perf report.
+            # The server can be bound to all interfaces, so the report is only returned to callers on this device.
+            if self.path.startswith("/perf"):
+                if TunnelPerfStats.IsLocalCaller(self.client_address[0]) is False:
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+                self.wfile.write(bytes(json.dumps(TunnelPerfReport.GetReport()), 'utf-8'))
+                return
+
             self.send_response(200)
             self.send_header("Content-type", "application/json")
             self.end_headers()
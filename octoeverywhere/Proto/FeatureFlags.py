@@ -0,0 +1,7 @@
+# automatically generated by the FlatBuffers compiler, do not modify
+
+# namespace: Proto
+
+class FeatureFlags(object):
+    None_ = 0
+    CompressionPassThrough = 1
@@ -92,8 +92,42 @@ class HandshakeAck(object):
             return bool(self._tab.Get(octoflatbuffers.number_types.BoolFlags, o + self._tab.Pos))
         return False
 
+    # HandshakeAck
+    def FeatureFlags(self):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(20))
+        if o != 0:
+            return self._tab.Get(octoflatbuffers.number_types.Uint64Flags, o + self._tab.Pos)
+        return 0
+
+    # HandshakeAck
+    def ZStandardDictIds(self, j: int):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(22))
+        if o != 0:
+            a = self._tab.Vector(o)
+            return self._tab.Get(octoflatbuffers.number_types.Uint32Flags, a + octoflatbuffers.number_types.UOffsetTFlags.py_type(j * 4))
+        return 0
+
+    # HandshakeAck
+    def ZStandardDictIdsAsNumpy(self):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(22))
+        if o != 0:
+            return self._tab.GetVectorAsNumpy(octoflatbuffers.number_types.Uint32Flags, o)
+        return 0
+
+    # HandshakeAck
+    def ZStandardDictIdsLength(self) -> int:
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(22))
+        if o != 0:
+            return self._tab.VectorLen(o)
+        return 0
+
+    # HandshakeAck
+    def ZStandardDictIdsIsNone(self) -> bool:
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(22))
+        return o == 0
+
 def HandshakeAckStart(builder: octoflatbuffers.Builder):
-    builder.StartObject(8)
+    builder.StartObject(10)
 
 def Start(builder: octoflatbuffers.Builder):
     HandshakeAckStart(builder)
@@ -152,6 +186,24 @@ def HandshakeAckAddRequiresRekey(builder: octoflatbuffers.Builder, requiresRekey
 def AddRequiresRekey(builder: octoflatbuffers.Builder, requiresRekey: bool):
     HandshakeAckAddRequiresRekey(builder, requiresRekey)
 
+def HandshakeAckAddFeatureFlags(builder: octoflatbuffers.Builder, featureFlags: int):
+    builder.PrependUint64Slot(8, featureFlags, 0)
+
+def AddFeatureFlags(builder: octoflatbuffers.Builder, featureFlags: int):
+    HandshakeAckAddFeatureFlags(builder, featureFlags)
+
+def HandshakeAckAddZStandardDictIds(builder: octoflatbuffers.Builder, zStandardDictIds: int):
+    builder.PrependUOffsetTRelativeSlot(9, octoflatbuffers.number_types.UOffsetTFlags.py_type(zStandardDictIds), 0)
+
+def AddZStandardDictIds(builder: octoflatbuffers.Builder, zStandardDictIds: int):
+    HandshakeAckAddZStandardDictIds(builder, zStandardDictIds)
+
+def HandshakeAckStartZStandardDictIdsVector(builder, numElems: int) -> int:
+    return builder.StartVector(4, numElems, 4)
+
+def StartZStandardDictIdsVector(builder, numElems: int) -> int:
+    return HandshakeAckStartZStandardDictIdsVector(builder, numElems)
+
 def HandshakeAckEnd(builder: octoflatbuffers.Builder) -> int:
     return builder.EndObject()
 
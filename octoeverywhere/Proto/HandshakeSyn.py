@@ -208,8 +208,42 @@ class HandshakeSyn(object):
         o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(42))
         return o == 0
 
+    # HandshakeSyn
+    def FeatureFlags(self):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(44))
+        if o != 0:
+            return self._tab.Get(octoflatbuffers.number_types.Uint64Flags, o + self._tab.Pos)
+        return 0
+
+    # HandshakeSyn
+    def ZStandardDictIds(self, j: int):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(46))
+        if o != 0:
+            a = self._tab.Vector(o)
+            return self._tab.Get(octoflatbuffers.number_types.Uint32Flags, a + octoflatbuffers.number_types.UOffsetTFlags.py_type(j * 4))
+        return 0
+
+    # HandshakeSyn
+    def ZStandardDictIdsAsNumpy(self):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(46))
+        if o != 0:
+            return self._tab.GetVectorAsNumpy(octoflatbuffers.number_types.Uint32Flags, o)
+        return 0
+
+    # HandshakeSyn
+    def ZStandardDictIdsLength(self) -> int:
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(46))
+        if o != 0:
+            return self._tab.VectorLen(o)
+        return 0
+
+    # HandshakeSyn
+    def ZStandardDictIdsIsNone(self) -> bool:
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(46))
+        return o == 0
+
 def HandshakeSynStart(builder: octoflatbuffers.Builder):
-    builder.StartObject(20)
+    builder.StartObject(22)
 
 def Start(builder: octoflatbuffers.Builder):
     HandshakeSynStart(builder)
@@ -346,6 +380,24 @@ def HandshakeSynStartPropertiesVector(builder, numElems: int) -> int:
 def StartPropertiesVector(builder, numElems: int) -> int:
     return HandshakeSynStartPropertiesVector(builder, numElems)
 
+def HandshakeSynAddFeatureFlags(builder: octoflatbuffers.Builder, featureFlags: int):
+    builder.PrependUint64Slot(20, featureFlags, 0)
+
+def AddFeatureFlags(builder: octoflatbuffers.Builder, featureFlags: int):
+    HandshakeSynAddFeatureFlags(builder, featureFlags)
+
+def HandshakeSynAddZStandardDictIds(builder: octoflatbuffers.Builder, zStandardDictIds: int):
+    builder.PrependUOffsetTRelativeSlot(21, octoflatbuffers.number_types.UOffsetTFlags.py_type(zStandardDictIds), 0)
+
+def AddZStandardDictIds(builder: octoflatbuffers.Builder, zStandardDictIds: int):
+    HandshakeSynAddZStandardDictIds(builder, zStandardDictIds)
+
+def HandshakeSynStartZStandardDictIdsVector(builder, numElems: int) -> int:
+    return builder.StartVector(4, numElems, 4)
+
+def StartZStandardDictIdsVector(builder, numElems: int) -> int:
+    return HandshakeSynStartZStandardDictIdsVector(builder, numElems)
+
 def HandshakeSynEnd(builder: octoflatbuffers.Builder) -> int:
     return builder.EndObject()
 
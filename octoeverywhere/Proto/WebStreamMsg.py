@@ -180,8 +180,15 @@ class WebStreamMsg(object):
             return self._tab.Get(octoflatbuffers.number_types.Uint8Flags, o + self._tab.Pos)
         return 0
 
+    # WebStreamMsg
+    def IsContentEncodingPassThrough(self):
+        o = octoflatbuffers.number_types.UOffsetTFlags.py_type(self._tab.Offset(40))
+        if o != 0:
+            return bool(self._tab.Get(octoflatbuffers.number_types.BoolFlags, o + self._tab.Pos))
+        return False
+
 def WebStreamMsgStart(builder: octoflatbuffers.Builder):
-    builder.StartObject(18)
+    builder.StartObject(19)
 
 def Start(builder: octoflatbuffers.Builder):
     WebStreamMsgStart(builder)
@@ -300,6 +307,12 @@ def WebStreamMsgAddMultipartReadsPerSecond(builder: octoflatbuffers.Builder, mul
 def AddMultipartReadsPerSecond(builder: octoflatbuffers.Builder, multipartReadsPerSecond: int):
     WebStreamMsgAddMultipartReadsPerSecond(builder, multipartReadsPerSecond)
 
+def WebStreamMsgAddIsContentEncodingPassThrough(builder: octoflatbuffers.Builder, isContentEncodingPassThrough: bool):
+    builder.PrependBoolSlot(18, isContentEncodingPassThrough, 0)
+
+def AddIsContentEncodingPassThrough(builder: octoflatbuffers.Builder, isContentEncodingPassThrough: bool):
+    WebStreamMsgAddIsContentEncodingPassThrough(builder, isContentEncodingPassThrough)
+
 def WebStreamMsgEnd(builder: octoflatbuffers.Builder) -> int:
     return builder.EndObject()
 
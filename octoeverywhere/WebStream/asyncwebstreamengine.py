@@ -0,0 +1,606 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+import collections
+from typing import Any, Deque, Dict, Optional
+
+import octoflatbuffers
+
+from .octowebstream import OctoWebStream
+from .octoheaderimpl import HeaderHelper, BaseProtocol
+from .octowebstreamhttphelper import OctoWebStreamHttpHelper, MsgBuilderContext
+from .webstreamworkerpool import WebStreamWorkerPool
+from ..buffer import Buffer
+from ..sentry import Sentry
+from ..compat import Compat
+from ..interfaces import IOctoSession, IWebStream
+from ..compression import Compression, CompressionContext
+from ..compressionpassthrough import CompressionPassThrough
+from ..compressibility import Compressibility
+from ..memorymanager import MemoryManager
+from ..sendbufferpool import SendCopyStats
+from ..tunnelperfstats import TunnelPerfStats
+from ..octohttprequest import OctoHttpRequest
+from ..octostreammsgbuilder import OctoStreamMsgBuilder
+from ..commandhandler import CommandHandler
+from ..Webcam.webcamhelper import WebcamHelper
+from ..Proto import WebStreamMsg
+from ..Proto import MessageContext
+from ..Proto import HttpInitialContext
+from ..Proto import OeAuthAllowed
+from ..Proto.PathTypes import PathTypes
+
+
+# The details of a request the async engine can handle, built from the open message.
+class AsyncHttpRequestContext:
+    def __init__(self, method:str, url:str, headers:Dict[str, str], pathType:int) -> None:
+        self.Method = method
+        self.Url = url
+        self.Headers = headers
+        self.PathType = pathType
+
+
+#
+# An alternative runtime for web streams, where http requests run as coroutines on a single event loop instead of a thread per stream.
+#
+# The engine is selected at startup, the default is still the threaded engine. It can be turned on with the setter or the OCTO_WEBSTREAM_ENGINE=asyncio env var.
+# If httpx isn't installed, the engine will log and the threaded engine will be used.
+#
+# The async engine only handles the common case, plain http requests with no upload body that go to the main URL.
+# Everything else (websockets, uploads, webcam and command requests, Slipstream hits, response handlers, and requests that need the fallback URL chain)
+# is handed off to a normal OctoWebStream, so there's only one implementation of that logic.
+#
+# Note the OctoSocket connection to the server itself still runs on the websocket threads, the engine only changes how the local http requests are made.
+#
+class AsyncWebStreamEngine:
+
+    c_EngineThreaded = "threaded"
+    c_EngineAsyncio = "asyncio"
+
+    # The max number of requests that can be connecting and waiting on response headers at once.
+    # Without this, a burst of streams will open all of their connections at the same time, which can overflow the local server's listen backlog.
+    # Once a request has its headers, it doesn't count against this, so long running streams can't starve other requests.
+    c_MaxConcurrentRequestStarts = 32
+
+    # The engine new web streams will use.
+    SelectedEngine = os.environ.get("OCTO_WEBSTREAM_ENGINE", c_EngineThreaded).lower()
+
+    _Instance:Optional["AsyncWebStreamEngine"] = None
+
+
+    @staticmethod
+    def Init(logger:logging.Logger) -> None:
+        if AsyncWebStreamEngine.SelectedEngine != AsyncWebStreamEngine.c_EngineAsyncio:
+            return
+        try:
+            # pylint: disable=import-outside-toplevel,unused-import
+            import httpx #pyright: ignore[reportUnusedImport] # noqa: F401
+        except Exception as e:
+            logger.warning("The asyncio web stream engine was selected but httpx isn't available, so the threaded engine will be used. "+str(e))
+            return
+        # httpx logs every request at info, which would flood the plugin log.
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        AsyncWebStreamEngine._Instance = AsyncWebStreamEngine(logger)
+        logger.info("Web streams are using the asyncio engine.")
+
+
+    @staticmethod
+    def Get() -> Optional["AsyncWebStreamEngine"]:
+        return AsyncWebStreamEngine._Instance
+
+
+    @staticmethod
+    def SetSelectedEngine(engine:str) -> None:
+        AsyncWebStreamEngine.SelectedEngine = engine.lower()
+
+
+    # Returns the engine if it's selected and has been setup, otherwise None.
+    @staticmethod
+    def GetIfEnabled() -> Optional["AsyncWebStreamEngine"]:
+        if AsyncWebStreamEngine.SelectedEngine != AsyncWebStreamEngine.c_EngineAsyncio:
+            return None
+        return AsyncWebStreamEngine._Instance
+
+
+    def __init__(self, logger:logging.Logger) -> None:
+        self.Logger = logger
+        self.HttpClient:Any = None
+        self.RequestStartSemaphore:Optional[asyncio.Semaphore] = None
+        self.Loop = asyncio.new_event_loop()
+        self.LoopThread = threading.Thread(target=self._LoopThreadWorker, name="AsyncWebStreamEngine", daemon=True)
+        self.LoopThread.start()
+
+        # Stats
+        self.StatsLock = threading.Lock()
+        self.ActiveStreams = 0
+        self.PeakActiveStreams = 0
+        self.TotalAsyncRequests = 0
+        self.TotalHandedOff = 0
+
+
+    # Creates a new web stream that runs on this engine.
+    # Called from the main websocket receive thread, so this must not block.
+    def CreateWebStream(self, logger:logging.Logger, streamId:int, octoSession:IOctoSession) -> "AsyncOctoWebStream":
+        stream = AsyncOctoWebStream(self, logger, streamId, octoSession)
+        self.Loop.call_soon_threadsafe(stream.StartOnLoop)
+        return stream
+
+
+    # Must be called on the loop.
+    def GetRequestStartSemaphore(self) -> asyncio.Semaphore:
+        if self.RequestStartSemaphore is None:
+            self.RequestStartSemaphore = asyncio.Semaphore(AsyncWebStreamEngine.c_MaxConcurrentRequestStarts)
+        return self.RequestStartSemaphore
+
+
+    # Must be called on the loop. The client is made on the loop so all of its resources are bound to it.
+    def GetHttpClient(self) -> Any:
+        if self.HttpClient is None:
+            # pylint: disable=import-outside-toplevel
+            import httpx
+            # Like the threaded engine, we use a long timeout because some api calls can hang for a while, and verify is off since local servers are usually self-signed.
+            self.HttpClient = httpx.AsyncClient(
+                verify=False,
+                trust_env=False,
+                timeout=httpx.Timeout(1800.0, connect=10.0),
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=MemoryManager.OctoWebStream_MaxWorkerPoolThreads),
+            )
+        return self.HttpClient
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        with self.StatsLock:
+            return {
+                "ActiveStreams": self.ActiveStreams,
+                "PeakActiveStreams": self.PeakActiveStreams,
+                "TotalAsyncRequests": self.TotalAsyncRequests,
+                "TotalHandedOff": self.TotalHandedOff,
+            }
+
+
+    def OnStreamStarted(self) -> None:
+        with self.StatsLock:
+            self.ActiveStreams += 1
+            if self.ActiveStreams > self.PeakActiveStreams:
+                self.PeakActiveStreams = self.ActiveStreams
+
+
+    def OnStreamDone(self, wasHandedOff:bool) -> None:
+        with self.StatsLock:
+            self.ActiveStreams -= 1
+            if wasHandedOff:
+                self.TotalHandedOff += 1
+            else:
+                self.TotalAsyncRequests += 1
+
+
+    def _LoopThreadWorker(self) -> None:
+        asyncio.set_event_loop(self.Loop)
+        try:
+            self.Loop.run_forever()
+        except Exception as e:
+            Sentry.OnException("Async web stream engine loop exited with an exception.", e)
+
+
+#
+# A web stream that runs on the AsyncWebStreamEngine.
+#
+# It owns a normal OctoWebStream, which is used for the stream state, sending, and closing, so both engines behave exactly the same to the server.
+# That stream is never started unless this request needs to be handed off, in which case it's started and given all of the messages in order.
+#
+class AsyncOctoWebStream(IWebStream):
+
+    def __init__(self, engine:AsyncWebStreamEngine, logger:logging.Logger, streamId:int, octoSession:IOctoSession) -> None:
+        self.Engine = engine
+        self.Logger = logger
+        self.Id = streamId
+        self.OpenedTime = time.time()
+        self.Stream = OctoWebStream(name="OctoWebStreamPumper", args=(logger, streamId, octoSession))
+
+        # Incoming messages are queued here until the coroutine takes them or the stream is handed off.
+        self.Lock = threading.Lock()
+        self.PendingMsgs:Deque[WebStreamMsg.WebStreamMsg] = collections.deque()
+        self.IsHandedOff = False
+        self.MsgReadyEvent:Optional[asyncio.Event] = None
+        self.Task:Optional["asyncio.Task[None]"] = None
+        # The request headers, once they have been built.
+        self.PreparedSendHeaders:Optional[Dict[str, str]] = None
+
+
+    @property
+    def IsClosed(self) -> bool:
+        return self.Stream.IsClosed
+
+
+    # Called on the main websocket receive thread, so this must not block.
+    def OnIncomingServerMessage(self, webStreamMsg:WebStreamMsg.WebStreamMsg) -> None:
+        with self.Lock:
+            if self.IsHandedOff is False and webStreamMsg.IsCloseMsg() is False:
+                self.PendingMsgs.append(webStreamMsg)
+                self.Engine.Loop.call_soon_threadsafe(self._WakeOnLoop)
+                return
+        # If we have been handed off, the stream handles everything. For close messages, the stream will set the state and close.
+        self.Stream.OnIncomingServerMessage(webStreamMsg)
+        self.Engine.Loop.call_soon_threadsafe(self._WakeOnLoop)
+
+
+    # Called from the main websocket receive thread, so it must not block.
+    def Close(self) -> None:
+        self.Stream.Close()
+        self.Engine.Loop.call_soon_threadsafe(self._WakeOnLoop)
+
+
+    def SendToOctoStream(self, buffer:Buffer, msgStartOffsetBytes:int, msgSize:int, isCloseFlagSet:bool=False, silentlyFail:bool=False) -> None:
+        self.Stream.SendToOctoStream(buffer, msgStartOffsetBytes, msgSize, isCloseFlagSet, silentlyFail)
+
+
+    def SetClosedDueToFailedRequestConnection(self) -> None:
+        self.Stream.SetClosedDueToFailedRequestConnection()
+
+
+    # Runs on the loop.
+    def StartOnLoop(self) -> None:
+        self.MsgReadyEvent = asyncio.Event()
+        self.Task = self.Engine.Loop.create_task(self._Run())
+
+
+    # Runs on the loop. If the stream was closed while the request is running, this cancels it, so we don't wait on the next body chunk.
+    def _WakeOnLoop(self) -> None:
+        if self.MsgReadyEvent is not None:
+            self.MsgReadyEvent.set()
+        if self.IsClosed and self.IsHandedOff is False and self.Task is not None and self.Task.done() is False:
+            self.Task.cancel()
+
+
+    async def _Run(self) -> None:
+        self.Engine.OnStreamStarted()
+        wasHandedOff = False
+        try:
+            openMsg = await self._GetNextMessageAsync()
+            if openMsg is None:
+                return
+            if openMsg.IsOpenMsg() is False:
+                # Throw so we reset the connection, like the threaded engine.
+                raise Exception("Web stream ["+str(self.Id)+"] got a non open message before it's open message.")
+            self.Stream.SendPriority = openMsg.MsgPriority()
+
+            # See if this is a request we can handle. If not, hand it off.
+            requestContext = self._TryGetAsyncRequestContext(openMsg)
+            if requestContext is None:
+                wasHandedOff = True
+                self._HandOff(openMsg)
+                return
+
+            # Make the request. If this returns false, the request needs the threaded logic.
+            if await self._ExecuteHttpRequestAsync(requestContext, openMsg) is False:
+                wasHandedOff = True
+                self._HandOff(openMsg)
+                return
+
+            # The request is done, close the stream. This will ensure the close message is sent, if it wasn't already.
+            await self._CloseStreamAsync()
+        except asyncio.CancelledError:
+            await self._CloseStreamAsync()
+        except Exception as e:
+            Sentry.OnException("Exception in async web stream ["+str(self.Id)+"].", e)
+            self.Stream.OctoSession.OnSessionError(0)
+        finally:
+            self.Engine.OnStreamDone(wasHandedOff)
+
+
+    # Closing the stream can send the close message, which is a blocking session send, so it's done on the executor.
+    async def _CloseStreamAsync(self) -> None:
+        await self.Engine.Loop.run_in_executor(None, self.Stream.Close)
+
+
+    async def _GetNextMessageAsync(self) -> Optional[WebStreamMsg.WebStreamMsg]:
+        msgReadyEvent = self.MsgReadyEvent
+        if msgReadyEvent is None:
+            raise Exception("Async web stream was run before it was started on the loop.")
+        while True:
+            if self.IsClosed:
+                return None
+            with self.Lock:
+                if len(self.PendingMsgs) > 0:
+                    return self.PendingMsgs.popleft()
+                msgReadyEvent.clear()
+            await msgReadyEvent.wait()
+
+
+    # Hands the stream off to the threaded engine. The open message and any pending messages are given to the stream in order.
+    def _HandOff(self, openMsg:WebStreamMsg.WebStreamMsg) -> None:
+        if self.IsClosed:
+            return
+        # If the worker pool is enabled, the stream must be on it before the messages are queued, so they schedule it.
+        workerPool = WebStreamWorkerPool.GetIfEnabled()
+        if workerPool is not None:
+            self.Stream.StartOnWorkerPool(workerPool)
+        self.Stream.HandOffSendHeaders = self.PreparedSendHeaders
+        # Hold the lock while we move the messages, so any new message on the receive thread waits and is queued after them.
+        with self.Lock:
+            self.IsHandedOff = True
+            self.Stream.OnIncomingServerMessage(openMsg)
+            while len(self.PendingMsgs) > 0:
+                self.Stream.OnIncomingServerMessage(self.PendingMsgs.popleft())
+        if workerPool is None:
+            self.Stream.start()
+
+
+    # Checks if the async engine can handle this request. If so, returns the context to make the request, otherwise None.
+    # This must match the checks OctoWebStreamHttpHelper.executeHttpRequest does before it makes a normal http call.
+    def _TryGetAsyncRequestContext(self, openMsg:WebStreamMsg.WebStreamMsg) -> Optional[AsyncHttpRequestContext]:
+        # Websockets and requests with an upload body always use the threaded engine.
+        if openMsg.IsWebsocketStream() or openMsg.IsControlFlagsOnly() or openMsg.IsDataTransmissionDone() is False or openMsg.DataLength() > 0:
+            return None
+        httpInitialContext = openMsg.HttpInitialContext()
+        if httpInitialContext is None:
+            return None
+        path = OctoStreamMsgBuilder.BytesToString(httpInitialContext.Path())
+        method = OctoStreamMsgBuilder.BytesToString(httpInitialContext.Method())
+        if path is None or method is None:
+            return None
+        pathType = httpInitialContext.PathType()
+
+        # If the relay is disabled, the threaded engine will close the stream correctly.
+        if OctoHttpRequest.GetDisableHttpRelay() and pathType != PathTypes.Absolute:
+            return None
+
+        # Build the headers, the same way the threaded engine does.
+        sendHeaders = HeaderHelper.GatherRequestHeaders(self.Logger, httpInitialContext, BaseProtocol.Http, self.Stream.OctoSession.GetNegotiatedFeatures())
+        localAuthHelper = Compat.GetLocalAuth()
+        if httpInitialContext.UseOctoeverywhereAuth() == OeAuthAllowed.OeAuthAllowed.Allow and localAuthHelper is not None:
+            localAuthHelper.AddAuthHeader(sendHeaders)
+        relayWebcamStreamDetector = Compat.GetRelayWebcamStreamDetector()
+        if relayWebcamStreamDetector is not None:
+            relayWebcamStreamDetector.OnIncomingRelayRequest(path, sendHeaders)
+        # From here on the request is handed off with these headers, so the threaded engine doesn't add the auth or run the detector again.
+        self.PreparedSendHeaders = sendHeaders
+
+        # Webcam, command, and Slipstream requests are all handled by the threaded engine.
+        webcamHelper = WebcamHelper.Get()
+        if webcamHelper is not None and webcamHelper.IsSnapshotOrWebcamStreamOracleRequest(sendHeaders):
+            return None
+        commandHandler = CommandHandler.Get()
+        if commandHandler is not None and commandHandler.IsCommandRequest(httpInitialContext):
+            return None
+        slipstream = Compat.GetSlipstream()
+        if slipstream is not None and slipstream.GetCachedOctoHttpResult(httpInitialContext) is not None:
+            return None
+
+        # If the response might need to be edited, use the threaded engine.
+        url = OctoHttpRequest.GetPrimaryUrl(path, pathType)
+        webRequestResponseHandler = Compat.GetWebRequestResponseHandler()
+        if webRequestResponseHandler is not None and webRequestResponseHandler.CheckIfResponseNeedsToBeHandled(url) is not None:
+            return None
+
+        # GatherRequestHeaders only allows an encoded response from the local server if compression pass through was negotiated,
+        # and we checked above that the response won't be edited.
+        return AsyncHttpRequestContext(method, url, sendHeaders, pathType)
+
+
+    # Makes the http request and streams the response back.
+    # Returns false if the request failed in a way that needs the threaded engine's fallback logic, before anything was sent.
+    async def _ExecuteHttpRequestAsync(self, requestContext:AsyncHttpRequestContext, openMsg:WebStreamMsg.WebStreamMsg) -> bool:
+        requestExecutionStart = time.time()
+        client = self.Engine.GetHttpClient()
+        try:
+            async with self.Engine.GetRequestStartSemaphore():
+                request = client.build_request(requestContext.Method, requestContext.Url, headers=requestContext.Headers)
+                response = await client.send(request, stream=True, follow_redirects=False)
+        except Exception as e:
+            self.Logger.debug("%s async http request failed, handing off. %s", self._GetLogMsgPrefix(), e)
+            return False
+        requestExecutionEnd = time.time()
+
+        try:
+            # The threaded engine handles the 404 and 431 retry logic. Multipart streams are also handed off, since they need the per frame reads.
+            if (response.status_code == 404 and requestContext.PathType == PathTypes.Relative) or response.status_code == 431:
+                return False
+
+            # Parse the headers like the threaded engine.
+            headers = self._GetResponseHeaders(response)
+            contentLength:Optional[int] = None
+            contentTypeLower:Optional[str] = None
+            contentEncodingLower:Optional[str] = None
+            ogLocationHeaderValue:Optional[str] = None
+            for name, value in list(headers.items()):
+                nameLower = name.lower()
+                if nameLower == "content-length":
+                    contentLength = int(value)
+                elif nameLower == "content-type":
+                    contentTypeLower = value.lower()
+                    if contentTypeLower.find("boundary=") != -1:
+                        return False
+                elif nameLower == "content-encoding":
+                    contentEncodingLower = value.lower()
+                elif nameLower == "location":
+                    ogLocationHeaderValue = value
+                    headers[name] = HeaderHelper.CorrectLocationResponseHeaderIfNeeded(self.Logger, requestContext.Url, value, requestContext.Headers)
+            if ogLocationHeaderValue is not None:
+                headers["x-og-location"] = ogLocationHeaderValue
+            TunnelPerfStats.OnResponseHeaders(requestContext.Url, contentTypeLower, requestExecutionEnd - requestExecutionStart)
+
+            hasBody = response.status_code != 304 and response.status_code != 204
+            # Like the threaded engine, a body the local server already encoded is forwarded as is.
+            negotiatedFeatures = self.Stream.OctoSession.GetNegotiatedFeatures()
+            isContentEncodingPassThrough = CompressionPassThrough.IsPassThroughContentEncoding(contentEncodingLower, negotiatedFeatures)
+            compressBody = hasBody and isContentEncodingPassThrough is False and OctoWebStreamHttpHelper.ShouldCompressContentType(contentTypeLower, contentLength)
+            readSizeBytes = MemoryManager.OctoWebStreamHttpHelper_DefaultBodyReadSizeBytes * (2 if compressBody else 1)
+
+            with CompressionContext(self.Logger) as compressionContext:
+                if contentLength is not None:
+                    compressionContext.SetTotalCompressedSizeOfData(contentLength)
+                compressionContext.SetContentType(contentTypeLower)
+                compressionContext.SetNegotiatedFeatures(negotiatedFeatures)
+
+                # Read the body as it arrives. For known lengths we batch up to the read size, for streams we send each chunk as soon as we get it.
+                # The raw bytes are the body, either because the response is identity or it's a pass through encoding.
+                sender = _AsyncResponseSender(self, response.status_code, headers, contentLength, compressBody, compressionContext, isContentEncodingPassThrough, contentTypeLower)
+                if hasBody:
+                    pending = bytearray()
+                    async for chunk in response.aiter_raw():
+                        if self.IsClosed:
+                            break
+                        pending += chunk
+                        if contentLength is None or len(pending) >= readSizeBytes:
+                            await sender.SendAsync(pending, False)
+                            pending = bytearray()
+                    if self.IsClosed is False and len(pending) > 0:
+                        await sender.SendAsync(pending, False)
+                # Make sure the last message is sent, even if there was no body.
+                if self.IsClosed is False and sender.HasSentLast is False:
+                    await sender.SendAsync(None, True)
+
+            # The body reads and sends are interleaved on the loop, so only the compression time is known on its own.
+            TunnelPerfStats.OnResponseComplete(requestContext.Url, contentTypeLower, None, sender.CompressionTimeSec if sender.CompressionType is not None else None, None)
+
+            if self.Logger.isEnabledFor(logging.DEBUG):
+                self.Logger.debug(
+                    "%s%s [upload:%ss; request_exe:%ss; send:%ss; compress:%ss] [async] size:(%s->%s) compressed:%s msgcount:%s type:%s status:%s for %s",
+                    self._GetLogMsgPrefix(),
+                    requestContext.Method,
+                    format(requestExecutionStart - self.OpenedTime, ".3f"),
+                    format(requestExecutionEnd - requestExecutionStart, ".3f"),
+                    format(time.time() - requestExecutionEnd, ".3f"),
+                    format(sender.CompressionTimeSec, ".3f"),
+                    sender.NonCompressedBytes,
+                    sender.SentBytes,
+                    sender.CompressBody,
+                    sender.MessageCount,
+                    contentTypeLower,
+                    response.status_code,
+                    requestContext.Url,
+                )
+            return True
+        finally:
+            await response.aclose()
+
+
+    # Returns the response headers with their original case. Like the requests lib, repeated headers are joined with a comma.
+    def _GetResponseHeaders(self, response:Any) -> Dict[str, str]:
+        headers:Dict[str, str] = {}
+        lowerToName:Dict[str, str] = {}
+        encoding = response.headers.encoding
+        for rawName, rawValue in response.headers.raw:
+            name = rawName.decode(encoding)
+            value = rawValue.decode(encoding)
+            nameLower = name.lower()
+            existingName = lowerToName.get(nameLower, None)
+            if existingName is not None:
+                headers[existingName] = headers[existingName] + ", " + value
+                continue
+            lowerToName[nameLower] = name
+            headers[name] = value
+        return headers
+
+
+    def _GetLogMsgPrefix(self) -> str:
+        return "Web Stream async http ["+str(self.Id)+"] "
+
+
+# Builds and sends the response messages for an async request.
+# Compression can take a while, so it's run on the loop's executor so it never blocks the other streams.
+class _AsyncResponseSender:
+
+    def __init__(self, stream:AsyncOctoWebStream, statusCode:int, headers:Dict[str, str], contentLength:Optional[int], compressBody:bool, compressionContext:CompressionContext, isContentEncodingPassThrough:bool=False, contentTypeLower:Optional[str]=None) -> None:
+        self.Stream = stream
+        self.StatusCode = statusCode
+        self.Headers = headers
+        self.ContentLength = contentLength
+        self.CompressBody = compressBody
+        self.CompressionContext = compressionContext
+        self.IsContentEncodingPassThrough = isContentEncodingPassThrough
+        self.ContentTypeLower = contentTypeLower
+        self.CompressionType:Optional[int] = None
+        self.CompressionTimeSec = 0.0
+        self.IsFirstMessage = True
+        self.HasSentLast = False
+        self.NonCompressedBytes = 0
+        self.SentBytes = 0
+        self.MessageCount = 0
+
+
+    async def SendAsync(self, data:Optional[bytearray], isLastMessage:bool) -> None:
+        loop = self.Stream.Engine.Loop
+        nonCompressedSize = 0 if data is None else len(data)
+        self.NonCompressedBytes += nonCompressedSize
+        if self.ContentLength is not None and self.NonCompressedBytes >= self.ContentLength:
+            isLastMessage = True
+
+        # Like the threaded engine, if compression isn't making the data smaller, turn it off for the rest of the stream.
+        if self.CompressBody and self.NonCompressedBytes > nonCompressedSize and self.SentBytes > (self.NonCompressedBytes - nonCompressedSize) * 0.9:
+            self.CompressBody = False
+
+        # If the first message has no data, there's nothing compressed.
+        if self.IsFirstMessage and nonCompressedSize == 0:
+            self.CompressBody = False
+
+        # Like the threaded engine, if the first data we would compress isn't compressible, don't compress the stream at all.
+        if self.CompressBody and self.CompressionType is None and data is not None and nonCompressedSize > 0 and Compressibility.IsCompressible(data, self.ContentTypeLower) is False:
+            self.CompressBody = False
+
+        dataBuffer:Optional[Buffer] = None
+        compressThisMessage = self.CompressBody and data is not None and nonCompressedSize > 0
+        if data is not None and nonCompressedSize > 0:
+            dataBuffer = Buffer(data)
+            if compressThisMessage:
+                compressionResult = await loop.run_in_executor(None, Compression.Get().Compress, self.CompressionContext, dataBuffer)
+                dataBuffer = compressionResult.Bytes
+                self.CompressionTimeSec += compressionResult.CompressionTimeSec
+                if self.CompressionType is None:
+                    self.CompressionType = compressionResult.CompressionType
+                elif self.CompressionType != compressionResult.CompressionType:
+                    raise Exception(f"The data compression has changed mid stream! It was {self.CompressionType} and now tried to be {compressionResult.CompressionType}")
+
+        buffer, msgStartOffsetBytes, msgSizeBytes = self._BuildMessage(dataBuffer, nonCompressedSize, isLastMessage)
+        self.SentBytes += 0 if dataBuffer is None else len(dataBuffer)
+        self.MessageCount += 1
+        self.IsFirstMessage = False
+        if isLastMessage:
+            self.HasSentLast = True
+        # The session send can block when the websocket is backed up, so it's done on the executor and the loop keeps running the other streams.
+        # The send is awaited, so the messages of this stream are still sent in order.
+        await loop.run_in_executor(None, self.Stream.SendToOctoStream, buffer, msgStartOffsetBytes, msgSizeBytes, isLastMessage, True)
+
+
+    def _BuildMessage(self, dataBuffer:Optional[Buffer], nonCompressedSize:int, isLastMessage:bool) -> Any:
+        builderContext = MsgBuilderContext()
+        builderContext.CreateBuilder(0 if dataBuffer is None else len(dataBuffer))
+        builder:octoflatbuffers.Builder = builderContext.Builder #pyright: ignore[reportAssignmentType]
+        dataOffset:Optional[int] = None
+        if dataBuffer is not None:
+            SendCopyStats.OnCopy(len(dataBuffer))
+            dataOffset = builder.CreateByteVector(dataBuffer.GetBytesLike()) #pyright: ignore[reportUnknownMemberType]
+
+        httpInitialContextOffset:Optional[int] = None
+        if self.IsFirstMessage:
+            headerVectorOffset = OctoWebStreamHttpHelper.BuildHeaderVectorFromDict(builder, self.Headers)
+            HttpInitialContext.Start(builder)
+            if headerVectorOffset is not None:
+                HttpInitialContext.AddHeaders(builder, headerVectorOffset)
+            httpInitialContextOffset = HttpInitialContext.End(builder)
+
+        WebStreamMsg.Start(builder)
+        WebStreamMsg.AddStreamId(builder, self.Stream.Id)
+        WebStreamMsg.AddIsControlFlagsOnly(builder, False)
+        if self.IsFirstMessage:
+            WebStreamMsg.AddStatusCode(builder, self.StatusCode)
+        if dataOffset is not None:
+            WebStreamMsg.AddData(builder, dataOffset)
+        if httpInitialContextOffset is not None:
+            WebStreamMsg.AddHttpInitialContext(builder, httpInitialContextOffset)
+        if self.IsFirstMessage and self.ContentLength is not None:
+            WebStreamMsg.AddFullStreamDataSize(builder, self.ContentLength)
+        if self.IsFirstMessage and self.IsContentEncodingPassThrough:
+            WebStreamMsg.AddIsContentEncodingPassThrough(builder, True)
+        # Like the threaded engine, once the stream is compressed every message is flagged, even the empty last message.
+        if self.CompressBody and self.CompressionType is not None:
+            WebStreamMsg.AddDataCompression(builder, self.CompressionType)
+            WebStreamMsg.AddOriginalDataSize(builder, nonCompressedSize)
+        if isLastMessage:
+            WebStreamMsg.AddIsDataTransmissionDone(builder, True)
+            WebStreamMsg.AddIsCloseMsg(builder, True)
+        webStreamMsgOffset = WebStreamMsg.End(builder)
+        return OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, MessageContext.MessageContext.WebStreamMsg, webStreamMsgOffset)
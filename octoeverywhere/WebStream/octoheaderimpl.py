@@ -5,6 +5,8 @@ from typing import Dict, Optional, List
 from ..sentry import Sentry
 from ..octostreammsgbuilder import OctoStreamMsgBuilder
 from ..octohttprequest import OctoHttpRequest
+from ..compressionpassthrough import CompressionPassThrough
+from ..negotiatedfeatures import NegotiatedFeatures
 
 from ..Proto.PathTypes import PathTypes
 from ..Proto.HttpInitialContext import HttpInitialContext
@@ -23,14 +25,16 @@ class HeaderHelper:
     c_xForwardedForForHeaderName = "X-Forwarded-For"
 
     # Called by slipstream and the main http class to gather and add required headers.
+    # negotiatedFeatures are the features the server of the request's session accepted, if there's no session, none are used.
     @staticmethod
-    def GatherRequestHeaders(logger:logging.Logger, httpInitialContext:Optional[HttpInitialContext], protocol:BaseProtocol) -> Dict[str, str]:
+    def GatherRequestHeaders(logger:logging.Logger, httpInitialContext:Optional[HttpInitialContext], protocol:BaseProtocol, negotiatedFeatures:Optional[NegotiatedFeatures]=None) -> Dict[str, str]:
 
         # Get the correct host address for this request type.
         hostAddress = HeaderHelper._HostHostAddress(logger, httpInitialContext)
 
         # Get the count of headers in the message.
         sendHeaders:Dict[str,str] = {}
+        clientAcceptEncodingLower:Optional[str] = None
         if httpInitialContext is not None:
             headersLen = httpInitialContext.HeadersLength()
             # Convert each header and fix them up.
@@ -56,6 +60,8 @@ class HeaderHelper:
                 if lowerName == "accept-encoding":
                     # We don't want to accept encoding because it's just a waste of CPU to send over
                     # local host. We will do our own encoding when we send the data over the websocket.
+                    # The only exception is compression pass through, which needs to know what the client accepts.
+                    clientAcceptEncodingLower = value.lower()
                     continue
                 if lowerName == "transfer-encoding":
                     # We don't want to send the transfer encoding since it' won't be accurate any longer.
@@ -129,10 +135,12 @@ class HeaderHelper:
         # We exclude this from being set above, but even more so, we want to define it as empty.
         # If we exclude it, the py request lib seems to add it by itself.
         # We don't want to mess with encoding, because doing to encoding over local host is a waste of time.
+        # The exception is if compression pass through was negotiated with the session's server, then we accept the encodings the
+        # client also accepts, and the already encoded body is forwarded as is.
         #
         # Note this header is also force set in MakeHttpCall, because calls to things like camera-streamer must set it
-        # and no users of the MakeHttpCall support handing response compression.
-        sendHeaders["Accept-Encoding"] = "identity"
+        # and no users of the MakeHttpCall support handing response compression. Only the OctoStream helper opts out.
+        sendHeaders["Accept-Encoding"] = CompressionPassThrough.GetAcceptEncodingHeaderValue(clientAcceptEncodingLower, negotiatedFeatures)
         return sendHeaders
 
 
@@ -2,14 +2,16 @@ import time
 import queue
 import threading
 import logging
-from typing import Any, Optional
+from typing import Any, Dict, Optional
 
 from ..buffer import Buffer
 from ..sentry import Sentry
 from ..interfaces import IOctoSession, IWebStream
+from ..memorymanager import MemoryManager
 from ..octostreammsgbuilder import OctoStreamMsgBuilder
 from .octowebstreamhttphelper import OctoWebStreamHttpHelper
 from .octowebstreamwshelper import OctoWebStreamWsHelper
+from .webstreamworkerpool import WebStreamWorkerPool
 from ..Proto import WebStreamMsg
 from ..Proto.MessageContext import MessageContext
 from ..Proto.MessagePriority import MessagePriority
@@ -22,6 +24,21 @@ class OctoWebStream(threading.Thread, IWebStream):
 
     c_MaxIncomingMessagesQueued = 16
 
+    # If enabled, incoming messages over the message count limit are queued up to a per stream byte cutoff instead of blocking the receive thread.
+    # A stream that's slow to process its messages only queues its own messages, so all other streams and the webcam keep flowing.
+    # This is not flow control, the protocol has no way to tell the server to slow down a single stream, so the server keeps sending.
+    # The receive thread never blocks, so if a single stream queues more than MemoryManager.OctoWebStream_IncomingOverflowCutoffBytes, the stream is closed.
+    # This is off by default, since it closes slow streams (like a large upload to a slow backend) that the legacy logic would wait on.
+    UseIncomingOverflowCutoff = False
+
+    @staticmethod
+    def SetUseIncomingOverflowCutoff(enable:bool) -> None:
+        OctoWebStream.UseIncomingOverflowCutoff = enable
+
+    @staticmethod
+    def GetUseIncomingOverflowCutoff() -> bool:
+        return OctoWebStream.UseIncomingOverflowCutoff
+
     # Created when an open message is sent for a new web stream from the server.
     def __init__(self, group:Any=None, target:Any=None, name:Any=None, args:Any=(), kwargs:Any=None, verbose:Any=None) -> None:
         threading.Thread.__init__(self, group=group, target=target, name=name)
@@ -38,6 +55,22 @@ class OctoWebStream(threading.Thread, IWebStream):
         self.IsHelperClosed = False
         self.OpenedTime = time.time()
         self.ClosedDueToRequestConnectionError = False
+        # Set by the async engine when it hands off a request, these are the request headers it already built.
+        self.HandOffSendHeaders:Optional[Dict[str, str]] = None
+
+        # Vars for the incoming message queue limits.
+        self.IncomingQueueLock = threading.Lock()
+        self.IncomingQueuedBytes = 0
+        self.IncomingParkedMessageCount = 0
+        self.IncomingOverflowCutoffCount = 0
+
+        # Set if this stream is running on the worker pool rather than its own thread.
+        self.WorkerPool:Optional[WebStreamWorkerPool] = None
+        self.IsScheduledOnWorkerPool = False
+        self.WorkerPoolPriority:int = MessagePriority.Normal
+
+        # The priority of the stream's open message, which is used to schedule the messages this stream sends.
+        self.SendPriority:int = MessagePriority.Normal
 
         # Vars for high pri streams
         self.IsHighPriStream = False
@@ -70,6 +103,10 @@ class OctoWebStream(threading.Thread, IWebStream):
             # Call close.
             # This can never block or it will hang the entire main websocket connection.
             self.Close()
+        elif OctoWebStream.UseIncomingOverflowCutoff:
+            # Use the per stream overflow cutoff, which never blocks the receive thread.
+            self.queueIncomingMessageWithOverflowCutoff(webStreamMsg)
+            self.scheduleOnWorkerPoolIfNeeded(webStreamMsg)
         else:
             # Otherwise, put the message into the queue, so the thread will pick it up.
             # We can't let the queue grow without bound, but we also can't block this main thread forever.
@@ -85,7 +122,51 @@ class OctoWebStream(threading.Thread, IWebStream):
                     return
                 self.Logger.debug("Web stream is sleeping because the incoming message queue has %d messages queued, which is over the limit of %d. Attempt #%d.", self.MsgQueue.qsize(), OctoWebStream.c_MaxIncomingMessagesQueued, attempt)
                 time.sleep(0.1)
+            with self.IncomingQueueLock:
+                self.IncomingQueuedBytes += webStreamMsg.DataLength()
             self.MsgQueue.put(webStreamMsg)
+            self.scheduleOnWorkerPoolIfNeeded(webStreamMsg)
+
+
+    # Queues an incoming message using the per stream overflow cutoff.
+    # Under the message count limit, this is the same as the legacy logic. Over the count limit, the message is parked in this stream's queue
+    # as long as the stream is under the cutoff, so the receive thread can move on to other streams right away.
+    # If the stream is over the cutoff, it's not keeping up with what the server is sending, so it's closed rather than blocking the
+    # receive thread, which would stall every other stream on the tunnel.
+    def queueIncomingMessageWithOverflowCutoff(self, webStreamMsg:WebStreamMsg.WebStreamMsg) -> None:
+        msgSizeBytes = webStreamMsg.DataLength()
+        isOverCutoff = False
+        with self.IncomingQueueLock:
+            if self.MsgQueue.qsize() >= OctoWebStream.c_MaxIncomingMessagesQueued:
+                # Always allow a message in if nothing is queued, or a single large message could never fit.
+                if self.IncomingQueuedBytes > 0 and self.IncomingQueuedBytes + msgSizeBytes > MemoryManager.OctoWebStream_IncomingOverflowCutoffBytes:
+                    self.IncomingOverflowCutoffCount += 1
+                    isOverCutoff = True
+                else:
+                    self.IncomingParkedMessageCount += 1
+            if isOverCutoff is False:
+                self.IncomingQueuedBytes += msgSizeBytes
+                self.MsgQueue.put(webStreamMsg)
+
+        # Close out of the lock, since close takes other locks.
+        if isOverCutoff:
+            self.Logger.warning("Web stream %s has %d bytes of incoming messages queued, which is over the cutoff of %d. Closing the stream.", self.Id, self.IncomingQueuedBytes, MemoryManager.OctoWebStream_IncomingOverflowCutoffBytes)
+            self.Close()
+
+
+    # Gets the next incoming message from the queue, or None on a timeout or wake up.
+    # This also removes the message's bytes from the queued byte count.
+    def getNextIncomingMessage(self, timeoutSec:float) -> Optional[WebStreamMsg.WebStreamMsg]:
+        webStreamMsg:Optional[WebStreamMsg.WebStreamMsg] = None
+        try:
+            webStreamMsg = self.MsgQueue.get(timeout=timeoutSec)
+        except Exception as _:
+            # We get this exception on the timeout.
+            return None
+        if webStreamMsg is not None:
+            with self.IncomingQueueLock:
+                self.IncomingQueuedBytes -= webStreamMsg.DataLength()
+        return webStreamMsg
 
 
     # Closes the web stream and all related elements.
@@ -167,14 +248,8 @@ class OctoWebStream(threading.Thread, IWebStream):
 
             # Wait on incoming messages
             # Timeout after 60 seconds just to check that we aren't closed.
-            # It's important to set this value to None, otherwise on loops it will hold it's old value
-            # which can accidentally re-process old messages.
-            webStreamMsg:Optional[WebStreamMsg.WebStreamMsg] = None
-            try:
-                webStreamMsg = self.MsgQueue.get(timeout=60)
-            except Exception as _:
-                # We get this exception on the timeout.
-                pass
+            # This returns None on the timeout, so we never re-process an old message.
+            webStreamMsg = self.getNextIncomingMessage(60)
 
             # Check that we aren't closed (under lock for thread safety)
             with self.StateLock:
@@ -185,46 +260,102 @@ class OctoWebStream(threading.Thread, IWebStream):
             if webStreamMsg is None:
                 continue
 
-            # Handle the message.
-            if webStreamMsg.IsOpenMsg():
-                self.initFromOpenMessage(webStreamMsg)
+            # Handle the message, if this returns true the stream is done.
+            if self.processIncomingMessage(webStreamMsg):
+                return
 
-            # Ensure we have an open message.
-            if self.OpenWebStreamMsg is None:
-                # Throw so we reset the connection.
-                raise Exception("Web stream ["+str(self.Id)+"] got a non open message before it's open message.")
 
-            # Don't pass it to the helper if there's nothing more.
-            if webStreamMsg.IsControlFlagsOnly():
-                continue
+    # Handles a single message from the queue.
+    # Returns true if the stream has been closed and no more messages should be processed.
+    def processIncomingMessage(self, webStreamMsg:WebStreamMsg.WebStreamMsg) -> bool:
+        # Handle the message.
+        if webStreamMsg.IsOpenMsg():
+            self.initFromOpenMessage(webStreamMsg)
+
+        # Ensure we have an open message.
+        if self.OpenWebStreamMsg is None:
+            # Throw so we reset the connection.
+            raise Exception("Web stream ["+str(self.Id)+"] got a non open message before it's open message.")
+
+        # Don't pass it to the helper if there's nothing more.
+        if webStreamMsg.IsControlFlagsOnly():
+            return False
+
+        # Allow the helper to process the message
+        # We should only ever have one, but just for safety, check both.
+        # We need to take a local reference, since they are cleared under lock on close.
+        returnValue = True
+        httpHelper = self.HttpHelper
+        wsHelper = self.WsHelper
+        if httpHelper is not None:
+            returnValue = httpHelper.IncomingServerMessage(webStreamMsg)
+        if wsHelper is not None:
+            returnValue = wsHelper.IncomingServerMessage(webStreamMsg)
+
+        # If process server message returns true, we should close the stream.
+        if returnValue is True:
+            self.Close()
+            return True
+
+        # When the http helper sends messages, it can indicate that the close flag has been set.
+        # In such a case, self.HasSentCloseMessage will be true. We don't want to rely on the client
+        # returning the correct returnValue, so if we see that we will call close to make sure things
+        # are going down. Since Close() is guarded against multiple entries, this is totally fine.
+        # Check under lock for thread safety.
+        with self.StateLock:
+            shouldClose = self.HasSentCloseMessage is True and self.IsClosed is False
+        if shouldClose:
+            self.Logger.warning("Web stream "+str(self.Id)+" processed a message and has sent a close message, but didn't call close on the web stream. Closing now.")
+            self.Close()
+            return True
+        return False
 
-            # Allow the helper to process the message
-            # We should only ever have one, but just for safety, check both.
-            # We need to take a local reference, since they are cleared under lock on close.
-            returnValue = True
-            httpHelper = self.HttpHelper
-            wsHelper = self.WsHelper
-            if httpHelper is not None:
-                returnValue = httpHelper.IncomingServerMessage(webStreamMsg)
-            if wsHelper is not None:
-                returnValue = wsHelper.IncomingServerMessage(webStreamMsg)
 
-            # If process server message returns true, we should close the stream.
-            if returnValue is True:
-                self.Close()
+    # Used instead of start() to run this stream on the worker pool rather than its own thread.
+    # The stream is scheduled on the pool each time it gets messages and runs until its queue is empty.
+    def StartOnWorkerPool(self, workerPool:WebStreamWorkerPool) -> None:
+        self.WorkerPool = workerPool
+
+
+    # If this stream is running on the worker pool, ensure it's scheduled to process its queued messages.
+    def scheduleOnWorkerPoolIfNeeded(self, webStreamMsg:WebStreamMsg.WebStreamMsg) -> None:
+        workerPool = self.WorkerPool
+        if workerPool is None:
+            return
+        # The open message is always the first message, and it sets the priority for the stream.
+        if webStreamMsg.IsOpenMsg():
+            self.WorkerPoolPriority = webStreamMsg.MsgPriority()
+        with self.StateLock:
+            if self.IsScheduledOnWorkerPool or self.IsClosed:
                 return
+            self.IsScheduledOnWorkerPool = True
+            workerPool.Schedule(self.WorkerPoolPriority, self.workerPoolRun)
 
-            # When the http helper sends messages, it can indicate that the close flag has been set.
-            # In such a case, self.HasSentCloseMessage will be true. We don't want to rely on the client
-            # returning the correct returnValue, so if we see that we will call close to make sure things
-            # are going down. Since Close() is guarded against multiple entries, this is totally fine.
-            # Check under lock for thread safety.
+
+    # Runs on a worker pool thread, processes messages until the queue is empty.
+    def workerPoolRun(self) -> None:
+        try:
+            while True:
+                with self.StateLock:
+                    if self.IsClosed:
+                        self.IsScheduledOnWorkerPool = False
+                        return
+                webStreamMsg = self.getNextIncomingMessage(0)
+                if webStreamMsg is None:
+                    # If the queue is still empty under lock, we are done until the next message schedules us again.
+                    # If a message was added before we took the lock, we need to keep going since it didn't schedule us.
+                    with self.StateLock:
+                        if self.MsgQueue.empty():
+                            self.IsScheduledOnWorkerPool = False
+                            return
+                    continue
+                if self.processIncomingMessage(webStreamMsg):
+                    return
+        except Exception as e:
             with self.StateLock:
-                shouldClose = self.HasSentCloseMessage is True and self.IsClosed is False
-            if shouldClose:
-                self.Logger.warning("Web stream "+str(self.Id)+" processed a message and has sent a close message, but didn't call close on the web stream. Closing now.")
-                self.Close()
-                return
+                self.IsScheduledOnWorkerPool = False
+            Sentry.OnException("Exception in web stream ["+str(self.Id)+"] worker pool run.", e)
+            self.OctoSession.OnSessionError(0)
 
 
     def initFromOpenMessage(self, webStreamMsg:WebStreamMsg.WebStreamMsg) -> None:
@@ -235,6 +366,7 @@ class OctoWebStream(threading.Thread, IWebStream):
 
         # Set the message.
         self.OpenWebStreamMsg = webStreamMsg
+        self.SendPriority = webStreamMsg.MsgPriority()
 
         # Check if this is high pri, if so, tell them system a high pri is active
         if self.OpenWebStreamMsg.MsgPriority() < MessagePriority.Normal:
@@ -248,9 +380,9 @@ class OctoWebStream(threading.Thread, IWebStream):
         httpHelper = None
         wsHelper = None
         if webStreamMsg.IsWebsocketStream():
-            wsHelper = OctoWebStreamWsHelper(self.Id, self.Logger, self, self.OpenWebStreamMsg, self.OpenedTime)
+            wsHelper = OctoWebStreamWsHelper(self.Id, self.Logger, self, self.OpenWebStreamMsg, self.OpenedTime, self.OctoSession.GetNegotiatedFeatures())
         else:
-            httpHelper = OctoWebStreamHttpHelper(self.Id, self.Logger, self, self.OpenWebStreamMsg, self.OpenedTime)
+            httpHelper = OctoWebStreamHttpHelper(self.Id, self.Logger, self, self.OpenWebStreamMsg, self.OpenedTime, self.OctoSession.GetNegotiatedFeatures(), self.HandOffSendHeaders)
 
         needsToCallCloseOnHelper = False
         with self.StateLock:
@@ -284,14 +416,17 @@ class OctoWebStream(threading.Thread, IWebStream):
             if self.IsClosed is True:
                 # The only reason we are allowed to send after a close is if we are sending the
                 # close flag message.
+                # If the message isn't sent, let the owner of the buffer know it's no longer being used.
                 if isCloseFlagSet is False:
                     self.Logger.info("Web Stream "+str(self.Id) + " tried to send a message after close.")
+                    buffer.OnSendComplete()
                     return
                 else:
                     # We can only send one close flag, so only allow this to send if we haven't sent yet.
                     if self.HasSentCloseMessage:
                         if silentlyFail is False:
                             self.Logger.warning("Web Stream "+str(self.Id)+" tried to send a close message after a close message was already sent")
+                        buffer.OnSendComplete()
                         return
 
             # No matter what, if the close flag is set, set the has sent now.
@@ -300,7 +435,7 @@ class OctoWebStream(threading.Thread, IWebStream):
 
         # Send now
         try:
-            self.OctoSession.Send(buffer, msgStartOffsetBytes, msgSize)
+            self.OctoSession.Send(buffer, msgStartOffsetBytes, msgSize, self.Id, self.SendPriority)
         except Exception as e:
             Sentry.OnException("Web stream "+str(self.Id)+ " failed to send a message to the OctoStream.", e)
 
@@ -1,12 +1,16 @@
+import os
 import time
 import logging
-from typing import Any, Dict, List, Optional, Tuple
+import threading
+from urllib.parse import urlsplit
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
 
 import requests
 import urllib3
 import octoflatbuffers
 
-from .uploadbody import UploadBody
+from .uploadbody import StreamingUploadBody, UploadBody
+from .octowebstreamhttppipeline import HttpBodyPipeline
 from .octoheaderimpl import HeaderHelper
 from .octoheaderimpl import BaseProtocol
 from ..octohttprequest import OctoHttpRequest
@@ -14,7 +18,12 @@ from ..octostreammsgbuilder import OctoStreamMsgBuilder
 from ..Webcam.webcamhelper import WebcamHelper
 from ..commandhandler import CommandHandler
 from ..compression import Compression, CompressionContext
+from ..compressionpassthrough import CompressionPassThrough
+from ..negotiatedfeatures import NegotiatedFeatures
+from ..compressibility import Compressibility
 from ..memorymanager import MemoryManager
+from ..sendbufferpool import SendBufferPool, SendCopyStats
+from ..tunnelperfstats import TunnelPerfStats
 from ..sentry import Sentry
 from ..compat import Compat
 from ..Proto import HttpHeader
@@ -42,9 +51,88 @@ class MsgBuilderContext:
 
     def __init__(self):
         self.Builder:Optional[octoflatbuffers.Builder] = None
+        self.InitialBufferSizeBytes = 0
+        # If set, the builder was created on this buffer from the SendBufferPool.
+        self.PooledBuffer:Optional[Buffer] = None
 
+    # Creates the builder. If the message is large enough and the pool is enabled, the builder uses a pooled buffer.
     def CreateBuilder(self, knownBodySizeBytes = 0):
-        self.Builder = octoflatbuffers.Builder(knownBodySizeBytes + self.c_MsgStreamOverheadSize)
+        self.InitialBufferSizeBytes = knownBodySizeBytes + self.c_MsgStreamOverheadSize
+        pool = SendBufferPool.GetIfEnabled()
+        if pool is None or self.InitialBufferSizeBytes < SendBufferPool.c_MinClassSizeBytes:
+            self.Builder = octoflatbuffers.Builder(self.InitialBufferSizeBytes)
+            return
+        # The builder writes from the back of the buffer, so it can use all of the class size buffer.
+        # Any padding the builder needs is explicitly written, so it's fine the pooled buffer isn't cleared.
+        self.PooledBuffer = pool.Rent(self.InitialBufferSizeBytes)
+        pooledByteArray = self.PooledBuffer.ForceAsByteArray()
+        builder = octoflatbuffers.Builder(0)
+        builder.Bytes = pooledByteArray
+        builder.head = len(pooledByteArray)
+        self.Builder = builder
+
+    # Reads the body directly into the data vector of the message, so the body is never copied.
+    # This must be the first thing written to the builder, because the data vector must be at the end of the buffer.
+    # The readInto function is given the target buffer, the offset, and the max read size and must return the number of bytes read.
+    # Returns the number of bytes read and the data vector offset, or (0, None) if there was nothing to read.
+    def CreateDataVectorFromReadInto(self, readSizeBytes:int, readInto:Callable[[bytearray, int, int], int]) -> Tuple[int, Optional[int]]:
+        builder = self.Builder
+        if builder is None:
+            raise Exception("CreateDataVectorFromReadInto was called before the builder was created.")
+        if builder.Head() != len(builder.Bytes):
+            raise Exception("CreateDataVectorFromReadInto must be the first thing written to the builder.")
+
+        # This matches what CreateByteVector does, but we read into the vector region rather than copying into it.
+        builder.assertNotNested()
+        builder.nested = True
+        builder.Prep(4, readSizeBytes)
+        dataEnd = builder.Head()
+        dataStart = dataEnd - readSizeBytes
+        bytesRead = readInto(builder.Bytes, dataStart, readSizeBytes)
+        if bytesRead <= 0:
+            # Reset the builder so it's empty again.
+            builder.nested = False
+            builder.head = len(builder.Bytes)
+            return (0, None)
+
+        if bytesRead < readSizeBytes:
+            # If we got a short read, the vector needs to end on the aligned position for the size we actually read.
+            # So we move the data into place. This is the only case where this path copies the body.
+            builder.head = len(builder.Bytes)
+            builder.Prep(4, bytesRead)
+            dataEnd = builder.Head()
+            with memoryview(builder.Bytes) as mv:
+                mv[dataEnd - bytesRead:dataEnd] = mv[dataStart:dataStart + bytesRead]
+            SendCopyStats.OnCopy(bytesRead)
+        else:
+            SendCopyStats.OnZeroCopy(bytesRead)
+
+        builder.head = dataEnd - bytesRead
+        builder.vectorNumElems = bytesRead
+        return (bytesRead, builder.EndVector())
+
+    # Must be called with the finalized message buffer.
+    # If the message was built on the pooled buffer, the buffer will be returned to the pool once the websocket has sent it.
+    # If the builder had to grow, the pooled buffer isn't being used, so it's returned now.
+    def OnMessageFinalized(self, buffer:Buffer) -> None:
+        pooledBuffer = self.PooledBuffer
+        pool = SendBufferPool.Get()
+        if pooledBuffer is None or pool is None:
+            return
+        self.PooledBuffer = None
+        if buffer.Get() is pooledBuffer.Get():
+            buffer.SetOnSendComplete(lambda: pool.Return(pooledBuffer))
+        else:
+            pool.Return(pooledBuffer)
+
+    # Must be called if the message is never finalized, so the pooled buffer isn't left outstanding.
+    def ReleaseUnusedBuffer(self) -> None:
+        pooledBuffer = self.PooledBuffer
+        pool = SendBufferPool.Get()
+        self.PooledBuffer = None
+        self.Builder = None
+        if pooledBuffer is not None and pool is not None:
+            pool.Return(pooledBuffer)
 
 
 #
@@ -55,31 +143,70 @@ class MsgBuilderContext:
 #
 class OctoWebStreamHttpHelper:
 
+    # If enabled, large responses with a known content length will use the HttpBodyPipeline, so the body read,
+    # compression, and send to the OctoStream can all run at the same time instead of one after another.
+    # This is off by default, it can be turned on with the setter or the OCTO_HTTP_BODY_PIPELINE=1 env var.
+    EnableBodyPipeline = os.environ.get("OCTO_HTTP_BODY_PIPELINE", "0") == "1"
+
+    @staticmethod
+    def SetEnableBodyPipeline(enable:bool) -> None:
+        OctoWebStreamHttpHelper.EnableBodyPipeline = enable
+
+    @staticmethod
+    def GetEnableBodyPipeline() -> bool:
+        return OctoWebStreamHttpHelper.EnableBodyPipeline
+
+    # If enabled, plain body reads are read directly into the message's data vector, so the body is never copied before it's sent.
+    # This is on by default, it can be turned off with the setter or the OCTO_ZERO_COPY_SEND=0 env var.
+    EnableZeroCopyBodyRead = os.environ.get("OCTO_ZERO_COPY_SEND", "1") == "1"
+
+    @staticmethod
+    def SetEnableZeroCopyBodyRead(enable:bool) -> None:
+        OctoWebStreamHttpHelper.EnableZeroCopyBodyRead = enable
+
+    @staticmethod
+    def GetEnableZeroCopyBodyRead() -> bool:
+        return OctoWebStreamHttpHelper.EnableZeroCopyBodyRead
+
+
     # Called by the main socket thread so this should be quick!
-    def __init__(self, streamId:int, logger:logging.Logger, webStream:IWebStream, webStreamOpenMsg:WebStreamMsg.WebStreamMsg, openedTime:float) -> None:
+    # negotiatedFeatures are the features the server of the stream's session accepted.
+    # If the request was handed off by the async engine, preparedSendHeaders are the request headers it already built.
+    def __init__(self, streamId:int, logger:logging.Logger, webStream:IWebStream, webStreamOpenMsg:WebStreamMsg.WebStreamMsg, openedTime:float, negotiatedFeatures:Optional[NegotiatedFeatures]=None, preparedSendHeaders:Optional[Dict[str, str]]=None) -> None:
         self.Id = streamId
         self.Logger = logger
         self.WebStream = webStream
         self.WebStreamOpenMsg = webStreamOpenMsg
+        self.NegotiatedFeatures = negotiatedFeatures
+        self.PreparedSendHeaders = preparedSendHeaders
         self.IsClosed = False
         self.OpenedTime = openedTime
         self.CompressionContext = CompressionContext(self.Logger)
+        self.CompressionContext.SetNegotiatedFeatures(negotiatedFeatures)
 
         # Vars for response reading
         self.BodyReadTempBuffer:Optional[Buffer] = None
+        self.BodyReadTempBufferIsPooled = False
         self.BodyReadUseReadInto = True
         self.BodyReadContentFallbackOffset = 0
         self.ChunkedBodyHasNoContentLengthHeaders = False
         self.CompressionType:Optional[int] = None
         self.CompressionTimeSec = -1
+        # Set if the first body read wasn't compressible, so it wasn't compressed and compression is off for the rest of the body.
+        self.CompressionSkippedByCheck = False
         self.MissingBoundaryWarningCounter = 0
         self.IsUsingFullBodyBuffer = False
         self.IsUsingCustomBodyStreamCallbacks = False
+        # The last buffer the custom body stream returned. Its send complete callback is called once the message that carries it is sent.
+        self.CustomBodyStreamBuffer:BufferOrNone = None
 
         # This is our fallback reader for body streams that have unknown lengths.
         # If this is not None, we are doing the unknown body read. Then the rest of the body reads must use this same system.
         self.HttpStreamAccumulationReader:Optional[HttpStreamAccumulationReader] = None
 
+        # If this is not None, the body is being read and sent by the pipeline threads.
+        self.BodyPipeline:Optional[HttpBodyPipeline] = None
+
         # Perf stats
         self.BodyReadTimeSec = 0.0
         self.ServiceUploadTimeSec = 0.0
@@ -102,6 +229,11 @@ class OctoWebStreamHttpHelper:
             fullStreamUploadSize = None
         self.UploadBody = UploadBody(self.Logger, self.Id, fullStreamUploadSize, self.CompressionContext)
 
+        # If this is not None, the upload is being streamed to the server as it arrives, and the request is running on the streaming upload thread.
+        self.StreamingUpload:Optional[StreamingUploadBody] = None
+        self.StreamingUploadThread:Optional[threading.Thread] = None
+        self.StreamingUploadException:Optional[Exception] = None
+
 
     # When close is called, all http operations should be shutdown.
     # IMPORTANT NOTE - This function should not block and must be quick, as it will block the entire main websocket connection.
@@ -115,6 +247,14 @@ class OctoWebStreamHttpHelper:
         if self.HttpStreamAccumulationReader is not None:
             self.HttpStreamAccumulationReader.CloseAsync()
 
+        # Same for the body pipeline, this will stop the read and send threads.
+        if self.BodyPipeline is not None:
+            self.BodyPipeline.CloseAsync()
+
+        # If the upload is being streamed, abort it so the message thread isn't blocked on back pressure and the request read throws.
+        if self.StreamingUpload is not None:
+            self.StreamingUpload.Abort()
+
         # Ensure the upload body is cleaned up.
         self.UploadBody.Cleanup()
 
@@ -130,19 +270,39 @@ class OctoWebStreamHttpHelper:
         # This http call might have data sent to us in multiple messages.
         # If this message has data, put it into our buffer.
         if webStreamMsg.DataLength() > 0:
-            # Copy this upload data from the message.
-            self.UploadBody.AppendMessage(webStreamMsg)
+            # If this is the first message of a multi message upload, see if we should stream it to the server as it arrives.
+            if self.StreamingUpload is None and self.UploadBody.UploadBytesReceivedSoFar == 0 and webStreamMsg.IsDataTransmissionDone() is False:
+                self.tryStartStreamingUpload()
+
+            if self.StreamingUpload is not None:
+                # This will block if the server isn't reading the upload as fast as it's arriving, which pushes back on the stream.
+                self.StreamingUpload.AppendMessage(webStreamMsg)
+            else:
+                # Copy this upload data from the message.
+                self.UploadBody.AppendMessage(webStreamMsg)
 
         # If the data is done flag is set, that indicates that
         # the full upload buffer has been transmitted.
         if webStreamMsg.IsDataTransmissionDone():
+            if self.StreamingUpload is not None and self.StreamingUploadThread is not None:
+                # The request is already running on the streaming upload thread, so wait for it to finish sending the response.
+                # The request thread compresses the response with the context, so it must be joined before the context is exited, even if the finish throws.
+                with self.CompressionContext:
+                    try:
+                        self.StreamingUpload.Finish()
+                    finally:
+                        self.StreamingUploadThread.join()
+                if self.StreamingUploadException is not None:
+                    raise self.StreamingUploadException
+                return True
+
             # If we didn't know the upload size, we need to finalize it now
             self.UploadBody.Finalize()
 
             # Do the request. This will block this thread until it's done and the entire response is sent.
             # We want to make sure we destroy the compression context after this returns, no matter what.
             with self.CompressionContext:
-                self.executeHttpRequest()
+                self.runHttpRequest()
 
             # Return true since this stream is now done
             return True
@@ -151,6 +311,64 @@ class OctoWebStreamHttpHelper:
         return False
 
 
+    def runHttpRequest(self) -> None:
+        try:
+            self.executeHttpRequest()
+        finally:
+            # If the body pipeline was used, make sure the threads are stopped, even if the request threw.
+            if self.BodyPipeline is not None:
+                self.BodyPipeline.CloseAsync()
+            # The temp buffer is only used by this thread, so now that the request is done it can go back to the pool.
+            self._ReturnBodyReadTempBuffer()
+
+
+    # Starts the request with a streaming upload body if this upload should be streamed to the server.
+    # Command requests are never streamed, since they parse the full upload body themselves (like the MultipartFormUploadBody uploads).
+    def tryStartStreamingUpload(self) -> None:
+        if StreamingUploadBody.Enabled is False or self.WebStreamOpenMsg is None:
+            return
+        httpInitialContext = self.WebStreamOpenMsg.HttpInitialContext()
+        if httpInitialContext is None:
+            return
+        method = OctoStreamMsgBuilder.BytesToString(httpInitialContext.Method())
+        path = OctoStreamMsgBuilder.BytesToString(httpInitialContext.Path())
+        if method is None or path is None:
+            return
+        if CommandHandler.Get().IsCommandRequest(httpInitialContext):
+            return
+        isAbsolute = httpInitialContext.PathType() == PathTypes.Absolute
+        if OctoHttpRequest.GetDisableHttpRelay() and isAbsolute is False:
+            return
+        # Chunked support is remembered per backend, relative paths always go to the local server.
+        backendKey = urlsplit(path).netloc.lower() if isAbsolute else "local"
+        if StreamingUploadBody.ShouldStream(method, self.UploadBody.KnownFullUploadSizeBytes, backendKey) is False:
+            return
+        # The streaming body can only be sent to one route, so if the request has fallback routes, the upload is also spooled, so it can be sent to them.
+        hasFallbackRoutes = OctoHttpRequest.GetHttpCallUrls(path, httpInitialContext.PathType()).FallbackUrl is not None
+        self.StreamingUpload = StreamingUploadBody(self.Logger, self.Id, self.UploadBody, backendKey, hasFallbackRoutes)
+        self.StreamingUploadThread = threading.Thread(target=self.streamingUploadRequestWorker, name="StreamingUploadRequest", daemon=True)
+        self.StreamingUploadThread.start()
+
+
+    def streamingUploadRequestWorker(self) -> None:
+        try:
+            self.runHttpRequest()
+        except Exception as e:
+            # The message thread will throw this once the upload is done, like it would if it made the request.
+            # If the upload is still arriving, close the stream now, so the server isn't left waiting on it.
+            self.StreamingUploadException = e
+            if self.StreamingUpload is not None and self.StreamingUpload.IsFinished is False:
+                Sentry.OnException("Http streaming upload request failed before the upload was done.", e)
+                self.WebStream.Close()
+        finally:
+            # If the request finished before all of the upload arrived, the rest of the upload isn't needed.
+            if self.StreamingUpload is not None:
+                self.StreamingUpload.Abort()
+            # If the stream was closed, the message thread will never get the end of the upload and exit the context, so it's done here.
+            if self.IsClosed:
+                self.CompressionContext.__exit__(None, None, None)
+
+
     # This function either needs to throw (which will restart the entire connection)
     # or return a WebStreamMsg, or close the web stream. Otherwise the server will be waiting for it
     # for until it hits a timeout.
@@ -165,7 +383,8 @@ class OctoWebStreamHttpHelper:
             if self.WebStreamOpenMsg is None:
                 raise Exception("ExecuteHttpRequest but there is no open message")
             # Make sure if there was a defined upload size, we have all of the data.
-            if self.UploadBody.KnownFullUploadSizeBytes is not None:
+            # A streaming upload is still arriving, it checks the size itself when it's done.
+            if self.UploadBody.KnownFullUploadSizeBytes is not None and self.StreamingUpload is None:
                 if self.UploadBody.UploadBytesReceivedSoFar != self.UploadBody.KnownFullUploadSizeBytes:
                     raise Exception("Http request tried to execute, but we haven't gotten all of the upload payload. Total:"+str(self.UploadBody.KnownFullUploadSizeBytes)+"; rec so far:"+str(self.UploadBody.UploadBytesReceivedSoFar))
 
@@ -175,15 +394,20 @@ class OctoWebStreamHttpHelper:
                 self.Logger.error(self.getLogMsgPrefix()+ " request open message had no initial context.")
                 raise Exception("Http request open message had no initial context")
 
-            # Setup the headers
-            sendHeaders = HeaderHelper.GatherRequestHeaders(self.Logger, httpInitialContext, BaseProtocol.Http)
+            # Setup the headers, unless the async engine already did when it handed off the request.
+            # In that case the auth header and the relay webcam detection were already applied, so they are not done twice.
+            isUsingPreparedHeaders = self.PreparedSendHeaders is not None
+            if self.PreparedSendHeaders is not None:
+                sendHeaders = self.PreparedSendHeaders
+            else:
+                sendHeaders = HeaderHelper.GatherRequestHeaders(self.Logger, httpInitialContext, BaseProtocol.Http, self.NegotiatedFeatures)
 
-            # Figure out if this is a special OctoEverywhere Auth call.
-            isOeAuthCall = httpInitialContext.UseOctoeverywhereAuth() == OeAuthAllowed.OeAuthAllowed.Allow
-            localAuthHelper = Compat.GetLocalAuth()
-            if isOeAuthCall and localAuthHelper is not None:
-                # If so and this platform supports local auth, add the auth header.
-                localAuthHelper.AddAuthHeader(sendHeaders)
+                # Figure out if this is a special OctoEverywhere Auth call.
+                isOeAuthCall = httpInitialContext.UseOctoeverywhereAuth() == OeAuthAllowed.OeAuthAllowed.Allow
+                localAuthHelper = Compat.GetLocalAuth()
+                if isOeAuthCall and localAuthHelper is not None:
+                    # If so and this platform supports local auth, add the auth header.
+                    localAuthHelper.AddAuthHeader(sendHeaders)
 
             # Find the method
             method = OctoStreamMsgBuilder.BytesToString(httpInitialContext.Method())
@@ -196,7 +420,7 @@ class OctoWebStreamHttpHelper:
 
             # Before we handle the request, see if this is a webcam stream request we need to handle specially.
             relayWebcamStreamDetector = Compat.GetRelayWebcamStreamDetector()
-            if relayWebcamStreamDetector is not None:
+            if relayWebcamStreamDetector is not None and isUsingPreparedHeaders is False:
                 relativeOrAbsolutePath = OctoStreamMsgBuilder.BytesToString(httpInitialContext.Path())
                 if relativeOrAbsolutePath is None:
                     raise Exception("Http request had a None path when trying to detect a webcam stream.")
@@ -235,8 +459,19 @@ class OctoWebStreamHttpHelper:
                 if octoHttpResult is not None:
                     isFromCache = True
                 else:
+                    # If compression pass through allowed an encoded response, make sure the response doesn't need to be edited, since we can't edit an encoded body.
+                    if sendHeaders.get("Accept-Encoding", "identity") != "identity":
+                        self.disallowEncodedResponseIfItNeedsToBeHandled(httpInitialContext, sendHeaders)
                     # If we don't have a valid result yet, do the normal http path.
-                    octoHttpResult = OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, sendHeaders, self.UploadBody)
+                    streamingUpload = self.StreamingUpload
+                    if streamingUpload is not None:
+                        # Send the upload as it arrives. If the backend refuses a chunked upload, or the route it was sent to failed and there are
+                        # fallback routes, it's sent again from the spooled upload body.
+                        streamingUpload.PrepareHeaders(sendHeaders)
+                        octoHttpResult = OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, sendHeaders, streamingUpload)
+                        octoHttpResult = streamingUpload.OnRequestResult(octoHttpResult, lambda body: OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, sendHeaders, body))
+                    else:
+                        octoHttpResult = OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, sendHeaders, self.UploadBody)
         finally:
             # Ensure the upload body is always cleaned up after the request is done.
             self.UploadBody.Cleanup()
@@ -308,6 +543,8 @@ class OctoWebStreamHttpHelper:
             boundaryStr:Optional[str] = None
             # Pull out the content type value, so we can use it to figure out if we want to compress this data or not
             contentTypeLower:Optional[str] = None
+            # If compression pass through is on, the body might already be encoded by the local server.
+            contentEncodingLower:Optional[str] = None
             ogLocationHeaderValue:Optional[str] = None
             headers = octoHttpResult.Headers
             for name, value in headers.items():
@@ -330,6 +567,9 @@ class OctoWebStreamHttpHelper:
                             self.Logger.error("We found a boundary stream, but didn't find the boundary string. "+ contentTypeLower)
                             continue
 
+                elif nameLower == "content-encoding":
+                    contentEncodingLower = value.lower()
+
                 elif nameLower == "location":
                     # We have noticed that some proxy servers aren't setup correctly to forward the x-forwarded-for and such headers.
                     # So when the web server responds back with a 301 or 302, the location header might not have the correct hostname, instead an ip like 127.0.0.1.
@@ -341,14 +581,26 @@ class OctoWebStreamHttpHelper:
                 # This has to be set out of the loop.
                 octoHttpResult.Headers["x-og-location"] = ogLocationHeaderValue
 
+            # Cached responses don't come from a backend, so they are counted as internal.
+            perfStatsUrl = None if isFromCache else uri
+            TunnelPerfStats.OnResponseHeaders(perfStatsUrl, contentTypeLower, requestExecutionEnd - requestExecutionStart)
+
             # We also look at the content-type to determine if we should add compression to this request or not.
             # general rule of thumb is that compression is quite cheap but really helps with text, so we should compress when we
             # can.
             compressBody = self.shouldCompressBody(contentTypeLower, octoHttpResult, contentLength)
 
+            # If the local server already encoded the body in a way the client accepts, forward it as is.
+            # The content-encoding header is kept and the message is flagged, so the server sends the body to the client untouched.
+            isContentEncodingPassThrough = octoHttpResult.FullBodyBuffer is None and CompressionPassThrough.IsPassThroughContentEncoding(contentEncodingLower, self.NegotiatedFeatures)
+            if isContentEncodingPassThrough:
+                compressBody = False
+
             # If the content length is known, tell the compression system, which will help performance.
+            # The content type and length are also used to pick how hard to compress.
             if contentLength is not None:
                 self.CompressionContext.SetTotalCompressedSizeOfData(contentLength)
+            self.CompressionContext.SetContentType(contentTypeLower)
 
             # Since streams with unknown content-lengths can run for a while, report now when we start one.
             # If the status code is 304 or 204, we don't expect content.
@@ -370,6 +622,24 @@ class OctoWebStreamHttpHelper:
             webRequestResponseHandler = Compat.GetWebRequestResponseHandler()
             if webRequestResponseHandler is not None:
                 responseHandlerContext = webRequestResponseHandler.CheckIfResponseNeedsToBeHandled(uri)
+                # We can't edit an encoded body. We check for this before the request is made, so this only happens if the final URL is different.
+                if responseHandlerContext is not None and isContentEncodingPassThrough:
+                    self.Logger.warning(f"{self.getLogMsgPrefix()} the response needs to be handled but it's encoded, so it will be sent as is. {uri}")
+                    responseHandlerContext = None
+
+            # If this is a large body read with a known length, see if we should use the pipeline to read, compress, and send at the same time.
+            if contentLength is not None and self.shouldUseBodyPipeline(octoHttpResult, boundaryStr, contentLength, compressBody, responseHandlerContext):
+                self.BodyPipeline = HttpBodyPipeline(
+                    self.Logger,
+                    self.Id,
+                    self.WebStream,
+                    lambda targetBuffer, offset, readSize: self.doBodyReadInto(octoHttpResult, targetBuffer, offset, readSize),
+                    contentLength,
+                    self.getDefaultBodyReadSizeBytes(compressBody, contentLength),
+                )
+                # If we were closed while the pipeline was being created, Close() didn't see it, so close it now.
+                if self.IsClosed:
+                    self.BodyPipeline.CloseAsync()
 
             # Setup a loop to read the stream and push it out in multiple messages.
             contentReadBytes = 0
@@ -411,10 +681,15 @@ class OctoWebStreamHttpHelper:
                     # Start by reading data from the response.
                     # This function will return a read length of 0 and a null data offset if there's nothing to read.
                     # Otherwise, it will return the length of the read data and the data offset in the buffer.
-                    nonCompressedBodyReadSize, lastBodyReadLength, dataOffset = self.readContentFromBodyAndMakeDataVector(builderContext, octoHttpResult, boundaryStr, compressBody, contentTypeLower, contentLength, responseHandlerContext)
+                    nonCompressedBodyReadSize, lastBodyReadLength, dataOffset = self.readContentFromBodyAndMakeDataVector(builderContext, octoHttpResult, boundaryStr, compressBody, contentTypeLower, contentLength, responseHandlerContext, nonCompressedContentReadSizeBytes)
                 contentReadBytes += lastBodyReadLength
                 nonCompressedContentReadSizeBytes += nonCompressedBodyReadSize
 
+                # If the body read found the data wasn't compressible, it didn't compress it, so compression is off for the rest of the body.
+                if compressBody and self.CompressionSkippedByCheck:
+                    compressBody = False
+                    self.Logger.debug("%s the body isn't compressible, so compression is disabled. type: %s url: %s", self.getLogMsgPrefix(), contentTypeLower, uri)
+
                 # Ensure that the build was created by now. In most cases it's created with the body read, but in other cases where there's no body, we create it now.
                 if builderContext.Builder is None:
                     builderContext.CreateBuilder()
@@ -441,6 +716,7 @@ class OctoWebStreamHttpHelper:
 
                 # Since this operation can take a while, check if we closed.
                 if self.IsClosed:
+                    builderContext.ReleaseUnusedBuffer()
                     break
 
                 # Validate.
@@ -499,6 +775,8 @@ class OctoWebStreamHttpHelper:
                 if isFirstResponse is True and contentLength is not None:
                     # Only on the first response, if we know the full size, set it.
                     WebStreamMsg.AddFullStreamDataSize(builder, contentLength)
+                if isFirstResponse is True and isContentEncodingPassThrough:
+                    WebStreamMsg.AddIsContentEncodingPassThrough(builder, True)
                 if compressBody:
                     # If we are compressing, we need to add what we are using and what the original size was.
                     if self.CompressionType is None:
@@ -542,32 +820,54 @@ class OctoWebStreamHttpHelper:
 
                 # Wrap in the OctoStreamMsg and finalize.
                 buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, MessageContext.MessageContext.WebStreamMsg, webStreamMsgOffset)
+                builderContext.OnMessageFinalized(buffer)
+
+                # If the body came from a custom body stream, let the stream know when its data has been sent, like the webcam stream uses for pacing.
+                customBodyStreamBuffer = self.CustomBodyStreamBuffer
+                if customBodyStreamBuffer is not None:
+                    self.CustomBodyStreamBuffer = None
+                    buffer.AddOnSendComplete(customBodyStreamBuffer.OnSendComplete)
 
                 # Send the message.
                 # If this is the last, we need to make sure to set that we have set the closed flag.
-                serviceSendStartSec = time.time()
-                self.WebStream.SendToOctoStream(buffer, msgStartOffsetBytes, msgSizeBytes, isLastMessage, True)
-                thisServiceSendTimeSec = time.time() - serviceSendStartSec
-                self.ServiceUploadTimeSec += thisServiceSendTimeSec
-                if thisServiceSendTimeSec > self.ServiceUploadTimeHighWaterMarkSec:
-                    self.ServiceUploadTimeHighWaterMarkSec = thisServiceSendTimeSec
+                if self.BodyPipeline is not None:
+                    # The pipeline's send thread will send it, in order, while we move on to the next chunk.
+                    self.BodyPipeline.QueueSend(buffer, msgStartOffsetBytes, msgSizeBytes, isLastMessage)
+                else:
+                    serviceSendStartSec = time.time()
+                    self.WebStream.SendToOctoStream(buffer, msgStartOffsetBytes, msgSizeBytes, isLastMessage, True)
+                    thisServiceSendTimeSec = time.time() - serviceSendStartSec
+                    self.ServiceUploadTimeSec += thisServiceSendTimeSec
+                    if thisServiceSendTimeSec > self.ServiceUploadTimeHighWaterMarkSec:
+                        self.ServiceUploadTimeHighWaterMarkSec = thisServiceSendTimeSec
 
                 # Do a debug check to see if our pre-allocated flatbuffer size was too small.
                 # If this fires often, we should increase the c_MsgStreamOverheadSize size.
                 finalFullBufferBytes = len(buffer)
-                if finalFullBufferBytes > lastBodyReadLength + builderContext.c_MsgStreamOverheadSize and self.Logger.isEnabledFor(logging.DEBUG):
-                    delta = msgSizeBytes - (lastBodyReadLength + builderContext.c_MsgStreamOverheadSize)
+                if finalFullBufferBytes > builderContext.InitialBufferSizeBytes and self.Logger.isEnabledFor(logging.DEBUG):
+                    delta = msgSizeBytes - builderContext.InitialBufferSizeBytes
                     self.Logger.warning(f"The flatbuffer internal buffer had to be resized from the guess we set. Flatbuffer full buffer size: {finalFullBufferBytes}, last body read length: {lastBodyReadLength}; overage delta: {delta}")
 
                 # Clear this flag
                 isFirstResponse = False
                 messageCount += 1
 
+            # If the pipeline was used, we must wait for the send thread to send everything, including the final close message,
+            # before we return. Otherwise the web stream close logic could send its own close message before our last data message.
+            pipelineStats = "off"
+            if self.BodyPipeline is not None:
+                self.BodyPipeline.WaitForSendsComplete()
+                self.BodyReadTimeSec = self.BodyPipeline.GetReadTimeSec()
+                self.ServiceUploadTimeSec = self.BodyPipeline.GetSendTimeSec()
+                pipelineStats = self.BodyPipeline.GetStatsStr()
+
+            TunnelPerfStats.OnResponseComplete(perfStatsUrl, contentTypeLower, self.BodyReadTimeSec, self.CompressionTimeSec, self.ServiceUploadTimeSec)
+
             # Log about it - only if debug is enabled. Otherwise, we don't want to waste time making the log string.
             responseWriteDone = time.time()
             if self.Logger.isEnabledFor(logging.DEBUG):
                 self.Logger.debug(
-                    "%s%s [upload:%ss; request_exe:%ss; send:%ss; body_read:%ss; compress:%ss; octo_stream_upload:%ss] size:(%s->%s) compressed:%s msgcount:%s accumulatedStreamReader:%s type:%s status:%s cached:%s for %s",
+                    "%s%s [upload:%ss; request_exe:%ss; send:%ss; body_read:%ss; compress:%ss; octo_stream_upload:%ss] [pipeline(busy/overlap) %s] size:(%s->%s) compressed:%s msgcount:%s accumulatedStreamReader:%s type:%s status:%s cached:%s for %s",
                     self.getLogMsgPrefix(),
                     method,
                     format(requestExecutionStart - self.OpenedTime, ".3f"),
@@ -576,6 +876,7 @@ class OctoWebStreamHttpHelper:
                     format(self.BodyReadTimeSec, ".3f"),
                     format(self.CompressionTimeSec, ".3f"),
                     format(self.ServiceUploadTimeSec, ".3f"),
+                    pipelineStats,
                     nonCompressedContentReadSizeBytes,
                     contentReadBytes,
                     compressBody,
@@ -589,9 +890,15 @@ class OctoWebStreamHttpHelper:
 
 
     def buildHeaderVector(self, builder:octoflatbuffers.Builder, httpResult:HttpResult) -> Optional[int]:
+        return OctoWebStreamHttpHelper.BuildHeaderVectorFromDict(builder, httpResult.Headers)
+
+
+    # Builds the response header vector from a header dict. Returns None if there are no headers to send.
+    # This is static so the async web stream engine can build the exact same messages.
+    @staticmethod
+    def BuildHeaderVectorFromDict(builder:octoflatbuffers.Builder, headers:Mapping[str, str]) -> Optional[int]:
         # Gather up the headers to return.
         headerTableOffsets:List[int] = []
-        headers = httpResult.Headers
         for name, value in headers.items():
             nameLower = name.lower()
 
@@ -629,6 +936,19 @@ class OctoWebStreamHttpHelper:
         return builder.EndVector() #pyright: ignore[reportUnknownMemberType]
 
 
+    # If the response for this request might need to be edited by the response handler, this sets the headers so the local server doesn't encode the body.
+    def disallowEncodedResponseIfItNeedsToBeHandled(self, httpInitialContext:HttpInitialContext.HttpInitialContext, sendHeaders:Dict[str, str]) -> None:
+        webRequestResponseHandler = Compat.GetWebRequestResponseHandler()
+        if webRequestResponseHandler is None:
+            return
+        path = OctoStreamMsgBuilder.BytesToString(httpInitialContext.Path())
+        if path is None:
+            return
+        url = OctoHttpRequest.GetPrimaryUrl(path, httpInitialContext.PathType())
+        if webRequestResponseHandler.CheckIfResponseNeedsToBeHandled(url) is not None:
+            sendHeaders["Accept-Encoding"] = "identity"
+
+
     def checkForNotModifiedCacheAndUpdateResponseIfSo(self, sentHeaders:Dict[str, str], httpResult:HttpResult) -> None:
         # Check if the sent headers have any conditional http headers.
         requestEtag:Optional[str] = None
@@ -720,7 +1040,12 @@ class OctoWebStreamHttpHelper:
         # will also read the flag and skip the compression.
         if httpResult.BodyBufferCompressionType != DataCompression.DataCompression.None_:
             return True
+        return OctoWebStreamHttpHelper.ShouldCompressContentType(contentTypeLower, contentLengthOpt)
+
 
+    # The content type and length part of the compression rules, shared with the async web stream engine.
+    @staticmethod
+    def ShouldCompressContentType(contentTypeLower:Optional[str], contentLengthOpt:Optional[int]) -> bool:
         # Make sure we have a known length and it's not too small to compress.
         if contentLengthOpt is not None and contentLengthOpt < Compression.MinSizeToCompress:
             return False
@@ -743,20 +1068,8 @@ class OctoWebStreamHttpHelper:
                 or contentTypeLower.find("svg") != -1 or contentTypeLower.find("application/octet-stream") != -1)
 
 
-    # Reads data from the response body, puts it in a data vector, and returns the offset.
-    # If the body has been fully read, this should return ogLen == 0, len = 0, and offset == None
-    # The read style depends on the presence of the boundary string existing.
-    def readContentFromBodyAndMakeDataVector(
-                self,
-                builderContext:MsgBuilderContext,
-                httpResult:HttpResult,
-                boundaryStr:Optional[str],
-                shouldCompress:bool,
-                contentTypeLower:Optional[str],
-                contentLength:Optional[int],
-                responseHandlerContext:Optional[Any]
-            ) -> Tuple[int, int, Optional[int]]:
-        # This is the max size each body read will be.
+    # Returns the size of each normal body read.
+    def getDefaultBodyReadSizeBytes(self, shouldCompress:bool, contentLength:Optional[int]) -> int:
         defaultBodyReadSizeBytes = MemoryManager.OctoWebStreamHttpHelper_DefaultBodyReadSizeBytes
 
         # If we are going to compress this read, use a higher number. Since most of what we compress is text,
@@ -770,6 +1083,42 @@ class OctoWebStreamHttpHelper:
         # But we want to limit the max size of the buffer, so we don't allocate a huge buffer for a large request.
         if contentLength is not None:
             defaultBodyReadSizeBytes = min(defaultBodyReadSizeBytes, contentLength)
+        return defaultBodyReadSizeBytes
+
+
+    # Determines if this response should use the HttpBodyPipeline.
+    # The pipeline only helps when there will be more than one body read, so it's only used for plain body reads with a known length
+    # that's larger than a single read. All of the special read paths (full body buffers, custom callbacks, boundary streams, response handlers) use the normal logic.
+    def shouldUseBodyPipeline(self, httpResult:HttpResult, boundaryStr:Optional[str], contentLength:int, shouldCompress:bool, responseHandlerContext:Optional[Any]) -> bool:
+        if OctoWebStreamHttpHelper.EnableBodyPipeline is False:
+            return False
+        if self.IsUsingFullBodyBuffer or self.IsUsingCustomBodyStreamCallbacks or responseHandlerContext is not None:
+            return False
+        if boundaryStr is not None and len(boundaryStr) != 0:
+            return False
+        if httpResult.StatusCode == 304 or httpResult.StatusCode == 204:
+            return False
+        if httpResult.ResponseForBodyRead is None:
+            return False
+        return contentLength > self.getDefaultBodyReadSizeBytes(shouldCompress, None)
+
+
+    # Reads data from the response body, puts it in a data vector, and returns the offset.
+    # If the body has been fully read, this should return ogLen == 0, len = 0, and offset == None
+    # The read style depends on the presence of the boundary string existing.
+    def readContentFromBodyAndMakeDataVector(
+                self,
+                builderContext:MsgBuilderContext,
+                httpResult:HttpResult,
+                boundaryStr:Optional[str],
+                shouldCompress:bool,
+                contentTypeLower:Optional[str],
+                contentLength:Optional[int],
+                responseHandlerContext:Optional[Any],
+                bodyBytesReadSoFar:int
+            ) -> Tuple[int, int, Optional[int]]:
+        # This is the max size each body read will be.
+        defaultBodyReadSizeBytes = self.getDefaultBodyReadSizeBytes(shouldCompress, contentLength)
 
         # Some requests like snapshot requests will already have a fully read body. In this case we use the existing body buffer instead of reading from the body.
         # Important! If the NeedsRelease flag is set we must release the buffer after we are done so the underlying buffer can be used on the next pass.
@@ -777,9 +1126,22 @@ class OctoWebStreamHttpHelper:
         finalDataBufferNeedsReleased = False
         finalDataBuffer:BufferOrNone = None
         finalDataBufferCreationSize:Optional[int] = None
+        pipelineReadBuffer:Optional[bytearray] = None
+        pipelineReadView:BufferOrNone = None
         try:
             bodyReadStartSec = time.time()
-            if self.IsUsingFullBodyBuffer:
+            if self.BodyPipeline is not None:
+                # The pipeline read thread has already read the data into one of its buffers, so we just take the next one.
+                # If None is returned, the body read is done.
+                pipelineRead = self.BodyPipeline.Read()
+                if pipelineRead is not None:
+                    pipelineReadBuffer, pipelineReadSize = pipelineRead
+                    # Same as the temp buffer below, the slice is a memory view that must be released before the buffer is reused.
+                    # We hold our own ref to it, since finalDataBuffer will be replaced if the data is compressed.
+                    with memoryview(pipelineReadBuffer) as mv:
+                        pipelineReadView = Buffer(mv[0:pipelineReadSize])
+                        finalDataBuffer = pipelineReadView
+            elif self.IsUsingFullBodyBuffer:
                 # In this case, the entire buffer and size are known, so we get them all in one go.
                 finalDataBuffer = httpResult.FullBodyBuffer
             elif self.IsUsingCustomBodyStreamCallbacks:
@@ -789,6 +1151,7 @@ class OctoWebStreamHttpHelper:
                 if callback is None:
                     raise Exception("The custom body stream callback returned None, but we are trying to read the body.")
                 finalDataBuffer = callback()
+                self.CustomBodyStreamBuffer = finalDataBuffer
             else:
                 # If the boundary string exist and is not empty, we will use it to try to read the data.
                 # Unless the self.ChunkedBodyHasNoContentLengthHeaders flag has been set, which indicate we have read the body has chunks
@@ -803,8 +1166,8 @@ class OctoWebStreamHttpHelper:
                         # Note that once we do on read as an unknown body size chunk read, we need to always do it, since there's a thread reading the body.
                         if self.HttpStreamAccumulationReader is None:
                             # Even though we read complete chunks as they come in, we might want to buffer smaller chunks up before sending them so the compression and stream is more efficient.
-                            # This does need to be small, because we want reading this min time period back to back, we are reading a chunk, doing all of the send logic, and then spinning back to here.
-                            # So if we set this at exactly 16.6 for a 60fps stream, for example, we will fall behind.
+                            # The reader returns data as soon as it hits a message boundary, an idle gap, or the flush size, so the accumulation time is only the upper bound on how long data waits.
+                            # This does need to be small, so if we set this at exactly 16.6 for a 60fps stream, for example, we will fall behind.
                             # So we set the accumulation time to 10ms, which should be small enough to not cause issues.
                             self.HttpStreamAccumulationReader = HttpStreamAccumulationReader(
                                 self.Logger,
@@ -831,6 +1194,23 @@ class OctoWebStreamHttpHelper:
                             else:
                                 defaultBodyReadSizeBytes = MemoryManager.Global_MaxSingleChunkSizeBytes
 
+                        # If we can, read the body directly into the message's data vector, so it's never copied before it's sent.
+                        # This can't be used if we are compressing or if the response handler might edit the body, since the final data isn't what we read.
+                        if responseHandlerContext is None and shouldCompress is False and OctoWebStreamHttpHelper.EnableZeroCopyBodyRead:
+                            # If we know the content length, only read what's left, so the last read fills the vector exactly.
+                            if contentLength is not None and contentLength - bodyBytesReadSoFar > 0:
+                                defaultBodyReadSizeBytes = min(defaultBodyReadSizeBytes, contentLength - bodyBytesReadSoFar)
+                            builderContext.CreateBuilder(defaultBodyReadSizeBytes)
+                            bytesRead, dataOffset = builderContext.CreateDataVectorFromReadInto(
+                                defaultBodyReadSizeBytes,
+                                lambda targetBuffer, offset, readSize: self.doBodyReadInto(httpResult, targetBuffer, offset, readSize)
+                            )
+                            thisBodyReadTimeSec = time.time() - bodyReadStartSec
+                            self.BodyReadTimeSec += thisBodyReadTimeSec
+                            if thisBodyReadTimeSec > self.BodyReadTimeHighWaterMarkSec:
+                                self.BodyReadTimeHighWaterMarkSec = thisBodyReadTimeSec
+                            return (bytesRead, bytesRead, dataOffset)
+
                         # Use the temp body buffer to read into, this is reused across reads to avoid multiple allocations.
                         # This reads into the temp body buffer, so we need to set finalDataBufferCreationSize to slice it.
                         tempBodyBuffer = self._EnsureBodyReadTempBufferSize(defaultBodyReadSizeBytes).ForceAsByteArray()
@@ -888,6 +1268,11 @@ class OctoWebStreamHttpHelper:
                     raise Exception(f"The BodyBufferCompressionType tried to be set but the compression was already set! It is {self.CompressionType} and now tried to be {httpResult.BodyBufferCompressionType}")
                 self.CompressionType = httpResult.BodyBufferCompressionType
 
+            # If this is the first data we would compress, make sure it's worth compressing. Already compressed data like zip files and images
+            # would only get larger, so we skip the compression pass. The caller sees the flag and turns compression off for the rest of the body.
+            elif shouldCompress and self.CompressionType is None and Compressibility.IsCompressible(finalDataBuffer.Get(), contentTypeLower) is False:
+                self.CompressionSkippedByCheck = True
+
             # Otherwise, check if we should compress
             elif shouldCompress:
                 compressionResult = Compression.Get().Compress(self.CompressionContext, finalDataBuffer)
@@ -916,6 +1301,7 @@ class OctoWebStreamHttpHelper:
             builder = builderContext.Builder
             if builder is None:
                 raise Exception("The builder is None, but we are trying to create a flatbuffer message.")
+            SendCopyStats.OnCopy(finalDataBufferSizeBytes)
             return (originalBufferSize, len(finalDataBuffer), builder.CreateByteVector(finalDataBuffer)) #pyright: ignore[reportArgumentType, reportUnknownMemberType]
         finally:
             # If we own the final data buffer, we must call release.
@@ -925,6 +1311,11 @@ class OctoWebStreamHttpHelper:
             # other threaded clients using them.
             if finalDataBufferNeedsReleased and finalDataBuffer is not None:
                 finalDataBuffer.Release()
+            # If this was a pipeline buffer, now that the data has been copied into the message, give it back so it can be read into again.
+            if pipelineReadView is not None:
+                pipelineReadView.Release()
+            if pipelineReadBuffer is not None and self.BodyPipeline is not None:
+                self.BodyPipeline.ReturnReadBuffer(pipelineReadBuffer)
 
 
     # Reads a single chunk from the http response.
@@ -1120,17 +1511,47 @@ class OctoWebStreamHttpHelper:
 
     # Ensures the temp body buffer is sized correctly and returns it.
     def _EnsureBodyReadTempBufferSize(self, requiredSize:int) -> Buffer:
-        if self.BodyReadTempBuffer is None:
-            # If there is no buffer, make it now either using the required size or a default size, whichever is larger.
-            self.BodyReadTempBuffer = Buffer(bytearray(max(10*1024, requiredSize)))
+        pool = SendBufferPool.GetIfEnabled()
+        if pool is None and self.BodyReadTempBufferIsPooled is False:
+            if self.BodyReadTempBuffer is None:
+                # If there is no buffer, make it now either using the required size or a default size, whichever is larger.
+                self.BodyReadTempBuffer = Buffer(bytearray(max(10*1024, requiredSize)))
+                return self.BodyReadTempBuffer
+            tempBufferByteArray = self.BodyReadTempBuffer.ForceAsByteArray()
+            currentSize = len(tempBufferByteArray)
+            if currentSize < requiredSize:
+                tempBufferByteArray.extend(bytearray(requiredSize - currentSize))
+            return self.BodyReadTempBuffer
+
+        # If the pool is being used, rent a buffer that's large enough. When growing, the existing data must be kept, since the multipart reads
+        # grow the buffer mid frame. The old buffer goes back to the pool, so the next stream can use it.
+        if self.BodyReadTempBuffer is not None and len(self.BodyReadTempBuffer) >= requiredSize:
             return self.BodyReadTempBuffer
-        tempBufferByteArray = self.BodyReadTempBuffer.ForceAsByteArray()
-        currentSize = len(tempBufferByteArray)
-        if currentSize < requiredSize:
-            tempBufferByteArray.extend(bytearray(requiredSize - currentSize))
+        pool = SendBufferPool.Get()
+        if pool is None:
+            raise Exception("The body read temp buffer is pooled, but there's no buffer pool.")
+        newBuffer = pool.Rent(requiredSize)
+        if self.BodyReadTempBuffer is not None:
+            oldByteArray = self.BodyReadTempBuffer.ForceAsByteArray()
+            newBuffer.ForceAsByteArray()[0:len(oldByteArray)] = oldByteArray
+            self._ReturnBodyReadTempBuffer()
+        self.BodyReadTempBuffer = newBuffer
+        self.BodyReadTempBufferIsPooled = True
         return self.BodyReadTempBuffer
 
 
+    # Gives the temp body buffer back to the pool, if it came from the pool.
+    def _ReturnBodyReadTempBuffer(self) -> None:
+        tempBuffer = self.BodyReadTempBuffer
+        self.BodyReadTempBuffer = None
+        if tempBuffer is None or self.BodyReadTempBufferIsPooled is False:
+            return
+        self.BodyReadTempBufferIsPooled = False
+        pool = SendBufferPool.Get()
+        if pool is not None:
+            pool.Return(tempBuffer)
+
+
     # The most effective way to read the body is to use the readinto function, which reads directly into a pre-allocated buffer, avoiding extra allocations and copies.
     def doBodyReadInto(self, httpResult:HttpResult, targetBuffer:bytearray, offset:int, readSize:int) -> int:
         try:
@@ -0,0 +1,297 @@
+import time
+import logging
+import threading
+import collections
+from typing import Callable, Deque, List, Optional, Tuple
+
+from ..buffer import Buffer
+from ..sentry import Sentry
+from ..interfaces import IWebStream
+from ..memorymanager import MemoryManager
+
+
+# Keeps track of how long each pipeline stage was busy and how much of that busy time overlapped with another stage.
+# The stages call StageStart and StageEnd from their own threads, so everything is done under lock.
+class PipelineStageTimer:
+
+    StageRead = 0
+    StageCompress = 1
+    StageSend = 2
+    c_StageCount = 3
+    c_StageNames = ["read", "compress", "send"]
+
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        self.IsBusy:List[bool] = [False] * PipelineStageTimer.c_StageCount
+        self.BusyTimeSec:List[float] = [0.0] * PipelineStageTimer.c_StageCount
+        self.OverlappedTimeSec:List[float] = [0.0] * PipelineStageTimer.c_StageCount
+        self.LastTransitionSec = time.time()
+
+
+    def StageStart(self, stage:int) -> None:
+        with self.Lock:
+            self._AccumulateLocked()
+            self.IsBusy[stage] = True
+
+
+    def StageEnd(self, stage:int) -> None:
+        with self.Lock:
+            self._AccumulateLocked()
+            self.IsBusy[stage] = False
+
+
+    def GetBusyTimeSec(self, stage:int) -> float:
+        with self.Lock:
+            self._AccumulateLocked()
+            return self.BusyTimeSec[stage]
+
+
+    # Returns a string like "read:0.210s/88%" for each stage, where the percent is how much of the stage's busy time overlapped another stage.
+    def GetStatsStr(self) -> str:
+        with self.Lock:
+            self._AccumulateLocked()
+            parts:List[str] = []
+            for i in range(PipelineStageTimer.c_StageCount):
+                overlapPercent = 0.0
+                if self.BusyTimeSec[i] > 0:
+                    overlapPercent = (self.OverlappedTimeSec[i] / self.BusyTimeSec[i]) * 100.0
+                parts.append(f"{PipelineStageTimer.c_StageNames[i]}:{format(self.BusyTimeSec[i], '.3f')}s/{int(overlapPercent)}%")
+            return " ".join(parts)
+
+
+    # Must be called under lock. Adds the time since the last transition to every busy stage.
+    def _AccumulateLocked(self) -> None:
+        nowSec = time.time()
+        deltaSec = nowSec - self.LastTransitionSec
+        self.LastTransitionSec = nowSec
+        if deltaSec <= 0:
+            return
+        busyCount = 0
+        for isBusy in self.IsBusy:
+            if isBusy:
+                busyCount += 1
+        if busyCount == 0:
+            return
+        for i in range(PipelineStageTimer.c_StageCount):
+            if self.IsBusy[i]:
+                self.BusyTimeSec[i] += deltaSec
+                if busyCount > 1:
+                    self.OverlappedTimeSec[i] += deltaSec
+
+
+# A message that's been built and is waiting for the send thread.
+class PipelineSendContext:
+    def __init__(self, buffer:Buffer, msgStartOffsetBytes:int, msgSizeBytes:int, isCloseFlagSet:bool) -> None:
+        self.Buffer = buffer
+        self.MsgStartOffsetBytes = msgStartOffsetBytes
+        self.MsgSizeBytes = msgSizeBytes
+        self.IsCloseFlagSet = isCloseFlagSet
+
+
+#
+# Splits an http response body transfer into three overlapping stages:
+#    read     - A read thread reads body chunks from the local http response into pooled buffers.
+#    compress - The web stream thread (the caller) takes chunks with Read(), compresses them, and builds the message.
+#    send     - A send thread sends the finished messages to the OctoStream, in the order they were queued.
+#
+# Each stage is bounded by MemoryManager.OctoWebStreamHttpHelper_MaxPipelineStageBufferedBytes, so if the websocket is slow
+# the read thread will stop reading rather than buffering the entire body in memory.
+#
+# This is only used for bodies with a known content length, since those are the big file downloads that benefit from it.
+# Streams with unknown lengths, boundary streams, and full body buffers all use the normal single thread logic.
+#
+class HttpBodyPipeline:
+
+    def __init__(self, logger:logging.Logger, streamId:int, webStream:IWebStream, readIntoCallback:Callable[[bytearray, int, int], int], contentLength:int, readSizeBytes:int, maxStageBufferedBytes:Optional[int]=None) -> None:
+        self.Logger = logger
+        self.StreamId = streamId
+        self.WebStream = webStream
+        self.ReadIntoCallback = readIntoCallback
+        self.ContentLength = contentLength
+        self.ReadSizeBytes = max(1, readSizeBytes)
+        if maxStageBufferedBytes is None:
+            maxStageBufferedBytes = MemoryManager.OctoWebStreamHttpHelper_MaxPipelineStageBufferedBytes
+        self.MaxStageBufferedBytes = maxStageBufferedBytes
+        self.Timer = PipelineStageTimer()
+        self.IsClosed = False
+
+        # The read stage. We always allow at least two buffers, so one can be read into while the other is being compressed.
+        self.ReadLock = threading.Condition()
+        self.MaxReadBuffers = max(2, self.MaxStageBufferedBytes // self.ReadSizeBytes)
+        self.ReadBuffersCreated = 0
+        self.FreeReadBuffers:List[bytearray] = []
+        self.ReadyReads:Deque[Tuple[bytearray, int]] = collections.deque()
+        self.ReadComplete = False
+        self.TotalBytesRead = 0
+        # Set if the read thread failed, in which case the body is incomplete and the stream is closed.
+        self.ReadException:Optional[Exception] = None
+
+        # The send stage.
+        self.SendLock = threading.Condition()
+        self.SendQueue:Deque[PipelineSendContext] = collections.deque()
+        self.SendQueueSizeBytes = 0
+        self.IsSending = False
+
+        # Start the threads. Mark them as daemons so they never hold up the process from shutting down.
+        self.ReadThread = threading.Thread(target=self._ReadThreadWorker, name="HttpBodyPipelineRead", daemon=True)
+        self.SendThread = threading.Thread(target=self._SendThreadWorker, name="HttpBodyPipelineSend", daemon=True)
+        self.ReadThread.start()
+        self.SendThread.start()
+
+
+    # Stops the read and send threads. Any messages that haven't been sent yet are dropped.
+    # This is also called when the request is done, even if it threw, so it ends the compress stage if the caller was in the middle of one.
+    # IMPORTANT NOTE - This must not block, since it's called from the web stream close, which is on the main websocket thread.
+    def CloseAsync(self) -> None:
+        self.IsClosed = True
+        self.Timer.StageEnd(PipelineStageTimer.StageCompress)
+        with self.ReadLock:
+            self.ReadLock.notify_all()
+        with self.SendLock:
+            self.SendLock.notify_all()
+
+
+    # Blocks until the next read chunk is ready. Returns the buffer and the number of bytes read into it.
+    # Returns None if the body is fully read or the pipeline was closed.
+    # If the read failed, this returns None, ReadException is set, and the stream has been closed, so the caller must not send the body as done.
+    # The buffer MUST be given back with ReturnReadBuffer when the caller is done with it.
+    def Read(self) -> Optional[Tuple[bytearray, int]]:
+        with self.ReadLock:
+            while True:
+                if self.IsClosed:
+                    return None
+                if len(self.ReadyReads) > 0:
+                    break
+                if self.ReadComplete:
+                    return None
+                self.ReadLock.wait()
+            result = self.ReadyReads.popleft()
+        # Once the caller has the chunk, it's doing the compress and message build work.
+        self.Timer.StageStart(PipelineStageTimer.StageCompress)
+        return result
+
+
+    # Gives a read buffer back to the pool so the read thread can use it again.
+    def ReturnReadBuffer(self, buffer:bytearray) -> None:
+        with self.ReadLock:
+            self.FreeReadBuffers.append(buffer)
+            self.ReadLock.notify_all()
+
+
+    # Queues a finished message to be sent. Messages are always sent in the order they are queued.
+    # This will block if too much data is already waiting to be sent.
+    def QueueSend(self, buffer:Buffer, msgStartOffsetBytes:int, msgSizeBytes:int, isCloseFlagSet:bool) -> None:
+        self.Timer.StageEnd(PipelineStageTimer.StageCompress)
+        with self.SendLock:
+            # Always allow at least one message in the queue, or a single large message could never be sent.
+            while self.IsClosed is False and self.SendQueueSizeBytes > 0 and self.SendQueueSizeBytes + msgSizeBytes > self.MaxStageBufferedBytes:
+                self.SendLock.wait()
+            if self.IsClosed:
+                return
+            self.SendQueue.append(PipelineSendContext(buffer, msgStartOffsetBytes, msgSizeBytes, isCloseFlagSet))
+            self.SendQueueSizeBytes += msgSizeBytes
+            self.SendLock.notify_all()
+
+
+    # Blocks until all of the queued messages have been sent or the pipeline is closed.
+    # This must be called before the http request returns, so the final message (with the close flag) is sent before the web stream closes.
+    def WaitForSendsComplete(self) -> None:
+        with self.SendLock:
+            while self.IsClosed is False and (len(self.SendQueue) > 0 or self.IsSending):
+                self.SendLock.wait()
+
+
+    # Returns how long the read stage was actively reading.
+    def GetReadTimeSec(self) -> float:
+        return self.Timer.GetBusyTimeSec(PipelineStageTimer.StageRead)
+
+
+    # Returns how long the send stage was actively sending.
+    def GetSendTimeSec(self) -> float:
+        return self.Timer.GetBusyTimeSec(PipelineStageTimer.StageSend)
+
+
+    def GetStatsStr(self) -> str:
+        return self.Timer.GetStatsStr()
+
+
+    def _ReadThreadWorker(self) -> None:
+        try:
+            while self.IsClosed is False:
+                # Stop once we have read the full known length.
+                remainingBytes = self.ContentLength - self.TotalBytesRead
+                if remainingBytes <= 0:
+                    break
+
+                # Get a buffer to read into, waiting for one to be returned if we are at the limit.
+                buffer:Optional[bytearray] = None
+                with self.ReadLock:
+                    while self.IsClosed is False and len(self.FreeReadBuffers) == 0 and self.ReadBuffersCreated >= self.MaxReadBuffers:
+                        self.ReadLock.wait()
+                    if self.IsClosed:
+                        break
+                    if len(self.FreeReadBuffers) > 0:
+                        buffer = self.FreeReadBuffers.pop()
+                    else:
+                        self.ReadBuffersCreated += 1
+                if buffer is None:
+                    buffer = bytearray(self.ReadSizeBytes)
+
+                # Do the read.
+                self.Timer.StageStart(PipelineStageTimer.StageRead)
+                try:
+                    bytesRead = self.ReadIntoCallback(buffer, 0, min(self.ReadSizeBytes, remainingBytes))
+                finally:
+                    self.Timer.StageEnd(PipelineStageTimer.StageRead)
+
+                # If nothing was read, the body is done.
+                if bytesRead <= 0:
+                    self.ReturnReadBuffer(buffer)
+                    break
+
+                self.TotalBytesRead += bytesRead
+                with self.ReadLock:
+                    self.ReadyReads.append((buffer, bytesRead))
+                    self.ReadLock.notify_all()
+        except Exception as e:
+            # The body can't be finished, so close the stream rather than letting the caller send what it has as the full body.
+            # The web stream close closes the http helper first, so the caller sees it's closed when the read returns None.
+            Sentry.OnException(self._GetLogMsgPrefix()+" exception thrown in the read thread. Closing the stream.", e)
+            self.ReadException = e
+            self.WebStream.Close()
+            self.CloseAsync()
+        finally:
+            with self.ReadLock:
+                self.ReadComplete = True
+                self.ReadLock.notify_all()
+
+
+    def _SendThreadWorker(self) -> None:
+        try:
+            while True:
+                with self.SendLock:
+                    while self.IsClosed is False and len(self.SendQueue) == 0:
+                        self.SendLock.wait()
+                    if self.IsClosed:
+                        return
+                    context = self.SendQueue.popleft()
+                    self.IsSending = True
+
+                try:
+                    self.Timer.StageStart(PipelineStageTimer.StageSend)
+                    self.WebStream.SendToOctoStream(context.Buffer, context.MsgStartOffsetBytes, context.MsgSizeBytes, context.IsCloseFlagSet, True)
+                finally:
+                    self.Timer.StageEnd(PipelineStageTimer.StageSend)
+                    with self.SendLock:
+                        self.IsSending = False
+                        self.SendQueueSizeBytes -= context.MsgSizeBytes
+                        self.SendLock.notify_all()
+        except Exception as e:
+            Sentry.OnException(self._GetLogMsgPrefix()+" exception thrown in the send thread.", e)
+            # If the send thread dies, nothing else can be sent, so close the stream.
+            self.CloseAsync()
+            self.WebStream.Close()
+
+
+    def _GetLogMsgPrefix(self) -> str:
+        return "Http Body Pipeline ["+str(self.StreamId)+"]"
@@ -15,6 +15,9 @@ from ..websocketimpl import Client
 from ..interfaces import IWebStream, IWebSocketClient, WebSocketOpCode
 from ..localip import LocalIpHelper
 from ..compression import Compression, CompressionContext, CompressionResult
+from ..negotiatedfeatures import NegotiatedFeatures
+from ..compressibility import Compressibility
+from ..zstandarddictionary import ZStandardDictionary
 from .octoheaderimpl import HeaderHelper
 from ..octohttprequest import OctoHttpRequest
 from ..octostreammsgbuilder import OctoStreamMsgBuilder
@@ -40,7 +43,7 @@ class OctoWebStreamWsHelper:
 
     # Called by the main socket thread so this should be quick!
     # Throwing from here will shutdown the entire connection.
-    def __init__(self, streamId:int, logger:logging.Logger, webStream:IWebStream, webStreamOpenMsg:WebStreamMsg.WebStreamMsg, openedTime:float):
+    def __init__(self, streamId:int, logger:logging.Logger, webStream:IWebStream, webStreamOpenMsg:WebStreamMsg.WebStreamMsg, openedTime:float, negotiatedFeatures:Optional[NegotiatedFeatures]=None):
         self.Id = streamId
         self.Logger = logger
         self.WebStream = webStream
@@ -53,6 +56,9 @@ class OctoWebStreamWsHelper:
         self.ResolvedLocalHostnameUrl:Optional[str] = None
         self.LookingForConnectMsgAttempts = 0
         self.CompressionContext = CompressionContext(self.Logger)
+        # The websocket messages are mostly json, like json-rpc and the printer status messages.
+        self.CompressionContext.SetTrafficClass(ZStandardDictionary.c_TrafficClassJson)
+        self.CompressionContext.SetNegotiatedFeatures(negotiatedFeatures)
         self.DisableBinaryCompression = False
         self.BinaryCompressionInefficientCount = 0
 
@@ -461,6 +467,11 @@ class OctoWebStreamWsHelper:
             usingCompression = len(buffer) >= Compression.MinSizeToCompress
             if sendType == WebSocketDataTypes.WebSocketDataTypes.Binary and self.DisableBinaryCompression:
                 usingCompression = False
+            # Binary payloads are often already compressed (video, images), so check that a binary message is worth compressing first.
+            # Skipping a message is safe, it just bypasses the compression stream, and it counts towards disabling binary compression for the stream.
+            if usingCompression and sendType == WebSocketDataTypes.WebSocketDataTypes.Binary and Compressibility.IsCompressible(buffer.Get()) is False:
+                usingCompression = False
+                self.onBinaryCompressionInefficient()
             originalDataSize = 0
             compressionResult:Optional[CompressionResult] = None
             if usingCompression:
@@ -479,13 +490,7 @@ class OctoWebStreamWsHelper:
                 if sendType == WebSocketDataTypes.WebSocketDataTypes.Binary:
                     minCompressedSizeThreshold = int(float(originalDataSize) * (1.0 - self.c_BinaryCompressionMinSavingsRatio))
                     if compressedSize >= minCompressedSizeThreshold:
-                        self.BinaryCompressionInefficientCount += 1
-                        if self.BinaryCompressionInefficientCount >= self.c_BinaryCompressionDisableAfterCount:
-                            self.DisableBinaryCompression = True
-                            self.Logger.info(
-                                "%sbinary compression disabled for this stream after repeated inefficient results.",
-                                self.getLogMsgPrefix(),
-                            )
+                        self.onBinaryCompressionInefficient()
                     else:
                         self.BinaryCompressionInefficientCount = 0
 
@@ -575,5 +580,16 @@ class OctoWebStreamWsHelper:
         self.Logger.info(self.getLogMsgPrefix()+"opened, attempt "+str(self.ConnectionAttempt) + " after " +str(time.time() - self.OpenedTime) + " seconds")
 
 
+    # Called when a binary message wasn't worth compressing. After enough of them, binary compression is disabled for this stream.
+    def onBinaryCompressionInefficient(self) -> None:
+        self.BinaryCompressionInefficientCount += 1
+        if self.BinaryCompressionInefficientCount >= self.c_BinaryCompressionDisableAfterCount and self.DisableBinaryCompression is False:
+            self.DisableBinaryCompression = True
+            self.Logger.info(
+                "%sbinary compression disabled for this stream after repeated inefficient results.",
+                self.getLogMsgPrefix(),
+            )
+
+
     def getLogMsgPrefix(self) -> str:
         return "Web Stream ws   ["+str(self.Id)+"] "
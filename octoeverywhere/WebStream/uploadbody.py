@@ -1,14 +1,17 @@
 from enum import Enum
 import logging
 import os
+import time
 import threading
+import collections
 import uuid
 import zlib
 import tempfile
 from urllib.parse import quote
-from typing import Any, BinaryIO, Callable, Dict, List, Optional, Union
+from typing import Any, BinaryIO, Callable, Deque, Dict, List, Optional, Tuple, Union
 
 from ..memorymanager import MemoryManager
+from ..sendbufferpool import SendBufferPool
 from ..Proto.DataCompression import DataCompression
 from ..buffer import Buffer, BufferOrNone, ByteLike
 from ..compression import Compression, CompressionContext
@@ -16,7 +19,7 @@ from ..compression import Compression, CompressionContext
 UploadBodyOrNone = Union[None, "UploadBody"]
 UploadBodyBufferOrNone = Union[BufferOrNone, "UploadBody"]
 UploadTypesOrNone = Union[None, "UploadBody", "MultipartFormUploadBody"]
-UploadTypesBufferOrNone = Union[BufferOrNone, "UploadBody", "MultipartFormUploadBody"]
+UploadTypesBufferOrNone = Union[BufferOrNone, "UploadBody", "MultipartFormUploadBody", "StreamingUploadBody"]
 BufferedReaderBytesOrNone = Union[BinaryIO, ByteLike, None]
 
 
@@ -344,20 +347,52 @@ class UploadBody:
             # The stream was cleaned up (e.g. closed mid-upload) while data was still arriving. Drop it quietly.
             self._Debug("ignoring upload data because the body was already cleaned up.")
             return
-        if self._state != UploadBodyState.Building:
-            raise Exception("OctoWebStreamUploadBody tried to append after finalize.")
-
         rawDataLen = webStreamMsg.DataLength()
         if rawDataLen <= 0:
             self._Warn("is waiting on upload data but got a message with no data.")
             return
+        compressionType, originalSizeBytes = self._GetMessageCompression(webStreamMsg)
+        self._Append(Buffer(webStreamMsg.DataAsByteArray()), originalSizeBytes, compressionType, webStreamMsg.IsDataTransmissionDone())
+
+
+    # Appends data that has already been decompressed, like the data a StreamingUploadBody has already sent, so it can be sent again.
+    def AppendData(self, data:Buffer, isLastMessage:bool) -> None:
+        if len(data) == 0:
+            return
+        self._Append(data, len(data), DataCompression.None_, isLastMessage)
+
+
+    # Returns the decompressed data of a message without adding it to this body.
+    # The messages must be passed in order, since the compression context might be streaming.
+    def DecompressMessageData(self, webStreamMsg:Any) -> Optional[Buffer]:
+        rawDataLen = webStreamMsg.DataLength()
+        if rawDataLen <= 0:
+            return None
+        compressionType, originalSizeBytes = self._GetMessageCompression(webStreamMsg)
+        chunk = _UploadChunk(0, rawDataLen, originalSizeBytes, compressionType, webStreamMsg.IsDataTransmissionDone())
+        return self._GetDecompressedChunk(chunk, Buffer(webStreamMsg.DataAsByteArray()))
+
 
+    def _GetMessageCompression(self, webStreamMsg:Any) -> Tuple[int, int]:
         compressionType = webStreamMsg.DataCompression()
-        originalSizeBytes = rawDataLen
+        originalSizeBytes = webStreamMsg.DataLength()
         if compressionType != DataCompression.None_:
             originalSizeBytes = int(webStreamMsg.OriginalDataSize())
             if originalSizeBytes <= 0:
                 raise Exception("Compressed upload message had no original data size.")
+        return compressionType, originalSizeBytes
+
+
+    def _Append(self, rawData:Buffer, originalSizeBytes:int, compressionType:int, isLastMessage:bool) -> None:
+        if self._state == UploadBodyState.CleanedUp:
+            # The stream was cleaned up (e.g. closed mid-upload) while data was still arriving. Drop it quietly.
+            self._Debug("ignoring upload data because the body was already cleaned up.")
+            return
+        if self._state != UploadBodyState.Building:
+            raise Exception("OctoWebStreamUploadBody tried to append after finalize.")
+
+        rawDataLen = len(rawData)
+        if compressionType != DataCompression.None_:
             self._hasCompressedChunks = True
 
         projectedUploadBytes = self.UploadBytesReceivedSoFar + originalSizeBytes
@@ -365,8 +400,6 @@ class UploadBody:
             self._Warn("received more bytes than it was expecting for the upload. thisMsg:"+str(originalSizeBytes)+"; so far:"+str(self.UploadBytesReceivedSoFar) + "; expected:"+str(self.KnownFullUploadSizeBytes))
             raise Exception("Too many bytes received for http upload buffer")
 
-        rawData = Buffer(webStreamMsg.DataAsByteArray())
-
         # Mark an append as in-progress under the lock so a concurrent Cleanup() (which can be called from the
         # socket close path on a different thread) won't tear down the storage we're about to write to. We do the
         # actual write outside the lock so we never block the close path on disk IO - instead, Cleanup() defers the
@@ -385,9 +418,9 @@ class UploadBody:
                 self._SwitchToFile("upload exceeded in-memory limit")
 
             if self._usingFile:
-                self._AppendRawDataToFile(rawData, originalSizeBytes, compressionType, webStreamMsg.IsDataTransmissionDone())
+                self._AppendRawDataToFile(rawData, originalSizeBytes, compressionType, isLastMessage)
             else:
-                self._chunks.append(_UploadChunk(0, rawDataLen, originalSizeBytes, compressionType, webStreamMsg.IsDataTransmissionDone(), rawData))
+                self._chunks.append(_UploadChunk(0, rawDataLen, originalSizeBytes, compressionType, isLastMessage, rawData))
 
             self.UploadBytesReceivedSoFar = projectedUploadBytes
             self._Debug("received upload data chunk. using file: %s; bytes in this msg: %s; total received so far: %s; known full size: %s", str(self._usingFile), originalSizeBytes, self.UploadBytesReceivedSoFar, self.KnownFullUploadSizeBytes)
@@ -642,17 +675,37 @@ class UploadBody:
 
 
     def _CopyBytes(self, source:BinaryIO, target:BinaryIO, bytesToCopy:int) -> int:
-        bytesRemaining = bytesToCopy
-        totalCopied = 0
-        while bytesRemaining > 0:
-            readSize = min(bytesRemaining, UploadBody.c_FileCopyBufferSizeBytes)
-            data = source.read(readSize)
-            if len(data) == 0:
-                raise Exception("OctoWebStreamUploadBody hit EOF while copying upload data.")
-            target.write(data)
-            bytesRemaining -= len(data)
-            totalCopied += len(data)
-        return totalCopied
+        # If we can, copy through a pooled buffer, so we don't allocate a new chunk for every read.
+        pool = SendBufferPool.GetIfEnabled()
+        if pool is None:
+            bytesRemaining = bytesToCopy
+            totalCopied = 0
+            while bytesRemaining > 0:
+                readSize = min(bytesRemaining, UploadBody.c_FileCopyBufferSizeBytes)
+                data = source.read(readSize)
+                if len(data) == 0:
+                    raise Exception("OctoWebStreamUploadBody hit EOF while copying upload data.")
+                target.write(data)
+                bytesRemaining -= len(data)
+                totalCopied += len(data)
+            return totalCopied
+
+        copyBuffer = pool.Rent(min(bytesToCopy, UploadBody.c_FileCopyBufferSizeBytes))
+        try:
+            with memoryview(copyBuffer.ForceAsByteArray()) as copyView:
+                bytesRemaining = bytesToCopy
+                totalCopied = 0
+                while bytesRemaining > 0:
+                    readSize = min(bytesRemaining, UploadBody.c_FileCopyBufferSizeBytes)
+                    bytesRead = source.readinto(copyView[:readSize]) #pyright: ignore[reportAttributeAccessIssue]
+                    if bytesRead is None or bytesRead == 0:
+                        raise Exception("OctoWebStreamUploadBody hit EOF while copying upload data.")
+                    target.write(copyView[:bytesRead])
+                    bytesRemaining -= bytesRead
+                    totalCopied += bytesRead
+                return totalCopied
+        finally:
+            pool.Return(copyBuffer)
 
 
     def _SwitchToFile(self, reason:str) -> None:
@@ -737,3 +790,286 @@ class UploadBody:
         if self.Logger.isEnabledFor(logging.WARNING) is False:
             return
         self.Logger.warning(self._LogPrefix() + " " + message, *args)
+
+
+# Streams an upload to the local server while it's still arriving over the web stream, instead of building the full body first.
+# This is used for big uploads like gcode files, so the server can start receiving the file right away and we don't write the whole file to disk first.
+#
+# The upload messages are decompressed and queued as they arrive, and the http request reads them from the queue.
+# If the queue is full, AppendMessage blocks, which blocks the thread that's handling the web stream messages until the backend reads more.
+# Since that can stall the other streams and time out the upload if the backend is slow, this is off by default.
+#
+# If the upload size is known, it's sent with a content length. Otherwise it's sent with chunked transfer encoding, and until we know the
+# backend supports chunked request bodies, the upload is also spooled to an UploadBody so it can be sent again if the backend refuses it.
+class StreamingUploadBody:
+
+    # If enabled, big uploads are streamed to the server as they arrive, instead of building the full upload body before making the request.
+    # This is off by default, it can be turned on with the setter or the OCTO_STREAMING_UPLOADS=1 env var.
+    Enabled = os.environ.get("OCTO_STREAMING_UPLOADS", "0") == "1"
+
+    # Uploads with a known size smaller than this are built in memory before the request, since there's not much to gain by streaming them.
+    c_MinKnownSizeBytes = 2 * MemoryManager.MB
+
+    # Only requests that send a body are streamed.
+    c_StreamMethods = ("POST", "PUT", "PATCH")
+
+    # The status codes a server returns if it doesn't support chunked transfer encoding request bodies.
+    c_ChunkedRefusedStatusCodes = (411, 501)
+
+    # The read size used when the body is iterated.
+    c_IterChunkSizeBytes = 64 * 1024
+
+    # Remembers if each backend supports chunked request bodies.
+    _ChunkedSupport:Dict[str, bool] = {}
+    _ChunkedSupportLock = threading.Lock()
+
+
+    @staticmethod
+    def SetEnabled(enabled:bool) -> None:
+        StreamingUploadBody.Enabled = enabled
+
+
+    @staticmethod
+    def GetChunkedSupport(backendKey:str) -> Optional[bool]:
+        with StreamingUploadBody._ChunkedSupportLock:
+            return StreamingUploadBody._ChunkedSupport.get(backendKey, None)
+
+
+    @staticmethod
+    def SetChunkedSupport(backendKey:str, isSupported:Optional[bool]) -> None:
+        with StreamingUploadBody._ChunkedSupportLock:
+            if isSupported is None:
+                StreamingUploadBody._ChunkedSupport.pop(backendKey, None)
+            else:
+                StreamingUploadBody._ChunkedSupport[backendKey] = isSupported
+
+
+    # Returns true if an upload should be streamed. Uploads with an unknown size are only streamed if the backend hasn't refused chunked bodies before.
+    @staticmethod
+    def ShouldStream(method:str, knownFullUploadSizeBytes:Optional[int], backendKey:str) -> bool:
+        if StreamingUploadBody.Enabled is False or method.upper() not in StreamingUploadBody.c_StreamMethods:
+            return False
+        if knownFullUploadSizeBytes is None:
+            return StreamingUploadBody.GetChunkedSupport(backendKey) is not False
+        return knownFullUploadSizeBytes >= StreamingUploadBody.c_MinKnownSizeBytes
+
+
+    # The upload body is used for decompression, and to spool the upload if needed.
+    # The backend key identifies the server the upload is sent to, so we can remember if it supports chunked bodies.
+    # If the request has fallback routes, the upload is spooled, since this body can only be read by the first route and the others would be skipped.
+    def __init__(self, logger:Any, streamId:int, uploadBody:UploadBody, backendKey:str, hasFallbackRoutes:bool=False, maxQueuedBytes:Optional[int]=None) -> None:
+        self.Logger = logger
+        self.StreamId = streamId
+        self.UploadBody = uploadBody
+        self.BackendKey = backendKey
+        self.HasFallbackRoutes = hasFallbackRoutes
+        self.KnownFullUploadSizeBytes = uploadBody.KnownFullUploadSizeBytes
+        self.IsChunked = self.KnownFullUploadSizeBytes is None
+        self.IsSpooling = hasFallbackRoutes or (self.IsChunked and StreamingUploadBody.GetChunkedSupport(backendKey) is not True)
+        self.MaxQueuedBytes = maxQueuedBytes if maxQueuedBytes is not None else MemoryManager.OctoWebStreamHttpHelper_MaxStreamingUploadQueuedBytes
+
+        self._condition = threading.Condition()
+        self._chunks:Deque[memoryview] = collections.deque()
+        self._queuedBytes = 0
+        self._isFinished = False
+        self._isAborted = False
+        # Set when the request is done with the queue, but the upload is still being spooled.
+        self._isOnlySpooling = False
+        self._finishedEvent = threading.Event()
+        self.UploadBytesReceivedSoFar = 0
+        # The number of bytes the request has read.
+        self.Position = 0
+
+        # Stats
+        self.CreatedTimeSec = time.time()
+        self.FirstReadTimeSec:Optional[float] = None
+        self.BackpressureTimeSec = 0.0
+
+
+    @property
+    def IsAborted(self) -> bool:
+        return self._isAborted
+
+
+    @property
+    def IsFinished(self) -> bool:
+        return self._isFinished
+
+
+    # Called in order for each upload message, on the web stream's message thread.
+    # This will block if the queue is full, until the request reads more data or the upload is aborted.
+    def AppendMessage(self, webStreamMsg:Any) -> None:
+        if self._isAborted:
+            # The request is already done or the stream was closed, so the data isn't needed.
+            return
+        isLastMessage = webStreamMsg.IsDataTransmissionDone()
+        data = self.UploadBody.DecompressMessageData(webStreamMsg)
+        if data is not None and len(data) > 0:
+            self.UploadBytesReceivedSoFar += len(data)
+            if self.KnownFullUploadSizeBytes is not None and self.UploadBytesReceivedSoFar > self.KnownFullUploadSizeBytes:
+                raise Exception("Too many bytes received for http upload buffer. so far:"+str(self.UploadBytesReceivedSoFar) + "; expected:"+str(self.KnownFullUploadSizeBytes))
+            if self.IsSpooling:
+                self.UploadBody.AppendData(data, isLastMessage)
+            self._Queue(data)
+        if isLastMessage:
+            self.Finish()
+
+
+    # Called when all of the upload has been received.
+    # If the upload was aborted, because the request finished early or the stream closed, the rest of the upload was dropped, so there's nothing to check.
+    def Finish(self) -> None:
+        if self._isAborted:
+            return
+        if self.KnownFullUploadSizeBytes is not None and self.UploadBytesReceivedSoFar != self.KnownFullUploadSizeBytes:
+            self.Abort()
+            raise Exception("Http streaming upload finished, but we haven't gotten all of the upload payload. Total:"+str(self.KnownFullUploadSizeBytes)+"; rec so far:"+str(self.UploadBytesReceivedSoFar))
+        with self._condition:
+            if self._isFinished:
+                return
+            self._isFinished = True
+            self._condition.notify_all()
+        self._finishedEvent.set()
+        if self.Logger.isEnabledFor(logging.DEBUG):
+            firstReadDelaySec = -1.0 if self.FirstReadTimeSec is None else self.FirstReadTimeSec - self.CreatedTimeSec
+            self.Logger.debug("Web Stream http - streaming upload - [%s] all upload data received. bytes: %d; chunked: %s; spooling: %s; first read after: %.3fs; backpressure: %.3fs", self.StreamId, self.UploadBytesReceivedSoFar, self.IsChunked, self.IsSpooling, firstReadDelaySec, self.BackpressureTimeSec)
+
+
+    # Stops the upload, any blocked appends return and any reads throw.
+    # Called when the request is done, or when the stream is closed.
+    def Abort(self) -> None:
+        with self._condition:
+            self._isAborted = True
+            self._chunks.clear()
+            self._queuedBytes = 0
+            self._condition.notify_all()
+        self._finishedEvent.set()
+
+
+    # Returns true if the body can be sent, which is only true if no other request has read any of it.
+    def CanSend(self) -> bool:
+        return self.Position == 0 and self._isAborted is False
+
+
+    # Removes the headers that conflict with how this body is sent. The content length is set by requests from the length of this object.
+    def PrepareHeaders(self, headers:Dict[str, str]) -> None:
+        for name in list(headers.keys()):
+            if name.lower() in ("content-length", "transfer-encoding"):
+                del headers[name]
+
+
+    # Called with the result of the request that used this body.
+    # The spooled upload is sent again using makeRequest, once all of it has arrived, if the backend refused the chunked body,
+    # or if a route read the body but failed, since then the fallback routes couldn't be sent the body.
+    def OnRequestResult(self, result:Any, makeRequest:Callable[[UploadBody], Any]) -> Any:
+        isChunkedRefused = False
+        if self.IsChunked and result is not None:
+            isChunkedRefused = result.StatusCode in StreamingUploadBody.c_ChunkedRefusedStatusCodes
+            StreamingUploadBody.SetChunkedSupport(self.BackendKey, isChunkedRefused is False)
+        isFallbackNeeded = self.HasFallbackRoutes and self.Position > 0 and (result is None or result.StatusCode == 404)
+        if self.IsSpooling is False or (isChunkedRefused is False and isFallbackNeeded is False):
+            return result
+        if isChunkedRefused and result is not None:
+            self.Logger.info("Web Stream http - streaming upload - [%s] the backend refused the chunked upload with %s, sending the spooled upload instead.", self.StreamId, result.StatusCode)
+        else:
+            self.Logger.info("Web Stream http - streaming upload - [%s] the route failed with %s, sending the spooled upload to the fallback routes.", self.StreamId, "no response" if result is None else result.StatusCode)
+        if result is not None:
+            result.Free()
+        # Nothing reads the queue anymore, so stop queuing, or the appends would block forever.
+        with self._condition:
+            self._isOnlySpooling = True
+            self._chunks.clear()
+            self._queuedBytes = 0
+            self._condition.notify_all()
+        # The upload might still be arriving, so wait for all of it. If the stream is closed, the upload is aborted.
+        while self._finishedEvent.wait(60) is False:
+            pass
+        if self._isAborted:
+            return None
+        self.UploadBody.Finalize()
+        return makeRequest(self.UploadBody)
+
+
+    #
+    # The file like interface used by requests to send the body.
+    #
+
+    # Requests uses the length for the content length. A length of 0 makes it use chunked transfer encoding.
+    def __len__(self) -> int:
+        return self.KnownFullUploadSizeBytes if self.KnownFullUploadSizeBytes is not None else 0
+
+
+    # Requests replaces a false body with an empty form, so this is always true, even when the length is 0.
+    def __bool__(self) -> bool:
+        return True
+
+
+    # Having an iterator makes requests treat this as a stream, rather than a form body.
+    def __iter__(self) -> Any:
+        while True:
+            data = self.read(StreamingUploadBody.c_IterChunkSizeBytes)
+            if len(data) == 0:
+                return
+            yield data
+
+
+    def tell(self) -> int:
+        return self.Position
+
+
+    # Blocks until there's data, and returns up to size bytes. Returns an empty buffer when all of the upload has been read.
+    def read(self, size:Optional[int]=-1) -> Union[bytes, memoryview]:
+        with self._condition:
+            if self.FirstReadTimeSec is None:
+                self.FirstReadTimeSec = time.time()
+            while len(self._chunks) == 0 and self._isFinished is False and self._isAborted is False:
+                self._condition.wait(1.0)
+            if self._isAborted:
+                raise Exception("The streaming upload was aborted.")
+            if len(self._chunks) == 0:
+                return b""
+            if size is None or size < 0:
+                size = self._queuedBytes
+
+            # Most of the time the read size is smaller than a message, so we return a slice of it without copying.
+            chunk = self._chunks[0]
+            if len(chunk) > size:
+                self._chunks[0] = chunk[size:]
+                result:Union[bytes, memoryview] = chunk[:size]
+            else:
+                self._chunks.popleft()
+                result = chunk
+                if len(chunk) < size and len(self._chunks) > 0:
+                    parts = [chunk]
+                    readSize = len(chunk)
+                    while readSize < size and len(self._chunks) > 0:
+                        nextChunk = self._chunks[0]
+                        take = min(len(nextChunk), size - readSize)
+                        if take == len(nextChunk):
+                            self._chunks.popleft()
+                        else:
+                            self._chunks[0] = nextChunk[take:]
+                        parts.append(nextChunk[:take])
+                        readSize += take
+                    result = b"".join(parts)
+            self._queuedBytes -= len(result)
+            self.Position += len(result)
+            self._condition.notify_all()
+            return result
+
+
+    def _Queue(self, data:Buffer) -> None:
+        view = memoryview(data.Get())
+        with self._condition:
+            blockStartSec:Optional[float] = None
+            # Always allow a message in if nothing is queued, or a single large message could never fit.
+            while self._isAborted is False and self._isOnlySpooling is False and self._queuedBytes > 0 and self._queuedBytes + len(view) > self.MaxQueuedBytes:
+                if blockStartSec is None:
+                    blockStartSec = time.time()
+                self._condition.wait(1.0)
+            if blockStartSec is not None:
+                self.BackpressureTimeSec += time.time() - blockStartSec
+            if self._isAborted or self._isOnlySpooling:
+                return
+            self._chunks.append(view)
+            self._queuedBytes += len(view)
+            self._condition.notify_all()
@@ -0,0 +1,244 @@
+import os
+import time
+import heapq
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from ..sentry import Sentry
+from ..memorymanager import MemoryManager
+
+
+# A single piece of scheduled work, which is tracked by the worker running it.
+class WorkerPoolTask:
+    def __init__(self, priority:int, seq:int, work:Callable[[], None]) -> None:
+        self.Priority = priority
+        self.Seq = seq
+        self.Work = work
+        self.QueuedSec = time.time()
+
+
+#
+# A bounded, priority-aware worker pool that web streams can run on instead of each stream having its own thread.
+#
+# Streams schedule work when they have incoming messages, and a worker runs the stream until its message queue is empty.
+# Work is picked up in priority order (lower values first, matching the MessagePriority values) and then in the order it was scheduled.
+#
+# The number of workers is bounded by MemoryManager.OctoWebStream_MaxWorkerPoolThreads. Workers are reused and exit after being idle for a while.
+# Some stream work can run for a long time (like webcam streams, event streams, or downloads), since the worker pumps the whole response body.
+# So those can't starve the pool, a worker that has been running one task for longer than c_LongRunningTaskSec is detached from the pool.
+# It keeps running the task on its own thread and no longer counts against the worker limit. When the task is done, the thread rejoins the pool
+# if there's room, otherwise it exits.
+#
+# The detached workers are also bounded, by MemoryManager.OctoWebStream_MaxWorkerPoolDetachedThreads. Once that many are detached, long running
+# tasks keep their workers and new work waits in the queue until a worker is free. So the pool never has more than the sum of the two limits
+# of threads, no matter how many streams are open. Websocket streams live as long as the socket, so they don't run on the pool at all.
+#
+class WebStreamWorkerPool:
+
+    # Workers that haven't had work for this long will exit.
+    c_WorkerIdleTimeoutSec = 30.0
+
+    # A task that has been running this long is considered long running, and its worker is detached from the pool.
+    c_LongRunningTaskSec = 5.0
+
+    # If enabled, new web streams will run on the worker pool rather than their own thread.
+    # This is off by default, it can be turned on with the setter or the OCTO_WEBSTREAM_WORKER_POOL=1 env var.
+    Enabled = os.environ.get("OCTO_WEBSTREAM_WORKER_POOL", "0") == "1"
+
+    _Instance:Optional["WebStreamWorkerPool"] = None
+
+
+    @staticmethod
+    def Init(logger:logging.Logger) -> None:
+        WebStreamWorkerPool._Instance = WebStreamWorkerPool(logger)
+
+
+    @staticmethod
+    def Get() -> Optional["WebStreamWorkerPool"]:
+        return WebStreamWorkerPool._Instance
+
+
+    @staticmethod
+    def SetEnabled(enabled:bool) -> None:
+        WebStreamWorkerPool.Enabled = enabled
+
+
+    # Returns the pool if it's enabled and has been setup, otherwise None.
+    @staticmethod
+    def GetIfEnabled() -> Optional["WebStreamWorkerPool"]:
+        if WebStreamWorkerPool.Enabled is False:
+            return None
+        return WebStreamWorkerPool._Instance
+
+
+    def __init__(self, logger:logging.Logger, maxWorkers:Optional[int]=None, maxDetachedWorkers:Optional[int]=None) -> None:
+        self.Logger = logger
+        self.MaxWorkers = maxWorkers if maxWorkers is not None else MemoryManager.OctoWebStream_MaxWorkerPoolThreads
+        self.MaxDetachedWorkers = maxDetachedWorkers if maxDetachedWorkers is not None else MemoryManager.OctoWebStream_MaxWorkerPoolDetachedThreads
+        self.Lock = threading.Condition()
+        self.ReadyQueue:List[Tuple[int, int, WorkerPoolTask]] = []
+        self.NextSeq = 0
+        self.WorkerCount = 0
+        self.IdleWorkerCount = 0
+        # The tasks that are currently running, by worker id.
+        self.RunningTasks:Dict[int, WorkerPoolTask] = {}
+        self.RunningTaskStartSec:Dict[int, float] = {}
+        # The workers that are running a long task and have been detached from the pool.
+        self.DetachedWorkerIds:Set[int] = set()
+        self.NextWorkerId = 0
+        self.MonitorThread:Optional[threading.Thread] = None
+
+        # Stats
+        self.PeakWorkerCount = 0
+        self.TotalTasks = 0
+        self.TotalWorkersCreated = 0
+        self.TotalQueueWaitSec = 0.0
+        self.MaxQueueWaitSec = 0.0
+        self.TotalDetachedWorkers = 0
+
+
+    # Schedules work to run on the pool. Lower priority values run first.
+    # This never blocks, so it's safe to call from the main websocket receive thread.
+    def Schedule(self, priority:int, work:Callable[[], None]) -> None:
+        with self.Lock:
+            task = WorkerPoolTask(priority, self.NextSeq, work)
+            self.NextSeq += 1
+            self.TotalTasks += 1
+            heapq.heappush(self.ReadyQueue, (task.Priority, task.Seq, task))
+
+            # If there's an idle worker, wake it to pick it up.
+            # We take it out of the idle count now, so the next schedule call doesn't count on the same worker.
+            if self.IdleWorkerCount > 0:
+                self.IdleWorkerCount -= 1
+                self.Lock.notify()
+                return
+
+            # Otherwise, make a new worker if we are allowed to.
+            self._DetachLongRunningWorkersLocked()
+            if self._CanAddWorkerLocked():
+                self._StartWorkerLocked()
+                return
+
+            # If we can't add a worker, make sure the monitor is running, so it can add one if a running task turns into a long running task.
+            self._EnsureMonitorLocked()
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        with self.Lock:
+            return {
+                "Workers": self.WorkerCount,
+                "DetachedWorkers": len(self.DetachedWorkerIds),
+                "TotalDetachedWorkers": self.TotalDetachedWorkers,
+                "MaxDetachedWorkers": self.MaxDetachedWorkers,
+                "IdleWorkers": self.IdleWorkerCount,
+                "PeakWorkers": self.PeakWorkerCount,
+                "MaxWorkers": self.MaxWorkers,
+                "QueuedTasks": len(self.ReadyQueue),
+                "TotalTasks": self.TotalTasks,
+                "TotalWorkersCreated": self.TotalWorkersCreated,
+                "MaxQueueWaitMs": int(self.MaxQueueWaitSec * 1000.0),
+                "AvgQueueWaitMs": int((self.TotalQueueWaitSec / max(1, self.TotalTasks)) * 1000.0),
+            }
+
+
+    # Must be called under lock.
+    def _CanAddWorkerLocked(self) -> bool:
+        return self.WorkerCount < self.MaxWorkers
+
+
+    # Must be called under lock.
+    # Detaches the workers that have been running the same task for a long time, so they don't count against the pool's limits.
+    # Once the max number of workers are detached, no more are, so long running tasks hold their workers until they are done.
+    def _DetachLongRunningWorkersLocked(self) -> None:
+        nowSec = time.time()
+        for workerId, startSec in self.RunningTaskStartSec.items():
+            if len(self.DetachedWorkerIds) >= self.MaxDetachedWorkers:
+                return
+            if workerId in self.DetachedWorkerIds or nowSec - startSec <= WebStreamWorkerPool.c_LongRunningTaskSec:
+                continue
+            self.DetachedWorkerIds.add(workerId)
+            self.WorkerCount -= 1
+            self.TotalDetachedWorkers += 1
+
+
+    # Must be called under lock.
+    def _StartWorkerLocked(self) -> None:
+        workerId = self.NextWorkerId
+        self.NextWorkerId += 1
+        self.WorkerCount += 1
+        self.TotalWorkersCreated += 1
+        if self.WorkerCount > self.PeakWorkerCount:
+            self.PeakWorkerCount = self.WorkerCount
+        try:
+            t = threading.Thread(target=self._WorkerThread, args=(workerId,), name="WebStreamWorker", daemon=True)
+            t.start()
+        except Exception:
+            # If we failed to make the thread, undo the count so we will try again later.
+            self.WorkerCount -= 1
+            raise
+
+
+    # Must be called under lock.
+    def _EnsureMonitorLocked(self) -> None:
+        if self.MonitorThread is not None:
+            return
+        self.MonitorThread = threading.Thread(target=self._MonitorThread, name="WebStreamWorkerMonitor", daemon=True)
+        self.MonitorThread.start()
+
+
+    def _WorkerThread(self, workerId:int) -> None:
+        while True:
+            task:Optional[WorkerPoolTask] = None
+            with self.Lock:
+                idleStartSec = time.time()
+                while len(self.ReadyQueue) == 0:
+                    remainingSec = WebStreamWorkerPool.c_WorkerIdleTimeoutSec - (time.time() - idleStartSec)
+                    if remainingSec <= 0:
+                        # We have been idle for too long, exit.
+                        self.WorkerCount -= 1
+                        return
+                    # If we are woken by Schedule, it already took us out of the idle count.
+                    self.IdleWorkerCount += 1
+                    if self.Lock.wait(remainingSec) is False:
+                        self.IdleWorkerCount -= 1
+                _, _, task = heapq.heappop(self.ReadyQueue)
+                nowSec = time.time()
+                queueWaitSec = nowSec - task.QueuedSec
+                self.TotalQueueWaitSec += queueWaitSec
+                if queueWaitSec > self.MaxQueueWaitSec:
+                    self.MaxQueueWaitSec = queueWaitSec
+                self.RunningTasks[workerId] = task
+                self.RunningTaskStartSec[workerId] = nowSec
+
+            try:
+                task.Work()
+            except Exception as e:
+                Sentry.OnException("Web stream worker pool task threw an exception.", e)
+
+            with self.Lock:
+                self.RunningTasks.pop(workerId, None)
+                self.RunningTaskStartSec.pop(workerId, None)
+                # If we were detached, rejoin the pool if there's room, otherwise this thread is done.
+                if workerId in self.DetachedWorkerIds:
+                    self.DetachedWorkerIds.discard(workerId)
+                    if self._CanAddWorkerLocked() is False:
+                        return
+                    self.WorkerCount += 1
+                    if self.WorkerCount > self.PeakWorkerCount:
+                        self.PeakWorkerCount = self.WorkerCount
+
+
+    # Only runs while there's queued work that no worker can pick up, and adds a worker once a running task becomes long running and is detached.
+    def _MonitorThread(self) -> None:
+        while True:
+            # Don't wait on the condition, or we could take a notify meant for an idle worker.
+            time.sleep(1.0)
+            with self.Lock:
+                if len(self.ReadyQueue) == 0:
+                    self.MonitorThread = None
+                    return
+                self._DetachLongRunningWorkersLocked()
+                if self.IdleWorkerCount == 0 and self._CanAddWorkerLocked():
+                    self.Logger.info("Web stream worker pool is adding a worker because the workers are running long tasks. Workers: %d, Detached: %d", self.WorkerCount, len(self.DetachedWorkerIds))
+                    self._StartWorkerLocked()
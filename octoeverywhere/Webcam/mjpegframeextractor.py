@@ -0,0 +1,211 @@
+import logging
+from typing import Any, Callable, Dict, List, Optional
+
+from ..buffer import Buffer
+from ..memorymanager import MemoryManager
+
+
+#
+# Extracts jpeg frames from a MJPEG byte stream without copying the frame data.
+#
+# The QuickCam backends used to read each chunk into a new bytes object, append it to a pending bytearray, and then slice the frame out of it,
+# which copied every frame two or three times, and the RTSP backend rescanned the pending data from the start after every read.
+#
+# This reads the stream directly into a preallocated arena, scans for the jpeg markers from where the last scan stopped, and returns each
+# frame as a memoryview backed Buffer of the arena. The frames are never copied, but they keep the arena alive while they are in use.
+# So the arena is only compacted when there are no frames still using it, otherwise we switch to a spare arena that is no longer in use,
+# or make a new one, and only the partial frame at the end is copied over.
+#
+# The arena is sized by the MemoryManager, and grows if a single frame is bigger than it.
+#
+class MjpegFrameExtractor:
+
+    # The jpeg start of image and end of image markers.
+    c_JpegStartOfImage = b"\xff\xd8"
+    c_JpegEndOfImage = b"\xff\xd9"
+
+    # How many arenas that are no longer used by frames we keep around to be reused.
+    c_MaxSpareArenas = 2
+
+
+    # The read function is given the arena, the offset, and the max size to read. It must read into the arena at the offset and return the number of bytes read.
+    # If the max frame size is hit while looking for the end of a marker framed image, the pending data is dropped so we can resync with the stream.
+    def __init__(self, logger:logging.Logger, maxFrameSizeBytes:int, arenaSizeBytes:Optional[int]=None, startOfImage:bytes=c_JpegStartOfImage) -> None:
+        self.Logger = logger
+        self.MaxFrameSizeBytes = maxFrameSizeBytes
+        self.ArenaSizeBytes = arenaSizeBytes if arenaSizeBytes is not None else MemoryManager.QuickCam_FrameArenaSizeBytes
+        self.StartOfImage = startOfImage
+        self.Arena = bytearray(self.ArenaSizeBytes)
+        self.SpareArenas:List[bytearray] = []
+        # The pending data is the range [Start, End) of the arena.
+        self.Start = 0
+        self.End = 0
+        # Where the next end of image scan starts, so the pending data is only scanned once.
+        self.ScanPos = 0
+
+        # Stats
+        self.Frames = 0
+        self.FrameBytes = 0
+        self.CopiedBytes = 0
+        self.ArenasAllocated = 1
+        self.ArenasRecycled = 0
+        self.Resyncs = 0
+
+
+    # Returns the number of bytes read and not yet consumed.
+    def PendingSize(self) -> int:
+        return self.End - self.Start
+
+
+    # Reads more of the stream into the arena, up to readSizeBytes, and returns the number of bytes read.
+    def ReadInto(self, readFunc:Callable[[bytearray, int, int], int], readSizeBytes:int) -> int:
+        self._EnsureSpace(readSizeBytes)
+        bytesRead = readFunc(self.Arena, self.End, readSizeBytes)
+        if bytesRead is None or bytesRead <= 0:
+            return 0
+        self.End += bytesRead
+        return bytesRead
+
+
+    # Returns the offset of the sub sequence in the pending data, or -1 if it's not found.
+    def Find(self, sub:bytes, startOffset:int=0) -> int:
+        pos = self.Arena.find(sub, self.Start + startOffset, self.End)
+        return -1 if pos == -1 else pos - self.Start
+
+
+    # Returns a copy of the first count bytes of the pending data. This is only meant for small things like headers.
+    def GetBytes(self, count:int) -> bytes:
+        count = min(count, self.PendingSize())
+        return bytes(self.Arena[self.Start:self.Start + count])
+
+
+    # Drops the first count bytes of the pending data.
+    def Consume(self, count:int) -> None:
+        self.Start = min(self.Start + count, self.End)
+        self.ScanPos = max(self.ScanPos, self.Start)
+
+
+    # Returns the next frameSizeBytes of the pending data as a frame, used for streams that tell us the size of the frame.
+    # Returns None if not all of the frame has been read yet.
+    def TakeFrame(self, frameSizeBytes:int) -> Optional[Buffer]:
+        if self.PendingSize() < frameSizeBytes:
+            return None
+        frame = self._MakeFrame(self.Start, self.Start + frameSizeBytes)
+        self.Start += frameSizeBytes
+        self.ScanPos = self.Start
+        return frame
+
+
+    # Returns the next frame of a stream that's only framed by the jpeg start and end markers, like ffmpeg's image2pipe output.
+    # Any data before the start marker is dropped. Returns None if there's no full frame yet.
+    def TakeMarkerFrame(self) -> Optional[Buffer]:
+        # Ensure the pending data starts with the start of image marker, otherwise we need to find it.
+        if self.Arena.startswith(self.StartOfImage, self.Start, self.End) is False:
+            if self.PendingSize() < len(self.StartOfImage):
+                return None
+            soi = self.Arena.find(self.StartOfImage, self.Start + 1, self.End)
+            if soi == -1:
+                # Keep the last few bytes, since they might be the start of a marker.
+                self.Start = max(self.Start, self.End - len(self.StartOfImage) + 1)
+                self.ScanPos = self.Start
+                return None
+            self.Start = soi
+            self.ScanPos = soi
+
+        # Scan for the end of image from where we stopped last time.
+        eoi = self.Arena.find(MjpegFrameExtractor.c_JpegEndOfImage, max(self.ScanPos, self.Start + len(self.StartOfImage)), self.End)
+        if eoi == -1:
+            self.ScanPos = max(self.Start, self.End - len(MjpegFrameExtractor.c_JpegEndOfImage) + 1)
+            # If the frame is too big, we fell behind or lost our place in the stream, so drop it and wait for the next start.
+            if self.PendingSize() > self.MaxFrameSizeBytes:
+                self.Logger.info("MjpegFrameExtractor dropped %d pending bytes with no jpeg end marker. This means we are running behind.", self.PendingSize())
+                self.Resyncs += 1
+                self.Start = self.End
+                self.ScanPos = self.End
+            return None
+
+        frameEnd = eoi + len(MjpegFrameExtractor.c_JpegEndOfImage)
+        frame = self._MakeFrame(self.Start, frameEnd)
+        self.Start = frameEnd
+        self.ScanPos = frameEnd
+        return frame
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        return {
+            "Frames": self.Frames,
+            "FrameBytes": self.FrameBytes,
+            "CopiedBytes": self.CopiedBytes,
+            "CopiedBytesPerFrame": round(self.CopiedBytes / self.Frames, 1) if self.Frames > 0 else 0.0,
+            "ArenaSizeBytes": len(self.Arena),
+            "ArenasAllocated": self.ArenasAllocated,
+            "ArenasRecycled": self.ArenasRecycled,
+            "Resyncs": self.Resyncs,
+        }
+
+
+    def _MakeFrame(self, start:int, end:int) -> Buffer:
+        self.Frames += 1
+        self.FrameBytes += end - start
+        # The slice holds its own reference to the arena, so it stays valid after the parent view is released.
+        with memoryview(self.Arena) as view:
+            return Buffer(view[start:end])
+
+
+    # Makes sure there's room for readSizeBytes after the pending data.
+    def _EnsureSpace(self, readSizeBytes:int) -> None:
+        if self.End + readSizeBytes <= len(self.Arena):
+            return
+        pending = self.PendingSize()
+        required = pending + readSizeBytes
+
+        # If no frames are using the arena and the pending data fits, move it to the front.
+        if required <= len(self.Arena) and MjpegFrameExtractor._HasExports(self.Arena) is False:
+            if pending > 0:
+                with memoryview(self.Arena) as view:
+                    view[0:pending] = view[self.Start:self.End]
+                self.CopiedBytes += pending
+            self._SetPending(pending)
+            return
+
+        # Otherwise, use a new arena. Keep the old one as a spare, so it can be reused once the frames using it are released.
+        newArena = self._GetSpareArena(required)
+        if newArena is None:
+            newArena = bytearray(max(self.ArenaSizeBytes, required))
+            self.ArenasAllocated += 1
+        if pending > 0:
+            with memoryview(self.Arena) as view:
+                newArena[0:pending] = view[self.Start:self.End]
+            self.CopiedBytes += pending
+        if len(self.Arena) >= self.ArenaSizeBytes and len(self.SpareArenas) < MjpegFrameExtractor.c_MaxSpareArenas:
+            self.SpareArenas.append(self.Arena)
+        self.Arena = newArena
+        self._SetPending(pending)
+
+
+    def _SetPending(self, pending:int) -> None:
+        self.ScanPos = self.ScanPos - self.Start if self.ScanPos > self.Start else 0
+        self.Start = 0
+        self.End = pending
+
+
+    # Returns a spare arena that's big enough and no frames are using, or None.
+    def _GetSpareArena(self, required:int) -> Optional[bytearray]:
+        for i, spare in enumerate(self.SpareArenas):
+            if len(spare) >= required and MjpegFrameExtractor._HasExports(spare) is False:
+                self.ArenasRecycled += 1
+                return self.SpareArenas.pop(i)
+        return None
+
+
+    # Returns true if there are memoryviews of the bytearray, which means frames are still using it.
+    # A bytearray can't be resized while it has exports, so we test that by removing and adding back the last byte, which doesn't reallocate.
+    @staticmethod
+    def _HasExports(arena:bytearray) -> bool:
+        try:
+            last = arena[-1]
+            del arena[-1]
+            arena.append(last)
+            return False
+        except BufferError:
+            return True
@@ -0,0 +1,168 @@
+import os
+import time
+import logging
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from ..sentry import Sentry
+from ..buffer import Buffer
+from ..httpresult import HttpResult, HttpResultOrNone
+from .quickcam import QuickCamManager
+from .webcamsettingitem import WebcamSettingItem
+
+
+# The result of one snapshot fetch, which is shared by the requests that were coalesced into it and the cache.
+class _SnapshotEntry:
+
+    def __init__(self) -> None:
+        self.Done = threading.Event()
+        self.StatusCode = 0
+        self.Headers:Dict[str, str] = {}
+        self.Url = ""
+        self.Body:Optional[Buffer] = None
+        self.FetchedSec = 0.0
+
+
+    # Makes a new result for a caller. Each caller gets its own result, since they are disposed and their headers are changed.
+    def MakeResult(self) -> HttpResultOrNone:
+        if self.Body is None:
+            return None if self.StatusCode == 0 else HttpResult.Error(self.StatusCode, self.Url)
+        return HttpResult(self.StatusCode, dict(self.Headers), self.Url, True, fullBodyBuffer=self.Body)
+
+
+#
+# Gets the snapshots of each camera for all of the things that want one.
+#
+# Snapshots are requested by the web UI, notifications, Gadget, the final snap, and the command handler, often at the same time. Without this,
+# each request makes its own http call to the camera or opens the camera's stream, and cheap USB cameras and mjpg-streamer stall when that happens.
+#
+# For each camera:
+#   - If a QuickCam capture thread is already running for it, the latest frame is returned, since that's free.
+#   - If a snapshot was fetched within the TTL, it's returned from the cache.
+#   - If a fetch is already running, the request waits for it and gets the same snapshot.
+#   - Otherwise, this request does the fetch.
+#
+class SnapshotService:
+
+    # If enabled, snapshots are cached and coalesced.
+    # This is on by default, it can be turned off with the setter or the OCTO_SNAPSHOT_SERVICE=0 env var.
+    Enabled = os.environ.get("OCTO_SNAPSHOT_SERVICE", "1") == "1"
+
+    # How long a fetched snapshot can be returned from the cache.
+    c_CacheTtlSec = 1.0
+
+    # The max time a coalesced request waits for the fetch it joined. It's longer than QuickCam's max wait for a first image.
+    c_CoalesceWaitTimeoutSec = 20.0
+
+    # Logic for a static singleton
+    _Instance:"SnapshotService" = None #pyright: ignore[reportAssignmentType]
+
+
+    @staticmethod
+    def Init(logger:logging.Logger) -> None:
+        SnapshotService._Instance = SnapshotService(logger)
+
+
+    @staticmethod
+    def Get() -> "SnapshotService":
+        return SnapshotService._Instance
+
+
+    @staticmethod
+    def SetEnabled(enabled:bool) -> None:
+        SnapshotService.Enabled = enabled
+
+
+    def __init__(self, logger:logging.Logger) -> None:
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        # The last fetch of each camera, which is either running or done.
+        self.Entries:Dict[Tuple[Optional[str], Optional[str]], _SnapshotEntry] = {}
+
+        # Stats
+        self.Requests = 0
+        self.Hits = 0
+        self.Misses = 0
+        self.Coalesced = 0
+        self.QuickCamFrames = 0
+        self.Failures = 0
+
+
+    # Returns a snapshot of the camera, the fetch function is only called if the snapshot can't be gotten another way.
+    # The result always has the full body buffer, like the fetch function's.
+    def GetSnapshot(self, webcamSettingsItem:WebcamSettingItem, fetch:Callable[[], HttpResultOrNone]) -> HttpResultOrNone:
+        if SnapshotService.Enabled is False:
+            return fetch()
+
+        # If the camera is already being captured by QuickCam, the latest frame is free.
+        qm = QuickCamManager.Get()
+        img = qm.TryGetRunningImage(webcamSettingsItem) if qm is not None else None
+        if img is not None:
+            with self.Lock:
+                self.Requests += 1
+                self.QuickCamFrames += 1
+            return HttpResult(200, {"Content-Type": "image/jpeg"}, webcamSettingsItem.StreamUrl or "", False, fullBodyBuffer=img)
+
+        key = (webcamSettingsItem.SnapshotUrl, webcamSettingsItem.StreamUrl)
+        isFetcher = False
+        with self.Lock:
+            self.Requests += 1
+            entry = self.Entries.get(key, None)
+            if entry is not None and entry.Done.is_set() is False:
+                self.Coalesced += 1
+            elif entry is not None and entry.Body is not None and time.time() - entry.FetchedSec < SnapshotService.c_CacheTtlSec:
+                self.Hits += 1
+            else:
+                self.Misses += 1
+                entry = _SnapshotEntry()
+                self.Entries[key] = entry
+                isFetcher = True
+
+        if isFetcher:
+            self._Fetch(key, entry, fetch)
+        elif entry.Done.wait(SnapshotService.c_CoalesceWaitTimeoutSec) is False:
+            self.Logger.warning("SnapshotService timed out waiting for a coalesced snapshot fetch.")
+            return None
+        return entry.MakeResult()
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        with self.Lock:
+            requests = self.Requests
+            return {
+                "Enabled": SnapshotService.Enabled,
+                "Requests": requests,
+                "Hits": self.Hits,
+                "Misses": self.Misses,
+                "Coalesced": self.Coalesced,
+                "QuickCamFrames": self.QuickCamFrames,
+                "Failures": self.Failures,
+                "HitRate": round(self.Hits / requests, 3) if requests > 0 else 0.0,
+                "MissRate": round(self.Misses / requests, 3) if requests > 0 else 0.0,
+                "CoalesceRate": round(self.Coalesced / requests, 3) if requests > 0 else 0.0,
+                "QuickCamRate": round(self.QuickCamFrames / requests, 3) if requests > 0 else 0.0,
+            }
+
+
+    def _Fetch(self, key:Tuple[Optional[str], Optional[str]], entry:_SnapshotEntry, fetch:Callable[[], HttpResultOrNone]) -> None:
+        try:
+            result = fetch()
+            if result is not None:
+                # The fetch results are always fully read, so the response can be disposed now.
+                with result:
+                    entry.StatusCode = result.StatusCode
+                    entry.Url = result.Url
+                    if result.StatusCode == 200 and result.FullBodyBuffer is not None:
+                        entry.Headers = dict(result.Headers)
+                        entry.Body = result.FullBodyBuffer
+        except Exception as e:
+            Sentry.OnException("SnapshotService failed to fetch a snapshot.", e)
+        finally:
+            entry.FetchedSec = time.time()
+            with self.Lock:
+                if entry.Body is None:
+                    self.Failures += 1
+                    # Don't keep failed fetches, so the next request tries again.
+                    if self.Entries.get(key, None) is entry:
+                        del self.Entries[key]
+            entry.Done.set()
@@ -0,0 +1,168 @@
+import logging
+import threading
+from typing import TYPE_CHECKING, Any, Dict, List
+
+from ..sentry import Sentry
+from ..buffer import Buffer, BufferOrNone
+from .webcamquality import WebcamDownscaler, WebcamQuality
+
+if TYPE_CHECKING:
+    from .webcamviewerpacer import WebcamViewerPacer
+
+
+# The viewers, cached frame, and stats of one quality tier of a camera.
+class _FrameTier:
+
+    def __init__(self, quality:WebcamQuality) -> None:
+        self.Quality = quality
+        # Each tier has its own lock, so a slow downscale doesn't hold up the viewers of the other tiers.
+        self.Lock = threading.Lock()
+        # The pacers of the tier's viewers, which are only used for stats.
+        self.Viewers:List["WebcamViewerPacer"] = []
+        # The image the cached frame was built from, and the frame.
+        self.CachedImage:BufferOrNone = None
+        self.CachedFrame:BufferOrNone = None
+
+        # Stats
+        self.FrameBuilds = 0
+        self.FrameBuildBytes = 0
+        self.SourceBytes = 0
+        self.Downscales = 0
+        self.DownscaleCpuSec = 0.0
+        self.Deliveries = 0
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        return {
+            "Viewers": len(self.Viewers),
+            "FrameBuilds": self.FrameBuilds,
+            "FrameBuildBytes": self.FrameBuildBytes,
+            "BytesSavedPerFrame": round((self.SourceBytes - self.FrameBuildBytes) / self.FrameBuilds, 1) if self.FrameBuilds > 0 else 0.0,
+            "Downscales": self.Downscales,
+            "DownscaleCpuMsPerFrame": round(self.DownscaleCpuSec * 1000.0 / self.Downscales, 2) if self.Downscales > 0 else 0.0,
+            "Deliveries": self.Deliveries,
+            "DeliveriesPerBuild": round(self.Deliveries / self.FrameBuilds, 2) if self.FrameBuilds > 0 else 0.0,
+        }
+
+
+#
+# Builds the multipart stream frame for each image a QuickCam captures once, and shares it with all of the camera's viewers.
+#
+# Each QuickCam has its own fanout, so cameras streaming at the same time don't evict each other's frame, and a viewer closing only
+# affects the camera it was watching. The frame is built by the first viewer that needs it, under the lock, so no matter how many viewers
+# are sending, each captured image is only framed once. The frame is held while the camera has viewers and dropped when the last one leaves.
+#
+# Viewers can ask for a smaller quality tier. Each tier that has viewers has its own cached frame, so the image is only scaled down once
+# per tier, and only when a viewer of that tier needs the frame. When a tier's last viewer leaves, the tier is removed.
+#
+class WebcamFrameFanout:
+
+    # The frame parts of the multipart stream, the boundary must match WebcamStreamInstance.c_OeStreamBoundaryString.
+    c_OeStreamBoundaryBytes = b"--oestreamboundary\r\nContent-Type: image/jpeg\r\nContent-Length: "
+    c_OeStreamHeaderEndBytes = b"\r\n\r\n"
+    c_OeStreamFrameEndBytes = b"\r\n"
+
+
+    def __init__(self, logger:logging.Logger) -> None:
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        self.Tiers:Dict[WebcamQuality, _FrameTier] = {}
+
+        # Stats
+        self.PeakViewers = 0
+        self.DownscaleErrors = 0
+
+
+    # Called when a viewer starts streaming from the camera.
+    def AddViewer(self, pacer:"WebcamViewerPacer", quality:WebcamQuality=WebcamQuality.Full) -> None:
+        with self.Lock:
+            tier = self.Tiers.get(quality, None)
+            if tier is None:
+                tier = _FrameTier(quality)
+                self.Tiers[quality] = tier
+            tier.Viewers.append(pacer)
+            self.PeakViewers = max(self.PeakViewers, self._GetViewerCountLocked())
+
+
+    # Called when a viewer's stream is closed. When the last viewer of a tier leaves, the tier and its cached frame are released.
+    def RemoveViewer(self, pacer:"WebcamViewerPacer", quality:WebcamQuality=WebcamQuality.Full) -> None:
+        with self.Lock:
+            tier = self.Tiers.get(quality, None)
+            if tier is None:
+                return
+            if pacer in tier.Viewers:
+                tier.Viewers.remove(pacer)
+            if len(tier.Viewers) == 0:
+                del self.Tiers[quality]
+
+
+    # Returns the multipart stream frame for the captured image, building it if this is the first viewer of the tier to send the image.
+    def GetFrame(self, capturedImage:Buffer, quality:WebcamQuality=WebcamQuality.Full) -> Buffer:
+        with self.Lock:
+            tier = self.Tiers.get(quality, None)
+        # If there are no viewers of the tier, the frame is built but not held on to.
+        if tier is None:
+            tier = _FrameTier(quality)
+        with tier.Lock:
+            tier.Deliveries += 1
+            if tier.CachedImage is capturedImage and tier.CachedFrame is not None:
+                return tier.CachedFrame
+            image = self._GetTierImage(tier, capturedImage)
+            header = b"".join((
+                WebcamFrameFanout.c_OeStreamBoundaryBytes,
+                str(len(image)).encode("ascii"),
+                WebcamFrameFanout.c_OeStreamHeaderEndBytes,
+            ))
+            frame = Buffer(b"".join((header, image.Get(), WebcamFrameFanout.c_OeStreamFrameEndBytes)))
+            tier.FrameBuilds += 1
+            tier.FrameBuildBytes += len(frame)
+            tier.SourceBytes += len(frame) - len(image) + len(capturedImage)
+            # Only hold on to the frame if there are viewers that will share it.
+            if len(tier.Viewers) > 0:
+                tier.CachedImage = capturedImage
+                tier.CachedFrame = frame
+            return frame
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        with self.Lock:
+            tiers = list(self.Tiers.values())
+            stats:Dict[str, Any] = {
+                "Viewers": self._GetViewerCountLocked(),
+                "PeakViewers": self.PeakViewers,
+                "DownscaleErrors": self.DownscaleErrors,
+            }
+        # The tiers and pacers have their own locks, so they are read outside of ours.
+        tierStats:Dict[str, Any] = {}
+        viewers:List["WebcamViewerPacer"] = []
+        for tier in tiers:
+            with tier.Lock:
+                tierStats[str(tier.Quality)] = tier.GetStats()
+                viewers.extend(tier.Viewers)
+        stats["Tiers"] = tierStats
+        stats["ViewerPacing"] = [p.GetStats() for p in viewers]
+        return stats
+
+
+    # Returns the image for the tier, which is the captured image if it's the full tier or the image can't be scaled down.
+    def _GetTierImage(self, tier:_FrameTier, capturedImage:Buffer) -> Buffer:
+        if tier.Quality == WebcamQuality.Full:
+            return capturedImage
+        try:
+            scaled, cpuSec = WebcamDownscaler.Downscale(capturedImage, tier.Quality.value)
+            tier.Downscales += 1
+            tier.DownscaleCpuSec += cpuSec
+            if scaled is not None:
+                return scaled
+        except Exception as e:
+            # If the camera sends something that's not a jpeg, or it's corrupt, just send the full image.
+            with self.Lock:
+                self.DownscaleErrors += 1
+                errorCount = self.DownscaleErrors
+            if errorCount == 1:
+                Sentry.OnException("WebcamFrameFanout failed to downscale a frame.", e)
+        return capturedImage
+
+
+    def _GetViewerCountLocked(self) -> int:
+        return sum(len(tier.Viewers) for tier in self.Tiers.values())
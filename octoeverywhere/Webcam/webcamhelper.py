@@ -1,12 +1,16 @@
 import os
 import json
 import logging
+from urllib.parse import parse_qs, urlsplit
 from typing import Any, Dict, List, Optional
 
 from ..sentry import Sentry
 from .webcamutil import WebcamUtil
 from .quickcam import QuickCamManager
+from .snapshotservice import SnapshotService
+from .webcamquality import WebcamQuality
 from ..octohttprequest import OctoHttpRequest
+from ..octostreammsgbuilder import OctoStreamMsgBuilder
 from ..interfaces import IWebcamPlatformHelper
 from .webcamsettingitem import WebcamSettingItem
 from ..httpresult import HttpResult, HttpResultOrNone
@@ -25,6 +29,10 @@ class WebcamHelper:
     c_OracleSnapshotHeaderKey = "oe-snapshot"         # The existence of this header with any value will be handled as a snapshot request.
     c_OracleStreamHeaderKey = "oe-webcamstream"       # The existence of this header with any value will be handled as a stream request.
     c_OracleWebcamIndexHeaderKey = "oe-webcam-index"  # The existence and value of this header will determine the webcam index.
+    c_OracleWebcamQualityHeaderKey = "oe-webcam-quality" # The optional quality tier of a stream request, like full, 720p, or 480p.
+
+    # The quality tier can also be set with this param on the stream url.
+    c_WebcamQualityUrlParam = "oe-webcam-quality"
 
     # If no other index is specified, 0 is the default webcam index.
     # This assumption is also made in the service and website, so it can't change.
@@ -41,6 +49,7 @@ class WebcamHelper:
     def Init(logger:logging.Logger, webcamPlatformHelperInterface:IWebcamPlatformHelper, pluginDataFolderPath:str) -> None:
         WebcamHelper._Instance = WebcamHelper(logger, webcamPlatformHelperInterface, pluginDataFolderPath)
         QuickCamManager.Init(logger, webcamPlatformHelperInterface)
+        SnapshotService.Init(logger)
 
 
     @staticmethod
@@ -110,6 +119,22 @@ class WebcamHelper:
         return None
 
 
+    # Returns the quality tier of a stream request, from the header or the stream url's params. Returns None if it's not set or not known.
+    def GetOracleRequestQuality(self, requestHeadersDict:Dict[str, str], path:Optional[str]) -> Optional[WebcamQuality]:
+        value = requestHeadersDict.get(WebcamHelper.c_OracleWebcamQualityHeaderKey, None)
+        if value is None and path is not None and WebcamHelper.c_WebcamQualityUrlParam in path:
+            try:
+                values = parse_qs(urlsplit(path).query).get(WebcamHelper.c_WebcamQualityUrlParam, None)
+                if values is not None and len(values) > 0:
+                    value = values[0]
+            except Exception as e:
+                Sentry.OnException("WebcamHelper GetOracleRequestQuality failed to parse the stream url.", e)
+        quality = WebcamQuality.FromString(value)
+        if value is not None and quality is None:
+            self.Logger.info("Unknown webcam stream quality requested: %s", value)
+        return quality
+
+
     # Called by the OctoWebStreamHelper when a Oracle snapshot or webcam stream request is detected.
     # It's important that this function returns a OctoHttpRequest that's very similar to what the default MakeHttpCall function
     # returns, to ensure the rest of the octostream http logic can handle the response.
@@ -118,7 +143,8 @@ class WebcamHelper:
         if self.IsSnapshotOracleRequest(sendHeaders):
             return self.GetSnapshot(cameraIndexOpt)
         elif self.IsWebcamStreamOracleRequest(sendHeaders):
-            return self.GetWebcamStream(cameraIndexOpt)
+            path = OctoStreamMsgBuilder.BytesToString(httpInitialContext.Path())
+            return self.GetWebcamStream(cameraIndexOpt, self.GetOracleRequestQuality(sendHeaders, path))
         else:
             raise Exception("Webcam helper MakeSnapshotOrWebcamStreamRequest was called but the request didn't have the oracle headers?")
 
@@ -128,17 +154,19 @@ class WebcamHelper:
     #
     # On failure, this returns None. Returning None will fail out the request.
     # On success, this will return a valid OctoHttpRequest.
-    def GetWebcamStream(self, cameraIndex:Optional[int]=None) -> HttpResultOrNone:
+    #
+    # The quality tier is only applied to QuickCam streams, since those are the only ones we have the frames of. Other streams are proxied as they are.
+    def GetWebcamStream(self, cameraIndex:Optional[int]=None, quality:Optional[WebcamQuality]=None) -> HttpResultOrNone:
         webcamSettingsObj = self._GetWebcamSettingObj(cameraIndex)
         if webcamSettingsObj is None:
             return None
         # Wrap the entire result in the add transform function, so on success the header gets added.
-        return self._AddOeWebcamTransformHeader(self._GetWebcamStreamInternal(webcamSettingsObj), webcamSettingsObj)
+        return self._AddOeWebcamTransformHeader(self._GetWebcamStreamInternal(webcamSettingsObj, quality), webcamSettingsObj)
 
 
-    def _GetWebcamStreamInternal(self, webcamSettingsObj:WebcamSettingItem) -> HttpResultOrNone:
+    def _GetWebcamStreamInternal(self, webcamSettingsObj:WebcamSettingItem, quality:Optional[WebcamQuality]=None) -> HttpResultOrNone:
         # First, check if this webcam URL needs to be handled by the QuickCam system.
-        result = QuickCamManager.Get().TryGetStream(webcamSettingsObj)
+        result = QuickCamManager.Get().TryGetStream(webcamSettingsObj, quality if quality is not None else WebcamQuality.Full)
         if result is not None:
             return result
 
@@ -166,9 +194,12 @@ class WebcamHelper:
         webcamSettingsObj = self._GetWebcamSettingObj(cameraIndex)
         if webcamSettingsObj is None:
             return None
+        # The snapshot service returns the running QuickCam frame or a cached snapshot if it can, and coalesces concurrent fetches of the same camera.
         # Wrap the entire result in the _EnsureJpegHeaderInfo function, so ensure the returned snapshot can be used by all image processing libs.
+        # It's also done in the fetch, so the cached snapshot is already fixed and the check after is only the fast path.
         # Wrap the entire result in the add transform function, so on success the header gets added.
-        return self._AddOeWebcamTransformHeader(self._EnsureJpegHeaderInfo(self._GetSnapshotInternal(webcamSettingsObj)), webcamSettingsObj)
+        result = SnapshotService.Get().GetSnapshot(webcamSettingsObj, lambda: self._EnsureJpegHeaderInfo(self._GetSnapshotInternal(webcamSettingsObj)))
+        return self._AddOeWebcamTransformHeader(self._EnsureJpegHeaderInfo(result), webcamSettingsObj)
 
 
     def _GetSnapshotInternal(self, webcamSettingsObj:WebcamSettingItem) -> HttpResultOrNone:
@@ -0,0 +1,94 @@
+import io
+import time
+from enum import Enum
+from typing import Any, Optional, Tuple
+
+from ..buffer import Buffer
+
+Image = None
+try:
+    # On some systems this package will install but the import will fail due to a missing system .so.
+    # If it can't be loaded, all of the quality tiers just get the full frame.
+    from PIL import Image
+except Exception as _:
+    pass
+
+
+# The quality tiers a webcam stream viewer can ask for. The value is the max frame height, 0 means the frame isn't changed.
+class WebcamQuality(Enum):
+    Full = 0
+    HD720 = 720
+    SD480 = 480
+
+    # Makes to str() cast not to include the class name.
+    def __str__(self):
+        return self.name
+
+
+    # Parses the quality from a url param or header value, like "full", "720p", or "480". Returns None if it's not a known quality.
+    @staticmethod
+    def FromString(value:Optional[str]) -> Optional["WebcamQuality"]:
+        if value is None:
+            return None
+        value = value.strip().lower()
+        if value.endswith("p"):
+            value = value[:-1]
+        if value in ("full", "0", ""):
+            return WebcamQuality.Full
+        if value == "720":
+            return WebcamQuality.HD720
+        if value == "480":
+            return WebcamQuality.SD480
+        return None
+
+
+#
+# Makes the smaller frames of the quality tiers.
+#
+# The jpeg is reduced while it's decoded using the PIL draft mode, which has libjpeg scale the DCT blocks by 1/2, 1/4, or 1/8, so the full
+# size image is never decoded. Draft mode picks the biggest of those scales that's still at least the tier's size, so if the result is
+# still bigger than the tier, it's resized the rest of the way. That resize is from the already reduced image, so it's cheap.
+#
+class WebcamDownscaler:
+
+    # The jpeg quality the smaller frames are encoded with.
+    c_JpegQuality = 75
+
+
+    # Returns true if the downscaler can be used, which requires PIL.
+    @staticmethod
+    def IsAvailable() -> bool:
+        return Image is not None
+
+
+    # Returns the PIL resampling filter with the given name, like BILINEAR.
+    # Newer versions of PIL only have them on Image.Resampling, and older versions only have them on Image.
+    @staticmethod
+    def GetResampleFilter(name:str) -> Any:
+        return getattr(getattr(Image, "Resampling", Image), name)
+
+
+    # Returns the jpeg scaled down to fit the max height, and the time it took.
+    # Returns None if the image doesn't need to be scaled, or it can't be, in which case the full image should be used.
+    @staticmethod
+    def Downscale(jpeg:Buffer, maxHeight:int) -> Tuple[Optional[Buffer], float]:
+        if Image is None or maxHeight <= 0:
+            return None, 0.0
+        startSec = time.thread_time()
+        with Image.open(io.BytesIO(jpeg.Get())) as img: #pyright: ignore[reportArgumentType]
+            width, height = img.size
+            if height <= maxHeight:
+                return None, time.thread_time() - startSec
+            targetWidth = max(1, int(round(width * maxHeight / height)))
+            # This only works on jpegs, for anything else it does nothing and the full image is decoded.
+            img.draft("RGB", (targetWidth, maxHeight))
+            scaled = img.convert("RGB")
+            if scaled.height > maxHeight:
+                scaled = scaled.resize((targetWidth, maxHeight), WebcamDownscaler.GetResampleFilter("BILINEAR"))
+            out = io.BytesIO()
+            scaled.save(out, format="JPEG", quality=WebcamDownscaler.c_JpegQuality)
+        result = out.getbuffer()
+        # If the smaller frame isn't any smaller in bytes, it's not worth sending.
+        if len(result) >= len(jpeg):
+            return None, time.thread_time() - startSec
+        return Buffer(result), time.thread_time() - startSec
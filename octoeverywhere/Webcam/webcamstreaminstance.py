@@ -7,6 +7,8 @@ from ..interfaces import IQuickCam
 from ..buffer import Buffer, BufferOrNone
 from ..httpresult import HttpResult, HttpResultOrNone
 from ..memorymanager import MemoryManager
+from .webcamquality import WebcamQuality
+from .webcamviewerpacer import WebcamViewerPacer
 
 
 # Stream Instance is a class that is created per web stream to handle streaming QuickCam images into the http stream.
@@ -14,23 +16,25 @@ class WebcamStreamInstance:
 
     # The string doesn't matter what it is, but we define it so it's consistent
     c_OeStreamBoundaryString = "oestreamboundary"
-    c_OeStreamBoundaryBytes = b"--oestreamboundary\r\nContent-Type: image/jpeg\r\nContent-Length: "
-    c_OeStreamHeaderEndBytes = b"\r\n\r\n"
-    c_OeStreamFrameEndBytes = b"\r\n"
 
-    SharedFrameCacheLock = threading.Lock()
-    SharedFrameCacheImage:BufferOrNone = None
-    SharedFrameCacheBuffer:BufferOrNone = None
 
-
-    def __init__(self, logger:logging.Logger, quickCam:IQuickCam) -> None:
+    def __init__(self, logger:logging.Logger, quickCam:IQuickCam, quality:WebcamQuality=WebcamQuality.Full) -> None:
         self.Logger = logger
         self.QuickCam = quickCam
+        # The frames are built once per camera and quality, and shared by all of the camera's viewers of that quality.
+        self.FrameFanout = quickCam.GetFrameFanout()
+        self.Quality = quality
+        self.IsViewer = False
         self.IsFirstSend = True
         self.StreamOpenTimeSec = time.time()
         self.ImageReadyEvent = threading.Event()
         self.AwaitingImage:BufferOrNone = None
         self.PendingBodyBuffer:BufferOrNone = None
+        self.RepeatFrameBuffer:BufferOrNone = None
+        # Paces the frames sent to this viewer, so a slow viewer gets the newest frame when it can take one, rather than a backlog.
+        self.Pacer = WebcamViewerPacer(self.ImageReadyEvent.set)
+        # The full size of the frame being sent, so the pacer knows how big it is when the last chunk goes out.
+        self.SendingFrameSizeBytes = 0
 
 
     # This will attempt to start a stream of the webcam.
@@ -46,6 +50,8 @@ class WebcamStreamInstance:
 
         # Note! We must be sure to call DetachImageStreamCallback to remove this stream callback!
         self.QuickCam.AttachImageStreamCallback(self._NewImageCallback)
+        self.FrameFanout.AddViewer(self.Pacer, self.Quality)
+        self.IsViewer = True
 
         # We must set the content type so that the web browser knows what kind of stream to expect.
         headers = {
@@ -58,6 +64,9 @@ class WebcamStreamInstance:
 
     # Define the callback we will get from QuickCam when there's a new image ready for us to send.
     def _NewImageCallback(self, imgBuffer:Buffer):
+        # If the image we had waiting was never sent, it's dropped, since the viewer only ever gets the newest image.
+        if self.AwaitingImage is not None:
+            self.Pacer.OnFrameDropped()
         self.AwaitingImage = imgBuffer
         self.ImageReadyEvent.set()
 
@@ -65,33 +74,47 @@ class WebcamStreamInstance:
     # Define a callback for our http body reading system to call when it needs data.
     def _CustomBodyStreamRead(self) -> Optional[Buffer]:
         try:
+            noImageTimeoutSec = time.time() + 60.0
             while True:
                 # If the previous read had to split a large frame, return the remainder before checking for a new image.
                 if self.PendingBodyBuffer is not None:
                     return self._GetNextBodyChunk(self.PendingBodyBuffer)
 
+                # If the first frame needs to be sent again, send the same shared frame rather than copying it.
+                if self.RepeatFrameBuffer is not None:
+                    frame = self.RepeatFrameBuffer
+                    self.RepeatFrameBuffer = None
+                    return self._GetNextBodyChunk(frame)
+
+                # Clear the event before checking, so an image or send complete that comes in after the check will wake us.
+                self.ImageReadyEvent.clear()
+
                 # See if we can capture an image. There might already be a new image we don't even have to wait for.
+                # If the viewer's last frame is still being sent, or the viewer is being paced, the image waits, and is replaced if a newer one comes in.
                 capturedImage = self.AwaitingImage
-                if capturedImage is not None:
-                    # If so, clear the awaiting image and reset the event.
+                waitSec = self.Pacer.GetWaitSec() if capturedImage is not None else 0.0
+                if capturedImage is not None and waitSec <= 0:
+                    # If so, clear the awaiting image.
                     self.AwaitingImage = None
-                    self.ImageReadyEvent.clear()
 
                     # Build the buffer to send
-                    imageChunkBuffer = WebcamStreamInstance._GetOrMakeFrameBuffer(capturedImage)
+                    imageChunkBuffer = self.FrameFanout.GetFrame(capturedImage, self.Quality)
 
                     # TODO - I don't know why, but chrome seems to delay the rendering of the image until it gets two?
                     # This could be something in the pipeline not flushing correctly, or other things. But for now, on the first send we double the image to make it render instantly.
+                    # The frame is sent twice in a row, which is the same stream data as doubling it, without the copy.
                     if self.IsFirstSend:
-                        imageChunkBufferBytes = imageChunkBuffer.ForceAsBytes()
-                        imageChunkBuffer = Buffer(imageChunkBufferBytes + imageChunkBufferBytes)
+                        self.RepeatFrameBuffer = imageChunkBuffer
                         self.IsFirstSend = False
                         if self.Logger.isEnabledFor(logging.DEBUG):
                             self.Logger.debug("QuickCam took %s seconds from octostream stream open to first image sent.", round(time.time() - self.StreamOpenTimeSec, 3))
                     return self._GetNextBodyChunk(imageChunkBuffer)
 
-                # If we didn't get an image, wait on the event for a new one.
-                if self.ImageReadyEvent.wait(timeout=60.0) is False:
+                # If we have an image, wait until the pacer lets us send it, or a send completes. Otherwise, wait on the event for a new one.
+                if capturedImage is not None:
+                    self.ImageReadyEvent.wait(timeout=waitSec)
+                    continue
+                if self.ImageReadyEvent.wait(timeout=max(noImageTimeoutSec - time.time(), 0.0)) is False:
                     self.Logger.info("Timed out waiting for new image from QuickCam.")
                     return None
         except Exception as e:
@@ -102,9 +125,11 @@ class WebcamStreamInstance:
 
     def _GetNextBodyChunk(self, bodyBuffer:Buffer) -> Buffer:
         maxChunkSizeBytes = MemoryManager.QuickCam_MaxStreamChunkSizeBytes
+        if self.PendingBodyBuffer is None:
+            self.SendingFrameSizeBytes = len(bodyBuffer)
         if len(bodyBuffer) <= maxChunkSizeBytes:
             self.PendingBodyBuffer = None
-            return bodyBuffer
+            return self._FinishChunk(bodyBuffer)
 
         self.Logger.debug("WebcamStreamInstance splitting body buffer into chunks. Total size: %d, max chunk size: %d. This is done to avoid allocating large buffers on low end devices.", len(bodyBuffer), maxChunkSizeBytes)
         bodyBytes = bodyBuffer.ForceAsBytes()
@@ -112,35 +137,20 @@ class WebcamStreamInstance:
         return Buffer(bodyBytes[:maxChunkSizeBytes])
 
 
+    # If this is the last chunk of the frame, and the frame isn't being sent again, the pacer tracks it until it's sent.
+    def _FinishChunk(self, chunk:Buffer) -> Buffer:
+        if self.RepeatFrameBuffer is not None:
+            return chunk
+        return self.Pacer.OnFrameSending(chunk, self.SendingFrameSizeBytes)
+
+
     # Define a callback for when the http stream is closed.
     def _CustomBodyStreamClosed(self) -> None:
         # It's important this is called so the stream will be detached!
         self.QuickCam.DetachImageStreamCallback(self._NewImageCallback)
         self.PendingBodyBuffer = None
-        WebcamStreamInstance._ClearSharedFrameCache()
-
-
-    @staticmethod
-    def _GetOrMakeFrameBuffer(capturedImage:Buffer) -> Buffer:
-        with WebcamStreamInstance.SharedFrameCacheLock:
-            if WebcamStreamInstance.SharedFrameCacheImage is capturedImage and WebcamStreamInstance.SharedFrameCacheBuffer is not None:
-                return WebcamStreamInstance.SharedFrameCacheBuffer
-
-        header = b"".join((
-            WebcamStreamInstance.c_OeStreamBoundaryBytes,
-            str(len(capturedImage)).encode("ascii"),
-            WebcamStreamInstance.c_OeStreamHeaderEndBytes,
-        ))
-        imageChunkBuffer = Buffer(b"".join((header, capturedImage.Get(), WebcamStreamInstance.c_OeStreamFrameEndBytes)))
-
-        with WebcamStreamInstance.SharedFrameCacheLock:
-            WebcamStreamInstance.SharedFrameCacheImage = capturedImage
-            WebcamStreamInstance.SharedFrameCacheBuffer = imageChunkBuffer
-        return imageChunkBuffer
-
-
-    @staticmethod
-    def _ClearSharedFrameCache() -> None:
-        with WebcamStreamInstance.SharedFrameCacheLock:
-            WebcamStreamInstance.SharedFrameCacheImage = None
-            WebcamStreamInstance.SharedFrameCacheBuffer = None
+        self.RepeatFrameBuffer = None
+        if self.IsViewer:
+            self.IsViewer = False
+            self.FrameFanout.RemoveViewer(self.Pacer, self.Quality)
+            self.Pacer.Close()
@@ -1,9 +1,9 @@
 import logging
-from typing import Optional
+from typing import Optional, Tuple
 
 from ..sentry import Sentry
 from ..httpresult import HttpResult
-from ..buffer import Buffer
+from ..buffer import Buffer, ByteLike
 from ..streamreadhelper import StreamReadHelper
 
 
@@ -95,31 +95,7 @@ class WebcamUtil:
             headerStrSize += 4
 
             # Try to find the size of this chunk.
-            frameSizeInt = 0
-            contentType = None
-            headers = headerBuffer[0:headerStrSize].split(b"\r\n")
-            for header in headers:
-                name, _, value = header.partition(b":")
-                nameLower = name.strip().lower()
-                if nameLower == b"content-type":
-                    contentType = value.strip().decode(errors="ignore")
-
-                elif nameLower == b"content-length":
-                    # We found the content-length header!
-                    # In some webcam servers, they add the content break --<boundary> to the content-length line.
-                    # So we need to strip that off if it's there.
-                    value = value.strip()
-                    boundaryStart = value.find(b"--")
-                    if boundaryStart != -1:
-                        value = value[0:boundaryStart].strip()
-                    # We have seen weird cases where there's a content-length header, but it's empty, and then there's another that has a length.
-                    if len(value) == 0:
-                        continue
-                    frameSizeInt = int(value)
-
-                # Break when done.
-                if frameSizeInt > 0 and contentType is not None:
-                    break
+            frameSizeInt, contentType = WebcamUtil.ParseMultipartFrameHeaders(headerBuffer[0:headerStrSize])
 
             if frameSizeInt == 0 or contentType is None:
                 if frameSizeInt == 0:
@@ -159,6 +135,38 @@ class WebcamUtil:
         return None
 
 
+    # Parses the headers of one part of a multipart jmpeg stream, and returns the frame size and content type.
+    # The frame size is 0 and the content type is None if they aren't found.
+    @staticmethod
+    def ParseMultipartFrameHeaders(headerBytes:ByteLike) -> Tuple[int, Optional[str]]:
+        frameSizeInt = 0
+        contentType = None
+        headers = headerBytes.split(b"\r\n")
+        for header in headers:
+            name, _, value = header.partition(b":")
+            nameLower = name.strip().lower()
+            if nameLower == b"content-type":
+                contentType = value.strip().decode(errors="ignore")
+
+            elif nameLower == b"content-length":
+                # We found the content-length header!
+                # In some webcam servers, they add the content break --<boundary> to the content-length line.
+                # So we need to strip that off if it's there.
+                value = value.strip()
+                boundaryStart = value.find(b"--")
+                if boundaryStart != -1:
+                    value = value[0:boundaryStart].strip()
+                # We have seen weird cases where there's a content-length header, but it's empty, and then there's another that has a length.
+                if len(value) == 0:
+                    continue
+                frameSizeInt = int(value)
+
+            # Break when done.
+            if frameSizeInt > 0 and contentType is not None:
+                break
+        return frameSizeInt, contentType
+
+
     # Checks if the jpeg header info is set correctly.
     # For some webcam servers, we have seen them return jpegs that have incomplete jpeg binary header data, which breaks some image processing libs.
     # This seems to break ImageSharp, whatever Telegram uses on it's server side for processing, and even browsers from showing the image.
@@ -0,0 +1,243 @@
+import os
+import time
+import threading
+import collections
+from typing import Any, Callable, Deque, Dict, Optional
+
+from ..buffer import Buffer
+from ..sendscheduler import SendScheduler
+
+
+#
+# Caps the share of the tunnel all of the webcam viewers together can use.
+#
+# The webcam frames of every viewer go over the same tunnel websocket as everything else. When other traffic is waiting to be sent,
+# like the UI's api calls or a download, the webcam viewers are held back once the webcam's share of the bytes the tunnel sent
+# in the current window is over the max. When nothing else is waiting, the webcam can use the whole tunnel.
+#
+class WebcamBandwidthBudget:
+
+    # If enabled, the webcam share of the tunnel is capped.
+    # This is on by default, it can be turned off with the setter or the OCTO_WEBCAM_BANDWIDTH_CAP=0 env var.
+    Enabled = os.environ.get("OCTO_WEBCAM_BANDWIDTH_CAP", "1") == "1"
+
+    # The max share of the tunnel bytes the webcam can use while other traffic is waiting.
+    c_MaxTunnelShare = 0.5
+
+    # How long each measurement window is.
+    c_WindowSec = 2.0
+
+    # How long a viewer waits before checking the budget again when it's over.
+    c_ThrottleWaitSec = 0.05
+
+    _Lock = threading.Lock()
+    _WindowStartSec = 0.0
+    _WindowStartTunnelBytes = 0
+    _WindowWebcamBytes = 0
+    _InFlightBytes = 0
+    _LastShare = 0.0
+    _ThrottledChecks = 0
+
+
+    @staticmethod
+    def SetEnabled(enabled:bool) -> None:
+        WebcamBandwidthBudget.Enabled = enabled
+
+
+    # Called when a frame is handed to the tunnel.
+    @staticmethod
+    def OnFrameSending(sizeBytes:int) -> None:
+        with WebcamBandwidthBudget._Lock:
+            WebcamBandwidthBudget._WindowWebcamBytes += sizeBytes
+            WebcamBandwidthBudget._InFlightBytes += sizeBytes
+
+
+    # Called when a frame has been sent, or dropped.
+    @staticmethod
+    def OnFrameSent(sizeBytes:int) -> None:
+        with WebcamBandwidthBudget._Lock:
+            WebcamBandwidthBudget._InFlightBytes = max(0, WebcamBandwidthBudget._InFlightBytes - sizeBytes)
+
+
+    # Returns how long the viewers should wait before sending another frame, which is 0 if they can send now.
+    @staticmethod
+    def GetWaitSec() -> float:
+        if WebcamBandwidthBudget.Enabled is False:
+            return 0.0
+        nowSec = time.time()
+        tunnelBytes = SendScheduler.GetTotalSentBytes()
+        queuedBytes = SendScheduler.GetTotalQueuedBytes()
+        with WebcamBandwidthBudget._Lock:
+            windowTunnelBytes = tunnelBytes - WebcamBandwidthBudget._WindowStartTunnelBytes
+            share = WebcamBandwidthBudget._WindowWebcamBytes / windowTunnelBytes if windowTunnelBytes > 0 else 0.0
+            if nowSec - WebcamBandwidthBudget._WindowStartSec > WebcamBandwidthBudget.c_WindowSec:
+                WebcamBandwidthBudget._LastShare = share
+                WebcamBandwidthBudget._WindowStartSec = nowSec
+                WebcamBandwidthBudget._WindowStartTunnelBytes = tunnelBytes
+                WebcamBandwidthBudget._WindowWebcamBytes = 0
+                return 0.0
+            # Only hold the webcam back if something other than webcam frames is waiting to be sent.
+            if queuedBytes <= WebcamBandwidthBudget._InFlightBytes or share <= WebcamBandwidthBudget.c_MaxTunnelShare:
+                return 0.0
+            WebcamBandwidthBudget._ThrottledChecks += 1
+            return WebcamBandwidthBudget.c_ThrottleWaitSec
+
+
+    @staticmethod
+    def GetStats() -> Dict[str, Any]:
+        with WebcamBandwidthBudget._Lock:
+            return {
+                "Enabled": WebcamBandwidthBudget.Enabled,
+                "MaxTunnelShare": WebcamBandwidthBudget.c_MaxTunnelShare,
+                "LastTunnelShare": round(WebcamBandwidthBudget._LastShare, 3),
+                "InFlightBytes": WebcamBandwidthBudget._InFlightBytes,
+                "ThrottledChecks": WebcamBandwidthBudget._ThrottledChecks,
+            }
+
+
+#
+# Paces the frames of one webcam viewer.
+#
+# Each viewer only has one frame in flight at a time, from when it's handed to the tunnel until the websocket has sent it.
+# While it's in flight, newer images replace the one waiting to be sent, so the viewer always gets the newest frame and never a stale queued one.
+# The time each frame takes to send is tracked, and if it's slow, like when the stream's share of a busy tunnel is small, the viewer's frame
+# rate is lowered so it only uses part of its share, leaving room for everything else. The other viewers aren't affected.
+#
+class WebcamViewerPacer:
+
+    # If a frame's send never completes, like if the message failed to build, we stop waiting for it after this long.
+    c_MaxInFlightSec = 5.0
+
+    # If frames take longer than this to send, the viewer's frame rate is lowered.
+    c_SlowSendSec = 0.2
+
+    # When the frame rate is lowered, the frames are spaced by this many times the send time.
+    c_SlowSendIntervalMultiplier = 2.0
+
+    # The lowest the frame rate will go.
+    c_MinFps = 1.0
+
+    # The weight of each new send time in the average.
+    c_SendTimeAverageWeight = 0.3
+
+    # The window the delivered and dropped fps are measured over.
+    c_FpsWindowSec = 5.0
+
+
+    def __init__(self, wakeCallback:Callable[[], None]) -> None:
+        # Called when a frame has been sent, so the viewer can send the next one.
+        self.WakeCallback = wakeCallback
+        self.Lock = threading.Lock()
+        self.InFlightSinceSec:Optional[float] = None
+        self.InFlightBytes = 0
+        # Incremented for each frame, so a late send complete of a frame we stopped waiting on isn't taken as the current frame's.
+        self.FrameId = 0
+        self.LastSendSec = 0.0
+        self.AverageSendSec = 0.0
+        self.StartSec = time.time()
+
+        # Stats
+        self.Delivered = 0
+        self.Dropped = 0
+        self.DeliveredTimes:Deque[float] = collections.deque()
+        self.DroppedTimes:Deque[float] = collections.deque()
+
+
+    # Called when a new image replaced one the viewer never sent.
+    def OnFrameDropped(self) -> None:
+        with self.Lock:
+            self.Dropped += 1
+            self._AddTimeLocked(self.DroppedTimes, time.time())
+
+
+    # Returns how long to wait before the next frame can be sent, 0 if it can be sent now.
+    def GetWaitSec(self) -> float:
+        nowSec = time.time()
+        with self.Lock:
+            if self.InFlightSinceSec is not None:
+                inFlightSec = nowSec - self.InFlightSinceSec
+                if inFlightSec < WebcamViewerPacer.c_MaxInFlightSec:
+                    return WebcamViewerPacer.c_MaxInFlightSec - inFlightSec
+                self._OnSendDoneLocked(nowSec)
+            waitSec = self.LastSendSec + self.GetFrameIntervalSec() - nowSec
+        return max(waitSec, WebcamBandwidthBudget.GetWaitSec(), 0.0)
+
+
+    # Returns the min time between the viewer's frames, 0 if it's not being paced.
+    def GetFrameIntervalSec(self) -> float:
+        if self.AverageSendSec <= WebcamViewerPacer.c_SlowSendSec:
+            return 0.0
+        return min(self.AverageSendSec * WebcamViewerPacer.c_SlowSendIntervalMultiplier, 1.0 / WebcamViewerPacer.c_MinFps)
+
+
+    # Called with the last chunk of a frame that's about to be handed to the tunnel. Returns the buffer to send in its place, which
+    # shares the same data, but lets us know when it has been sent.
+    def OnFrameSending(self, lastChunk:Buffer, frameSizeBytes:int) -> Buffer:
+        nowSec = time.time()
+        with self.Lock:
+            self.FrameId += 1
+            frameId = self.FrameId
+            self.InFlightSinceSec = nowSec
+            self.InFlightBytes = frameSizeBytes
+            self.LastSendSec = nowSec
+            self.Delivered += 1
+            self._AddTimeLocked(self.DeliveredTimes, nowSec)
+        WebcamBandwidthBudget.OnFrameSending(frameSizeBytes)
+        tracked = Buffer(lastChunk.Get())
+        tracked.SetOnSendComplete(lambda: self._OnSendComplete(frameId))
+        return tracked
+
+
+    # Called when the viewer's stream is closed.
+    def Close(self) -> None:
+        with self.Lock:
+            if self.InFlightSinceSec is not None:
+                self.InFlightSinceSec = None
+                WebcamBandwidthBudget.OnFrameSent(self.InFlightBytes)
+                self.InFlightBytes = 0
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        nowSec = time.time()
+        with self.Lock:
+            windowSec = min(max(nowSec - self.StartSec, 0.001), WebcamViewerPacer.c_FpsWindowSec)
+            self._TrimTimesLocked(self.DeliveredTimes, nowSec)
+            self._TrimTimesLocked(self.DroppedTimes, nowSec)
+            return {
+                "DeliveredFps": round(len(self.DeliveredTimes) / windowSec, 1),
+                "DroppedFps": round(len(self.DroppedTimes) / windowSec, 1),
+                "Delivered": self.Delivered,
+                "Dropped": self.Dropped,
+                "AverageSendMs": round(self.AverageSendSec * 1000.0, 1),
+                "FrameIntervalMs": round(self.GetFrameIntervalSec() * 1000.0, 1),
+            }
+
+
+    def _OnSendComplete(self, frameId:int) -> None:
+        with self.Lock:
+            if self.InFlightSinceSec is None or frameId != self.FrameId:
+                return
+            self._OnSendDoneLocked(time.time())
+        self.WakeCallback()
+
+
+    def _OnSendDoneLocked(self, nowSec:float) -> None:
+        inFlightSinceSec = self.InFlightSinceSec
+        if inFlightSinceSec is None:
+            return
+        sendSec = nowSec - inFlightSinceSec
+        weight = WebcamViewerPacer.c_SendTimeAverageWeight
+        self.AverageSendSec = sendSec if self.AverageSendSec == 0.0 else (self.AverageSendSec * (1.0 - weight)) + (sendSec * weight)
+        self.InFlightSinceSec = None
+        WebcamBandwidthBudget.OnFrameSent(self.InFlightBytes)
+        self.InFlightBytes = 0
+
+
+    def _AddTimeLocked(self, times:Deque[float], nowSec:float) -> None:
+        times.append(nowSec)
+        self._TrimTimesLocked(times, nowSec)
+
+
+    def _TrimTimesLocked(self, times:Deque[float], nowSec:float) -> None:
+        while len(times) > 0 and nowSec - times[0] > WebcamViewerPacer.c_FpsWindowSec:
+            times.popleft()
@@ -1,4 +1,4 @@
-from typing import Optional, Union
+from typing import Callable, Optional, Union
 
 # Define a type for bytes like objects, for ease of use.
 BufferOrNone = Union["Buffer", None]
@@ -22,6 +22,8 @@ class Buffer():
         self._bytes:Optional[bytes] = None
         self._bytearray:Optional[bytearray] = None
         self._memoryview:Optional[memoryview] = None
+        # If set, this is called by the websocket once the buffer has been fully sent, so the underlying memory can be reused.
+        self._onSendComplete:Optional[Callable[[], None]] = None
 
         # Set the correct var depending on the type of data.
         if isinstance(data, bytes):
@@ -136,6 +138,32 @@ class Buffer():
             raise ValueError("Buffer is empty")
 
 
+    # Sets a callback that will be called once the websocket is done with this buffer, either because it was sent or it was dropped.
+    # The callback is only ever called once.
+    def SetOnSendComplete(self, callback:Optional[Callable[[], None]]) -> None:
+        self._onSendComplete = callback
+
+
+    # Adds a callback to the one that's called once the websocket is done with this buffer, rather than replacing it.
+    def AddOnSendComplete(self, callback:Callable[[], None]) -> None:
+        existing = self._onSendComplete
+        if existing is None:
+            self._onSendComplete = callback
+            return
+        def callBoth() -> None:
+            existing()
+            callback()
+        self._onSendComplete = callBoth
+
+
+    # Called by the websocket once the buffer has been sent and is no longer being used.
+    def OnSendComplete(self) -> None:
+        callback = self._onSendComplete
+        if callback is not None:
+            self._onSendComplete = None
+            callback()
+
+
     # Allow the len function to work.
     def __len__(self) -> int:
         if self._bytes is not None:
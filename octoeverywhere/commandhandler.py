@@ -14,6 +14,7 @@ from .filesystemcommands import FileSystemCommandHelper
 from .octohttprequest import PathTypes
 from .WebStream.uploadbody import UploadBody, UploadBodyOrNone
 from .Webcam.webcamhelper import WebcamHelper
+from .Webcam.webcamquality import WebcamQuality
 from .octostreammsgbuilder import OctoStreamMsgBuilder
 from .Webcam.webcamsettingitem import WebcamSettingItem
 from .interfaces import INotificationHandler, IPlatformCommandHandler, IHostCommandHandler, CommandResponse, ICommandWebsocketProvider
@@ -114,6 +115,8 @@ class CommandHandler:
     # For webcam calls, this is an optional GET arg that will be an int of the webcam index.
     # The webcam index is the index of the webcam in the list-webcam response.
     c_WebcamIndexGetKey = "index"
+    # For webcam stream calls, this is an optional GET arg of the quality tier, like full, 720p, or 480p.
+    c_WebcamQualityGetKey = "quality"
 
 
     #
@@ -173,7 +176,7 @@ class CommandHandler:
             if commandPathLower.startswith("webcam/snapshot"):
                 return WebcamHelper.Get().GetSnapshot(self._GetWebcamCamIndex(jsonObj))
             elif commandPathLower.startswith("webcam/stream"):
-                return WebcamHelper.Get().GetWebcamStream(self._GetWebcamCamIndex(jsonObj))
+                return WebcamHelper.Get().GetWebcamStream(self._GetWebcamCamIndex(jsonObj), self._GetWebcamQuality(jsonObj))
         if commandPathLower.startswith(CommandHandler.c_FilesUploadCommand):
             if self.PlatformCommandHandler is None:
                 return CommandResponse.Error(400, FileSystemCommandHelper.MissingPlatformHandlerError(CommandHandler.c_FilesUploadCommand))
@@ -924,6 +927,13 @@ class CommandHandler:
         return webcamIndex
 
 
+    def _GetWebcamQuality(self, jsonObj:Optional[Dict[str, Any]]) -> Optional[WebcamQuality]:
+        if jsonObj is None:
+            return None
+        value = jsonObj.get(CommandHandler.c_WebcamQualityGetKey, None)
+        return WebcamQuality.FromString(str(value)) if value is not None else None
+
+
     #
     # Common send-command transport parsers.
     #
@@ -0,0 +1,146 @@
+import os
+import time
+import zlib
+import threading
+from typing import Any, Dict, Optional
+
+from .buffer import ByteLikeOrMemoryView
+from .compression import Compression
+
+
+#
+# A cheap check to see if data is worth compressing before we compress it.
+#
+# The web stream helpers pick if a body is compressed from the content type, and they only stop compressing once the first compressed chunk
+# comes out barely smaller than the original. So the first chunk of every gzipped download, .3mf or .zip project file, and thumbnail behind
+# a generic mimetype like application/octet-stream is compressed for nothing, which is a full compression pass of up to a few MB.
+#
+# Before the first compression pass, we look at the magic bytes of the data for known compressed formats, and if that doesn't tell us,
+# we compress a few small samples of the data with the fastest zlib level. If the samples don't get smaller, the data is skipped.
+# Both checks only look at a few KB, so they are much cheaper than compressing the data.
+#
+class Compressibility:
+
+    # If enabled, data that isn't compressible isn't compressed.
+    # This is on by default, it can be turned off with the setter or the OCTO_COMPRESSIBILITY_CHECK=0 env var.
+    Enabled = os.environ.get("OCTO_COMPRESSIBILITY_CHECK", "1") == "1"
+
+    # The magic bytes of formats that are already compressed, as (offset, magic bytes, format name).
+    c_CompressedFormats = [
+        (0, b"\x1f\x8b", "gzip"),
+        (0, b"PK\x03\x04", "zip"),
+        (0, b"\x28\xb5\x2f\xfd", "zstd"),
+        (0, b"\xfd7zXZ\x00", "xz"),
+        (0, b"7z\xbc\xaf\x27\x1c", "7z"),
+        (0, b"Rar!\x1a\x07", "rar"),
+        (0, b"\x89PNG\r\n\x1a\n", "png"),
+        (0, b"\xff\xd8\xff", "jpeg"),
+        (0, b"GIF8", "gif"),
+        (8, b"WEBP", "webp"),
+        (4, b"ftyp", "mp4"),
+        (0, b"\x1a\x45\xdf\xa3", "webm"),
+        (0, b"wOFF", "woff"),
+        (0, b"wOF2", "woff2"),
+    ]
+
+    # The number and size of the samples we trial compress.
+    c_SampleCount = 3
+    c_SampleSizeBytes = 1024
+
+    # If the trial compressed samples are larger than this ratio of the original, the data isn't worth compressing.
+    # This matches the ratio the web stream helpers use to turn compression off mid stream.
+    c_MaxCompressedRatio = 0.9
+
+    # Text types are almost always compressible, so they only get the magic bytes check, which catches things like gzip files served as text.
+    c_TextContentTypes = ("text/", "javascript", "json", "xml", "svg")
+
+    # The compression speed we use to estimate the time saved if the device hasn't been calibrated.
+    c_DefaultCompressionMBps = 50.0
+
+    _Lock = threading.Lock()
+    _Checks = 0
+    _CheckTimeSec = 0.0
+    _Skipped = 0
+    _SkippedBytes = 0
+    _SkippedByFormat:Dict[str, int] = {}
+
+
+    @staticmethod
+    def SetEnabled(enabled:bool) -> None:
+        Compressibility.Enabled = enabled
+
+
+    # Returns the name of the compressed format the data starts with, or None if it's not a known compressed format.
+    @staticmethod
+    def GetCompressedFormat(data:ByteLikeOrMemoryView) -> Optional[str]:
+        for offset, magic, name in Compressibility.c_CompressedFormats:
+            if data[offset:offset + len(magic)] == magic:
+                return name
+        return None
+
+
+    # Trial compresses samples from the start, middle, and end of the data and returns the compressed ratio.
+    @staticmethod
+    def GetSampledRatio(data:ByteLikeOrMemoryView) -> float:
+        dataLen = len(data)
+        if dataLen == 0:
+            return 0.0
+        if dataLen <= Compressibility.c_SampleCount * Compressibility.c_SampleSizeBytes:
+            sample = bytes(data)
+        else:
+            step = (dataLen - Compressibility.c_SampleSizeBytes) // (Compressibility.c_SampleCount - 1)
+            sample = b"".join(bytes(data[i * step:i * step + Compressibility.c_SampleSizeBytes]) for i in range(Compressibility.c_SampleCount))
+        return len(zlib.compress(sample, 1)) / len(sample)
+
+
+    # Returns false if the data isn't worth compressing. This should be called before the first compression pass of a body or message.
+    # The content type is optional, it's only used to skip the trial compression for text.
+    @staticmethod
+    def IsCompressible(data:ByteLikeOrMemoryView, contentTypeLower:Optional[str]=None) -> bool:
+        if Compressibility.Enabled is False or len(data) == 0:
+            return True
+        startSec = time.perf_counter()
+        skipReason = Compressibility.GetCompressedFormat(data)
+        if skipReason is None:
+            isText = contentTypeLower is not None and any(contentTypeLower.find(t) != -1 for t in Compressibility.c_TextContentTypes)
+            if isText is False and Compressibility.GetSampledRatio(data) > Compressibility.c_MaxCompressedRatio:
+                skipReason = "sampled"
+        durationSec = time.perf_counter() - startSec
+        with Compressibility._Lock:
+            Compressibility._Checks += 1
+            Compressibility._CheckTimeSec += durationSec
+            if skipReason is not None:
+                Compressibility._Skipped += 1
+                Compressibility._SkippedBytes += len(data)
+                Compressibility._SkippedByFormat[skipReason] = Compressibility._SkippedByFormat.get(skipReason, 0) + 1
+        return skipReason is None
+
+
+    # Returns the check counters. The saved time is an estimate of the compression time of the skipped data, less the time spent checking.
+    @staticmethod
+    def GetStats() -> Dict[str, Any]:
+        mbps = Compressibility.c_DefaultCompressionMBps
+        compression = Compression.Get()
+        if compression is not None and compression.Policies.CalibratedMBps is not None:
+            mbps = compression.Policies.CalibratedMBps
+        with Compressibility._Lock:
+            skippedCompressSec = (Compressibility._SkippedBytes / (1024 * 1024)) / max(mbps, 0.001)
+            return {
+                "Enabled": Compressibility.Enabled,
+                "Checks": Compressibility._Checks,
+                "CheckTimeSec": round(Compressibility._CheckTimeSec, 4),
+                "Skipped": Compressibility._Skipped,
+                "SkippedBytes": Compressibility._SkippedBytes,
+                "SkippedByFormat": dict(Compressibility._SkippedByFormat),
+                "EstimatedSavedSec": round(skippedCompressSec - Compressibility._CheckTimeSec, 4),
+            }
+
+
+    @staticmethod
+    def Reset() -> None:
+        with Compressibility._Lock:
+            Compressibility._Checks = 0
+            Compressibility._CheckTimeSec = 0.0
+            Compressibility._Skipped = 0
+            Compressibility._SkippedBytes = 0
+            Compressibility._SkippedByFormat = {}
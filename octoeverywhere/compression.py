@@ -2,7 +2,7 @@ import os
 import sys
 import json
 import time
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import zlib
 import logging
@@ -14,6 +14,9 @@ from .sentry import Sentry
 from .memorymanager import MemoryManager
 from .buffer import Buffer, BufferOrNone, ByteLikeOrMemoryView
 from .zstandarddictionary import ZStandardDictionary
+from .negotiatedfeatures import NegotiatedFeatures
+from .compressionscheduler import CompressionScheduler
+from .compressionpolicy import CompressionPolicy, CompressionPolicyManager
 
 from .Proto.DataCompression import DataCompression
 
@@ -49,6 +52,16 @@ class CompressionContext:
         self.CompressionByteBuffer:Optional[bytes] = None
         # The compression is more efficient if we know the size of the data of the og data.
         self.CompressionTotalSizeOfDataBytes:int = CompressionContext.TOTAL_SIZE_UNKNOWN
+        # The content type and size are used to pick the compression policy, which is picked on the first compress.
+        self.CompressionContentTypeLower:Optional[str] = None
+        self.CompressionPolicy:Optional[CompressionPolicy] = None
+        # The zstandard dict is picked on the first compress, from the traffic class if it's set, otherwise from the content type.
+        self.CompressionTrafficClass:Optional[str] = None
+        self.CompressionDictId:Optional[int] = None
+        # The trained dicts can only be used if the service of the stream's session accepted them, so by default only the pre-trained dict is used.
+        self.CompressionNegotiatedFeatures:Optional[NegotiatedFeatures] = None
+        # The zstandard thread count is picked by the compression scheduler on the first compress.
+        self.CompressionThreads:Optional[int] = None
 
         # Decompression - can't be shared to be thread safe
         self.Decompressor = None
@@ -99,7 +112,7 @@ class CompressionContext:
         if streamWriter is not None:
             streamWriter.__exit__(exc_type, exc_value, traceback)
         if compressor is not None:
-            Compression.Get().ReturnZStandardCompressor(compressor)
+            Compression.Get().ReturnZStandardCompressor(compressor, self.CompressionPolicy, self.GetDictId(), self.CompressionThreads)
         if streamReader is not None:
             streamReader.__exit__(exc_type, exc_value, traceback)
         if decompressor is not None:
@@ -113,6 +126,65 @@ class CompressionContext:
         self.CompressionTotalSizeOfDataBytes = totalSizeBytes
 
 
+    # If known, the content type of the data helps pick how hard to compress it. This must be set before the first compress.
+    def SetContentType(self, contentTypeLower:Optional[str]) -> None:
+        if self.CompressionPolicy is not None:
+            raise Exception("CompressionContext SetContentType tried to be set after compression started")
+        self.CompressionContentTypeLower = contentTypeLower
+
+
+    # Sets the compression policy to use, rather than having one picked from the content type and size. This must be set before the first compress.
+    def SetCompressionPolicy(self, policy:CompressionPolicy) -> None:
+        if self.CompressionPolicy is not None:
+            raise Exception("CompressionContext SetCompressionPolicy tried to be set after compression started")
+        self.CompressionPolicy = policy
+
+
+    # Sets the traffic class used to pick the zstandard dict, for data that has no content type, like websocket messages. This must be set before the first compress.
+    def SetTrafficClass(self, trafficClass:Optional[str]) -> None:
+        if self.CompressionDictId is not None:
+            raise Exception("CompressionContext SetTrafficClass tried to be set after compression started")
+        self.CompressionTrafficClass = trafficClass
+
+
+    # Sets the features the session's service accepted, which are used to pick the zstandard dict. This must be set before the first compress.
+    def SetNegotiatedFeatures(self, negotiatedFeatures:Optional[NegotiatedFeatures]) -> None:
+        if self.CompressionDictId is not None:
+            raise Exception("CompressionContext SetNegotiatedFeatures tried to be set after compression started")
+        self.CompressionNegotiatedFeatures = negotiatedFeatures
+
+
+    # Returns the zstandard dict id for this context, the dict can't change once it's picked, since the compressor is made with it.
+    # The data that's precompressed and kept, like the Slipstream cache, always uses the pre-trained dict, since the trained dicts the service accepts can change.
+    def GetDictId(self) -> int:
+        if self.CompressionDictId is None:
+            if self.GetCompressionPolicy().Bucket == CompressionPolicyManager.c_BucketPrecompressed:
+                self.CompressionDictId = ZStandardDictionary.c_DefaultDictId
+            else:
+                trafficClass = self.CompressionTrafficClass
+                if trafficClass is None:
+                    trafficClass = ZStandardDictionary.GetTrafficClass(self.CompressionContentTypeLower)
+                acceptedDictIds = self.CompressionNegotiatedFeatures.AcceptedZStandardDictIds if self.CompressionNegotiatedFeatures is not None else frozenset()
+                self.CompressionDictId = ZStandardDictionary.Get().GetDictIdForTrafficClass(trafficClass, acceptedDictIds)
+        return self.CompressionDictId
+
+
+    # Returns the zstandard thread count for this context, the count can't change once it's picked, since the compressor is made with it.
+    # The policy asks for a thread count, but the scheduler only gives multiple threads if the process wide budget has room.
+    def GetCompressionThreads(self) -> int:
+        if self.CompressionThreads is None:
+            self.CompressionThreads = CompressionScheduler.Get().PickThreads(self.GetCompressionPolicy().Threads)
+        return self.CompressionThreads
+
+
+    # Returns the compression policy for this context, the policy can't change once it's picked, since the compressor is made from it.
+    def GetCompressionPolicy(self) -> CompressionPolicy:
+        if self.CompressionPolicy is None:
+            totalSizeBytes = None if self.CompressionTotalSizeOfDataBytes == CompressionContext.TOTAL_SIZE_UNKNOWN else self.CompressionTotalSizeOfDataBytes
+            self.CompressionPolicy = Compression.Get().Policies.GetPolicy(self.CompressionContentTypeLower, totalSizeBytes)
+        return self.CompressionPolicy
+
+
     # This is the callback from stream_writer that get called when it has data to write.
     def write(self, data:bytes):
         # A bytearray is a better option if we are continuously appending data, since we can allocate a bigger buffer
@@ -133,7 +205,7 @@ class CompressionContext:
             if self.IsClosed:
                 raise Exception("The compression context is closed, we can't compress data")
             if self.Compressor is None:
-                self.Compressor = Compression.Get().RentZStandardCompressor()
+                self.Compressor = Compression.Get().RentZStandardCompressor(self.GetCompressionPolicy(), self.GetDictId(), self.GetCompressionThreads())
                 if self.Compressor is None:
                     raise Exception("CompressionContext failed to rent a compressor")
 
@@ -146,7 +218,9 @@ class CompressionContext:
         #
         # Thus, as a good middle ground, if the buffer input is the exact size as we know the full length is, we do a one time compress.
         if self.CompressionTotalSizeOfDataBytes == len(data):
-            return CompressionResult(Buffer(self.Compressor.compress(data.Get())), time.time() - startSec, DataCompression.ZStandard, originalDataSize)
+            result = CompressionResult(Buffer(self.Compressor.compress(data.Get())), time.time() - startSec, DataCompression.ZStandard, originalDataSize)
+            Compression.Get().OnCompressed(self.GetCompressionPolicy(), result)
+            return result
 
         # If the data is size is unknown or this buffer is smaller than it, it's most likely a stream, so the streaming setup works much better.
         # Since we are passing the size if known, we can't call flush(zstd.FLUSH_FRAME), since the size indicates the expected full frame size.
@@ -170,7 +244,9 @@ class CompressionContext:
         self.CompressionByteBuffer = None
 
         # Done
-        return CompressionResult(Buffer(resultBuffer), time.time() - startSec, DataCompression.ZStandard, originalDataSize)
+        result = CompressionResult(Buffer(resultBuffer), time.time() - startSec, DataCompression.ZStandard, originalDataSize)
+        Compression.Get().OnCompressed(self.GetCompressionPolicy(), result)
+        return result
 
 
     # This is the callback from stream_reader that get called when it needs more data to read.
@@ -274,7 +350,9 @@ class Compression:
     def __init__(self, logger: logging.Logger, localFileStoragePath:str) -> None:
         self.Logger = logger
         self.LocalFileStoragePath = localFileStoragePath
-        self.ZStandardCompressorPool:List[Any] = []
+        # The compressors are made for a dict and policy, so they are pooled by the dict id and policy key.
+        self.ZStandardCompressorPool:Dict[Tuple[int, int, int, Optional[int]], List[Any]] = {}
+        self.ZStandardCompressorPoolCount = 0
         self.ZStandardCompressorPoolLock = threading.Lock()
         self.ZStandardCompressorCreatedCount = 0
 
@@ -293,6 +371,12 @@ class Compression:
         else:
             self.ZStandardThreadCount = min(4, cpuCores - 2)
 
+        # Picks the level and thread count per compression context.
+        self.Policies = CompressionPolicyManager(logger, self.ZStandardThreadCount)
+
+        # Bounds the threads all of the compression jobs can use at once to the same cores zstandard is allowed to use.
+        CompressionScheduler.Init(logger, self.ZStandardThreadCount)
+
         # Always init the zstandard singleton, even if we aren't using zstandard.
         ZStandardDictionary.Init(logger)
 
@@ -311,6 +395,10 @@ class Compression:
             self.CanUseZStandardLib = True
             self.Logger.info(f"Compression is using zstandard with {self.ZStandardThreadCount} threads")
 
+            # Measure how fast this device can compress, so the policy knows how much cpu it can spend.
+            if CompressionPolicyManager.Enabled:
+                self.Policies.Calibrate(Compression._CompressForCalibration)
+
             # Once the state is set, make a compressor and decompressor so they are cached and ready to go.
             c = self.RentZStandardCompressor()
             self.ReturnZStandardCompressor(c)
@@ -332,12 +420,32 @@ class Compression:
         if self.CanUseZStandardLib:
             # If we are training, submit the data to be sampled.
             # ZStandardDictionary.Get().SubmitData(data)
-            return compressionContext.Compress(data)
+            # The scheduler runs the compress once the process wide thread budget has room for it.
+            return CompressionScheduler.Get().Run(compressionContext.GetCompressionThreads(), len(data), lambda: compressionContext.Compress(data))
 
         # If we can't use zStandard lib, fallback to zlib
+        return CompressionScheduler.Get().Run(1, len(data), lambda: self._CompressZlib(compressionContext, data))
+
+
+    def _CompressZlib(self, compressionContext:CompressionContext, data:Buffer) -> CompressionResult:
+        policy = compressionContext.GetCompressionPolicy()
         startSec = time.time()
-        compressed = zlib.compress(data.Get(), 3)
-        return CompressionResult(Buffer(compressed), time.time() - startSec, DataCompression.Zlib, len(data.Get()))
+        compressed = zlib.compress(data.Get(), policy.ZlibLevel)
+        result = CompressionResult(Buffer(compressed), time.time() - startSec, DataCompression.Zlib, len(data.Get()))
+        self.OnCompressed(policy, result)
+        return result
+
+
+    # Called after every compress, so the policy can measure and adapt.
+    def OnCompressed(self, policy:CompressionPolicy, result:CompressionResult) -> None:
+        self.Policies.OnCompressed(policy, result.UncompressedSize, len(result.Bytes), result.CompressionTimeSec)
+
+
+    # Returns the stats for each policy bucket, including the achieved ratio and MB/s, and which zstandard dicts are used.
+    def GetPolicyStats(self) -> Dict[str, Any]:
+        stats = self.Policies.GetStats()
+        stats["Dictionaries"] = ZStandardDictionary.Get().GetStats()
+        return stats
 
 
     # Given a buffer of data and the compression type, decompresses it.
@@ -359,37 +467,83 @@ class Compression:
 
     # Returns a compressor or None if it fails to load.
     # The compressor warps the zstandard lib context, they are reusable but not thread safe.
-    def RentZStandardCompressor(self) -> Optional[Any]:
+    # If no policy is given, the compressor uses the default level and thread count.
+    # If no dict id is given, the compressor uses the pre-trained dict.
+    def RentZStandardCompressor(self, policy:Optional[CompressionPolicy]=None, dictId:int=ZStandardDictionary.c_DefaultDictId, threads:Optional[int]=None) -> Optional[Any]:
         if self.CanUseZStandardLib is False:
             return None
+        key = self._GetCompressorPoolKey(policy, dictId, threads)
         try:
             with self.ZStandardCompressorPoolLock:
-                if len(self.ZStandardCompressorPool) > 0:
-                    return self.ZStandardCompressorPool.pop()
+                pool = self.ZStandardCompressorPool.get(key, None)
+                if pool is not None and len(pool) > 0:
+                    self.ZStandardCompressorPoolCount -= 1
+                    return pool.pop()
 
                 # Report how many we have created for leak detection.
                 self.ZStandardCompressorCreatedCount += 1
                 if self.ZStandardCompressorCreatedCount > 40:
                     self.Logger.warning(f"Compression zstandard compressor pool has created {self.ZStandardCompressorCreatedCount} items, there might be a leak")
 
-                #pylint: disable=import-outside-toplevel
-                import zstandard as zstd
-                # We must use the pre-trained dict, since the service uses it as well and it must match.
-                return zstd.ZstdCompressor(threads=self.ZStandardThreadCount, dict_data=ZStandardDictionary.Get().PreTrainedDict)
+            #pylint: disable=import-outside-toplevel
+            import zstandard as zstd
+            # We must use the pre-trained dict or a trained dict the service accepted, since the service must decompress with the same dict.
+            # The precomputed dict sets the level, so it must be the one precomputed for this level.
+            _, level, threads, windowLog = key
+            if policy is not None and policy.Bucket == CompressionPolicyManager.c_BucketPrecompressed:
+                # These are rarely used, so don't hold a precomputed dict for the level.
+                params = zstd.ZstdCompressionParameters.from_level(level, threads=threads)
+                return zstd.ZstdCompressor(dict_data=ZStandardDictionary.Get().GetPreTrainedDictNotPrecomputed(dictId), compression_params=params)
+            if level == CompressionPolicyManager.c_DefaultLevel and windowLog is None and dictId == ZStandardDictionary.c_DefaultDictId:
+                return zstd.ZstdCompressor(threads=threads, dict_data=ZStandardDictionary.Get().PreTrainedDict)
+            dictData = ZStandardDictionary.Get().GetPreTrainedDictForParams(level, windowLog, dictId)
+            # The service reads the dict id from the frame header to know which dict to use, so it must be written for the trained dicts.
+            writeDictId = 0 if dictId == ZStandardDictionary.c_DefaultDictId else 1
+            if windowLog is None:
+                params = zstd.ZstdCompressionParameters.from_level(level, threads=threads, write_dict_id=writeDictId)
+            else:
+                params = zstd.ZstdCompressionParameters.from_level(level, threads=threads, window_log=windowLog, write_dict_id=writeDictId)
+            return zstd.ZstdCompressor(dict_data=dictData, compression_params=params)
         except Exception as e:
             self.Logger.error(f"Failed to rent zstandard compressor. Error: {e}")
         return None
 
 
     # Puts the compressor back into the pool
-    def ReturnZStandardCompressor(self, compressor:Optional[Any]) -> None:
+    # This must be the same policy, dict id, and thread count the compressor was rented with.
+    def ReturnZStandardCompressor(self, compressor:Optional[Any], policy:Optional[CompressionPolicy]=None, dictId:int=ZStandardDictionary.c_DefaultDictId, threads:Optional[int]=None) -> None:
         if compressor is None:
             return
+        # The precompress level compressors hold a lot of memory and are rarely used, so they aren't kept.
+        if policy is not None and policy.Bucket == CompressionPolicyManager.c_BucketPrecompressed:
+            return
+        key = self._GetCompressorPoolKey(policy, dictId, threads)
         with self.ZStandardCompressorPoolLock:
-            if len(self.ZStandardCompressorPool) >= MemoryManager.Compression_MaxPoolSize:
+            if self.ZStandardCompressorPoolCount >= MemoryManager.Compression_MaxPoolSize:
                 self.Logger.debug("ZStandard compressor pool is full, dropping compressor")
                 return
-            self.ZStandardCompressorPool.append(compressor)
+            pool = self.ZStandardCompressorPool.get(key, None)
+            if pool is None:
+                pool = []
+                self.ZStandardCompressorPool[key] = pool
+            pool.append(compressor)
+            self.ZStandardCompressorPoolCount += 1
+
+
+    # If the thread count is given, it's used rather than the policy's, since the scheduler can give a compressor less threads than the policy asked for.
+    def _GetCompressorPoolKey(self, policy:Optional[CompressionPolicy], dictId:int, threads:Optional[int]=None) -> Tuple[int, int, int, Optional[int]]:
+        if policy is None:
+            return (dictId, CompressionPolicyManager.c_DefaultLevel, self.ZStandardThreadCount if threads is None else threads, None)
+        level, policyThreads, windowLog = policy.GetKey()
+        return (dictId, level, policyThreads if threads is None else threads, windowLog)
+
+
+    # Used to measure the device's compression speed, this must use a single thread.
+    @staticmethod
+    def _CompressForCalibration(level:int, data:bytes) -> None:
+        #pylint: disable=import-outside-toplevel
+        import zstandard as zstd
+        zstd.ZstdCompressor(level=level).compress(data)
 
 
     # Returns a decompressor or None if it fails to load.
@@ -465,6 +619,8 @@ class Compression:
         except Exception as e:
             self.Logger.error(f"Compression failed to pip install zstandard lib. {e}")
 
+#
+# For reproducible numbers on the current compression setup, use developer/benchmarks/compressionbenchmark.py
 #
 # This is an old comment, from before zstandard lib. But it still has useful info about zlib and brotli
 # For zstandard, we found that it's faster and compresses way better, especially on small messages if it can stream like the websocket.
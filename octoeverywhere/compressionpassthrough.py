@@ -0,0 +1,70 @@
+import os
+from typing import Optional
+
+from .negotiatedfeatures import NegotiatedFeatures
+from .Proto.FeatureFlags import FeatureFlags
+
+
+#
+# Allows responses that are already gzip or br encoded by the local server to be forwarded as they are.
+#
+# By default we ask the local server for identity responses and apply our own compression to the body when we send it over the websocket.
+# But many servers have pre-compressed static files (like the big js bundles), so when this is on, we accept gzip or br from the local server
+# and forward the encoded body without decompressing or recompressing it. The content-encoding header is forwarded and the message is flagged,
+# so the server knows the body must be sent to the client as is.
+#
+# This must be negotiated with the server, since older servers don't know about the flag. We advertise the feature in the handshake syn
+# and it's only used for the streams of a session once the server accepts it in that session's handshake ack.
+#
+class CompressionPassThrough:
+
+    # The encodings we will forward as they are. These are the ones all of the browsers support.
+    c_PassThroughEncodings = ("gzip", "br")
+
+    # If enabled, the feature is advertised to the server.
+    # This is on by default, it can be turned off with the setter or the OCTO_COMPRESSION_PASS_THROUGH=0 env var.
+    Enabled = os.environ.get("OCTO_COMPRESSION_PASS_THROUGH", "1") == "1"
+
+    @staticmethod
+    def SetEnabled(enabled:bool) -> None:
+        CompressionPassThrough.Enabled = enabled
+
+
+    # Returns the feature flags to advertise in the handshake syn.
+    @staticmethod
+    def GetSupportedFeatureFlags() -> int:
+        if CompressionPassThrough.Enabled is False:
+            return FeatureFlags.None_
+        return FeatureFlags.CompressionPassThrough
+
+
+    # Returns true if the feature is enabled and the server of the session accepted it.
+    # Older servers don't set the flags, so they read as 0 and the feature is off.
+    @staticmethod
+    def IsActive(negotiatedFeatures:Optional[NegotiatedFeatures]) -> bool:
+        return CompressionPassThrough.Enabled and negotiatedFeatures is not None and negotiatedFeatures.HasFeature(FeatureFlags.CompressionPassThrough)
+
+
+    # Given the client's accept-encoding header value, this returns the accept-encoding header value to send to the local server.
+    # We only ask for the encodings the client also accepts, since the body is sent to the client as is.
+    @staticmethod
+    def GetAcceptEncodingHeaderValue(clientAcceptEncodingLower:Optional[str], negotiatedFeatures:Optional[NegotiatedFeatures]) -> str:
+        if clientAcceptEncodingLower is None or CompressionPassThrough.IsActive(negotiatedFeatures) is False:
+            return "identity"
+        accepted = []
+        for part in clientAcceptEncodingLower.split(","):
+            # Drop any params, like the q value. We don't bother with q=0, since browsers don't send it for these.
+            encoding = part.split(";")[0].strip()
+            if encoding in CompressionPassThrough.c_PassThroughEncodings and encoding not in accepted:
+                accepted.append(encoding)
+        if len(accepted) == 0:
+            return "identity"
+        return ", ".join(accepted)
+
+
+    # Returns true if the response's content-encoding header value is one we forward as is.
+    @staticmethod
+    def IsPassThroughContentEncoding(contentEncodingLower:Optional[str], negotiatedFeatures:Optional[NegotiatedFeatures]) -> bool:
+        if contentEncodingLower is None or CompressionPassThrough.IsActive(negotiatedFeatures) is False:
+            return False
+        return contentEncodingLower.strip() in CompressionPassThrough.c_PassThroughEncodings
@@ -0,0 +1,301 @@
+import os
+import time
+import random
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from .memorymanager import MemoryManager
+from .sendscheduler import SendScheduler
+
+
+# Describes how a compression context will compress its data.
+# Compressors are pooled by the key, so contexts with the same key can share them.
+class CompressionPolicy:
+    def __init__(self, bucket:str, level:int, threads:int, windowLog:Optional[int]) -> None:
+        self.Bucket = bucket
+        self.Level = level
+        self.Threads = threads
+        self.WindowLog = windowLog
+        # zlib is only used if zstandard can't be used, it doesn't support the fast levels, so keep it between 1 and the old default of 3.
+        self.ZlibLevel = max(1, min(3, level))
+
+
+    def GetKey(self) -> Tuple[int, int, Optional[int]]:
+        return (self.Level, self.Threads, self.WindowLog)
+
+
+# The state and stats for one group of similar payloads.
+class _PolicyBucket:
+    def __init__(self, name:str, defaultLevel:int, minLevel:int, maxThreads:int, windowLog:Optional[int]) -> None:
+        self.Name = name
+        self.DefaultLevel = defaultLevel
+        self.MinLevel = minLevel
+        self.MaxThreads = maxThreads
+        self.WindowLog = windowLog
+        self.CurrentLevel = defaultLevel
+        # The current evaluation window, used to adapt the level.
+        self.WindowBytes = 0
+        self.WindowSec = 0.0
+        # The totals, for stats.
+        self.Count = 0
+        self.UncompressedBytes = 0
+        self.CompressedBytes = 0
+        self.DurationSec = 0.0
+        self.LevelDrops = 0
+        self.LevelRaises = 0
+
+
+#
+# Picks the compression level, window and thread count for each compression context.
+#
+# It's wasteful to spend the same effort on a 4MB js file as on a 300 byte websocket message, so payloads are put into buckets by their
+# content type and expected size, and each bucket has its own level and thread count. Multiple zstandard threads only help when there's
+# a lot of data to compress, so only the large buckets use them.
+#
+# On startup we measure how fast this device can compress. If it can't compress as fast as we can send, the buckets that can adapt
+# start at level 1. After that, each bucket measures the throughput it actually gets, and if the compression becomes slower than the
+# send rate, compression is what's limiting the send, so the level is lowered, down to the bucket's min level. Once there's plenty of
+# headroom again, the level is slowly raised back to the default.
+#
+# The send rate is measured by the websocket send thread. Until it's known, c_TargetMBps is used, and since a faster connection doesn't
+# need more than that, it's also the cap. On a slow connection, the send is the limit, so the compression can use the cpu to make less data.
+#
+# Small payloads are mostly per call overhead, so they aren't used to measure the throughput.
+#
+class CompressionPolicyManager:
+
+    # The buckets.
+    c_BucketSmall = "small"
+    c_BucketStream = "stream"
+    c_BucketText = "text"
+    c_BucketLargeText = "large_text"
+    c_BucketBinary = "binary"
+    # Used for everything if the adaptive policy is disabled.
+    c_BucketFixed = "fixed"
+    # Used for data that's compressed once in the background and then sent many times, like the Slipstream cache.
+    c_BucketPrecompressed = "precompressed"
+
+    # Known sizes equal to or less than this are in the small bucket.
+    c_SmallMaxSizeBytes = 16 * 1024
+
+    # Known sizes larger than this are in the large bucket and can use multiple threads.
+    c_LargeMinSizeBytes = 1024 * 1024
+
+    # This is about how fast we can send on a fast connection. If compression is slower than this, it's slowing the send down.
+    # If the measured send rate is lower, that's used instead.
+    c_TargetMBps = 30.0
+
+    # If compression is this much faster than the target, the level can be raised.
+    c_RaiseLevelHeadroom = 2.0
+
+    # The level the adaptive buckets start at if the device can't compress as fast as the target.
+    c_SlowDeviceLevel = 1
+
+    # The amount of data each bucket evaluates the throughput over before adapting the level.
+    c_EvaluateWindowBytes = 4 * 1024 * 1024
+
+    # Compress calls smaller than this aren't used to measure the throughput.
+    c_MinSampleSizeBytes = 16 * 1024
+
+    # The size of the buffer used to measure the device's compression speed on startup.
+    c_CalibrationSizeBytes = 256 * 1024
+
+    # The level zstandard uses by default, this is what the legacy fixed policy uses.
+    c_DefaultLevel = 3
+
+    # If enabled, the policy adapts per content type, size, and cpu budget. If disabled, everything uses the old fixed level and thread count.
+    # This is on by default, it can be turned off with the setter or the OCTO_ADAPTIVE_COMPRESSION=0 env var.
+    Enabled = os.environ.get("OCTO_ADAPTIVE_COMPRESSION", "1") == "1"
+
+
+    @staticmethod
+    def SetEnabled(enabled:bool) -> None:
+        CompressionPolicyManager.Enabled = enabled
+
+
+    def __init__(self, logger:logging.Logger, zStandardThreadCount:int) -> None:
+        self.Logger = logger
+        self.ZStandardThreadCount = zStandardThreadCount
+        self.Lock = threading.Lock()
+        # The measured single thread compression speed of the device, if it's been calibrated.
+        self.CalibratedMBps:Optional[float] = None
+        self.Buckets:Dict[str, _PolicyBucket] = {
+            CompressionPolicyManager.c_BucketSmall: _PolicyBucket(CompressionPolicyManager.c_BucketSmall, 3, 3, 1, None),
+            CompressionPolicyManager.c_BucketStream: _PolicyBucket(CompressionPolicyManager.c_BucketStream, 3, 1, 1, MemoryManager.Compression_StreamWindowLog),
+            CompressionPolicyManager.c_BucketText: _PolicyBucket(CompressionPolicyManager.c_BucketText, 3, 1, 1, None),
+            CompressionPolicyManager.c_BucketLargeText: _PolicyBucket(CompressionPolicyManager.c_BucketLargeText, 3, -1, zStandardThreadCount, None),
+            CompressionPolicyManager.c_BucketBinary: _PolicyBucket(CompressionPolicyManager.c_BucketBinary, 1, -1, zStandardThreadCount, None),
+            CompressionPolicyManager.c_BucketFixed: _PolicyBucket(CompressionPolicyManager.c_BucketFixed, CompressionPolicyManager.c_DefaultLevel, CompressionPolicyManager.c_DefaultLevel, zStandardThreadCount, None),
+            CompressionPolicyManager.c_BucketPrecompressed: _PolicyBucket(CompressionPolicyManager.c_BucketPrecompressed, MemoryManager.Compression_PrecompressLevel, MemoryManager.Compression_PrecompressLevel, zStandardThreadCount, None),
+        }
+
+
+    # Measures how fast this device can compress and sets the starting levels from it.
+    # compressFunc is given the level and data and must compress it with a single thread.
+    def Calibrate(self, compressFunc:Any) -> None:
+        try:
+            data = CompressionPolicyManager._MakeCalibrationData(CompressionPolicyManager.c_CalibrationSizeBytes)
+            # Take the best of a few runs, so a busy moment on startup doesn't make the device look slower than it is.
+            bestSec = None
+            for _ in range(3):
+                startSec = time.perf_counter()
+                compressFunc(CompressionPolicyManager.c_DefaultLevel, data)
+                durationSec = time.perf_counter() - startSec
+                if bestSec is None or durationSec < bestSec:
+                    bestSec = durationSec
+            mbps = (len(data) / (1024 * 1024)) / max(bestSec or 0.0, 0.000001)
+            self.OnCalibrated(mbps)
+        except Exception as e:
+            self.Logger.warning(f"Compression policy failed to calibrate the device, using the default levels. {e}")
+
+
+    # Sets the starting levels from the device's compression speed.
+    # Only the measured throughput of each bucket can drop it below the slow device level, since the calibration data is only a guess at the payloads.
+    def OnCalibrated(self, mbps:float) -> None:
+        isSlowDevice = mbps < CompressionPolicyManager.c_TargetMBps
+        with self.Lock:
+            self.CalibratedMBps = mbps
+            if isSlowDevice:
+                for bucket in self.Buckets.values():
+                    bucket.CurrentLevel = max(bucket.MinLevel, min(bucket.DefaultLevel, CompressionPolicyManager.c_SlowDeviceLevel))
+        self.Logger.info(f"Compression policy calibrated the device at {mbps:.1f} MB/s, {'using the slow device levels' if isSlowDevice else 'using the default levels'}.")
+
+
+    # Returns the compression throughput that keeps up with the send.
+    @staticmethod
+    def GetTargetMBps() -> float:
+        sendMBps = SendScheduler.GetSendMBps()
+        if sendMBps is None:
+            return CompressionPolicyManager.c_TargetMBps
+        return min(CompressionPolicyManager.c_TargetMBps, sendMBps)
+
+
+    # Returns the policy for a context given what we know about the data it will compress.
+    def GetPolicy(self, contentTypeLower:Optional[str], totalSizeBytes:Optional[int]) -> CompressionPolicy:
+        bucketName = self._GetBucketName(contentTypeLower, totalSizeBytes)
+        with self.Lock:
+            bucket = self.Buckets[bucketName]
+            level = bucket.CurrentLevel
+        threads = 1
+        if bucketName == CompressionPolicyManager.c_BucketFixed or (totalSizeBytes is not None and totalSizeBytes >= CompressionPolicyManager.c_LargeMinSizeBytes):
+            threads = bucket.MaxThreads
+        return CompressionPolicy(bucketName, level, threads, bucket.WindowLog)
+
+
+    # Returns the policy for data that's compressed once in the background and then sent many times.
+    # This doesn't depend on the adaptive policy being enabled, since the cpu cost isn't on the send path.
+    def GetPrecompressedPolicy(self) -> CompressionPolicy:
+        bucket = self.Buckets[CompressionPolicyManager.c_BucketPrecompressed]
+        policy = CompressionPolicy(bucket.Name, bucket.DefaultLevel, bucket.MaxThreads, bucket.WindowLog)
+        # There's no send waiting on this, so zlib can use its best level too.
+        policy.ZlibLevel = 9
+        return policy
+
+
+    # Called after each compress so the bucket can measure its throughput and adapt the level.
+    def OnCompressed(self, policy:CompressionPolicy, uncompressedSizeBytes:int, compressedSizeBytes:int, durationSec:float) -> None:
+        newLevel:Optional[int] = None
+        with self.Lock:
+            bucket = self.Buckets.get(policy.Bucket, None)
+            if bucket is None:
+                return
+            bucket.Count += 1
+            bucket.UncompressedBytes += uncompressedSizeBytes
+            bucket.CompressedBytes += compressedSizeBytes
+            bucket.DurationSec += durationSec
+
+            # Only adapt from samples large enough to measure, and only buckets that have a range of levels.
+            if uncompressedSizeBytes < CompressionPolicyManager.c_MinSampleSizeBytes or bucket.MinLevel == bucket.DefaultLevel:
+                return
+            # Only count samples from the current level, since the old level's compressors can still be finishing up.
+            if policy.Level != bucket.CurrentLevel:
+                return
+            bucket.WindowBytes += uncompressedSizeBytes
+            bucket.WindowSec += durationSec
+            if bucket.WindowBytes < CompressionPolicyManager.c_EvaluateWindowBytes:
+                return
+
+            mbps = (bucket.WindowBytes / (1024 * 1024)) / max(bucket.WindowSec, 0.000001)
+            bucket.WindowBytes = 0
+            bucket.WindowSec = 0.0
+            targetMBps = CompressionPolicyManager.GetTargetMBps()
+            if mbps < targetMBps and bucket.CurrentLevel > bucket.MinLevel:
+                bucket.CurrentLevel = CompressionPolicyManager._StepLevel(bucket.CurrentLevel, -1)
+                bucket.LevelDrops += 1
+                newLevel = bucket.CurrentLevel
+            elif mbps > targetMBps * CompressionPolicyManager.c_RaiseLevelHeadroom and bucket.CurrentLevel < bucket.DefaultLevel:
+                bucket.CurrentLevel = CompressionPolicyManager._StepLevel(bucket.CurrentLevel, 1)
+                bucket.LevelRaises += 1
+                newLevel = bucket.CurrentLevel
+        if newLevel is not None:
+            self.Logger.debug("Compression policy bucket %s measured %.1f MB/s, moved to level %d", policy.Bucket, mbps, newLevel)
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        with self.Lock:
+            buckets:Dict[str, Any] = {}
+            for bucket in self.Buckets.values():
+                if bucket.Count == 0:
+                    continue
+                buckets[bucket.Name] = {
+                    "Level": bucket.CurrentLevel,
+                    "Count": bucket.Count,
+                    "UncompressedBytes": bucket.UncompressedBytes,
+                    "CompressedBytes": bucket.CompressedBytes,
+                    "Ratio": round(bucket.UncompressedBytes / bucket.CompressedBytes, 3) if bucket.CompressedBytes > 0 else 0.0,
+                    "MBps": round((bucket.UncompressedBytes / (1024 * 1024)) / bucket.DurationSec, 3) if bucket.DurationSec > 0 else 0.0,
+                    "LevelDrops": bucket.LevelDrops,
+                    "LevelRaises": bucket.LevelRaises,
+                }
+            return {
+                "Enabled": CompressionPolicyManager.Enabled,
+                "CalibratedMBps": round(self.CalibratedMBps, 3) if self.CalibratedMBps is not None else None,
+                "TargetMBps": round(CompressionPolicyManager.GetTargetMBps(), 3),
+                "Buckets": buckets,
+            }
+
+
+    def _GetBucketName(self, contentTypeLower:Optional[str], totalSizeBytes:Optional[int]) -> str:
+        if CompressionPolicyManager.Enabled is False:
+            return CompressionPolicyManager.c_BucketFixed
+        if totalSizeBytes is None or totalSizeBytes < 0:
+            return CompressionPolicyManager.c_BucketStream
+        if totalSizeBytes <= CompressionPolicyManager.c_SmallMaxSizeBytes:
+            return CompressionPolicyManager.c_BucketSmall
+        if contentTypeLower is not None and CompressionPolicyManager._IsTextContentType(contentTypeLower) is False:
+            return CompressionPolicyManager.c_BucketBinary
+        if totalSizeBytes >= CompressionPolicyManager.c_LargeMinSizeBytes:
+            return CompressionPolicyManager.c_BucketLargeText
+        return CompressionPolicyManager.c_BucketText
+
+
+    # This matches the text types the web stream http helper compresses, application/octet-stream is compressed but it's not text.
+    @staticmethod
+    def _IsTextContentType(contentTypeLower:str) -> bool:
+        return (contentTypeLower.find("text/") != -1 or contentTypeLower.find("javascript") != -1
+                or contentTypeLower.find("json") != -1 or contentTypeLower.find("xml") != -1
+                or contentTypeLower.find("svg") != -1)
+
+
+    # Level 0 means the zstandard default level, so skip it when stepping.
+    @staticmethod
+    def _StepLevel(level:int, step:int) -> int:
+        level += step
+        if level == 0:
+            level += step
+        return level
+
+
+    # Makes semi random json like data, which compresses about like the api payloads we send.
+    @staticmethod
+    def _MakeCalibrationData(sizeBytes:int) -> bytes:
+        rand = random.Random(3)
+        words = [b"toolhead", b"position", b"extruder", b"temperature", b"target", b"print_stats", b"heater_bed", b"state", b"filename", b"progress"]
+        parts = []
+        total = 0
+        while total < sizeBytes:
+            part = b'"' + rand.choice(words) + b'":' + str(rand.randint(0, 100000) / 100).encode("ascii") + b","
+            parts.append(part)
+            total += len(part)
+        return b"".join(parts)[:sizeBytes]
@@ -0,0 +1,236 @@
+import os
+import sys
+import time
+import queue
+import logging
+import threading
+import collections
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from .sentry import Sentry
+from .latencyhistogram import LatencyHistogram
+
+
+# A compression job that's run on one of the low priority worker threads.
+class _LowPriorityJob:
+    def __init__(self, work:Callable[[], Any]) -> None:
+        self.Work = work
+        self.Done = threading.Event()
+        self.Result:Any = None
+        self.Exception:Optional[Exception] = None
+
+
+#
+# Bounds the cpu all of the compression in the process can use.
+#
+# Each compression context rents its own compressor, and the compressors for big bodies can use multiple zstandard threads.
+# Under heavy parallel load, like a cold dashboard load plus a webcam and downloads, all of the compressors running at once would
+# oversubscribe a small board and starve the OctoPrint or Klipper host, which can hurt the print quality.
+#
+# So every compress is a job that has to get its threads from a process wide budget before it runs, and the jobs that don't fit wait in order.
+# When a context makes its compressor, the scheduler decides if it gets the multiple threads the policy asked for, or only one if the budget is busy.
+# While a print is active, new compressors are always single threaded and the jobs run on worker threads with a lower priority (nice), so the
+# host always wins the cpu. Small jobs are so cheap they skip the queue, so the websocket messages are never stuck behind a big body.
+#
+class CompressionScheduler:
+
+    # If enabled, compression is bounded by the budget.
+    # This is on by default, it can be turned off with the setter or the OCTO_COMPRESSION_SCHEDULER=0 env var.
+    Enabled = os.environ.get("OCTO_COMPRESSION_SCHEDULER", "1") == "1"
+
+    # Jobs smaller than this run right away, without taking any of the budget.
+    c_SmallJobSizeBytes = 32 * 1024
+
+    # The nice value of the worker threads that run the jobs while a print is active.
+    c_PrintingNiceValue = 10
+
+    # How long we cache if a print is active, since it's checked for every job.
+    c_PrintActiveCacheSec = 1.0
+
+    # Returns if a print is active, set by the notification handler.
+    # It's held in a list, since a callable class attribute would be treated as a method of the class.
+    _IsPrintActiveCallback:List[Callable[[], bool]] = []
+
+    _Instance:"CompressionScheduler" = None #pyright: ignore[reportAssignmentType]
+
+
+    @staticmethod
+    def Init(logger:logging.Logger, threadBudget:int) -> None:
+        CompressionScheduler._Instance = CompressionScheduler(logger, threadBudget)
+
+
+    @staticmethod
+    def Get() -> "CompressionScheduler":
+        return CompressionScheduler._Instance
+
+
+    @staticmethod
+    def SetEnabled(enabled:bool) -> None:
+        CompressionScheduler.Enabled = enabled
+
+
+    @staticmethod
+    def SetIsPrintActiveCallback(callback:Optional[Callable[[], bool]]) -> None:
+        CompressionScheduler._IsPrintActiveCallback = [] if callback is None else [callback]
+
+
+    def __init__(self, logger:logging.Logger, threadBudget:int) -> None:
+        self.Logger = logger
+        self.ThreadBudget = max(1, threadBudget)
+        self.Condition = threading.Condition()
+        self.ThreadsInUse = 0
+        # The jobs waiting for threads, in order. Each is a ticket and the number of threads it needs.
+        self.Waiting:Deque[Tuple[object, int]] = collections.deque()
+
+        # The print active state is cached, since it's checked for every job.
+        self.IsPrintActiveCache = False
+        self.IsPrintActiveCheckSec = 0.0
+
+        # The worker threads that run the jobs at a lower priority while printing. They are only made the first time they are needed.
+        # Since an unprivileged process can't raise a thread's priority back up, these stay low priority and are only used while printing.
+        self.CanLowerThreadPriority = sys.platform.startswith("linux") and hasattr(os, "setpriority") and hasattr(threading, "get_native_id")
+        self.LowPriorityQueue:"queue.Queue[_LowPriorityJob]" = queue.Queue()
+        self.LowPriorityWorkers:List[threading.Thread] = []
+        self.LowPriorityWorkersLock = threading.Lock()
+
+        # Stats
+        self.QueueWait = LatencyHistogram()
+        self.Jobs = 0
+        self.SmallJobs = 0
+        self.LowPriorityJobs = 0
+        self.MultiThreadedCompressors = 0
+        self.SingleThreadedCompressors = 0
+        self.DowngradedCompressors = 0
+        self.PeakThreadsInUse = 0
+        self.PeakWaiting = 0
+
+
+    # Returns the number of threads a new compressor should use, given the number the compression policy asked for.
+    # Multiple threads are only given if a print isn't active and the budget has room for them right now.
+    def PickThreads(self, policyThreads:int) -> int:
+        threads = max(1, policyThreads)
+        if CompressionScheduler.Enabled and threads > 1:
+            threads = min(threads, self.ThreadBudget)
+            with self.Condition:
+                freeThreads = self.ThreadBudget - self.ThreadsInUse
+            if threads > 1 and (self.IsPrintActive() or freeThreads < threads):
+                threads = 1
+                self.DowngradedCompressors += 1
+        if threads > 1:
+            self.MultiThreadedCompressors += 1
+        else:
+            self.SingleThreadedCompressors += 1
+        return threads
+
+
+    # Runs a compression job that will use the given number of threads, once the budget has room for it. Returns what the work returns.
+    def Run(self, threads:int, sizeBytes:int, work:Callable[[], Any]) -> Any:
+        if CompressionScheduler.Enabled is False:
+            return work()
+        self.Jobs += 1
+        if sizeBytes < CompressionScheduler.c_SmallJobSizeBytes:
+            self.SmallJobs += 1
+            return work()
+
+        threads = min(max(1, threads), self.ThreadBudget)
+        self._Acquire(threads)
+        try:
+            if self.CanLowerThreadPriority and self.IsPrintActive():
+                self.LowPriorityJobs += 1
+                return self._RunOnLowPriorityWorker(work)
+            return work()
+        finally:
+            self._Release(threads)
+
+
+    # Returns if a print is active, the value is cached for a short time.
+    def IsPrintActive(self) -> bool:
+        callbacks = CompressionScheduler._IsPrintActiveCallback
+        if len(callbacks) == 0:
+            return False
+        callback = callbacks[0]
+        nowSec = time.time()
+        if nowSec - self.IsPrintActiveCheckSec > CompressionScheduler.c_PrintActiveCacheSec:
+            self.IsPrintActiveCheckSec = nowSec
+            try:
+                self.IsPrintActiveCache = callback()
+            except Exception as e:
+                Sentry.OnException("CompressionScheduler failed to check if a print is active.", e)
+                self.IsPrintActiveCache = False
+        return self.IsPrintActiveCache
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        with self.Condition:
+            threadsInUse = self.ThreadsInUse
+            waiting = len(self.Waiting)
+        return {
+            "Enabled": CompressionScheduler.Enabled,
+            "ThreadBudget": self.ThreadBudget,
+            "ThreadsInUse": threadsInUse,
+            "PeakThreadsInUse": self.PeakThreadsInUse,
+            "WaitingJobs": waiting,
+            "PeakWaitingJobs": self.PeakWaiting,
+            "Jobs": self.Jobs,
+            "SmallJobs": self.SmallJobs,
+            "LowPriorityJobs": self.LowPriorityJobs,
+            "PrintActive": self.IsPrintActiveCache,
+            "MultiThreadedCompressors": self.MultiThreadedCompressors,
+            "SingleThreadedCompressors": self.SingleThreadedCompressors,
+            "DowngradedCompressors": self.DowngradedCompressors,
+            "QueueWait": self.QueueWait.GetStats(),
+        }
+
+
+    # Blocks until the threads are available. The jobs get the threads in the order they asked for them.
+    def _Acquire(self, threads:int) -> None:
+        startSec = time.time()
+        ticket = object()
+        with self.Condition:
+            self.Waiting.append((ticket, threads))
+            self.PeakWaiting = max(self.PeakWaiting, len(self.Waiting))
+            while self.Waiting[0][0] is not ticket or self.ThreadsInUse + threads > self.ThreadBudget:
+                self.Condition.wait()
+            self.Waiting.popleft()
+            self.ThreadsInUse += threads
+            self.PeakThreadsInUse = max(self.PeakThreadsInUse, self.ThreadsInUse)
+            # The next job in line might fit as well.
+            self.Condition.notify_all()
+        self.QueueWait.Add(time.time() - startSec)
+
+
+    def _Release(self, threads:int) -> None:
+        with self.Condition:
+            self.ThreadsInUse -= threads
+            self.Condition.notify_all()
+
+
+    def _RunOnLowPriorityWorker(self, work:Callable[[], Any]) -> Any:
+        with self.LowPriorityWorkersLock:
+            # There's never more jobs running than the budget, so that's all of the workers we need.
+            if len(self.LowPriorityWorkers) < self.ThreadBudget:
+                t = threading.Thread(target=self._LowPriorityWorkerThread, name="CompressionLowPriorityWorker", daemon=True)
+                self.LowPriorityWorkers.append(t)
+                t.start()
+        job = _LowPriorityJob(work)
+        self.LowPriorityQueue.put(job)
+        job.Done.wait()
+        if job.Exception is not None:
+            raise job.Exception
+        return job.Result
+
+
+    def _LowPriorityWorkerThread(self) -> None:
+        try:
+            # On linux, the priority of a thread can be set with its thread id.
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), CompressionScheduler.c_PrintingNiceValue) #pyright: ignore[reportAttributeAccessIssue]
+        except Exception as e:
+            self.Logger.warning(f"CompressionScheduler failed to lower the priority of a compression thread. {e}")
+        while True:
+            job = self.LowPriorityQueue.get()
+            try:
+                job.Result = job.Work()
+            except Exception as e:
+                job.Exception = e
+            finally:
+                job.Done.set()
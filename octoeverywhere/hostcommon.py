@@ -7,11 +7,14 @@ from typing import Optional
 
 from .memorymanager import MemoryManager
 from .compression import Compression
+from .sendbufferpool import SendBufferPool
 from .mdns import MDns
 from .deviceid import DeviceId
 from .printinfo import PrintInfoManager
 from .telemetry import Telemetry
 from .pingpong import PingPong
+from .WebStream.webstreamworkerpool import WebStreamWorkerPool
+from .WebStream.asyncwebstreamengine import AsyncWebStreamEngine
 
 
 # Common functions that the hosts might need to use.
@@ -48,6 +51,15 @@ class HostCommon:
         # Init compression
         Compression.Init(logging, localStorageDir)
 
+        # Init the buffer pool, it must be created after the memory manager.
+        SendBufferPool.Init(logging)
+
+        # Init the web stream worker pool. It's only used if it's enabled, but it must be created after the memory manager.
+        WebStreamWorkerPool.Init(logging)
+
+        # Init the asyncio web stream engine, this only does anything if it's the selected engine.
+        AsyncWebStreamEngine.Init(logging)
+
         # Init the mdns client
         MDns.Init(logging, localStorageDir)
 
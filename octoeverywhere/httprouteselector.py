@@ -0,0 +1,260 @@
+import os
+import time
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .httpresult import HttpResult
+
+
+# One of the urls MakeHttpCall can use for a request.
+# The url is built on first use, since some of them need the local IP, which we don't want to look up unless it's needed.
+class HttpRoute:
+    def __init__(self, name:str, isFallback:bool, getUrl:Callable[[], str]) -> None:
+        self.Name = name
+        self.IsFallback = isFallback
+        self._getUrl = getUrl
+        self._url:Optional[str] = None
+
+
+    @property
+    def Url(self) -> str:
+        if self._url is None:
+            self._url = self._getUrl()
+        return self._url
+
+
+# The counters for one route, by route name.
+class _HttpRouteStats:
+    def __init__(self) -> None:
+        self.Attempts = 0
+        self.Wins = 0
+        self.Failures = 0
+        self.MemoHits = 0
+        self.WinLatencySec = 0.0
+
+
+#
+# Picks which of the MakeHttpCall routes to use for a request.
+#
+# MakeHttpCall has a list of routes it tries in order, the main url, the http proxy, the local IP http proxy, the local IP direct port, and the webcam port.
+# Each route is only tried after the one before it fails, so on setups where the first routes never work, every request has to wait for them to fail.
+#
+# This does two things to fix that:
+#   1) The route that worked is remembered per (host, path prefix), so the next request for the same kind of path goes right to it.
+#      The winner expires after a while, and it's forgotten as soon as it fails, then all of the routes are tried again.
+#   2) When there are fallback routes, each attempt uses a short connect timeout, so a route that can't be reached fails fast rather than
+#      waiting for the full request timeout, and the next route is tried sooner.
+#
+# The routes are still tried one at a time, in order, and the next route is only tried on a failure signal, a failed connection or a 404,
+# never because a route is slow. Most of the routes reach the same backend, like the http proxy forwarding to the same server as the main url,
+# so trying another route for a slow request would just send the request to the same server twice. This also means any request can use
+# the selector, since a request is never sent to more than one route unless the ones before it failed.
+#
+# A 404 isn't a success, just like in MakeHttpCall, but if every route fails the main url's response is returned.
+#
+class HttpRouteSelector:
+
+    # If enabled, the winning routes are remembered and the connect timeout is used.
+    # This is on by default, it can be turned off with the setter or the OCTO_HTTP_ROUTE_MEMO=0 env var.
+    Enabled = os.environ.get("OCTO_HTTP_ROUTE_MEMO", "1") == "1"
+
+    # How long a winning route is remembered.
+    c_WinnerTtlSec = 300.0
+
+    # How long an attempt can take to connect when there are other routes to try.
+    # The routes are all on the local device or LAN, so a connection that takes this long isn't going to work.
+    c_ConnectTimeoutSec = 5.0
+
+    _Lock = threading.Lock()
+    _Winners:Dict[Tuple[str, str], Tuple[str, float]] = {}
+    _Stats:Dict[str, _HttpRouteStats] = {}
+
+
+    @staticmethod
+    def SetEnabled(enabled:bool) -> None:
+        HttpRouteSelector.Enabled = enabled
+
+
+    # Returns the connect timeout attempts should use, or None if they should use the request timeout.
+    @staticmethod
+    def GetConnectTimeoutSec(routeCount:int) -> Optional[float]:
+        if HttpRouteSelector.Enabled is False or routeCount < 2:
+            return None
+        return HttpRouteSelector.c_ConnectTimeoutSec
+
+
+    # Returns the memo key for a request, which is the host and the first segment of the path.
+    # All of the paths under a prefix are usually served by the same thing, like /webcam/ or /api/.
+    @staticmethod
+    def GetRouteKey(host:str, path:str) -> Tuple[str, str]:
+        end = len(path)
+        for c in ("?", "#"):
+            pos = path.find(c)
+            if pos != -1 and pos < end:
+                end = pos
+        secondSlash = path.find("/", 1, end)
+        if secondSlash != -1:
+            end = secondSlash
+        return (host.lower(), path[:end] if end > 0 else "/")
+
+
+    # Returns the name of the remembered winner for the key, or None if there isn't one or it expired.
+    @staticmethod
+    def GetWinner(key:Tuple[str, str]) -> Optional[str]:
+        with HttpRouteSelector._Lock:
+            winner = HttpRouteSelector._Winners.get(key, None)
+            if winner is None:
+                return None
+            if time.time() > winner[1]:
+                del HttpRouteSelector._Winners[key]
+                return None
+            return winner[0]
+
+
+    @staticmethod
+    def ClearWinners() -> None:
+        with HttpRouteSelector._Lock:
+            HttpRouteSelector._Winners.clear()
+
+
+    # Returns the counters for each route name that's been used.
+    @staticmethod
+    def GetStats() -> Dict[str, Dict[str, float]]:
+        ret:Dict[str, Dict[str, float]] = {}
+        with HttpRouteSelector._Lock:
+            for name, stats in HttpRouteSelector._Stats.items():
+                ret[name] = {
+                    "Attempts": stats.Attempts,
+                    "Wins": stats.Wins,
+                    "Failures": stats.Failures,
+                    "MemoHits": stats.MemoHits,
+                    "AvgWinLatencyMs": 0.0 if stats.Wins == 0 else round((stats.WinLatencySec / stats.Wins) * 1000.0, 3),
+                }
+        return ret
+
+
+    @staticmethod
+    def ResetStats() -> None:
+        with HttpRouteSelector._Lock:
+            HttpRouteSelector._Stats.clear()
+
+
+    # Returns true if the result should be used, which matches the MakeHttpCall fallback logic.
+    @staticmethod
+    def IsSuccess(result:Optional[HttpResult]) -> bool:
+        return result is not None and result.StatusCode != 404
+
+
+    # Makes the request using the routes, which must be in the order MakeHttpCall would try them, starting with the main url.
+    # The attempt function makes the request for a route and returns the result, or None if it failed to connect.
+    @staticmethod
+    def Run(logger:logging.Logger, key:Tuple[str, str], routes:List[HttpRoute], attempt:Callable[[HttpRoute], Optional[HttpResult]]) -> Optional[HttpResult]:
+        if len(routes) == 0:
+            return None
+        if HttpRouteSelector.Enabled is False or len(routes) == 1:
+            return HttpRouteSelector._RunInOrder(routes, attempt, None)[1]
+
+        # If we know which route works for this kind of path, try it first.
+        mainResult:Optional[HttpResult] = None
+        winnerName = HttpRouteSelector.GetWinner(key)
+        if winnerName is not None:
+            winnerRoute = next((r for r in routes if r.Name == winnerName), None)
+            if winnerRoute is not None:
+                result = HttpRouteSelector._Attempt(winnerRoute, attempt)
+                if HttpRouteSelector.IsSuccess(result):
+                    with HttpRouteSelector._Lock:
+                        HttpRouteSelector._GetStatsLocked(winnerName).MemoHits += 1
+                    return result
+                # It didn't work, so forget it and try all of the routes again.
+                logger.debug("Http route %s stopped working for %s, trying all of the routes.", winnerName, key)
+                HttpRouteSelector._ForgetWinner(key, winnerName)
+                if winnerRoute is routes[0]:
+                    # Keep the main result, in case nothing else works.
+                    mainResult = result
+                else:
+                    HttpRouteSelector._Free(result)
+                routes = [r for r in routes if r is not winnerRoute]
+                if len(routes) == 0:
+                    return mainResult
+
+        winner, result = HttpRouteSelector._RunInOrder(routes, attempt, mainResult)
+        if winner is not None:
+            HttpRouteSelector._RememberWinner(key, winner.Name)
+        return result
+
+
+    # Tries each route in order until one works. Returns the winning route and the result.
+    # If nothing works, the main result is returned, or the last result if there's no main result.
+    @staticmethod
+    def _RunInOrder(routes:List[HttpRoute], attempt:Callable[[HttpRoute], Optional[HttpResult]], mainResult:Optional[HttpResult]) -> Tuple[Optional[HttpRoute], Optional[HttpResult]]:
+        lastResult:Optional[HttpResult] = None
+        for route in routes:
+            result = HttpRouteSelector._Attempt(route, attempt)
+            if HttpRouteSelector.IsSuccess(result):
+                HttpRouteSelector._Free(mainResult)
+                HttpRouteSelector._Free(lastResult)
+                return (route, result)
+            if route.IsFallback is False and mainResult is None:
+                mainResult = result
+            else:
+                HttpRouteSelector._Free(lastResult)
+                lastResult = result
+        if mainResult is not None:
+            HttpRouteSelector._Free(lastResult)
+            return (None, mainResult)
+        return (None, lastResult)
+
+
+    # Makes the attempt and updates the counters.
+    @staticmethod
+    def _Attempt(route:HttpRoute, attempt:Callable[[HttpRoute], Optional[HttpResult]]) -> Optional[HttpResult]:
+        start = time.time()
+        result:Optional[HttpResult] = None
+        try:
+            result = attempt(route)
+        finally:
+            isSuccess = HttpRouteSelector.IsSuccess(result)
+            with HttpRouteSelector._Lock:
+                stats = HttpRouteSelector._GetStatsLocked(route.Name)
+                stats.Attempts += 1
+                if isSuccess:
+                    stats.Wins += 1
+                    stats.WinLatencySec += time.time() - start
+                else:
+                    stats.Failures += 1
+        return result
+
+
+    @staticmethod
+    def _RememberWinner(key:Tuple[str, str], name:str) -> None:
+        with HttpRouteSelector._Lock:
+            HttpRouteSelector._Winners[key] = (name, time.time() + HttpRouteSelector.c_WinnerTtlSec)
+
+
+    @staticmethod
+    def _ForgetWinner(key:Tuple[str, str], name:str) -> None:
+        with HttpRouteSelector._Lock:
+            winner = HttpRouteSelector._Winners.get(key, None)
+            if winner is not None and winner[0] == name:
+                del HttpRouteSelector._Winners[key]
+
+
+    @staticmethod
+    def _GetStatsLocked(name:str) -> _HttpRouteStats:
+        stats = HttpRouteSelector._Stats.get(name, None)
+        if stats is None:
+            stats = _HttpRouteStats()
+            HttpRouteSelector._Stats[name] = stats
+        return stats
+
+
+    # Results that aren't returned must be freed, so they don't hold the connection open.
+    @staticmethod
+    def _Free(result:Optional[HttpResult]) -> None:
+        if result is None:
+            return
+        try:
+            result.Free()
+        except Exception:
+            pass
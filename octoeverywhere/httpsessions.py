@@ -1,17 +1,46 @@
+import os
+import time
 import logging
+import weakref
+import ipaddress
 import threading
-from typing import Dict
+from typing import Any, Dict, List, Optional
 
 import requests
 from requests import Session
 from requests.adapters import HTTPAdapter
+from urllib3.poolmanager import PoolManager
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
+from .sentry import Sentry
+from .repeattimer import RepeatTimer
 from .memorymanager import MemoryManager
+from .latencyhistogram import LatencyHistogram
 
 # A common class to cache http sessions per host.
 # This makes the connections more efficient as we can reuse the connections and the session isn't created every time.
+#
+# Each session also tracks its connection pool, so we can see how often connections are reused, and the time to first byte of the requests.
+# For the local backends, like OctoPrint, Moonraker, or nginx, the pool can also be kept warm. After an idle period the servers close the
+# keep-alive connections, so the first dashboard load has to make new connections to all of them. When a tunnel session starts, we make
+# a few small requests to each local backend at the same time, which leaves that many warm connections in the pool. While the tunnel is
+# being used, we do it again every so often, which keeps the server from closing them and replaces any it did close.
 class HttpSessions:
 
+    # If enabled, the local backend pools are prewarmed and kept warm.
+    # This is off by default, since it makes requests the user didn't. It can be turned on with the setter or the OCTO_HTTP_KEEP_WARM=1 env var.
+    KeepWarmEnabled = os.environ.get("OCTO_HTTP_KEEP_WARM", "0") == "1"
+
+    # How often the warm pools are refreshed.
+    c_KeepWarmIntervalSec = 20.0
+
+    # The pools are only kept warm if a session was used within this long, so an idle tunnel doesn't keep making requests.
+    c_KeepWarmActiveWindowSec = 120.0
+
+    # The timeouts of the warm requests.
+    c_WarmConnectTimeoutSec = 2.0
+    c_WarmReadTimeoutSec = 5.0
+
     _Instance:"HttpSessions" = None #pyright: ignore[reportAssignmentType]
 
     @staticmethod
@@ -24,10 +53,21 @@ class HttpSessions:
         return HttpSessions._Instance
 
 
+    @staticmethod
+    def SetKeepWarmEnabled(enabled:bool) -> None:
+        HttpSessions.KeepWarmEnabled = enabled
+
+
     def __init__(self, logger:logging.Logger):
         self.Logger = logger
         self.Sessions:Dict[str, Session] = {}
+        self.Backends:Dict[str, _HttpBackend] = {}
         self.SessionsLock = threading.Lock()
+        # The hosts we keep warm, set by Prewarm.
+        self.WarmHosts:List[str] = []
+        self.KeepWarmTimer:Optional[RepeatTimer] = None
+        # The last time a session was handed out, which is how we know the tunnel is being used.
+        self.LastUseSec = 0.0
 
 
     # Returns a Session given the url or host.
@@ -36,34 +76,57 @@ class HttpSessions:
     @staticmethod
     def GetSession(hostOrUrl:str) -> Session:
         #pylint: disable=protected-access
-        return HttpSessions.Get()._GetSession(hostOrUrl)
+        instance = HttpSessions.Get()
+        instance.LastUseSec = time.time()
+        return instance._GetSession(hostOrUrl)
+
+
+    # Opens the warm connections to the given local backends and keeps them warm.
+    # This is called when a tunnel session starts, it does the work on a background thread.
+    @staticmethod
+    def Prewarm(urls:List[str]) -> None:
+        instance = HttpSessions.Get()
+        if instance is None or HttpSessions.KeepWarmEnabled is False:
+            return
+        try:
+            threading.Thread(target=instance.PrewarmHosts, args=(urls,), name="HttpSessionsPrewarm", daemon=True).start()
+        except Exception as e:
+            Sentry.OnException("HttpSessions failed to start the prewarm thread.", e)
+
+
+    # Returns the connection counters and time to first byte histogram for each backend.
+    @staticmethod
+    def GetStats() -> Dict[str, Dict[str, Any]]:
+        instance = HttpSessions.Get()
+        if instance is None:
+            return {}
+        with instance.SessionsLock:
+            backends = list(instance.Backends.items())
+        return {host: backend.Stats.GetStats() for host, backend in backends}
+
+
+    # Returns true if the host is on this device or the local network, which are the only ones we keep warm.
+    @staticmethod
+    def IsLocalHost(host:str) -> bool:
+        # Remove the protocol and port.
+        protocolEnd = host.find("://")
+        if protocolEnd != -1:
+            host = host[protocolEnd+3:]
+        if host.startswith("["):
+            host = host[1:host.find("]")] if host.find("]") != -1 else host[1:]
+        elif host.count(":") == 1:
+            host = host[:host.find(":")]
+        if host.lower() == "localhost":
+            return True
+        try:
+            ip = ipaddress.ip_address(host)
+            return ip.is_loopback or ip.is_private or ip.is_link_local
+        except ValueError:
+            return False
 
 
     def _GetSession(self, hostOrUrl:str) -> Session:
-        # Get the root host from what's passed.
-        host = ""
-        if hostOrUrl.startswith('/'):
-            # There's no way to specify a port, so all relative urls are assumed to be on the same host.
-            host = "relative"
-        else:
-            # Extract only the host.
-            # Examples can be:
-            #   https://127.0.0.1/
-            #   http://127.0.0.1
-            #   http://test.local:80/path
-            #   ws://test.local:80/path
-            protocolStart = hostOrUrl.find("://")
-            if protocolStart == -1:
-                self.Logger.error("Invalid url passed to GetSession: " + hostOrUrl)
-                host = "unknown"
-            else:
-                # Skip past the protocol and find the host end
-                protocolStart += 3
-                hostEnd = hostOrUrl.find("/", protocolStart)
-                if hostEnd == -1:
-                    # This means the url is "http://test.local" or "http://test.local:80"
-                    hostEnd = len(hostOrUrl)
-                host = hostOrUrl[:hostEnd]
+        host = self._GetHostKey(hostOrUrl)
 
         # If one exists, we don't need to lock.
         s = self.Sessions.get(host, None)
@@ -81,7 +144,11 @@ class HttpSessions:
             s = requests.Session()
 
             # Set our limits on the max hostnames pooled and the max connections per host.
-            adapter = HTTPAdapter(
+            # The adapter tracks the connections it makes, so we can see how often they are reused.
+            backend = _HttpBackend(host)
+            adapter = _TrackedHttpAdapter(
+                backend.Stats,
+                backend.Pools,
                 pool_connections=MemoryManager.HttpSessions_MaxConnections,
                 pool_maxsize=MemoryManager.HttpSessions_MaxPoolSize
             )
@@ -94,5 +161,229 @@ class HttpSessions:
             s.trust_env = False
 
             # Set the session and return it!
+            self.Backends[host] = backend
             self.Sessions[host] = s
             return s
+
+
+    # Returns the key we use for the session, which is the protocol and host.
+    def _GetHostKey(self, hostOrUrl:str) -> str:
+        # Get the root host from what's passed.
+        host = ""
+        if hostOrUrl.startswith('/'):
+            # There's no way to specify a port, so all relative urls are assumed to be on the same host.
+            host = "relative"
+        else:
+            # Extract only the host.
+            # Examples can be:
+            #   https://127.0.0.1/
+            #   http://127.0.0.1
+            #   http://test.local:80/path
+            #   ws://test.local:80/path
+            protocolStart = hostOrUrl.find("://")
+            if protocolStart == -1:
+                self.Logger.error("Invalid url passed to GetSession: " + hostOrUrl)
+                host = "unknown"
+            else:
+                # Skip past the protocol and find the host end
+                protocolStart += 3
+                hostEnd = hostOrUrl.find("/", protocolStart)
+                if hostEnd == -1:
+                    # This means the url is "http://test.local" or "http://test.local:80"
+                    hostEnd = len(hostOrUrl)
+                # Drop any user info, like webcam credentials, so they don't end up in the logs or the stats.
+                hostStart = hostOrUrl.rfind("@", protocolStart, hostEnd)
+                if hostStart == -1:
+                    host = hostOrUrl[:hostEnd]
+                else:
+                    host = hostOrUrl[:protocolStart] + hostOrUrl[hostStart+1:hostEnd]
+        return host
+
+
+    # Warms the local backends of the given urls, and starts the timer that keeps them warm.
+    # This blocks while the warm requests are made.
+    def PrewarmHosts(self, urls:List[str]) -> None:
+        try:
+            with self.SessionsLock:
+                for url in urls:
+                    host = self._GetHostKey(url)
+                    if host.startswith("http://") is False and host.startswith("https://") is False:
+                        continue
+                    if HttpSessions.IsLocalHost(host) is False:
+                        continue
+                    if host not in self.WarmHosts:
+                        self.WarmHosts.append(host)
+                if self.KeepWarmTimer is None and len(self.WarmHosts) > 0:
+                    self.KeepWarmTimer = RepeatTimer(self.Logger, "HttpSessionsKeepWarm", HttpSessions.c_KeepWarmIntervalSec, self.KeepWarm)
+                    self.KeepWarmTimer.daemon = True
+                    self.KeepWarmTimer.start()
+            # The tunnel just connected, so it counts as being used.
+            self.LastUseSec = time.time()
+            self.KeepWarm()
+        except Exception as e:
+            Sentry.OnException("HttpSessions failed to prewarm.", e)
+
+
+    # Makes the configured number of requests to each warm host at the same time, so the pool is left with that many connected sockets.
+    # The pool replaces any idle sockets the server closed when they are taken for a request, and the requests reset the server's idle timeout.
+    def KeepWarm(self) -> None:
+        if HttpSessions.KeepWarmEnabled is False:
+            return
+        if time.time() - self.LastUseSec > HttpSessions.c_KeepWarmActiveWindowSec:
+            return
+        with self.SessionsLock:
+            hosts = list(self.WarmHosts)
+        threads:List[threading.Thread] = []
+        for host in hosts:
+            for _ in range(MemoryManager.HttpSessions_WarmConnectionsPerBackend):
+                t = threading.Thread(target=self._WarmRequest, args=(host,), name="HttpSessionsWarm", daemon=True)
+                t.start()
+                threads.append(t)
+        for t in threads:
+            t.join()
+
+
+    def _WarmRequest(self, host:str) -> None:
+        try:
+            # Use the internal function, since the warm requests don't count as the tunnel being used.
+            session = self._GetSession(host)
+            with self.SessionsLock:
+                backend = self.Backends.get(host, None)
+            if backend is not None:
+                backend.Stats.OnWarmRequest()
+            # Like all of our requests, this uses verify=False, which is part of the pool key, so the warm connections are the ones the requests use.
+            timeout = (HttpSessions.c_WarmConnectTimeoutSec, HttpSessions.c_WarmReadTimeoutSec)
+            with session.head(host + "/", timeout=timeout, verify=False, allow_redirects=False):
+                pass
+        except Exception as e:
+            self.Logger.debug(f"HttpSessions failed to keep {host} warm. {e}")
+
+
+# The counters for one backend.
+class _HttpBackendStats:
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        # The number of connections taken from the pool for a request, including the warm requests.
+        self.Requests = 0
+        # The number of requests made to keep the pool warm.
+        self.WarmRequests = 0
+        # The number of requests that had to make a new TCP connection.
+        self.Connects = 0
+        # The number of those that reconnected a pooled connection the server had closed.
+        self.Recycled = 0
+        self.TimeToFirstByte = LatencyHistogram()
+
+
+    def OnRequest(self, connects:bool, recycled:bool) -> None:
+        with self.Lock:
+            self.Requests += 1
+            if connects:
+                self.Connects += 1
+            if recycled:
+                self.Recycled += 1
+
+
+    def OnWarmRequest(self) -> None:
+        with self.Lock:
+            self.WarmRequests += 1
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        with self.Lock:
+            ret:Dict[str, Any] = {
+                "Requests": self.Requests,
+                "WarmRequests": self.WarmRequests,
+                "Connects": self.Connects,
+                "Reuses": max(0, self.Requests - self.Connects),
+                "Recycled": self.Recycled,
+            }
+        ret["TimeToFirstByte"] = self.TimeToFirstByte.GetStats()
+        return ret
+
+
+class _HttpBackend:
+    def __init__(self, host:str) -> None:
+        self.Host = host
+        self.Stats = _HttpBackendStats()
+        self.Pools:List[HTTPConnectionPool] = []
+
+
+# Counts the connections taken from the pool, and if they need to connect.
+# A connection without a socket will connect when the request is sent, either because it's new or because the pool closed it after the server did.
+class _PoolConnectionTracker:
+    def __init__(self) -> None:
+        self.BackendStats:Optional[_HttpBackendStats] = None
+        # The connections that have been used, so we know when one is reconnecting.
+        self.UsedConnections:"weakref.WeakSet[Any]" = weakref.WeakSet()
+
+
+    def OnGetConn(self, conn:Any) -> None:
+        if self.BackendStats is None:
+            return
+        connects = getattr(conn, "sock", None) is None
+        recycled = False
+        if connects:
+            recycled = conn in self.UsedConnections
+            self.UsedConnections.add(conn)
+        self.BackendStats.OnRequest(connects, recycled)
+
+
+class _TrackedHttpConnectionPool(HTTPConnectionPool):
+    def __init__(self, *args:Any, **kwargs:Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.Tracker = _PoolConnectionTracker()
+
+    def _get_conn(self, timeout:Optional[float]=None) -> Any:
+        conn = super()._get_conn(timeout)
+        self.Tracker.OnGetConn(conn)
+        return conn
+
+
+class _TrackedHttpsConnectionPool(HTTPSConnectionPool):
+    def __init__(self, *args:Any, **kwargs:Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.Tracker = _PoolConnectionTracker()
+
+    def _get_conn(self, timeout:Optional[float]=None) -> Any:
+        conn = super()._get_conn(timeout)
+        self.Tracker.OnGetConn(conn)
+        return conn
+
+
+class _TrackedPoolManager(PoolManager):
+    def __init__(self, backendStats:_HttpBackendStats, pools:List[HTTPConnectionPool], **kwargs:Any) -> None:
+        super().__init__(**kwargs)
+        self.BackendStats = backendStats
+        self.Pools = pools
+        self.pool_classes_by_scheme = {"http": _TrackedHttpConnectionPool, "https": _TrackedHttpsConnectionPool} #pyright: ignore[reportAttributeAccessIssue]
+
+    def _new_pool(self, scheme:str, host:str, port:int, request_context:Optional[Dict[str, Any]]=None) -> Any:
+        pool = super()._new_pool(scheme, host, port, request_context)
+        if isinstance(pool, (_TrackedHttpConnectionPool, _TrackedHttpsConnectionPool)):
+            pool.Tracker.BackendStats = self.BackendStats
+        self.Pools.append(pool)
+        return pool
+
+
+class _TrackedHttpAdapter(HTTPAdapter):
+    def __init__(self, backendStats:_HttpBackendStats, pools:List[HTTPConnectionPool], **kwargs:Any) -> None:
+        # These must be set before the base init, since it creates the pool manager.
+        self.BackendStats = backendStats
+        self.Pools = pools
+        super().__init__(**kwargs)
+
+
+    def init_poolmanager(self, connections:int, maxsize:int, block:bool=False, **pool_kwargs:Any) -> None:
+        # Match the base class, but use our pool manager.
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = _TrackedPoolManager(self.BackendStats, self.Pools, num_pools=connections, maxsize=maxsize, block=block, **pool_kwargs)
+
+
+    # Since the requests are streamed, send returns once the headers are read, which is the time to first byte.
+    def send(self, request:Any, *args:Any, **kwargs:Any) -> Any:
+        start = time.perf_counter()
+        response = super().send(request, *args, **kwargs)
+        self.BackendStats.TimeToFirstByte.Add(time.perf_counter() - start)
+        return response
@@ -1,8 +1,11 @@
+import os
+import ssl
+import socket
 import collections
 import logging
 import threading
 import time
-from typing import Deque, Optional
+from typing import Any, Deque, Dict, List, Optional
 
 import urllib3.exceptions
 
@@ -10,25 +13,66 @@ from .buffer import Buffer, BufferOrNone
 from .httpresult import HttpResult
 from .sentry import Sentry
 from .memorymanager import MemoryManager
+from .latencyhistogram import LatencyHistogram
+from .httpstreamreadloop import ChunkedBodyDecoder, HttpStreamReadLoop
 
 
 # This class can be used to read any Request.Response object stream, no matter the content type.
-# The point of this class is that when a read call is made, it will always wait for an accumulation time before returning data.
-# If there is no data to be returned, it will block until there is data, and then wait for the accumulation time.
+# The point of this class is that when a read call is made, it will return the data that's ready without getting stuck in a body read call.
 #
-# The special behavior of this class is that if there's data to be returned, it will always return it after the accumulation time.
 # Where as in contrast to a normal read, we might accumulate data but then get stuck in a read call waiting for more data.
-#
 # For example,
 #     Read is called, there's 10 bytes available to read.
-#     The 10 bytes is read from the request, but we want to accumulate for 10ms, so we call read on the request again.
+#     The 10 bytes is read from the request, but we want to accumulate more, so we call read on the request again.
 #     The server doesn't send more data for 1 minute, like in an event stream.
 #   In this example, we have the 10 bytes of data, but it's blocked waiting for the request read before it can be returned.
 #
+# The body is read as data arrives, either by the shared HttpStreamReadLoop or by a read thread for streams the loop can't service.
+# Read calls are event driven, they return the pending data as soon as one of these happen:
+#     1. The pending data is over the flush size.
+#     2. The last data read ended on a message boundary, like the end of an SSE event or a json line.
+#     3. No new data has arrived for the idle gap time.
+#     4. The oldest pending data has been waiting for the accumulation time, which is the upper bound on the added latency.
+# So event streams are sent right away, while bulk streams still get coalesced into bigger buffers.
 class HttpStreamAccumulationReader:
 
+    # If enabled, plain http bodies are read by the shared read loop instead of a read thread per stream.
+    # This is off by default, since the loop decodes the body itself, so the connection can't go back to the pool for reuse.
+    # It can be turned on with the setter or the OCTO_ACCUMULATION_READ_LOOP=1 env var.
+    ReadLoopEnabled = os.environ.get("OCTO_ACCUMULATION_READ_LOOP", "0") == "1"
+
+    # If no new data arrives for this long, the pending data is returned.
+    c_IdleGapSec = 0.002
+
+    # If this much data is pending, it's returned right away, since it's already a good size for compression and sending.
+    c_FlushSizeBytes = 512 * 1024
+
+    # The max size of one socket read done by the read loop.
+    c_LoopRecvSizeBytes = 256 * 1024
+
+    # The max number of reads the loop will do on one stream before servicing the others.
+    c_MaxLoopReadsPerService = 8
+
+    # The time from when data was read from the body until it was returned from a Read call, for all streams.
+    AllAddedLatency = LatencyHistogram()
+
+
+    @staticmethod
+    def SetReadLoopEnabled(enabled:bool) -> None:
+        HttpStreamAccumulationReader.ReadLoopEnabled = enabled
+
+
+    @staticmethod
+    def GetStats() -> Dict[str, Any]:
+        loop = HttpStreamReadLoop._Instance #pylint: disable=protected-access
+        return {
+            "AddedLatency": HttpStreamAccumulationReader.AllAddedLatency.GetStats(),
+            "ReadLoop": loop.GetStats() if loop is not None else None,
+        }
+
+
     # After being constructed the reading starts immediately.
-    # This class must be disposed of properly to stop the read thread.
+    # This class must be disposed of properly to stop the read.
     def __init__(self, logger:logging.Logger, streamId:int, httpResult:HttpResult, accumulationTimeSec:float, maxReturnBufferSizeBytes:Optional[int]=None, maxPendingBufferSizeBytes:Optional[int]=None):
         self.Logger = logger
         self.StreamId = streamId
@@ -45,10 +89,14 @@ class HttpStreamAccumulationReader:
         self.MaxPendingBufferSizeBytes = maxPendingBufferSizeBytes if maxPendingBufferSizeBytes is not None else MemoryManager.HttpStreamAccumulationReader_MaxPendingBufferSizeBytes
 
         # We use a list so we can efficiently append all of the pending buffers at once when they are being sent.
+        # The arrival times are kept in a matching list, so we know how long each buffer has been waiting.
         self.BufferList:Deque[bytes] = collections.deque()
+        self.BufferArrivalTimes:Deque[float] = collections.deque()
         self.BufferListPendingSize:int = 0
         self.BufferLock = threading.Lock()
         self.BufferDataReadyEvent = threading.Event()
+        # True if the last buffer read ended on a message boundary.
+        self.PendingEndsOnBoundary = False
 
         # Set to true when the read is done either from the end of the body or an error.
         # Once true, it will never read again, but we do need to process the BufferList
@@ -62,12 +110,16 @@ class HttpStreamAccumulationReader:
         # instead of sleeping a fixed duration, so it resumes as soon as the consumer
         # drains enough data.
         self.BackpressureRelievedEvent = threading.Event()
+        # When the read loop is used, the stream is removed from the loop instead, and this is set until the consumer drains enough data.
+        self.IsPausedForBackpressure = False
 
         # Stats
         self.OpenedTimeSec = time.time()
         self.SocketReads = 0
         self.OctoStreamReads = 0
         self.TotalBytesRead = 0
+        self.AddedLatency = LatencyHistogram()
+        self.FlushReasons:Dict[str, int] = {}
 
         # Cache this so we don't have to read each time.
         self.ShouldDebugLog = self.Logger.isEnabledFor(logging.DEBUG)
@@ -77,15 +129,22 @@ class HttpStreamAccumulationReader:
         if self.ResponseBody is None:
             raise Exception("HttpStreamAccumulationReader was called with a httpResult that has not Response object to read from.")
 
-        # Start the read thread.
-        self.debugLog("Starting read thread.")
-        self.ReadThread = threading.Thread(target=self.readThreadWorker)
-        # Mark it as a daemon to prevent it from stopping PY from shutting down the process if it's the only thread running.
-        self.ReadThread.daemon = True
-        self.ReadThread.start()
-
-
-    # Must be called to close the stream reader and clean up the thread.
+        # Use the shared read loop if we can, otherwise start the read thread.
+        self.ReadLoop:Optional[HttpStreamReadLoop] = None
+        self.LoopSocket:Optional[socket.socket] = None
+        self.LoopBufferedReader:Any = None
+        self.LoopChunkedDecoder:Optional[ChunkedBodyDecoder] = None
+        self.LoopBodyBytesLeft:Optional[int] = None
+        self.ReadThread:Optional[threading.Thread] = None
+        if self._TrySetupReadLoop() and self.LoopSocket is not None:
+            self.debugLog("Adding the stream to the read loop.")
+            self.ReadLoop = HttpStreamReadLoop.Get(self.Logger)
+            self.ReadLoop.Add(self, self.LoopSocket)
+        else:
+            self._StartReadThread()
+
+
+    # Must be called to close the stream reader and stop the read.
     # NOTE - This will also close the stream body to ensure the read thread exists!
     # IMPORTANT NOTE - This must not block or the main websocket thread will be blocked.
     def CloseAsync(self):
@@ -101,20 +160,14 @@ class HttpStreamAccumulationReader:
                 self.IsClosed = True
                 self.ReadComplete = True
                 self.BufferDataReadyEvent.set()
+                self.BackpressureRelievedEvent.set()
 
-            # We need to make sure the http body is closed to ensure the read thread exits.
-            # The response body close CAN BLOCK FOR UP TO THE READ TIME OUT (which we set high) SO IT MUST BE CALLED ON A SEPARATE THREAD.
-            # WE CAN NOT BLOCK IN THIS FUNCTION OR THE MAIN WEBSOCKET WILL BE HUNG.
-            def closeBodyWorker():
-                try:
-                    self.debugLog("Calling raw.close() on the response body.")
-                    if self.ResponseBody is not None:
-                        self.ResponseBody.raw.close()
-                    self.debugLog("raw.close() close complete.")
-                except Exception as e:
-                    self.Logger.info(f"{self.getLogMsgPrefix()} Exception thrown when closing the HTTP response body in HttpStreamAccumulationReader.CloseAsync closeBody thread: {str(e)}")
-            closeBodyThread = threading.Thread(target=closeBodyWorker, daemon=True)
-            closeBodyThread.start()
+            # If the read loop is reading the body, the body can only be closed once the loop is done with it.
+            # The loop will call the close once the stream has been removed.
+            if self.ReadLoop is not None:
+                self.ReadLoop.Remove(self, self._StartCloseBodyThread)
+            else:
+                self._StartCloseBodyThread()
 
             # We CAN NOT AND DO NOT WANT TO join the thread because we don't close the HTTP body, and the thread will not return until the body read is done.
             # Instead, we just set the IsClosed flag and the event, and let the thread exit when the body read is done.
@@ -124,13 +177,12 @@ class HttpStreamAccumulationReader:
             Sentry.OnException(self.getLogMsgPrefix()+ " exception thrown in HttpStreamAccumulationReader.CloseAsync", e)
 
 
-    # Reads up to the max buffer size, and will always wait for accumulation.
+    # Returns the pending data as soon as it should be flushed, see the class comment for when that is.
     #
-    # If data is ready, it will wait the accumulation time, gather all ready data, and return it.
-    # If no data is ready, it will block until data is ready, and then wait for accumulation time, gather all data, and return it.
+    # If no data is ready, it will block until data is ready and should be flushed.
     # If the HTTP body read is complete and there's no more data, it will will return None.
     #
-    # If a timeout is set, if the timeout is hit before any data is ready, it will return None.
+    # If a timeout is set and it's hit, it will return whatever data is pending, or None if there is no data.
     def Read(self, timeoutSec:Optional[float]=None) -> BufferOrNone:
 
         # Just as a sanity check, we will define the max amount of time we will wait for one chunk.
@@ -143,146 +195,68 @@ class HttpStreamAccumulationReader:
 
         try:
             readCallStartTimeSec = time.time()
-            accumulatedBufferList:Optional[Deque[bytes]] = None
-            accumulatedBufferListSizeBytes = 0
-            mustReturnAccumulatedBuffers = False
-            firstAccumulatedBufferTime = None
-            isFirstLoopRun = True
+            accumulatedBufferList:Optional[List[bytes]] = None
+            firstArrivalTimeSec = 0.0
+            resumeReadLoop = False
 
             # Note the read
             self.OctoStreamReads += 1
 
-            # Since we will always sleep for at least the min time, there's no need to do work until the min time is meet.
-            # If we did do the loop, we would just end up spinning and sleeping again.
-            time.sleep(self.AccumulationTimeSec)
-
-            # Try to read a chunk or wait for the read to be done.
             # Only try to read while the stream is open.
             while self.IsClosed is False:
 
                 # First, sanity check we haven't been running forever.
-                loopStartNow = time.time()
-                if loopStartNow - readCallStartTimeSec > maxReadTimeSec:
+                now = time.time()
+                elapsedSec = now - readCallStartTimeSec
+                if elapsedSec > maxReadTimeSec:
                     raise Exception(f"HttpStreamAccumulationReader has been waiting for a chunk for {maxReadTimeSec} seconds. This is an error.")
+                timedOut = timeoutSec is not None and elapsedSec >= timeoutSec
 
-                # Check for a read timeout, if we hit it, break.
-                # This will return whatever we have accumulated so far, which might be empty, which means the read is done.
-                if timeoutSec is not None and loopStartNow - readCallStartTimeSec > timeoutSec:
-                    self.debugLog(f"Read timeout of {timeoutSec} seconds hit in HttpStreamAccumulationReader.Read.")
-                    break
-
-                # Next, check to see if there are new buffers to add to our accumulation list.
                 with self.BufferLock:
-                    if len(self.BufferList) > 0:
-                        # There are buffers to read!
-
-                        # If the pending size + our accumulated size is under the max, take them all.
-                        if accumulatedBufferListSizeBytes + self.BufferListPendingSize < self.MaxReturnBufferSizeBytes:
-                            if accumulatedBufferList is None:
-                                accumulatedBufferList = self.BufferList
-                            else:
-                                accumulatedBufferList += self.BufferList
-                            accumulatedBufferListSizeBytes += self.BufferListPendingSize
-
-                            # Reset the pending list.
-                            self.BufferList = collections.deque()
-                            self.BufferListPendingSize = 0
-
-                        else:
-                            # If we are here, the pending buffers are larger than our max size.
-
-                            # This is an important flag, it means that we need to return what we currently have because the next buffer will put us over the max.
-                            mustReturnAccumulatedBuffers = True
-
-                            # We need to only take as many as we can up to the max size.
-                            while accumulatedBufferListSizeBytes < self.MaxReturnBufferSizeBytes and len(self.BufferList) > 0:
-
-                                # See how big the next buffer is.
-                                nextBuffer = self.BufferList[0]
-                                nextBufferSize = len(nextBuffer)
-                                if accumulatedBufferListSizeBytes + nextBufferSize > self.MaxReturnBufferSizeBytes:
-                                    # It's too big, we are done.
-                                    break
-
-                                # We can take this entire buffer.
-                                if accumulatedBufferList is None:
-                                    accumulatedBufferList = collections.deque()
-                                    accumulatedBufferList.append(nextBuffer)
-                                else:
-                                    accumulatedBufferList.append(nextBuffer)
-                                accumulatedBufferListSizeBytes += nextBufferSize
-
-                                # Remove it from the pending list.
-                                self.BufferList.popleft()
-                                self.BufferListPendingSize -= nextBufferSize
-
-                        # Signal the producer that buffer space has been freed, relieving back-pressure.
-                        self.BackpressureRelievedEvent.set()
-
-                        # Before we clear it under lock, always check to see if the isClosed flag is set.
-                        # This ensures we don't miss the close flag before we clear the event and wait on it again.
-                        if self.IsClosed:
-                            # If we are closed, return None to end the read.
-                            return None
-
-                        # Clear the event under lock, so we don't miss a new set.
-                        self.BufferDataReadyEvent.clear()
-
-                #
-                # We are done accumulating new buffers, if any.
-
-                # The first time we get any buffers, we need to start the accumulation timer.
-                if accumulatedBufferList is not None and firstAccumulatedBufferTime is None:
-                    firstAccumulatedBufferTime = loopStartNow
-
-                # If we have chunks check if we are done.
-                # There are three cases:
-                #    1. We have to return the accumulated buffers because the next buffer would put us over the max size.
-                #    2. If this is the first loop run. Since we always sleep for the accumulation time before starting the loop, if the first run picked up buffers, we are done.
-                #    3. If it's not the first loop run, We have been accumulating for longer than the accumulation time.
-                if accumulatedBufferList is not None:
-                    # This should be impossible due to the above check, but sanity check it.
-                    if firstAccumulatedBufferTime is None:
-                        raise Exception("Internal error in HttpStreamAccumulationReader.Read: firstAccumulatedBufferTime is None but accumulatedBufferList is not None.")
-                    if mustReturnAccumulatedBuffers or isFirstLoopRun or loopStartNow - firstAccumulatedBufferTime >= self.AccumulationTimeSec:
+                    # Always check the closed flag under lock, so we don't miss it before we clear the event and wait on it again.
+                    if self.IsClosed:
+                        return None
+
+                    waitSec = maxReadTimeSec
+                    if self.BufferListPendingSize > 0:
+                        flushReason = self._GetFlushReasonLocked(now, timedOut)
+                        if flushReason is not None:
+                            firstArrivalTimeSec = self.BufferArrivalTimes[0]
+                            accumulatedBufferList = self._TakeBuffersLocked()
+                            self.FlushReasons[flushReason] = self.FlushReasons.get(flushReason, 0) + 1
+
+                            # Signal the producer that buffer space has been freed, relieving back-pressure.
+                            self.BackpressureRelievedEvent.set()
+                            if self.IsPausedForBackpressure and self.BufferListPendingSize <= self.MaxPendingBufferSizeBytes:
+                                self.IsPausedForBackpressure = False
+                                resumeReadLoop = True
+                            break
+                        waitSec = self._GetFlushWaitSecLocked(now)
+                    elif self.ReadComplete or timedOut:
+                        # The body is done and there's no more data, or we hit the timeout with no data.
                         break
-                isFirstLoopRun = False
 
-                # AFTER we have accumulated the buffers, we need to check to see if the read is complete.
-                # This must be done after to ensure that any last buffers are read.
-                if self.ReadComplete:
-                    break
+                    # Clear the event under lock, so we don't miss a new set.
+                    self.BufferDataReadyEvent.clear()
 
-                # If we are here, we need to wait for more data or the accumulation time.
-                # If we already got the first buffer, we know how long we need to wait for accumulation.
-                # So there's no need to wait on the event, which might wake us up multiple times in the accumulation time.
-                now = time.time()
-                if accumulatedBufferList is not None:
-                    if firstAccumulatedBufferTime is None:
-                        raise Exception("Internal error in HttpStreamAccumulationReader.Read: firstAccumulatedBufferTime is None but accumulatedBufferList is not None.")
-                    elapsedAccumulationTimeSec = now - firstAccumulatedBufferTime
-                    remainingAccumulationTimeSec = self.AccumulationTimeSec - elapsedAccumulationTimeSec
-                    if remainingAccumulationTimeSec > 0:
-                        time.sleep(remainingAccumulationTimeSec)
-                    # Run the loop again to pick up any new buffers and then return whatever we have.
-                    continue
-
-                # If we have no buffers, we need to wait.
-                sleepTimeSec = maxReadTimeSec
+                # Wait for new data or until the pending data should be flushed.
                 if timeoutSec is not None:
-                    elapsedSec = now - readCallStartTimeSec
-                    remainingTimeoutSec = timeoutSec - elapsedSec
-                    sleepTimeSec = min(sleepTimeSec, remainingTimeoutSec)
-                if sleepTimeSec > 0:
-                    self.BufferDataReadyEvent.wait(sleepTimeSec)
-
-            # If we broke out of the loop, 3 things could have happened:
-            #    1. We have accumulated buffers to return.
-            #    2. The read is complete.
-            #    3. We hit a timeout.
+                    waitSec = min(waitSec, timeoutSec - elapsedSec)
+                if waitSec > 0:
+                    self.BufferDataReadyEvent.wait(waitSec)
+
+            # If the loop was paused for back pressure, resume it now that there's room.
+            if resumeReadLoop and self.ReadLoop is not None and self.LoopSocket is not None:
+                self.ReadLoop.Add(self, self.LoopSocket)
+
             if accumulatedBufferList is None:
                 return None
 
+            # Note how much latency we added to this data.
+            addedLatencySec = time.time() - firstArrivalTimeSec
+            self.AddedLatency.Add(addedLatencySec)
+            HttpStreamAccumulationReader.AllAddedLatency.Add(addedLatencySec)
+
             # Optimize for the single chunk scenario.
             if len(accumulatedBufferList) == 1:
                 return Buffer(accumulatedBufferList[0])
@@ -312,6 +286,148 @@ class HttpStreamAccumulationReader:
             return None
 
 
+    # Returns the per stream stats.
+    def GetStreamStats(self) -> Dict[str, Any]:
+        return {
+            "ReadLoop": self.ReadLoop is not None,
+            "SocketReads": self.SocketReads,
+            "OctoStreamReads": self.OctoStreamReads,
+            "TotalBytesRead": self.TotalBytesRead,
+            "FlushReasons": dict(self.FlushReasons),
+            "AddedLatency": self.AddedLatency.GetStats(),
+        }
+
+
+    # Must be called under the buffer lock with pending data.
+    # Returns the reason the pending data should be returned now, or None if it should keep accumulating.
+    def _GetFlushReasonLocked(self, now:float, timedOut:bool) -> Optional[str]:
+        if self.BufferListPendingSize >= HttpStreamAccumulationReader.c_FlushSizeBytes or self.BufferListPendingSize >= self.MaxReturnBufferSizeBytes:
+            return "Size"
+        if self.PendingEndsOnBoundary:
+            return "Boundary"
+        if self.ReadComplete:
+            return "End"
+        if now - self.BufferArrivalTimes[-1] >= HttpStreamAccumulationReader.c_IdleGapSec:
+            return "Idle"
+        if now - self.BufferArrivalTimes[0] >= self.AccumulationTimeSec:
+            return "Age"
+        if timedOut:
+            return "Timeout"
+        return None
+
+
+    # Must be called under the buffer lock with pending data.
+    # Returns how long until the pending data should be flushed if nothing else arrives.
+    def _GetFlushWaitSecLocked(self, now:float) -> float:
+        idleWaitSec = self.BufferArrivalTimes[-1] + HttpStreamAccumulationReader.c_IdleGapSec - now
+        ageWaitSec = self.BufferArrivalTimes[0] + self.AccumulationTimeSec - now
+        return max(0.0, min(idleWaitSec, ageWaitSec))
+
+
+    # Must be called under the buffer lock with pending data.
+    # Takes as many pending buffers as fit in the max return size, but always at least one.
+    def _TakeBuffersLocked(self) -> List[bytes]:
+        taken:List[bytes] = []
+        takenSizeBytes = 0
+        while len(self.BufferList) > 0:
+            nextBufferSize = len(self.BufferList[0])
+            if len(taken) > 0 and takenSizeBytes + nextBufferSize > self.MaxReturnBufferSizeBytes:
+                break
+            taken.append(self.BufferList.popleft())
+            self.BufferArrivalTimes.popleft()
+            takenSizeBytes += nextBufferSize
+            self.BufferListPendingSize -= nextBufferSize
+        # If we only took some of the buffers, the rest will be returned on the next read since they are over the max return size.
+        if len(self.BufferList) == 0:
+            self.PendingEndsOnBoundary = False
+        return taken
+
+
+    # Adds a chunk read from the body to the pending list.
+    # Returns true if the pending list is over the max size, so the producer must stop reading until the consumer drains it.
+    def _OnChunkRead(self, chunk:bytes) -> bool:
+        with self.BufferLock:
+            bufferLen = len(chunk)
+            # This should be impossible due to the read1 size, but sanity check it.
+            if bufferLen > self.MaxReturnBufferSizeBytes:
+                raise Exception(f"The unknown body chunk read read a chunk larger than the max single chunk size of {self.MaxReturnBufferSizeBytes} bytes! Read size: {bufferLen} bytes.")
+
+            self.BufferList.append(chunk)
+            self.BufferArrivalTimes.append(time.time())
+            self.BufferListPendingSize += bufferLen
+            # Event streams (SSE, sockjs, json lines, etc) end each message with a new line, so if the chunk ends with one, it's most likely a complete message.
+            self.PendingEndsOnBoundary = chunk.endswith(b"\n")
+
+            # Update stats.
+            self.SocketReads += 1
+            self.TotalBytesRead += bufferLen
+
+            # Let the consumer know we have data ready to be read!
+            self.BufferDataReadyEvent.set()
+
+            # Important! Since our sending websocket logic will block if there's too much back pressure on sending on the WS,
+            # We must also bound this pending buffer size so it doesn't eat memory just accumulating buffers that can't be sent.
+            if self.IsClosed is False and self.BufferListPendingSize > self.MaxPendingBufferSizeBytes:
+                if self.ShouldDebugLog:
+                    self.Logger.debug(f"{self.getLogMsgPrefix()} Pending buffer size of {self.BufferListPendingSize/1024.0/1024.0} MB exceeds the max of {self.MaxPendingBufferSizeBytes/1024.0/1024.0} MB. Waiting for consumer to drain buffer." )
+                if self.ReadLoop is not None:
+                    self.IsPausedForBackpressure = True
+                self.BackpressureRelievedEvent.clear()
+                return True
+            return False
+
+
+    # Called when the body read is done, from the end of the body, an error, or the stream being closed.
+    def _OnReadDone(self) -> None:
+        # Set the event to break the stream read wait, so it will shutdown.
+        # Call set under lock, to ensure the other thread doesn't clear it without us seeing it.
+        with self.BufferLock:
+            # Ensure we always set this flag, so the web stream will know the body read is done.
+            self.ReadComplete = True
+            self.BufferDataReadyEvent.set()
+
+        try:
+            runTimeSec = time.time() - self.OpenedTimeSec
+            if self.ShouldDebugLog:
+                self.Logger.debug(f"{self.getLogMsgPrefix()} Read done. ReadLoop: {self.ReadLoop is not None}, Run Time: {runTimeSec:.2f} sec, SocketReads: {self.SocketReads}, OctoStreamReads: {self.OctoStreamReads}, TotalBytesRead: {self.TotalBytesRead/1024.0:.2f} KB, FlushReasons: {self.FlushReasons}, AddedLatency: {self.AddedLatency.GetStats()}")
+        except Exception:
+            pass
+
+
+    # Handles the exceptions of either read method in the same way.
+    def _OnReadException(self, e:Exception) -> None:
+        if isinstance(e, (urllib3.exceptions.HTTPError, ConnectionError)):
+            # These happen for a variety of reasons, including the stream being closed.
+            # Don't send it to Sentry.
+            self.Logger.info(f"{self.getLogMsgPrefix()} HTTPError exception thrown in HttpStreamAccumulationReader, ending read. {str(e)}")
+            return
+        # If the web stream is already closed, don't bother logging the exception.
+        # These exceptions happen for use cases as above, where stream() doesn't close in time and such.
+        # Note the exception can be a timeout, but it can also be a "doesn't have a read" function error bc if the socket gets data the lib will try to call read on a fp that's closed and set to None. :/
+        if self.IsClosed is False:
+            Sentry.OnException(self.getLogMsgPrefix()+ " exception thrown in HttpStreamAccumulationReader", e)
+
+
+    def _StartCloseBodyThread(self) -> None:
+        # We need to make sure the http body is closed to ensure the read thread exits.
+        # The response body close CAN BLOCK FOR UP TO THE READ TIME OUT (which we set high) SO IT MUST BE CALLED ON A SEPARATE THREAD.
+        # WE CAN NOT BLOCK IN THIS FUNCTION OR THE MAIN WEBSOCKET (or the read loop) WILL BE HUNG.
+        def closeBodyWorker():
+            try:
+                self.debugLog("Calling raw.close() on the response body.")
+                if self.ResponseBody is not None:
+                    self.ResponseBody.raw.close()
+                    # If the loop read the body, the connection was closed above, since it's in non-blocking mode and http.client doesn't know where the body ended.
+                    # Release it now, so the pool gets its slot back and makes a new connection for the next request.
+                    if self.LoopSocket is not None:
+                        self.ResponseBody.raw.release_conn()
+                self.debugLog("raw.close() close complete.")
+            except Exception as e:
+                self.Logger.info(f"{self.getLogMsgPrefix()} Exception thrown when closing the HTTP response body in HttpStreamAccumulationReader.CloseAsync closeBody thread: {str(e)}")
+        closeBodyThread = threading.Thread(target=closeBodyWorker, daemon=True)
+        closeBodyThread.start()
+
+
     def debugLog(self, msg:str) -> None:
         # This should be as fast as possible when debug logging is disabled.
         if not self.ShouldDebugLog:
@@ -323,7 +439,137 @@ class HttpStreamAccumulationReader:
         return f"[HttpStreamAccumulationReader-{self.StreamId}]"
 
 
-    # This is the read thread, where the actual reading from the HTTP response happens.
+    #
+    # Read loop logic
+    #
+
+    # Finds the socket under the requests response and takes over the body read from http.client.
+    # The loop must never block, so it reads the socket in non-blocking mode and does the chunked transfer decoding itself, since http.client's decoding
+    # would block waiting for the rest of a chunk frame. Anything that doesn't fit this uses the read thread.
+    # Since http.client doesn't know the body was read, the connection is closed when the stream is, rather than being reused.
+    def _TrySetupReadLoop(self) -> bool:
+        if HttpStreamAccumulationReader.ReadLoopEnabled is False or self.ResponseBody is None:
+            return False
+        # raw is the urllib3 response, _fp is the http.client response, and it's fp is the buffered reader over the socket.
+        raw = self.ResponseBody.raw
+        httpClientResponse = getattr(raw, "_fp", None)
+        bufferedReader = getattr(httpClientResponse, "fp", None)
+        sock = getattr(getattr(bufferedReader, "raw", None), "_sock", None)
+        if httpClientResponse is None or bufferedReader is None or hasattr(bufferedReader, "peek") is False:
+            return False
+        # TLS sockets buffer data in the TLS layer, which select can't see.
+        if not isinstance(sock, socket.socket) or isinstance(sock, ssl.SSLSocket):
+            return False
+        # Only take over the body if none of it has been read yet.
+        if getattr(raw, "_fp_bytes_read", 0) != 0 or getattr(httpClientResponse, "chunk_left", None) is not None:
+            return False
+        try:
+            sock.setblocking(False)
+        except Exception as e:
+            self.Logger.debug(f"{self.getLogMsgPrefix()} Failed to make the socket non-blocking, using the read thread. {e}")
+            return False
+        self.LoopSocket = sock
+        self.LoopBufferedReader = bufferedReader
+        if getattr(httpClientResponse, "chunked", False):
+            self.LoopChunkedDecoder = ChunkedBodyDecoder()
+        else:
+            # This is None if the body is read until the connection closes.
+            self.LoopBodyBytesLeft = getattr(httpClientResponse, "length", None)
+        return True
+
+
+    # Called by the read loop if the socket can't be added to the selector.
+    def OnLoopAddFailed(self, e:Exception) -> None:
+        self.Logger.info(f"{self.getLogMsgPrefix()} Failed to add the stream to the read loop, using the read thread. {e}")
+        self.ReadLoop = None
+        self.LoopChunkedDecoder = None
+        if self.LoopSocket is not None:
+            try:
+                self.LoopSocket.setblocking(True)
+            except Exception:
+                pass
+        self._StartReadThread()
+
+
+    # Called on the read loop thread when the socket is readable or when the stream might have buffered data.
+    # This must never block, since it would block all of the other streams.
+    def OnLoopReadable(self) -> int:
+        sock = self.LoopSocket
+        try:
+            if sock is None:
+                raise Exception("HttpStreamAccumulationReader OnLoopReadable was called without a socket.")
+
+            # http.client might have read some of the body into its buffer when it read the headers, so that must be used first.
+            # With the socket non-blocking, peek returns the buffered data without touching the socket, or does one socket read if the buffer is empty.
+            if self.LoopBufferedReader is not None:
+                bufferedReader = self.LoopBufferedReader
+                self.LoopBufferedReader = None
+                buffered = bufferedReader.peek(1)
+                if len(buffered) > 0:
+                    bufferedReader.read1(len(buffered))
+                    if self._OnLoopData(buffered):
+                        return HttpStreamReadLoop.c_Done
+
+            reads = 0
+            while self.IsClosed is False:
+                if reads >= HttpStreamAccumulationReader.c_MaxLoopReadsPerService:
+                    return HttpStreamReadLoop.c_ReadAgain
+                reads += 1
+                try:
+                    data = sock.recv(HttpStreamAccumulationReader.c_LoopRecvSizeBytes)
+                except BlockingIOError:
+                    # There's no more data right now.
+                    return HttpStreamReadLoop.c_Wait
+                if not data:
+                    if self.LoopChunkedDecoder is not None or self.LoopBodyBytesLeft is not None:
+                        self.Logger.info(f"{self.getLogMsgPrefix()} The connection was closed before the end of the body.")
+                    else:
+                        self.debugLog("Read loop reached clean end of body stream.")
+                    self._OnReadDone()
+                    return HttpStreamReadLoop.c_Done
+                if self._OnLoopData(data):
+                    return HttpStreamReadLoop.c_Done
+            return HttpStreamReadLoop.c_Done
+        except Exception as e:
+            self._OnReadException(e)
+            self._OnReadDone()
+            return HttpStreamReadLoop.c_Done
+
+
+    # Handles raw body bytes read by the loop.
+    # Returns true if the loop should stop reading, because the body is done or the stream is paused for back pressure.
+    def _OnLoopData(self, data:bytes) -> bool:
+        isBodyDone = False
+        if self.LoopChunkedDecoder is not None:
+            data = self.LoopChunkedDecoder.Feed(data)
+            isBodyDone = self.LoopChunkedDecoder.IsDone
+        elif self.LoopBodyBytesLeft is not None:
+            data = data[:self.LoopBodyBytesLeft]
+            self.LoopBodyBytesLeft -= len(data)
+            isBodyDone = self.LoopBodyBytesLeft <= 0
+        isPaused = False
+        if len(data) > 0:
+            isPaused = self._OnChunkRead(data)
+        if isBodyDone:
+            self.debugLog("Read loop reached clean end of body stream.")
+            self._OnReadDone()
+            return True
+        return isPaused
+
+
+    #
+    # Read thread logic
+    #
+
+    def _StartReadThread(self) -> None:
+        self.debugLog("Starting read thread.")
+        self.ReadThread = threading.Thread(target=self.readThreadWorker)
+        # Mark it as a daemon to prevent it from stopping PY from shutting down the process if it's the only thread running.
+        self.ReadThread.daemon = True
+        self.ReadThread.start()
+
+
+    # This is the read thread, where the actual reading from the HTTP response happens for streams that can't use the read loop.
     def readThreadWorker(self):
         try:
             self.debugLog("Read thread starting")
@@ -346,8 +592,7 @@ class HttpStreamAccumulationReader:
                     # If not, it will make one OS function call to block until there's anything, and then will return it.
                     # This is exactly what we want here.
                     #
-                    # We use the max read size so we basically read as much as we can in one call. Since we are sleeping for the accumulation time before each read,
-                    # we need to make sure we read a sufficient amount of data each time to keep up.
+                    # We use the max read size so we basically read as much as we can in one call.
                     chunk = response.raw.read1(self.MaxReturnBufferSizeBytes) #pyright: ignore[reportUnknownMemberType, reportAttributeAccessIssue] this doesn't exist on PY 3.7
                 else:
                     # According to Google some wrappers of the raw object won't have read1, so we fall back to read.
@@ -360,59 +605,16 @@ class HttpStreamAccumulationReader:
                     break
 
                 # Append the chunk to the buffer list.
-                with self.BufferLock:
-                    self.BufferList.append(chunk)
-                    bufferLen = len(chunk)
-                    self.BufferListPendingSize += bufferLen
-
-                    # Update stats.
-                    self.SocketReads += 1
-                    self.TotalBytesRead += len(chunk)
-
-                    # This should be impossible due to the read1 size, but sanity check it.
-                    if bufferLen > self.MaxReturnBufferSizeBytes:
-                        raise Exception(f"The unknown body chunk read thread read a chunk larger than the max single chunk size of {self.MaxReturnBufferSizeBytes} bytes! Read size: {bufferLen} bytes.")
-
-                    # Let the consumer know we have data ready to be read!
-                    self.BufferDataReadyEvent.set()
-
-                    # Important! Since our sending websocket logic will block if there's too much back pressure on sending on the WS,
-                    # We must also bound this pending buffer size so it doesn't eat memory just accumulating buffers that can't be sent.
-                    # We use an event-based approach: the consumer signals BackpressureRelievedEvent when it drains data,
-                    # allowing the producer to resume immediately instead of sleeping a fixed duration.
+                # We use an event-based approach: the consumer signals BackpressureRelievedEvent when it drains data,
+                # allowing the producer to resume immediately instead of sleeping a fixed duration.
+                if self._OnChunkRead(chunk):
                     while self.IsClosed is False and self.BufferListPendingSize > self.MaxPendingBufferSizeBytes:
-                        if self.Logger.isEnabledFor(logging.DEBUG):
-                            self.Logger.debug(f"{self.getLogMsgPrefix()} Pending buffer size of {self.BufferListPendingSize/1024.0/1024.0} MB exceeds the max of {self.MaxPendingBufferSizeBytes/1024.0/1024.0} MB. Waiting for consumer to drain buffer." )
-                        self.BackpressureRelievedEvent.clear()
-                        self.BufferLock.release()
                         self.BackpressureRelievedEvent.wait(timeout=0.5)
-                        self.BufferLock.acquire() #pylint: disable=consider-using-with
+                        self.BackpressureRelievedEvent.clear()
 
             # When the loop exits, the body read is complete and the stream is closed.
 
-        except urllib3.exceptions.HTTPError as e:
-            # These happen for a variety of reasons, including the stream being closed.
-            # Don't send it to Sentry.
-            self.Logger.info(f"{self.getLogMsgPrefix()} HTTPError exception thrown in HttpStreamAccumulationReader, ending read. {str(e)}")
-
         except Exception as e:
-            # If the web stream is already closed, don't bother logging the exception.
-            # These exceptions happen for use cases as above, where stream() doesn't close in time and such.
-            # Note the exception can be a timeout, but it can also be a "doesn't have a read" function error bc if the socket gets data the lib will try to call read on a fp that's closed and set to None. :/
-            if self.IsClosed is False:
-                Sentry.OnException(self.getLogMsgPrefix()+ " exception thrown in HttpStreamAccumulationReader", e)
+            self._OnReadException(e)
         finally:
-
-            # Set the event to break the stream read wait, so it will shutdown.
-            # Call set under lock, to ensure the other thread doesn't clear it without us seeing it.
-            with self.BufferLock:
-                # Ensure we always set this flag, so the web stream will know the body read is done.
-                self.ReadComplete = True
-                self.BufferDataReadyEvent.set()
-
-            try:
-                runTimeSec = time.time() - self.OpenedTimeSec
-                if self.Logger.isEnabledFor(logging.DEBUG):
-                    self.Logger.debug(f"{self.getLogMsgPrefix()} Read thread exited. Run Time: {runTimeSec:.2f} sec, SocketReads: {self.SocketReads}, OctoStreamReads: {self.OctoStreamReads}, TotalBytesRead: {self.TotalBytesRead/1024.0:.2f} KB")
-            except Exception:
-                pass
+            self._OnReadDone()
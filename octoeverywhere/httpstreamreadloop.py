@@ -0,0 +1,248 @@
+import socket
+import logging
+import threading
+import selectors
+import collections
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from .sentry import Sentry
+
+
+# A single selector driven thread that services the body reads of all open HttpStreamAccumulationReaders.
+#
+# Before this, each reader had its own thread blocked in a read call, so every open event stream (OctoPrint sockjs fallbacks, Moonraker event streams, etc)
+# cost a thread. With this loop the readers register their socket and the loop only reads from a stream when the socket is readable or
+# the http lib already has buffered data for it, and the sockets are non-blocking, so the reads never wait on the network.
+#
+# Readers that can't be serviced this way (like TLS sockets, where select doesn't see the data buffered in the TLS layer) fall back to their own read thread.
+class HttpStreamReadLoop:
+
+    # The return values of a reader's OnLoopReadable call.
+    # Wait means there's nothing more to read right now, so wait for the socket to be readable again.
+    c_Wait = 0
+    # ReadAgain means the reader stopped reading to be fair to the other streams, but there's still data buffered.
+    c_ReadAgain = 1
+    # Done means the reader is done reading or is paused, so it's removed from the selector.
+    c_Done = 2
+
+    _OpAdd = 0
+    _OpRemove = 1
+
+    _Instance:Optional["HttpStreamReadLoop"] = None
+    _InstanceLock = threading.Lock()
+
+
+    # The loop is created on first use, since it's only needed if there are unknown length body streams.
+    @staticmethod
+    def Get(logger:logging.Logger) -> "HttpStreamReadLoop":
+        with HttpStreamReadLoop._InstanceLock:
+            if HttpStreamReadLoop._Instance is None:
+                HttpStreamReadLoop._Instance = HttpStreamReadLoop(logger)
+            return HttpStreamReadLoop._Instance
+
+
+    def __init__(self, logger:logging.Logger) -> None:
+        self.Logger = logger
+        self.Selector = selectors.DefaultSelector()
+
+        # The readers currently registered with the selector, and their sockets.
+        self.Readers:Dict[Any, socket.socket] = {}
+        # The readers that need to be serviced even if their socket isn't readable, because they might already have buffered data.
+        self.Checks:List[Any] = []
+
+        # Commands are queued from other threads and processed on the loop thread, so only the loop thread touches the selector.
+        self.CommandLock = threading.Lock()
+        self.Commands:Deque[Tuple[int, Any, Optional[socket.socket], Optional[Callable[[], None]]]] = collections.deque()
+
+        # Used to wake the loop up from the select call when there are new commands.
+        self.WakeRecv, self.WakeSend = socket.socketpair()
+        self.WakeRecv.setblocking(False)
+        self.WakeSend.setblocking(False)
+        self.Selector.register(self.WakeRecv, selectors.EVENT_READ, None)
+
+        # Stats
+        self.Wakes = 0
+        self.Services = 0
+
+        self.Thread = threading.Thread(target=self._Run, name="HttpStreamReadLoop", daemon=True)
+        self.Thread.start()
+
+
+    # Adds a reader to the loop. It will be serviced right away, in case there's already buffered data.
+    # This is also used to resume a reader that was paused for back pressure.
+    def Add(self, reader:Any, sock:socket.socket) -> None:
+        self._QueueCommand(HttpStreamReadLoop._OpAdd, reader, sock, None)
+
+
+    # Removes a reader from the loop. The callback is called on the loop thread once the reader has been removed,
+    # after which the loop will not touch the reader or its response again.
+    def Remove(self, reader:Any, onRemoved:Optional[Callable[[], None]]=None) -> None:
+        self._QueueCommand(HttpStreamReadLoop._OpRemove, reader, None, onRemoved)
+
+
+    def GetStats(self) -> Dict[str, int]:
+        return {
+            "Streams": len(self.Readers),
+            "Wakes": self.Wakes,
+            "Services": self.Services,
+        }
+
+
+    def _QueueCommand(self, op:int, reader:Any, sock:Optional[socket.socket], callback:Optional[Callable[[], None]]) -> None:
+        with self.CommandLock:
+            self.Commands.append((op, reader, sock, callback))
+        try:
+            self.WakeSend.send(b"\0")
+        except BlockingIOError:
+            # The wake socket is full, so the loop is already going to wake up.
+            pass
+
+
+    def _Run(self) -> None:
+        while True:
+            try:
+                # If there are readers with buffered data left to read, don't block in the select.
+                events = self.Selector.select(timeout=0 if len(self.Checks) > 0 else None)
+                self.Wakes += 1
+                readable:List[Any] = []
+                for key, _ in events:
+                    if key.data is None:
+                        self._DrainWakeSocket()
+                    else:
+                        readable.append(key.data)
+
+                # Process the commands first, so we don't read from a reader that has been removed.
+                self._ProcessCommands()
+
+                checks = self.Checks
+                self.Checks = []
+                for reader in readable:
+                    if reader in self.Readers:
+                        self._Service(reader)
+                for reader in checks:
+                    if reader in self.Readers and reader not in readable:
+                        self._Service(reader)
+            except Exception as e:
+                Sentry.OnException("HttpStreamReadLoop exception in the read loop.", e)
+
+
+    def _DrainWakeSocket(self) -> None:
+        try:
+            while len(self.WakeRecv.recv(4096)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+
+
+    def _ProcessCommands(self) -> None:
+        with self.CommandLock:
+            commands = self.Commands
+            self.Commands = collections.deque()
+        for op, reader, sock, callback in commands:
+            if op == HttpStreamReadLoop._OpAdd:
+                if reader not in self.Readers and sock is not None:
+                    try:
+                        self.Selector.register(sock, selectors.EVENT_READ, reader)
+                    except (ValueError, OSError) as e:
+                        # If the socket can't be selected on, the reader falls back to its own read thread.
+                        reader.OnLoopAddFailed(e)
+                        continue
+                    self.Readers[reader] = sock
+                self.Checks.append(reader)
+            else:
+                self._Unregister(reader)
+                if callback is not None:
+                    try:
+                        callback()
+                    except Exception as e:
+                        Sentry.OnException("HttpStreamReadLoop exception in a remove callback.", e)
+
+
+    def _Service(self, reader:Any) -> None:
+        self.Services += 1
+        result = reader.OnLoopReadable()
+        if result == HttpStreamReadLoop.c_Done:
+            self._Unregister(reader)
+        elif result == HttpStreamReadLoop.c_ReadAgain:
+            self.Checks.append(reader)
+
+
+    def _Unregister(self, reader:Any) -> None:
+        sock = self.Readers.pop(reader, None)
+        if sock is None:
+            return
+        try:
+            self.Selector.unregister(sock)
+        except (KeyError, ValueError, OSError) as e:
+            self.Logger.debug("HttpStreamReadLoop failed to unregister a socket, it was most likely closed. %s", e)
+
+
+# Decodes a chunked transfer encoding body as the data arrives.
+# http.client does this too, but it blocks until it has the whole chunk frame, which the read loop can't do.
+class ChunkedBodyDecoder:
+
+    _StateSize = 0
+    _StateData = 1
+    _StateDataEnd = 2
+    _StateTrailer = 3
+
+    # A sanity limit for the chunk size and trailer lines, which are small.
+    c_MaxLineLength = 64 * 1024
+
+
+    def __init__(self) -> None:
+        self.State = ChunkedBodyDecoder._StateSize
+        self.ChunkBytesLeft = 0
+        self.Line = bytearray()
+        # Set when the last chunk and the trailers have been read.
+        self.IsDone = False
+
+
+    # Returns the body data decoded from the given raw data, which might be empty if the data was only framing.
+    def Feed(self, data:bytes) -> bytes:
+        body:List[bytes] = []
+        pos = 0
+        length = len(data)
+        while pos < length and self.IsDone is False:
+            if self.State == ChunkedBodyDecoder._StateData:
+                take = min(self.ChunkBytesLeft, length - pos)
+                body.append(data[pos:pos + take])
+                pos += take
+                self.ChunkBytesLeft -= take
+                if self.ChunkBytesLeft == 0:
+                    self.State = ChunkedBodyDecoder._StateDataEnd
+                continue
+
+            # The rest of the states are lines.
+            end = data.find(b"\n", pos)
+            if end == -1:
+                self.Line += data[pos:]
+                if len(self.Line) > ChunkedBodyDecoder.c_MaxLineLength:
+                    raise Exception("ChunkedBodyDecoder chunk line is too long.")
+                break
+            self.Line += data[pos:end + 1]
+            pos = end + 1
+            line = bytes(self.Line).strip()
+            self.Line = bytearray()
+
+            if self.State == ChunkedBodyDecoder._StateSize:
+                # Chunk extensions are after a ;
+                size = int(line.split(b";", 1)[0], 16)
+                if size < 0:
+                    raise Exception(f"ChunkedBodyDecoder invalid chunk size {size}.")
+                if size == 0:
+                    self.State = ChunkedBodyDecoder._StateTrailer
+                else:
+                    self.ChunkBytesLeft = size
+                    self.State = ChunkedBodyDecoder._StateData
+            elif self.State == ChunkedBodyDecoder._StateDataEnd:
+                if len(line) != 0:
+                    raise Exception("ChunkedBodyDecoder chunk data wasn't followed by a line end.")
+                self.State = ChunkedBodyDecoder._StateSize
+            elif len(line) == 0:
+                # An empty line ends the trailers, and the body.
+                self.IsDone = True
+
+        if len(body) == 1:
+            return body[0]
+        return b"".join(body)
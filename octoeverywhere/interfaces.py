@@ -8,9 +8,12 @@ from .snapshotresizeparams import SnapshotResizeParams
 from .Webcam.webcamsettingitem import WebcamSettingItem
 
 from .Proto.HttpInitialContext import HttpInitialContext
+from .Proto.MessagePriority import MessagePriority
 
 if TYPE_CHECKING:
+    from .negotiatedfeatures import NegotiatedFeatures
     from .WebStream.uploadbody import UploadBody
+    from .Webcam.webcamframefanout import WebcamFrameFanout
 
 #
 # Common Objects
@@ -497,8 +500,10 @@ class IOctoStream(ABC):
     def OnSessionError(self, sessionId:int, backoffModifierSec:int) -> None:
         pass
 
+    # The stream id and priority are used to schedule the send. Messages are normal priority unless the sender says otherwise,
+    # the session's control messages, like the handshake, are sent as critical.
     @abstractmethod
-    def SendMsg(self, buffer:Buffer, msgStartOffsetBytes:int, msgSize:int) -> None:
+    def SendMsg(self, buffer:Buffer, msgStartOffsetBytes:int, msgSize:int, streamId:int=0, priority:int=MessagePriority.Normal) -> None:
         pass
 
     @abstractmethod
@@ -529,7 +534,12 @@ class IOctoSession(ABC):
         pass
 
     @abstractmethod
-    def Send(self, buffer:Buffer, msgStartOffsetBytes:int, msgSize:int) -> None:
+    def Send(self, buffer:Buffer, msgStartOffsetBytes:int, msgSize:int, streamId:int=0, priority:int=MessagePriority.Normal) -> None:
+        pass
+
+    # Returns the features the server accepted in this session's handshake.
+    @abstractmethod
+    def GetNegotiatedFeatures(self) -> "NegotiatedFeatures":
         pass
 
 
@@ -597,6 +607,11 @@ class IQuickCam(ABC):
     def DetachImageStreamCallback(self, callback:Callable[[Buffer], None]):
         pass
 
+    # Returns the WebcamFrameFanout the camera's stream viewers share.
+    @abstractmethod
+    def GetFrameFanout(self) -> "WebcamFrameFanout":
+        pass
+
 
 class IOctoPrintPlugin(ABC):
 
@@ -0,0 +1,78 @@
+import threading
+from typing import Any, Dict, List, Optional
+
+
+# A small thread safe latency histogram with fixed buckets.
+# This is used for the perf counters, so it's cheap to add to and it doesn't hold on to the samples.
+class LatencyHistogram:
+
+    # The upper bound of each bucket in ms, the last bucket holds everything above the last bound.
+    c_DefaultBucketBoundsMs = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+    def __init__(self, bucketBoundsMs:Optional[List[float]]=None) -> None:
+        self.BucketBoundsMs = bucketBoundsMs if bucketBoundsMs is not None else LatencyHistogram.c_DefaultBucketBoundsMs
+        self.Lock = threading.Lock()
+        self.Counts = [0] * (len(self.BucketBoundsMs) + 1)
+        self.Count = 0
+        self.TotalMs = 0.0
+        self.MaxMs = 0.0
+
+
+    def Add(self, durationSec:float) -> None:
+        ms = durationSec * 1000.0
+        i = 0
+        while i < len(self.BucketBoundsMs) and ms > self.BucketBoundsMs[i]:
+            i += 1
+        with self.Lock:
+            self.Counts[i] += 1
+            self.Count += 1
+            self.TotalMs += ms
+            if ms > self.MaxMs:
+                self.MaxMs = ms
+
+
+    def Reset(self) -> None:
+        with self.Lock:
+            self.Counts = [0] * (len(self.BucketBoundsMs) + 1)
+            self.Count = 0
+            self.TotalMs = 0.0
+            self.MaxMs = 0.0
+
+
+    # Returns the upper bound of the bucket the percentile falls in, in ms.
+    # Since only the bucket counts are kept, this is an estimate that's never lower than the real value, except for the last bucket, which uses the max.
+    def GetPercentileMs(self, percentile:float) -> float:
+        with self.Lock:
+            return self._GetPercentileMsLocked(percentile)
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        with self.Lock:
+            buckets:Dict[str, int] = {}
+            for i, bound in enumerate(self.BucketBoundsMs):
+                buckets[f"<={bound}ms"] = self.Counts[i]
+            buckets[f">{self.BucketBoundsMs[-1]}ms"] = self.Counts[-1]
+            return {
+                "Count": self.Count,
+                "AvgMs": 0.0 if self.Count == 0 else round(self.TotalMs / self.Count, 3),
+                "MaxMs": round(self.MaxMs, 3),
+                "P50Ms": self._GetPercentileMsLocked(50),
+                "P90Ms": self._GetPercentileMsLocked(90),
+                "P99Ms": self._GetPercentileMsLocked(99),
+                "Buckets": buckets,
+            }
+
+
+    def _GetPercentileMsLocked(self, percentile:float) -> float:
+        if self.Count == 0:
+            return 0.0
+        target = self.Count * (percentile / 100.0)
+        seen = 0
+        for i, count in enumerate(self.Counts):
+            seen += count
+            if seen >= target and count > 0:
+                if i >= len(self.BucketBoundsMs):
+                    return round(self.MaxMs, 3)
+                return float(min(self.BucketBoundsMs[i], round(self.MaxMs, 3)))
+        return round(self.MaxMs, 3)
@@ -47,21 +47,67 @@ class MemoryManager:
     # This can be larger than Global_MaxSingleChunkSizeBytes because it's not sent as one websocket message.
     OctoWebStreamHttpHelper_MaxUploadBufferSizeBytes = 32 * MB
 
+    # This is the max amount of upload data a streaming upload will queue while it waits for the local server to read it.
+    # When it's full, the web stream stops taking messages, which pushes back on the server through the stream's flow control.
+    OctoWebStreamHttpHelper_MaxStreamingUploadQueuedBytes = 4 * MB
+
+    # When the http body pipeline is enabled, this is the max amount of data each pipeline stage can hold before it blocks.
+    # The read stage holds read buffers waiting to be compressed and the send stage holds built messages waiting to be sent,
+    # so a single pipelined request can hold up to about twice this amount.
+    OctoWebStreamHttpHelper_MaxPipelineStageBufferedBytes = 4 * MB
+
+    # When the OctoWebStream incoming overflow cutoff is enabled, this is how many bytes of incoming messages a single web stream can have queued
+    # before it's closed for not keeping up. Under this limit, a slow stream only parks its own messages
+    # and the receive thread keeps dispatching messages to all of the other streams.
+    OctoWebStream_IncomingOverflowCutoffBytes = 8 * MB
+
+    # When the web stream worker pool is enabled, this is the max number of worker threads that will run web streams.
+    # Each thread has a stack and other overhead, so on low memory devices we keep this small.
+    OctoWebStream_MaxWorkerPoolThreads = 16
+
+    # When the web stream worker pool is enabled, this is the max number of workers that can be detached from the pool to run long tasks,
+    # like webcam streams. Past this, long tasks hold their workers, so the pool's total threads stay bounded.
+    OctoWebStream_MaxWorkerPoolDetachedThreads = 16
+
+    # This is the max total size of the idle buffers the SendBufferPool will hold on to.
+    # The pool is used for the large, short lived buffers like message buffers and body read buffers, so this bounds how many are kept around between uses.
+    SendBufferPool_MaxPooledBytes = 8 * MB
+
     # This is the largest chunk we will return for a single quickcam stream frame.
     # MUST BE LESS THAN OR EQUAL TO Global_MaxSingleChunkSizeBytes
     QuickCam_MaxStreamChunkSizeBytes = 3 * MB
 
+    # The size of the arena each QuickCam backend reads the camera stream into. The frames are returned as views of the arena, so a few are kept alive at once.
+    # This is grown if a single frame is bigger than it.
+    QuickCam_FrameArenaSizeBytes = 2 * MB
+
     # The is the max for both compression and decompression pools.
     # A single Home Assistant cached dashboard load can use upwards of 70 concurrent compression objects.
     # Once the max pool size is hit, new instances will be created and destroyed rather than blocking.
     Compression_MaxPoolSize = 10
 
+    # This caps the zstandard window for streams with an unknown size, like websockets, which can hold a compressor for a long time.
+    # Each compressor holds a buffer the size of the window, so on low memory devices we keep it small. None uses the level's default window.
+    Compression_StreamWindowLog:Optional[int] = 20
+
+    # The zstandard level used for data that's compressed once in the background and sent many times, like the Slipstream cache.
+    # The higher levels use a lot more memory while compressing, so low memory devices use a middle level.
+    Compression_PrecompressLevel = 12
+
+    # The total size of the compressed bodies Slipstream will cache, both in memory and on disk.
+    # Once it's full, the least recently used bodies are evicted.
+    Slipstream_MaxCacheBytes = 50 * MB
+
     # These control the max number of HTTP sessions the urllib3 lib can hold on to.
     # The more we hold, the more memory we hold open but also the faster we can make the connection.
     # The default value in the lib is 10.
     HttpSessions_MaxConnections = 10
     HttpSessions_MaxPoolSize = 10
 
+    # The number of idle connections kept open to each local backend, like OctoPrint, Moonraker, or nginx.
+    # This must be less than the max pool size.
+    HttpSessions_WarmConnectionsPerBackend = 2
+
 
     _Instance:"MemoryManager" = None #pyright: ignore[reportAssignmentType]
 
@@ -98,11 +144,22 @@ class MemoryManager:
             MemoryManager.OctoWebStreamHttpHelper_DefaultBodyReadSizeBytes = 2 * MemoryManager.MB
             MemoryManager.OctoWebStreamHttpHelper_MaxMultipartReadSizeBytes = MemoryManager.Global_MaxSingleChunkSizeBytes
             MemoryManager.OctoWebStreamHttpHelper_MaxUploadBufferSizeBytes = 128 * MemoryManager.MB
+            MemoryManager.OctoWebStreamHttpHelper_MaxStreamingUploadQueuedBytes = 16 * MemoryManager.MB
+            MemoryManager.OctoWebStreamHttpHelper_MaxPipelineStageBufferedBytes = 16 * MemoryManager.MB
+            MemoryManager.OctoWebStream_IncomingOverflowCutoffBytes = 32 * MemoryManager.MB
+            MemoryManager.OctoWebStream_MaxWorkerPoolThreads = 64
+            MemoryManager.OctoWebStream_MaxWorkerPoolDetachedThreads = 64
+            MemoryManager.SendBufferPool_MaxPooledBytes = 32 * MemoryManager.MB
             MemoryManager.QuickCam_MaxStreamChunkSizeBytes = MemoryManager.Global_MaxSingleChunkSizeBytes
+            MemoryManager.QuickCam_FrameArenaSizeBytes = 8 * MemoryManager.MB
             MemoryManager.Compression_MaxPoolSize = 50
+            MemoryManager.Compression_StreamWindowLog = None
+            MemoryManager.Compression_PrecompressLevel = 19
+            MemoryManager.Slipstream_MaxCacheBytes = 100 * MemoryManager.MB
             # We care less about the unique hosts and more about total connections to each host.
             MemoryManager.HttpSessions_MaxConnections = 10
             MemoryManager.HttpSessions_MaxPoolSize = 50
+            MemoryManager.HttpSessions_WarmConnectionsPerBackend = 4
         except Exception as e:
             self.Logger.warning(f"MemoryManager failed to read system memory info during initialization. {e}")
         finally:
@@ -0,0 +1,22 @@
+from typing import FrozenSet, Iterable, Optional
+
+from .Proto.FeatureFlags import FeatureFlags
+
+
+#
+# The features the server accepted in a session's handshake ack.
+#
+# Each OctoSession has its own, since the primary, secondary, and summon connections can each be to a server that accepts different features.
+# It's replaced as a whole on each handshake, so it can be read without a lock, and the streams of a session keep the one they started with.
+#
+class NegotiatedFeatures:
+
+    def __init__(self, featureFlags:int=FeatureFlags.None_, acceptedZStandardDictIds:Optional[Iterable[int]]=None) -> None:
+        self.FeatureFlags = featureFlags
+        # The trained zstandard dict ids the server accepted, the pre-trained dict is always accepted so it's not in here.
+        self.AcceptedZStandardDictIds:FrozenSet[int] = frozenset(acceptedZStandardDictIds) if acceptedZStandardDictIds is not None else frozenset()
+
+
+    # Returns true if the server accepted the feature flag.
+    def HasFeature(self, featureFlag:int) -> bool:
+        return (self.FeatureFlags & featureFlag) != 0
@@ -13,6 +13,7 @@ from .compat import Compat
 from .finalsnap import FinalSnap
 from .repeattimer import RepeatTimer
 from .httpsessions import HttpSessions
+from .compressionscheduler import CompressionScheduler
 from .buffer import Buffer, BufferOrNone, ByteLikeOrMemoryView
 from .interfaces import IPrinterStateReporter, INotificationHandler
 from .Webcam.webcamhelper import WebcamHelper
@@ -96,6 +97,9 @@ class NotificationsHandler(INotificationHandler):
         # But we pass none, so we don't delete any print infos that might be on disk we will try to recover when connected to the server.
         self._RecoverOrRestForNewPrint(None)
 
+        # While we are tracking a print, compression uses less cpu, so the host always has enough.
+        CompressionScheduler.SetIsPrintActiveCallback(self.IsTrackingPrint)
+
 
     # Called to start a new print.
     # On class init, this can be called with printCookie=None, but after that we should always have a print cookie.
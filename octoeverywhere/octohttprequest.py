@@ -1,22 +1,38 @@
 import platform
 import logging
-from typing import Dict, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 from urllib.parse import urlsplit
 
+import requests
+
 from .mdns import MDns
 from .buffer import Buffer
 from .compat import Compat
 from .localip import LocalIpHelper
 from .httpresult import HttpResult
 from .httpsessions import HttpSessions
+from .httprouteselector import HttpRoute, HttpRouteSelector
 from .octostreammsgbuilder import OctoStreamMsgBuilder
-from .WebStream.uploadbody import MultipartFormUploadBody, MultipartFormUploadBodyReadContext, MultipartFormUploadBodyReader, UploadBody, UploadBodyReadContext, UploadTypesBufferOrNone, BufferedReaderBytesOrNone
+from .WebStream.uploadbody import MultipartFormUploadBody, MultipartFormUploadBodyReadContext, MultipartFormUploadBodyReader, StreamingUploadBody, UploadBody, UploadBodyReadContext, UploadTypesBufferOrNone, BufferedReaderBytesOrNone
 
 
 from .Proto.PathTypes import PathTypes
 from .Proto.HttpInitialContext import HttpInitialContext
 
 
+# The main URL and the fallback URLs a http call will try, in order.
+class OctoHttpCallUrls:
+    def __init__(self, pathOrUrl:str, url:str, fallbackUrl:Optional[str], fallbackWebcamUrl:Optional[str], fallbackLocalIpDirectServicePortSuffix:Optional[str], fallbackLocalIpHttpProxySuffix:Optional[str]) -> None:
+        # The requested path or URL, with any corrections applied.
+        self.PathOrUrl = pathOrUrl
+        self.Url = url
+        self.FallbackUrl = fallbackUrl
+        self.FallbackWebcamUrl = fallbackWebcamUrl
+        # The local IP fallbacks are only suffixes, since the local IP is only looked up if it's needed.
+        self.FallbackLocalIpDirectServicePortSuffix = fallbackLocalIpDirectServicePortSuffix
+        self.FallbackLocalIpHttpProxySuffix = fallbackLocalIpHttpProxySuffix
+
+
 class OctoHttpRequest:
     LocalHttpProxyPort = 80
     LocalHttpProxyIsHttps = False
@@ -101,42 +117,21 @@ class OctoHttpRequest:
         pathType = httpInitialContext.PathType()
 
         # Make the common call.
-        return OctoHttpRequest.MakeHttpCall(logger, path, pathType, method, headers, data)
+        # The headers come from GatherRequestHeaders, which only allows encoded responses if compression pass through was negotiated.
+        return OctoHttpRequest.MakeHttpCall(logger, path, pathType, method, headers, data, allowPassThroughEncoding=True)
 
 
-    # allowRedirects should be false for all proxy calls. If it's true, then the content returned might be from a redirected URL and the actual URL will be incorrect.
-    # Instead, the system needs to handle the redirect 301 or 302 call as normal, sending it back to the caller, and allowing them to follow the redirect if needed.
-    # The X-Forwarded-Host header will tell the OctoPrint server the correct place to set the location redirect header.
-    # However, for calls that aren't proxy calls, things like local snapshot requests and such, we want to allow redirects to be more robust.
+    # Returns the URL that MakeHttpCall will try first for the given path, without making the call.
+    # This is used by the async web stream engine, which only handles the main URL itself, and hands anything that needs the fallback chain to MakeHttpCall.
     @staticmethod
-    def MakeHttpCall(logger:logging.Logger, pathOrUrl:str, pathOrUrlType:int, method:str, headers:Optional[Dict[str, str]]=None, data:UploadTypesBufferOrNone=None, allowRedirects:bool=False, timeoutSec:Optional[float]=None) -> Optional[HttpResult]:
-        # First of all, we need to figure out what the URL is. There are two options
-        #
-        # 1) Absolute URLs
-        # These are the easiest, because we just want to make a request to exactly what the absolute URL is. These are used
-        # when the OctoPrint portal is trying to make an local LAN http request to the same device or even a different device.
-        # For these to work properly on a remote browser, the OctoEverywhere service will detect and convert the URLs in to encoded relative
-        # URLs for the portal. This ensures when the remote browser tries to access the HTTP endpoint, it will hit OctoEverywhere. The OctoEverywhere
-        # server detects the special relative URL, decodes the absolute URL, and sends that in the OctoMessage as "AbsUrl". For these URLs we just try
-        # to hit them and we take whatever we get, we don't care if fails or not.
-        #
-        # 2) Relative Urls
-        # These Urls are the most common, standard URLs. The browser makes the relative requests to the same hostname:port as it's currently
-        # on. However, for our setup its a little more complex. The issue is the OctoEverywhere plugin not knowing how the user's system is setup.
-        # The plugin can with 100% certainty query and know the port OctoPrint's http server is running on directly. So we do that to know exactly what
-        # OctoPrint server to talk to. (consider there might be multiple instances running on one device.)
-        #
-        # But, the other most common use case for http calls are the webcam streams to mjpegstreamer. This is the tricky part. There are two ways it can be
-        # setup. 1) the webcam stream uses an absolute local LAN url with the ip and port. This is covered by the absolute URL system above. 2) The webcam stream
-        # uses a relative URL and haproxy handles detecting the webcam path to send it to the proper mjpegstreamer instance. This is the tricky one, because we can't
-        # directly query or know what the correct port for haproxy or mjpegstreamer is. We could look at the configs, but a user might not setup the configs in the
-        # standard places. So to fix the issue, we use logic in the frontend JS to determine if a web browser is connecting locally, and if so what the port is. That gives
-        # use a reliable way to know what port haproxy is running on. It sends that to the plugin, which is then given here as `localHttpProxyPort`.
-        #
-        # The last problem is knowing which calls should be sent to OctoPrint directly and which should be sent to haproxy. We can't rely on any URL matching, because
-        # the user can setup the webcam stream to start with anything they want. So the method we use right now is to simply always request to OctoPrint first, and if we
-        # get a 404 back try the haproxy. This adds a little bit of unneeded overhead, but it works really well to cover all of the cases.
+    def GetPrimaryUrl(pathOrUrl:str, pathOrUrlType:int) -> str:
+        return OctoHttpRequest.GetHttpCallUrls(pathOrUrl, pathOrUrlType).Url
+
 
+    # Figures out the main URL and the fallback URLs MakeHttpCall will try for the given path, without making the call.
+    # See the comment in MakeHttpCall for how the URLs are picked.
+    @staticmethod
+    def GetHttpCallUrls(pathOrUrl:str, pathOrUrlType:int) -> OctoHttpCallUrls:
         # Setup the protocol we need to use for the http proxy. We need to use the same protocol that was detected.
         localServiceProtocol = "http://"
         if OctoHttpRequest.LocalHostUseHttps:
@@ -222,6 +217,66 @@ class OctoHttpRequest:
         else:
             raise Exception("Http request got a message with an unknown path type. "+str(pathOrUrlType))
 
+        return OctoHttpCallUrls(pathOrUrl, url, fallbackUrl, fallbackWebcamUrl, fallbackLocalIpDirectServicePortSuffix, fallbackLocalIpHttpProxySuffix)
+
+
+    # Returns the root URLs of the local servers relative requests are sent to, the main server and the http proxy.
+    # These are used to prewarm the connection pools when a tunnel session starts.
+    @staticmethod
+    def GetLocalBackendUrls() -> List[str]:
+        localServiceProtocol = "https://" if OctoHttpRequest.LocalHostUseHttps else "http://"
+        httpProxyProtocol = "https://" if OctoHttpRequest.LocalHttpProxyIsHttps else "http://"
+        urls = [localServiceProtocol + OctoHttpRequest.LocalHostAddress + ":" + str(OctoHttpRequest.LocalOctoPrintPort) + "/"]
+        proxyUrl = httpProxyProtocol + OctoHttpRequest.LocalHostAddress + ":" + str(OctoHttpRequest.LocalHttpProxyPort) + "/"
+        if proxyUrl not in urls:
+            urls.append(proxyUrl)
+        return urls
+
+
+    # allowRedirects should be false for all proxy calls. If it's true, then the content returned might be from a redirected URL and the actual URL will be incorrect.
+    # Instead, the system needs to handle the redirect 301 or 302 call as normal, sending it back to the caller, and allowing them to follow the redirect if needed.
+    # The X-Forwarded-Host header will tell the OctoPrint server the correct place to set the location redirect header.
+    # However, for calls that aren't proxy calls, things like local snapshot requests and such, we want to allow redirects to be more robust.
+    @staticmethod
+    def MakeHttpCall(logger:logging.Logger, pathOrUrl:str, pathOrUrlType:int, method:str, headers:Optional[Dict[str, str]]=None, data:UploadTypesBufferOrNone=None, allowRedirects:bool=False, timeoutSec:Optional[float]=None, allowPassThroughEncoding:bool=False) -> Optional[HttpResult]:
+        # First of all, we need to figure out what the URL is. There are two options
+        #
+        # 1) Absolute URLs
+        # These are the easiest, because we just want to make a request to exactly what the absolute URL is. These are used
+        # when the OctoPrint portal is trying to make an local LAN http request to the same device or even a different device.
+        # For these to work properly on a remote browser, the OctoEverywhere service will detect and convert the URLs in to encoded relative
+        # URLs for the portal. This ensures when the remote browser tries to access the HTTP endpoint, it will hit OctoEverywhere. The OctoEverywhere
+        # server detects the special relative URL, decodes the absolute URL, and sends that in the OctoMessage as "AbsUrl". For these URLs we just try
+        # to hit them and we take whatever we get, we don't care if fails or not.
+        #
+        # 2) Relative Urls
+        # These Urls are the most common, standard URLs. The browser makes the relative requests to the same hostname:port as it's currently
+        # on. However, for our setup its a little more complex. The issue is the OctoEverywhere plugin not knowing how the user's system is setup.
+        # The plugin can with 100% certainty query and know the port OctoPrint's http server is running on directly. So we do that to know exactly what
+        # OctoPrint server to talk to. (consider there might be multiple instances running on one device.)
+        #
+        # But, the other most common use case for http calls are the webcam streams to mjpegstreamer. This is the tricky part. There are two ways it can be
+        # setup. 1) the webcam stream uses an absolute local LAN url with the ip and port. This is covered by the absolute URL system above. 2) The webcam stream
+        # uses a relative URL and haproxy handles detecting the webcam path to send it to the proper mjpegstreamer instance. This is the tricky one, because we can't
+        # directly query or know what the correct port for haproxy or mjpegstreamer is. We could look at the configs, but a user might not setup the configs in the
+        # standard places. So to fix the issue, we use logic in the frontend JS to determine if a web browser is connecting locally, and if so what the port is. That gives
+        # use a reliable way to know what port haproxy is running on. It sends that to the plugin, which is then given here as `localHttpProxyPort`.
+        #
+        # The last problem is knowing which calls should be sent to OctoPrint directly and which should be sent to haproxy. We can't rely on any URL matching, because
+        # the user can setup the webcam stream to start with anything they want. So the method we use right now is to simply always request to OctoPrint first, and if we
+        # get a 404 back try the haproxy. This adds a little bit of unneeded overhead, but it works really well to cover all of the cases.
+
+        # Figure out the main and fallback urls.
+        urls = OctoHttpRequest.GetHttpCallUrls(pathOrUrl, pathOrUrlType)
+        pathOrUrl = urls.PathOrUrl
+        url = urls.Url
+        fallbackUrl = urls.FallbackUrl
+        fallbackWebcamUrl = urls.FallbackWebcamUrl
+        fallbackLocalIpDirectServicePortSuffix = urls.FallbackLocalIpDirectServicePortSuffix
+        fallbackLocalIpHttpProxySuffix = urls.FallbackLocalIpHttpProxySuffix
+        # The local IP http proxy fallback must use the same protocol that was detected for the http proxy.
+        httpProxyProtocol = "https://" if OctoHttpRequest.LocalHttpProxyIsHttps else "http://"
+
         # Ensure if there's no data we don't set it. Sometimes our json message parsing will leave an empty bytearray where it should be None.
         if isinstance(data, Buffer) and len(data) == 0:
             data = None
@@ -231,102 +286,50 @@ class OctoHttpRequest:
         # Beyond nothing handling compressed responses, since the call is almost always over localhost, there's no point in doing compression, since it mainly just helps in transmit less data.
         # Thus, for all calls, we set the Accept-Encoding to identity, telling the server no response compression is allowed.
         # This is important for somethings like camera-streamer, which will use gzip by default. (which is also silly, because it's sending jpegs and jmpeg streams?)
+        # The only exception is the OctoStream helper when compression pass through is negotiated, since it forwards the encoded body as is.
         if headers is None:
             headers = {}
-        headers["Accept-Encoding"] = "identity"
-
-        # First, try the main URL.
-        # For the first main url, we set the main response to None and is fallback to False.
-        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Main request", method, url, headers, data, None, False, fallbackUrl, allowRedirects, timeoutSec=timeoutSec)
-        # If the function reports the chain is done, the next fallback URL is invalid and we should always return
-        # whatever is in the Response, even if it's None.
-        if ret.IsChainDone:
-            return ret.Result
-
-        # We should have a fallback url if we are here.
-        if fallbackUrl is None:
-            logger.error("Main request failed and no fallback URL was provided. This is a critical error and should be reported to the OctoEverywhere team.")
-            return ret.Result
-
-        # We keep track of the main response, if all future fallbacks fail. (This can be None)
-        mainResult = ret.Result
-
-        # Main failed, try the fallback, which should be the http proxy.
-        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Http proxy fallback", method, fallbackUrl, headers, data, mainResult, True, fallbackLocalIpHttpProxySuffix, allowRedirects, timeoutSec=timeoutSec)
-        # If the function reports the chain is done, the next fallback URL is invalid and we should always return
-        # whatever is in the Response, even if it's None.
-        if ret.IsChainDone:
-            return ret.Result
-
-        # Try to get the local IP of this device and try to use the same ports with it.
-        # We build these full URLs after the failures so we don't try to get the local IP on every call.
-        localIp = LocalIpHelper.TryToGetLocalIpOfConnectionTarget()
-
-        # We should have a fallbackLocalIpHttpProxySuffix if we are here.
-        if fallbackLocalIpHttpProxySuffix is None:
-            logger.error("Main request failed and no fallbackLocalIpHttpProxySuffix was provided. This is a critical error and should be reported to the OctoEverywhere team.")
-            return ret.Result
-
-        # With the local IP, first try to use the http proxy URL, since it's the most likely to be bound to the public IP and not firewalled.
-        # It's important we use the right http proxy protocol with the http proxy port.
-        localIpFallbackUrl = httpProxyProtocol + localIp + fallbackLocalIpHttpProxySuffix
-        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Local IP Http Proxy Fallback", method, localIpFallbackUrl, headers, data, mainResult, True, fallbackLocalIpDirectServicePortSuffix, allowRedirects, timeoutSec=timeoutSec)
-        # If the function reports the chain is done, the next fallback URL is invalid and we should always return
-        # whatever is in the Response, even if it's None.
-        if ret.IsChainDone:
-            return ret.Result
-
-        # We should have a fallbackLocalIpHttpProxySuffix if we are here.
-        if fallbackLocalIpDirectServicePortSuffix is None:
-            logger.error("Main request failed and no fallbackLocalIpOctoPrintPortSuffix was provided. This is a critical error and should be reported to the OctoEverywhere team.")
-            return ret.Result
-
-        # Now try the OcotoPrint direct port with the local IP.
-        localIpFallbackUrl = "http://" + localIp + fallbackLocalIpDirectServicePortSuffix
-        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Local IP fallback", method, localIpFallbackUrl, headers, data, mainResult, True, fallbackWebcamUrl, allowRedirects, timeoutSec=timeoutSec)
-        # If the function reports the chain is done, the next fallback URL is invalid and we should always return
-        # whatever is in the Response, even if it's None.
-        if ret.IsChainDone:
-            return ret.Result
-
-        # We should have a fallbackWebcamUrl if we are here.
-        if fallbackWebcamUrl is None:
-            logger.error("Main request failed and no fallbackWebcamUrl was provided. This is a critical error and should be reported to the OctoEverywhere team.")
-            return ret.Result
-
-        # If all others fail, try the hardcoded webcam URL.
-        # Note this has to be last, because there commonly isn't a fallbackWebcamUrl, so it will stop the
-        # chain of other attempts.
-        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Webcam hardcode fallback", method, fallbackWebcamUrl, headers, data, mainResult, True, None, allowRedirects, timeoutSec=timeoutSec)
-
-        # No matter what, always return the result now.
-        return ret.Result
-
-
-    # Returned by a single http request attempt.
-    # IsChainDone - indicates if the fallback chain is done and the response should be returned
-    # Result - is the final result. Note the result can be unsuccessful or even `None` if everything failed.
-    class AttemptResult():
-        def __init__(self, isChainDone:bool, result:Optional[HttpResult]):
-            self.isChainDone = isChainDone
-            self.result = result
-
-        @property
-        def IsChainDone(self) -> bool:
-            return self.isChainDone
-
-        @property
-        def Result(self) -> Optional[HttpResult]:
-            return self.result
-
-
-    # This function should always return a AttemptResult object.
-    @staticmethod
-    def MakeHttpCallAttempt(logger:logging.Logger, attemptName:str, method:str, url:str, headers:Optional[Dict[str,str]], data:UploadTypesBufferOrNone, mainResult:Optional[HttpResult], isFallback:bool, nextFallbackUrl:Optional[str], allowRedirects:bool=False, timeoutSec:Optional[float]=None) -> AttemptResult:
+        if allowPassThroughEncoding is False or "Accept-Encoding" not in headers:
+            headers["Accept-Encoding"] = "identity"
+
+        # Build the routes, in the order they should be tried.
+        # Note the chain stops at the first route we don't have, which matches how each fallback URL is only given to the attempt before it.
+        routes = [HttpRoute("Main request", False, lambda: url)]
+        if fallbackUrl is not None:
+            routes.append(HttpRoute("Http proxy fallback", True, lambda: fallbackUrl)) #pyright: ignore[reportArgumentType]
+            if fallbackLocalIpHttpProxySuffix is not None:
+                # Try to get the local IP of this device and try to use the same ports with it.
+                # These URLs are built when they are first used, so we don't try to get the local IP on every call.
+                # With the local IP, first try to use the http proxy URL, since it's the most likely to be bound to the public IP and not firewalled.
+                # It's important we use the right http proxy protocol with the http proxy port.
+                routes.append(HttpRoute("Local IP Http Proxy Fallback", True, lambda: httpProxyProtocol + LocalIpHelper.TryToGetLocalIpOfConnectionTarget() + fallbackLocalIpHttpProxySuffix)) #pyright: ignore[reportOperatorIssue]
+                if fallbackLocalIpDirectServicePortSuffix is not None:
+                    # Now try the OcotoPrint direct port with the local IP.
+                    routes.append(HttpRoute("Local IP fallback", True, lambda: "http://" + LocalIpHelper.TryToGetLocalIpOfConnectionTarget() + fallbackLocalIpDirectServicePortSuffix)) #pyright: ignore[reportOperatorIssue]
+                    # If all others fail, try the hardcoded webcam URL.
+                    # Note this has to be last, because there commonly isn't a fallbackWebcamUrl.
+                    if fallbackWebcamUrl is not None:
+                        routes.append(HttpRoute("Webcam hardcode fallback", True, lambda: fallbackWebcamUrl)) #pyright: ignore[reportArgumentType]
+
+        # The route selector remembers which route worked for this kind of path, so the next request can go right to it.
+        # If there are other routes to try, a route that can't connect fails fast, so the next one is tried sooner.
+        connectTimeoutSec = HttpRouteSelector.GetConnectTimeoutSec(len(routes))
+        def attempt(route:HttpRoute) -> Optional[HttpResult]:
+            response = OctoHttpRequest._MakeRequest(logger, route.Name, method, route.Url, headers, data, allowRedirects, timeoutSec, connectTimeoutSec)
+            if response is None:
+                return None
+            return HttpResult.BuildFromRequestLibResponse(response, route.Url, route.IsFallback)
+        routeKey = HttpRouteSelector.GetRouteKey(urlsplit(url).netloc, OctoHttpRequest.ParseOutPath(pathOrUrl) if pathOrUrlType == PathTypes.Absolute else pathOrUrl)
+        return HttpRouteSelector.Run(logger, routeKey, routes, attempt)
+
 
+    # Makes the http request for one url, returns the response or None if the request failed.
+    # If the connect timeout is set, it's only used to connect, the timeout is still used for the rest of the request.
+    @staticmethod
+    def _MakeRequest(logger:logging.Logger, attemptName:str, method:str, url:str, headers:Optional[Dict[str,str]], data:UploadTypesBufferOrNone, allowRedirects:bool=False, timeoutSec:Optional[float]=None, connectTimeoutSec:Optional[float]=None) -> Optional[requests.Response]:
         # Prepare the body, if there is one.
         scopedBodyContext:Optional[Union[UploadBodyReadContext, MultipartFormUploadBodyReadContext]] = None
-        requestBodyDataObject:Union[BufferedReaderBytesOrNone, MultipartFormUploadBodyReader] = None
+        requestBodyDataObject:Union[BufferedReaderBytesOrNone, MultipartFormUploadBodyReader, StreamingUploadBody] = None
         if data is not None:
             if isinstance(data, Buffer):
                 # If we were passed a buffer, use it directly. We don't own it, so we don't clean it up.
@@ -339,6 +342,12 @@ class OctoHttpRequest:
             elif isinstance(data, MultipartFormUploadBody):
                 scopedBodyContext = data.OpenForRequest()
                 requestBodyDataObject = scopedBodyContext.GetData()
+            elif isinstance(data, StreamingUploadBody):
+                # A streaming body can only be read once, so if a previous attempt read any of it, it can't be sent again.
+                if data.CanSend() is False:
+                    logger.info("%s skipped, the streaming upload body was already used by another attempt.", attemptName)
+                    return None
+                requestBodyDataObject = data
 
         # Now if we have a scope, enter it and do the work.
         response = None
@@ -351,6 +360,7 @@ class OctoHttpRequest:
                 # timeout note! This value also effects how long a body read can be. This can effect unknown body chunk stream reads can hang while waiting on a chunk.
                 # But whatever this timeout value is will be the max time a body read can take, and then the chunk will fail and the stream will close.
                 timeoutSec = 1800 if timeoutSec is None else timeoutSec
+                timeout:Union[float, Tuple[float, float]] = timeoutSec if connectTimeoutSec is None else (min(connectTimeoutSec, timeoutSec), timeoutSec)
 
                 # See the note about allowRedirects above MakeHttpCall.
                 #
@@ -365,7 +375,7 @@ class OctoHttpRequest:
                     url,
                     headers=headers,
                     data=requestBodyDataObject, #pyright: ignore[reportArgumentType]
-                    timeout=timeoutSec,
+                    timeout=timeout,
                     allow_redirects=allowRedirects, stream=True, verify=False)
             except Exception as e:
                 logger.debug("%s http URL threw an exception: %s", attemptName, e)
@@ -375,7 +385,8 @@ class OctoHttpRequest:
             # most of these systems don't need auth headers or anything.
             # Strangely this seems to only work on Linux, where as on Windows the request.request function will throw a 'An existing connection was forcibly closed by the remote host' error.
             # Thus for windows, if the response is ever null, try again. This isn't ideal, but most windows users are just doing dev anyways.
-            if (response is not None and response.status_code == 431) or (platform.system() == "Windows" and response is None):
+            canResendBody = not isinstance(data, StreamingUploadBody) or data.CanSend()
+            if canResendBody and ((response is not None and response.status_code == 431) or (platform.system() == "Windows" and response is None)):
                 if response is not None and response.status_code == 431:
                     logger.info(url + " http call returned 431, too many headers. Trying again with no headers.")
                 else:
@@ -396,32 +407,4 @@ class OctoHttpRequest:
             requestBodyDataObject = None
             if scopedBodyContext is not None:
                 scopedBodyContext.Close()
-
-        # Check if we got a valid response.
-        if response is not None and response.status_code != 404:
-            # We got a valid response, we are done.
-            # Return true and the result object, so it can be returned.
-            return OctoHttpRequest.AttemptResult(True, HttpResult.BuildFromRequestLibResponse(response, url, isFallback))
-
-        # Check if we have another fallback URL to try.
-        if nextFallbackUrl is not None:
-            # We have more fallbacks to try.
-            # Return false so we keep going, but also return this response if we had one. This lets
-            # use capture the main result object, so we can use it eventually if all fallbacks fail.
-            if response is None:
-                return OctoHttpRequest.AttemptResult(False, None)
-            return OctoHttpRequest.AttemptResult(False, HttpResult.BuildFromRequestLibResponse(response, url, isFallback))
-
-        # We don't have another fallback, so we need to end this.
-        if mainResult is not None:
-            # If we got something back from the main try, always return it (we should only get here on a 404)
-            logger.info(attemptName + " failed and we have no more fallbacks. Returning the main URL response.")
-            return OctoHttpRequest.AttemptResult(True, mainResult)
-        else:
-            if response is not None:
-                logger.debug("%s failed and we have no more fallbacks. We DON'T have a main response.", attemptName)
-                return OctoHttpRequest.AttemptResult(True, HttpResult.BuildFromRequestLibResponse(response, url, isFallback))
-
-            # Otherwise return the failure.
-            logger.debug("%s failed and we have no more fallbacks. We DON'T have a main response.", attemptName)
-            return OctoHttpRequest.AttemptResult(True, None)
+        return response
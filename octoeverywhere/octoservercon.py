@@ -12,6 +12,7 @@ from .repeattimer import RepeatTimer
 from .pingpong import PingPong
 from .interfaces import IOctoStream, IOctoEverywhereHost, IPopUpInvoker, IStateChangeHandler, IWebSocketClient, WebSocketOpCode
 from .hostcommon import HostCommon
+from .Proto.MessagePriority import MessagePriority
 
 #
 # This class is responsible for connecting and maintaining a connection to a server.
@@ -81,7 +82,7 @@ class OctoServerCon(IOctoStream):
         self.IsDisconnecting = False
         self.IsWsConnecting = False
         self.ActiveSessionId = 0
-        self.Ws:Optional[IWebSocketClient] = None
+        self.Ws:Optional[Client] = None
         self.WsConnectBackOffSec = self.WsConnectBackOffSec_Default
         self.NoWaitReconnect = False
 
@@ -415,12 +416,12 @@ class OctoServerCon(IOctoStream):
                     return
 
 
-    def SendMsg(self, buffer:Buffer, msgStartOffsetBytes:int, msgSize:int) -> None:
+    def SendMsg(self, buffer:Buffer, msgStartOffsetBytes:int, msgSize:int, streamId:int=0, priority:int=MessagePriority.Normal) -> None:
         # When we send any message, consider it user activity.
         self.LastUserActivityTimeSec = time.time()
         ws = self.Ws
         if ws is not None:
-            ws.Send(buffer, msgStartOffsetBytes, msgSize, True)
+            ws.Send(buffer, msgStartOffsetBytes, msgSize, True, streamId, priority)
 
 
     def GetWsId(self, ws:Optional[IWebSocketClient]) -> str:
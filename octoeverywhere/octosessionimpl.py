@@ -1,14 +1,18 @@
 import sys
 import threading
 import logging
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
 
 #
 # This file represents one connection session to the service. If anything fails it is destroyed and a new connection will be made.
 #
 
 from .WebStream.octowebstream import OctoWebStream
+from .WebStream.webstreamworkerpool import WebStreamWorkerPool
+from .WebStream.asyncwebstreamengine import AsyncWebStreamEngine, AsyncOctoWebStream
 from .octohttprequest import OctoHttpRequest
+from .httpsessions import HttpSessions
+from .tunnelperfstats import TunnelPerfStats
 from .localip import LocalIpHelper
 from .octostreammsgbuilder import OctoStreamMsgBuilder
 from .serverauth import ServerAuthHelper
@@ -16,11 +20,15 @@ from .sentry import Sentry
 from .ostypeidentifier import OsTypeIdentifier
 from .threaddebug import ThreadDebug
 from .compression import Compression
+from .compressionpassthrough import CompressionPassThrough
+from .negotiatedfeatures import NegotiatedFeatures
+from .zstandarddictionary import ZStandardDictionary
 from .deviceid import DeviceId
 from .interfaces import IPopUpInvoker, IOctoStream, IOctoSession
 from .buffer import Buffer, ByteLikeOrMemoryView
 
 from .Proto.OctoStreamMessage import OctoStreamMessage
+from .Proto.MessagePriority import MessagePriority
 from .Proto import HandshakeAck
 from .Proto import MessageContext
 from .Proto import WebStreamMsg
@@ -45,7 +53,7 @@ class OctoSession(IOctoSession):
                     isDockerContainer:bool,
                     conProperties:Optional[Dict[str, Any]] = None
                 ):
-        self.ActiveWebStreams:Dict[int,OctoWebStream] = {}
+        self.ActiveWebStreams:Dict[int,Union[OctoWebStream, AsyncOctoWebStream]] = {}
         self.ActiveWebStreamsLock = threading.Lock()
         self.IsAcceptingStreams = True
 
@@ -62,6 +70,9 @@ class OctoSession(IOctoSession):
         self.IsDockerContainer = isDockerContainer
         self.ConProperties = conProperties
 
+        # The features the server accepted in this session's handshake, nothing is used until the handshake is done.
+        self.NegotiatedFeatures = NegotiatedFeatures()
+
         # Create our server auth helper.
         self.ServerAuth = ServerAuthHelper(self.Logger)
 
@@ -71,9 +82,13 @@ class OctoSession(IOctoSession):
         self.OctoStream.OnSessionError(self.SessionId, backoffModifierSec)
 
 
-    def Send(self, buffer:Buffer, msgStartOffsetBytes:int, msgSize:int) -> None:
+    def Send(self, buffer:Buffer, msgStartOffsetBytes:int, msgSize:int, streamId:int=0, priority:int=MessagePriority.Normal) -> None:
         # The message is already encoded, pass it along to the socket.
-        self.OctoStream.SendMsg(buffer, msgStartOffsetBytes, msgSize)
+        self.OctoStream.SendMsg(buffer, msgStartOffsetBytes, msgSize, streamId, priority)
+
+
+    def GetNegotiatedFeatures(self) -> NegotiatedFeatures:
+        return self.NegotiatedFeatures
 
 
     def HandleSummonRequest(self, msg:OctoStreamMessage):
@@ -169,6 +184,13 @@ class OctoSession(IOctoSession):
             if octoKey is None:
                 raise Exception("Handshake ack is missing octokey.")
 
+            # Set the features the server accepted for this session. Older servers don't send any, which turns them off.
+            acceptedDictIds = ZStandardDictionary.Get().OnHandshakeAck([handshakeAck.ZStandardDictIds(i) for i in range(handshakeAck.ZStandardDictIdsLength())])
+            self.NegotiatedFeatures = NegotiatedFeatures(handshakeAck.FeatureFlags(), acceptedDictIds)
+
+            # Now that the tunnel is up, open warm connections to the local servers, so the first requests don't have to connect.
+            HttpSessions.Prewarm(OctoHttpRequest.GetLocalBackendUrls())
+
             # Handle it.
             self.OctoStream.OnHandshakeComplete(self.SessionId, octoKey, connectedAccounts)
         else:
@@ -213,7 +235,7 @@ class OctoSession(IOctoSession):
             raise Exception("We got a web stream message for an invalid stream id of 0")
 
         # Grab the lock before messing with the map.
-        localStream:Optional[OctoWebStream] = None
+        localStream:Optional[Union[OctoWebStream, AsyncOctoWebStream]] = None
         with self.ActiveWebStreamsLock:
             localStream = self.ActiveWebStreams.get(streamId, None)
             if localStream is None:
@@ -237,12 +259,25 @@ class OctoSession(IOctoSession):
                     self.Logger.info("OctoSession got a webstream open request after we stopped accepting streams. streamId:"+str(streamId))
                     return
 
-                # Create the new stream object now.
-                localStream = OctoWebStream(name="OctoWebStreamPumper", args=(self.Logger, streamId, self, ))
-                # Set it in the map
-                self.ActiveWebStreams[streamId] = localStream
-                # Start it's main worker thread
-                localStream.start()
+                # If the asyncio engine is selected, the stream runs on its event loop.
+                asyncEngine = AsyncWebStreamEngine.GetIfEnabled()
+                if asyncEngine is not None:
+                    localStream = asyncEngine.CreateWebStream(self.Logger, streamId, self)
+                    self.ActiveWebStreams[streamId] = localStream
+                else:
+                    # Create the new stream object now.
+                    threadedStream = OctoWebStream(name="OctoWebStreamPumper", args=(self.Logger, streamId, self, ))
+                    localStream = threadedStream
+                    # Set it in the map
+                    self.ActiveWebStreams[streamId] = threadedStream
+                    # If the worker pool is enabled, the stream will run on it as messages arrive. Otherwise, start it's main worker thread.
+                    # Websocket streams are open for as long as the socket is, so they would hold a worker the whole time. They always get their own thread.
+                    workerPool = WebStreamWorkerPool.GetIfEnabled()
+                    if workerPool is not None and webStreamMsg.IsWebsocketStream() is False:
+                        threadedStream.StartOnWorkerPool(workerPool)
+                    else:
+                        threadedStream.start()
+                TunnelPerfStats.OnStreamOpened()
 
         # If we get here, we know we must have a localStream
         localStream.OnIncomingServerMessage(webStreamMsg)
@@ -255,12 +290,14 @@ class OctoSession(IOctoSession):
             foundStream = self.ActiveWebStreams.pop(sessionId, None)
             if foundStream is None:
                 self.Logger.error("A web stream asked to close that wasn't in our webstream map.")
+            else:
+                TunnelPerfStats.OnStreamClosed()
 
 
     def CloseAllWebStreamsAndDisable(self):
         # The streams will remove them selves from the map when they close, so all we need to do is ask them
         # to close.
-        localWebStreamList:List[OctoWebStream] = []
+        localWebStreamList:List[Union[OctoWebStream, AsyncOctoWebStream]] = []
         with self.ActiveWebStreamsLock:
             # Close them all.
             self.Logger.info("Closing all open web stream sockets ("+str(len(self.ActiveWebStreams))+")")
@@ -307,10 +344,11 @@ class OctoSession(IOctoSession):
             # Build the message
             buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.BuildHandshakeSyn(self.PrinterId, self.PrivateKey, self.IsPrimarySession, self.PluginVersion,
                 OctoHttpRequest.GetLocalHttpProxyPort(), LocalIpHelper.TryToGetLocalIpOfConnectionTarget(),
-                rasChallenge, rasChallengeKeyVerInt, summonMethod, self.ServerHostType, OsTypeIdentifier.DetectOsType(), receiveCompressionType, deviceId, self.IsCompanion, self.IsDockerContainer, self.ConProperties)
+                rasChallenge, rasChallengeKeyVerInt, summonMethod, self.ServerHostType, OsTypeIdentifier.DetectOsType(), receiveCompressionType, deviceId, self.IsCompanion, self.IsDockerContainer, self.ConProperties,
+                CompressionPassThrough.GetSupportedFeatureFlags(), ZStandardDictionary.Get().GetSupportedDictIds(self.ServerHostType))
 
-            # Send!
-            self.OctoStream.SendMsg(buffer, msgStartOffsetBytes, msgSizeBytes)
+            # Send! The handshake is a control message, so it goes before any queued stream data.
+            self.OctoStream.SendMsg(buffer, msgStartOffsetBytes, msgSizeBytes, priority=MessagePriority.Critical)
         except Exception as e:
             Sentry.OnException("Failed to send handshake syn.", e)
             self.OnSessionError(0)
@@ -27,7 +27,9 @@ class OctoStreamMsgBuilder:
                             deviceId:Optional[str],
                             isCompanion:bool,
                             isDockerContainer:bool,
-                            conProperties:Optional[Dict[str, Any]] = None
+                            conProperties:Optional[Dict[str, Any]] = None,
+                            featureFlags:int = 0,
+                            zStandardDictIds:Optional[List[int]] = None
                         ) -> Tuple[Buffer, int, int]:
         # Get a buffer
         builder = OctoStreamMsgBuilder.CreateBuffer(500)
@@ -53,6 +55,14 @@ class OctoStreamMsgBuilder:
                 builder.PrependUOffsetTRelative(offset) #pyright: ignore[reportUnknownMemberType]
             propertyTableVectorOffset = builder.EndVector() #pyright: ignore[reportUnknownMemberType]
 
+        # Build the list of zstandard dict ids we can compress with, if there are any.
+        zStandardDictIdsOffset:Optional[int] = None
+        if zStandardDictIds is not None and len(zStandardDictIds) > 0:
+            HandshakeSyn.StartZStandardDictIdsVector(builder, len(zStandardDictIds))
+            for dictId in reversed(zStandardDictIds):
+                builder.PrependUint32(dictId) #pyright: ignore[reportUnknownMemberType]
+            zStandardDictIdsOffset = builder.EndVector() #pyright: ignore[reportUnknownMemberType]
+
         # Setup strings
         printerIdOffset = builder.CreateString(printerId) #pyright: ignore[reportUnknownMemberType]
         privateKeyOffset = builder.CreateString(privateKey) #pyright: ignore[reportUnknownMemberType]
@@ -88,6 +98,10 @@ class OctoStreamMsgBuilder:
             HandshakeSyn.AddDeviceId(builder, deviceIdOffset)
         if propertyTableVectorOffset is not None:
             HandshakeSyn.AddProperties(builder, propertyTableVectorOffset)
+        if featureFlags != 0:
+            HandshakeSyn.AddFeatureFlags(builder, featureFlags)
+        if zStandardDictIdsOffset is not None:
+            HandshakeSyn.AddZStandardDictIds(builder, zStandardDictIdsOffset)
         synOffset = HandshakeSyn.End(builder)
 
         # Create and return.
@@ -0,0 +1,196 @@
+import os
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+from .buffer import Buffer
+from .memorymanager import MemoryManager
+
+
+#
+# Counts how many times message data is copied on the way from the body read to the websocket.
+# This lets us measure how well the zero-copy send path is working.
+#
+# A copy is any time the body data is copied into another buffer in user space, like into the flatbuffer data vector or into a new websocket frame.
+# A zero-copy is when the body was read directly into the message buffer that's sent on the websocket.
+#
+class SendCopyStats:
+
+    _Lock = threading.Lock()
+    _Copies = 0
+    _BytesCopied = 0
+    _ZeroCopies = 0
+    _BytesZeroCopied = 0
+
+
+    @staticmethod
+    def OnCopy(sizeBytes:int) -> None:
+        with SendCopyStats._Lock:
+            SendCopyStats._Copies += 1
+            SendCopyStats._BytesCopied += sizeBytes
+
+
+    @staticmethod
+    def OnZeroCopy(sizeBytes:int) -> None:
+        with SendCopyStats._Lock:
+            SendCopyStats._ZeroCopies += 1
+            SendCopyStats._BytesZeroCopied += sizeBytes
+
+
+    @staticmethod
+    def GetStats() -> Dict[str, Any]:
+        with SendCopyStats._Lock:
+            return {
+                "Copies": SendCopyStats._Copies,
+                "BytesCopied": SendCopyStats._BytesCopied,
+                "ZeroCopies": SendCopyStats._ZeroCopies,
+                "BytesZeroCopied": SendCopyStats._BytesZeroCopied,
+            }
+
+
+    @staticmethod
+    def Reset() -> None:
+        with SendCopyStats._Lock:
+            SendCopyStats._Copies = 0
+            SendCopyStats._BytesCopied = 0
+            SendCopyStats._ZeroCopies = 0
+            SendCopyStats._BytesZeroCopied = 0
+
+
+#
+# A size class buffer pool for the large, short lived buffers on the relay hot paths, like the message buffers body reads are read into.
+#
+# Allocating a new multi MB bytearray for every message causes heap fragmentation on low memory devices, and the RSS only grows.
+# Instead, buffers are rented from the pool and returned when the owner is done with them.
+#
+# Rented buffers are rounded up to a size class, so buffers of similar sizes can be reused. There are four classes for every power of two,
+# so a buffer is never more than 25% larger than what was asked for. Requests smaller than the min class use the min class, and requests
+# larger than the max class aren't pooled at all.
+#
+# The total size of the idle buffers is capped by MemoryManager.SendBufferPool_MaxPooledBytes, if a returned buffer would go over the cap it's just freed.
+#
+# IMPORTANT - A buffer must only be returned once nothing is using it any longer. Buffers that are never returned are just freed by the GC,
+# but they will show in the outstanding stats, so leaks are visible.
+#
+class SendBufferPool:
+
+    # Buffers smaller than this are cheap to allocate, so callers shouldn't bother using the pool for them.
+    c_MinClassSizeBytes = 64 * 1024
+
+    # Buffers larger than this are not pooled.
+    c_MaxClassSizeBytes = 8 * 1024 * 1024
+
+    # If enabled, the hot paths will rent their buffers from the pool.
+    # This is on by default, it can be turned off with the setter or the OCTO_BUFFER_POOL=0 env var.
+    Enabled = os.environ.get("OCTO_BUFFER_POOL", "1") == "1"
+
+    _Instance:Optional["SendBufferPool"] = None
+
+
+    @staticmethod
+    def Init(logger:logging.Logger) -> None:
+        SendBufferPool._Instance = SendBufferPool(logger)
+
+
+    @staticmethod
+    def Get() -> Optional["SendBufferPool"]:
+        return SendBufferPool._Instance
+
+
+    @staticmethod
+    def SetEnabled(enabled:bool) -> None:
+        SendBufferPool.Enabled = enabled
+
+
+    # Returns the pool if it's enabled and has been setup, otherwise None.
+    @staticmethod
+    def GetIfEnabled() -> Optional["SendBufferPool"]:
+        if SendBufferPool.Enabled is False:
+            return None
+        return SendBufferPool._Instance
+
+
+    # Returns the size class a buffer of this size will be rounded up to.
+    @staticmethod
+    def GetClassSizeBytes(sizeBytes:int) -> int:
+        if sizeBytes <= SendBufferPool.c_MinClassSizeBytes:
+            return SendBufferPool.c_MinClassSizeBytes
+        # Find the power of two that's equal to or larger than the size, then round up to the next quarter step between it and the one below it.
+        powerOfTwo = 1 << (sizeBytes - 1).bit_length()
+        step = powerOfTwo // 8
+        return ((sizeBytes + step - 1) // step) * step
+
+
+    def __init__(self, logger:logging.Logger, maxPooledBytes:Optional[int]=None) -> None:
+        self.Logger = logger
+        self.MaxPooledBytes = maxPooledBytes if maxPooledBytes is not None else MemoryManager.SendBufferPool_MaxPooledBytes
+        self.Lock = threading.Lock()
+        # The idle buffers, by their class size.
+        self.FreeBuffers:Dict[int, List[bytearray]] = {}
+        self.PooledBytes = 0
+        self.Hits = 0
+        self.Misses = 0
+        self.Unpooled = 0
+        self.Returns = 0
+        self.Dropped = 0
+        self.Outstanding = 0
+        self.OutstandingBytes = 0
+
+
+    # Returns a bytearray backed buffer that's at least this size. The contents of the buffer are not cleared.
+    def Rent(self, minSizeBytes:int) -> Buffer:
+        classSizeBytes = SendBufferPool.GetClassSizeBytes(minSizeBytes)
+        with self.Lock:
+            if classSizeBytes > SendBufferPool.c_MaxClassSizeBytes:
+                # Too big to pool, so just allocate what was asked for.
+                self.Unpooled += 1
+                classSizeBytes = minSizeBytes
+            else:
+                freeList = self.FreeBuffers.get(classSizeBytes, None)
+                if freeList is not None and len(freeList) > 0:
+                    self.Hits += 1
+                    self.PooledBytes -= classSizeBytes
+                    self.Outstanding += 1
+                    self.OutstandingBytes += classSizeBytes
+                    return Buffer(freeList.pop())
+                self.Misses += 1
+            self.Outstanding += 1
+            self.OutstandingBytes += classSizeBytes
+        return Buffer(bytearray(classSizeBytes))
+
+
+    # Gives a rented buffer back to the pool. This must only be called once nothing is using the buffer any longer.
+    # The buffer object is released, so it can't be used after this.
+    def Return(self, buffer:Buffer) -> None:
+        data = buffer.Get()
+        sizeBytes = len(data)
+        buffer.Release()
+        with self.Lock:
+            self.Returns += 1
+            self.Outstanding -= 1
+            self.OutstandingBytes -= sizeBytes
+            # Only full bytearray buffers of a class size can be reused. If the pool is full, just let the buffer be freed.
+            if not isinstance(data, bytearray) or sizeBytes > SendBufferPool.c_MaxClassSizeBytes or SendBufferPool.GetClassSizeBytes(sizeBytes) != sizeBytes or self.PooledBytes + sizeBytes > self.MaxPooledBytes:
+                self.Dropped += 1
+                return
+            self.PooledBytes += sizeBytes
+            freeList = self.FreeBuffers.get(sizeBytes, None)
+            if freeList is None:
+                freeList = []
+                self.FreeBuffers[sizeBytes] = freeList
+            freeList.append(data)
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        with self.Lock:
+            return {
+                "PooledBuffers": sum(len(freeList) for freeList in self.FreeBuffers.values()),
+                "PooledBytes": self.PooledBytes,
+                "Hits": self.Hits,
+                "Misses": self.Misses,
+                "Unpooled": self.Unpooled,
+                "Returns": self.Returns,
+                "Dropped": self.Dropped,
+                "Outstanding": self.Outstanding,
+                "OutstandingBytes": self.OutstandingBytes,
+            }
@@ -0,0 +1,266 @@
+import time
+import weakref
+import threading
+import collections
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from .latencyhistogram import LatencyHistogram
+from .Proto.MessagePriority import MessagePriority
+
+
+# A single flow of messages, which is all of the messages of one stream in one priority class.
+class _SendFlow:
+
+    def __init__(self, key:Tuple[int, int], quantumBytes:int) -> None:
+        self.Key = key
+        self.QuantumBytes = quantumBytes
+        # Each entry is the item, the size, and the time it was queued.
+        self.Queue:Deque[Tuple[Any, int, float]] = collections.deque()
+        self.QueuedBytes = 0
+        self.DeficitBytes = 0
+        self.HasTurn = False
+
+
+#
+# The send scheduler for the websocket send queue.
+#
+# Before this, the send queue was a single FIFO, so a multi megabyte download or timelapse transfer that was queued would delay every small
+# message behind it, like json-rpc responses and webcam frames, which made the UI freeze during big transfers.
+#
+# Messages are queued in flows keyed by their stream id and priority class, and the flows are served with deficit round robin.
+# Each time a flow gets a turn it can send up to its quantum of bytes, and the quantum is weighted by the priority class, so
+# a big transfer only gets its share of the socket and the small messages of other streams are sent in between its messages.
+# Critical messages, like the session control messages, aren't part of the round robin, they are always sent first.
+#
+# A message is always sent whole, the websocket can't interleave other messages in a fragmented message. The large bodies are already
+# split into many messages (each a complete flatbuffer) by the stream helpers, so those message boundaries are where other traffic gets in.
+#
+class SendScheduler:
+
+    # The priority classes, in order.
+    c_ClassCritical = 0
+    c_ClassHigh = 1
+    c_ClassNormal = 2
+    c_ClassLow = 3
+    c_ClassNames = ["Critical", "High", "Normal", "Low"]
+
+    # The round robin weight of each class. Critical isn't weighted, since it's always sent first.
+    c_ClassWeights = [0, 4, 2, 1]
+
+    # The number of bytes a weight of 1 can send per turn.
+    c_QuantumBytes = 64 * 1024
+
+    # Sends smaller than this usually just fill the socket buffer, so how long they take doesn't say how fast the connection is.
+    c_MinSendRateSampleBytes = 64 * 1024
+
+    # The amount of sent data the send rate is measured over.
+    c_SendRateWindowBytes = 4 * 1024 * 1024
+
+    # The measured send rate of all websockets, which the compression policy uses to know how much cpu compression can spend.
+    _SendRateLock = threading.Lock()
+    _SendRateWindowBytes = 0
+    _SendRateWindowSec = 0.0
+    _SendMBps:Optional[float] = None
+
+    # The queueing delay of all schedulers, by class. The stats of each scheduler are also kept.
+    _AllQueueDelay = [LatencyHistogram() for _ in c_ClassNames]
+
+    # All of the live schedulers, so the stats can report the total queue depth.
+    _AllSchedulers:"weakref.WeakSet[SendScheduler]" = weakref.WeakSet()
+    _AllSchedulersLock = threading.Lock()
+
+
+    # Maps the message priority of a stream to the class it's scheduled in.
+    @staticmethod
+    def GetPriorityClass(priority:int) -> int:
+        if priority <= MessagePriority.Critical:
+            return SendScheduler.c_ClassCritical
+        if priority <= MessagePriority.High:
+            return SendScheduler.c_ClassHigh
+        if priority <= MessagePriority.Normal:
+            return SendScheduler.c_ClassNormal
+        return SendScheduler.c_ClassLow
+
+
+    # Called by the websocket send thread when a message has been written to the socket, with how long the write took.
+    @staticmethod
+    def OnSendComplete(sizeBytes:int, durationSec:float) -> None:
+        if sizeBytes < SendScheduler.c_MinSendRateSampleBytes:
+            return
+        with SendScheduler._SendRateLock:
+            SendScheduler._SendRateWindowBytes += sizeBytes
+            SendScheduler._SendRateWindowSec += durationSec
+            if SendScheduler._SendRateWindowBytes < SendScheduler.c_SendRateWindowBytes:
+                return
+            mbps = (SendScheduler._SendRateWindowBytes / (1024 * 1024)) / max(SendScheduler._SendRateWindowSec, 0.000001)
+            SendScheduler._SendRateWindowBytes = 0
+            SendScheduler._SendRateWindowSec = 0.0
+            # Blend with the last window, so one fast or slow burst doesn't swing it.
+            SendScheduler._SendMBps = mbps if SendScheduler._SendMBps is None else (SendScheduler._SendMBps + mbps) / 2.0
+
+
+    # Returns the measured send rate in MB/s, or None if not enough has been sent to measure it yet.
+    @staticmethod
+    def GetSendMBps() -> Optional[float]:
+        with SendScheduler._SendRateLock:
+            return SendScheduler._SendMBps
+
+
+    # Returns the total bytes all of the schedulers have handed to the websocket to send.
+    @staticmethod
+    def GetTotalSentBytes() -> int:
+        with SendScheduler._AllSchedulersLock:
+            schedulers = list(SendScheduler._AllSchedulers)
+        return sum(sum(scheduler.SentBytes) for scheduler in schedulers)
+
+
+    # Returns the total bytes queued in all of the schedulers.
+    @staticmethod
+    def GetTotalQueuedBytes() -> int:
+        with SendScheduler._AllSchedulersLock:
+            schedulers = list(SendScheduler._AllSchedulers)
+        return sum(scheduler.QueuedBytes for scheduler in schedulers)
+
+
+    # Returns the queue depth and the queueing delay of all schedulers by class.
+    @staticmethod
+    def GetStats() -> Dict[str, Any]:
+        with SendScheduler._AllSchedulersLock:
+            schedulers = list(SendScheduler._AllSchedulers)
+        queuedBytes = 0
+        queuedCount = 0
+        for scheduler in schedulers:
+            with scheduler.Condition:
+                queuedBytes += scheduler.QueuedBytes
+                queuedCount += scheduler.QueuedCount
+        sendMBps = SendScheduler.GetSendMBps()
+        return {
+            "QueuedBytes": queuedBytes,
+            "QueuedMessages": queuedCount,
+            "SendMBps": None if sendMBps is None else round(sendMBps, 3),
+            "QueueDelay": {name: SendScheduler._AllQueueDelay[i].GetStats() for i, name in enumerate(SendScheduler.c_ClassNames)},
+        }
+
+
+    def __init__(self) -> None:
+        self.Condition = threading.Condition()
+        self.Flows:Dict[Tuple[int, int], _SendFlow] = {}
+        # The flows that have messages queued, in round robin order. Critical flows are kept separately.
+        self.ActiveFlows:Deque[_SendFlow] = collections.deque()
+        self.CriticalFlows:Deque[_SendFlow] = collections.deque()
+        self.QueuedBytes = 0
+        self.QueuedCount = 0
+        self.IsClosed = False
+
+        # Stats
+        self.QueueDelay = [LatencyHistogram() for _ in SendScheduler.c_ClassNames]
+        self.SentBytes = [0] * len(SendScheduler.c_ClassNames)
+
+        with SendScheduler._AllSchedulersLock:
+            SendScheduler._AllSchedulers.add(self)
+
+
+    # Queues an item to send. Returns false if the scheduler is closed, in which case the item wasn't queued.
+    def Put(self, item:Any, sizeBytes:int, streamId:int=0, priority:int=MessagePriority.Normal) -> bool:
+        priorityClass = SendScheduler.GetPriorityClass(priority)
+        key = (streamId, priorityClass)
+        with self.Condition:
+            if self.IsClosed:
+                return False
+            flow = self.Flows.get(key, None)
+            if flow is None:
+                flow = _SendFlow(key, SendScheduler.c_QuantumBytes * max(1, SendScheduler.c_ClassWeights[priorityClass]))
+                self.Flows[key] = flow
+                if priorityClass == SendScheduler.c_ClassCritical:
+                    self.CriticalFlows.append(flow)
+                else:
+                    self.ActiveFlows.append(flow)
+            flow.Queue.append((item, sizeBytes, time.time()))
+            flow.QueuedBytes += sizeBytes
+            self.QueuedBytes += sizeBytes
+            self.QueuedCount += 1
+            self.Condition.notify()
+        return True
+
+
+    # Returns the next item to send, or None if the timeout expires or the scheduler is closed.
+    def Get(self, timeoutSec:Optional[float]=None) -> Optional[Any]:
+        with self.Condition:
+            if self.QueuedCount == 0 and self.IsClosed is False:
+                self.Condition.wait(timeoutSec)
+            if self.QueuedCount == 0 or self.IsClosed:
+                return None
+            flow = self._NextFlowLocked()
+            item, sizeBytes, queuedTimeSec = flow.Queue.popleft()
+            flow.QueuedBytes -= sizeBytes
+            flow.DeficitBytes -= sizeBytes
+            self.QueuedBytes -= sizeBytes
+            self.QueuedCount -= 1
+            if len(flow.Queue) == 0:
+                self._RemoveFlowLocked(flow)
+        priorityClass = flow.Key[1]
+        delaySec = time.time() - queuedTimeSec
+        self.QueueDelay[priorityClass].Add(delaySec)
+        SendScheduler._AllQueueDelay[priorityClass].Add(delaySec)
+        self.SentBytes[priorityClass] += sizeBytes
+        return item
+
+
+    # Returns the number of bytes queued for a stream in the class of the given priority.
+    def GetFlowQueuedBytes(self, streamId:int, priority:int) -> int:
+        with self.Condition:
+            flow = self.Flows.get((streamId, SendScheduler.GetPriorityClass(priority)), None)
+            return 0 if flow is None else flow.QueuedBytes
+
+
+    # Closes the scheduler and returns all of the items that were still queued, so they can be released.
+    def Close(self) -> List[Any]:
+        with self.Condition:
+            self.IsClosed = True
+            items:List[Any] = []
+            for flow in self.Flows.values():
+                items.extend(entry[0] for entry in flow.Queue)
+            self.Flows.clear()
+            self.ActiveFlows.clear()
+            self.CriticalFlows.clear()
+            self.QueuedBytes = 0
+            self.QueuedCount = 0
+            self.Condition.notify_all()
+            return items
+
+
+    def GetSchedulerStats(self) -> Dict[str, Any]:
+        with self.Condition:
+            queuedBytes = self.QueuedBytes
+            flows = len(self.Flows)
+        return {
+            "QueuedBytes": queuedBytes,
+            "Flows": flows,
+            "QueueDelay": {name: self.QueueDelay[i].GetStats() for i, name in enumerate(SendScheduler.c_ClassNames)},
+            "SentBytes": {name: self.SentBytes[i] for i, name in enumerate(SendScheduler.c_ClassNames)},
+        }
+
+
+    def _NextFlowLocked(self) -> _SendFlow:
+        if len(self.CriticalFlows) > 0:
+            return self.CriticalFlows[0]
+        # Deficit round robin. When a flow gets a turn it adds its quantum, and it keeps the turn while it has enough deficit for its next message.
+        # A message larger than the quantum is sent once the flow has built up enough deficit over a few turns.
+        while True:
+            flow = self.ActiveFlows[0]
+            if flow.HasTurn is False:
+                flow.HasTurn = True
+                flow.DeficitBytes += flow.QuantumBytes
+            if flow.Queue[0][1] <= flow.DeficitBytes:
+                return flow
+            flow.HasTurn = False
+            self.ActiveFlows.rotate(-1)
+
+
+    def _RemoveFlowLocked(self, flow:_SendFlow) -> None:
+        del self.Flows[flow.Key]
+        if flow.Key[1] == SendScheduler.c_ClassCritical:
+            self.CriticalFlows.remove(flow)
+        else:
+            # The flow with the turn is always the first one.
+            self.ActiveFlows.popleft()
@@ -0,0 +1,412 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from .buffer import Buffer
+from .sentry import Sentry
+from .httpresult import HttpResult, HttpResultOrNone
+from .memorymanager import MemoryManager
+from .compression import Compression, CompressionContext
+from .zstandarddictionary import ZStandardDictionary
+from .Proto.DataCompression import DataCompression
+
+
+# One cached body and everything needed to rebuild its HttpResult.
+class _SlipstreamCacheEntry:
+    def __init__(self, url:str, fileName:str, statusCode:int, headers:Dict[str, str], compressionType:int, preCompressSizeBytes:int, sizeBytes:int, bodyHash:str) -> None:
+        self.Url = url
+        self.FileName = fileName
+        self.StatusCode = statusCode
+        self.Headers = headers
+        self.CompressionType = compressionType
+        self.PreCompressSizeBytes = preCompressSizeBytes
+        self.SizeBytes = sizeBytes
+        self.BodyHash = bodyHash
+        # The result is only loaded into memory once it's used, so after a restart the bodies stay on disk until they are requested.
+        self.Result:HttpResultOrNone = None
+
+
+    def ToDict(self) -> Dict[str, Any]:
+        return {
+            "Url": self.Url,
+            "FileName": self.FileName,
+            "StatusCode": self.StatusCode,
+            "Headers": self.Headers,
+            "CompressionType": self.CompressionType,
+            "PreCompressSizeBytes": self.PreCompressSizeBytes,
+            "SizeBytes": self.SizeBytes,
+            "BodyHash": self.BodyHash,
+        }
+
+
+    @staticmethod
+    def FromDict(d:Dict[str, Any]) -> "_SlipstreamCacheEntry":
+        return _SlipstreamCacheEntry(d["Url"], d["FileName"], int(d["StatusCode"]), dict(d["Headers"]), int(d["CompressionType"]), int(d["PreCompressSizeBytes"]), int(d["SizeBytes"]), d["BodyHash"])
+
+
+#
+# The storage for the Slipstream caches.
+#
+# Slipstream pre-compresses the bodies it caches, and the cached files rarely change between restarts. But the cache used to only live in memory,
+# so after every restart it had to be rebuilt from scratch, which on server boot can take 25-30s for the index alone.
+#
+# This keeps the cached bodies in memory and on disk in the plugin data folder, already compressed with the precompress level.
+# On startup the index of the disk cache is loaded, so the cache can be served right away, while Slipstream refreshes it in the background.
+# The refresh sends the ETag and Last-Modified validators it has, so if the file hasn't changed we keep the body we have. If the server
+# doesn't support validators, the body hash is used, so at least the expensive compression isn't done again.
+#
+# The total size of the bodies is capped by MemoryManager.Slipstream_MaxCacheBytes. Once it's full, the least recently used bodies are evicted.
+#
+class SlipstreamCache:
+
+    c_FolderName = "slipstream-cache"
+    c_IndexFileName = "index.json"
+
+    # Bump this if the format of the files changes, so old caches are dropped.
+    # Version 2 only keeps the cacheable headers, older indexes could have per request headers like Set-Cookie.
+    c_FormatVersion = 2
+
+    # The header names of the validators we store.
+    c_ETagHeaderLower = "etag"
+    c_LastModifiedHeaderLower = "last-modified"
+
+    # The only headers that are kept with a cached body, everything else is dropped.
+    # Headers like Set-Cookie must never be replayed to other users, and headers like Date and Expires change on every response,
+    # so they would make every refresh look like a change and rewrite the index.
+    c_CacheableHeadersLower = frozenset((
+        "content-type",
+        "content-length",
+        "content-language",
+        "cache-control",
+        "etag",
+        "last-modified",
+        "vary",
+        "x-oe-slipstream-plugin",
+    ))
+
+
+    def __init__(self, logger:logging.Logger, localStorageDir:Optional[str], maxTotalBytes:Optional[int]=None) -> None:
+        self.Logger = logger
+        self.MaxTotalBytes = maxTotalBytes if maxTotalBytes is not None else MemoryManager.Slipstream_MaxCacheBytes
+        self.Lock = threading.Lock()
+        # The entries in least recently used order, the first item is the next to be evicted.
+        self.Entries:"OrderedDict[str, _SlipstreamCacheEntry]" = OrderedDict()
+        self.TotalBytes = 0
+        self.Hits = 0
+        self.DiskLoads = 0
+        self.Misses = 0
+        self.Evictions = 0
+        self.NotModifiedRefreshes = 0
+        self.HashMatchRefreshes = 0
+
+        # If there's no storage dir, this is just an in memory cache.
+        self.FolderPath:Optional[str] = None
+        if localStorageDir is not None:
+            self.FolderPath = os.path.join(localStorageDir, SlipstreamCache.c_FolderName)
+            self._LoadIndex()
+
+
+    # Returns a replay copy of the cached result, or None if there's no cached result for the url.
+    def Get(self, url:str) -> HttpResultOrNone:
+        with self.Lock:
+            entry = self.Entries.get(url, None)
+            if entry is None:
+                self.Misses += 1
+                return None
+            self.Entries.move_to_end(url)
+            if entry.Result is None:
+                # Load it from disk. The bodies are small and this only happens once per entry, so we just do it under the lock.
+                entry.Result = self._LoadResultFromDisk(entry)
+                if entry.Result is None:
+                    self._RemoveLocked(url)
+                    self.Misses += 1
+                    return None
+                self.DiskLoads += 1
+            self.Hits += 1
+            # The http system will free the result when it's done, so we must return a copy.
+            return entry.Result.CreateReplayCopy()
+
+
+    # Returns all of the urls in the cache.
+    def GetUrls(self) -> List[str]:
+        with self.Lock:
+            return list(self.Entries.keys())
+
+
+    # Returns the conditional request headers for the cached url, so the server can tell us if it has changed.
+    def GetRevalidationHeaders(self, url:str) -> Dict[str, str]:
+        headers:Dict[str, str] = {}
+        with self.Lock:
+            entry = self.Entries.get(url, None)
+            if entry is None:
+                return headers
+            for name, value in entry.Headers.items():
+                nameLower = name.lower()
+                if nameLower == SlipstreamCache.c_ETagHeaderLower:
+                    headers["If-None-Match"] = value
+                elif nameLower == SlipstreamCache.c_LastModifiedHeaderLower:
+                    headers["If-Modified-Since"] = value
+        return headers
+
+
+    # Called when the server responded with a 304 for a revalidation, the cached body is still good.
+    # Returns True if the entry is still in the cache.
+    def OnNotModified(self, url:str) -> bool:
+        with self.Lock:
+            if url not in self.Entries:
+                return False
+            self.NotModifiedRefreshes += 1
+            return True
+
+
+    # Returns the hash used to tell if a body has changed.
+    @staticmethod
+    def GetBodyHash(body:Buffer) -> str:
+        return hashlib.sha256(body.Get()).hexdigest()
+
+
+    # Returns only the headers that can be kept with a cached body.
+    @staticmethod
+    def GetCacheableHeaders(headers:Mapping[str, str]) -> Dict[str, str]:
+        return {name: value for name, value in headers.items() if name.lower() in SlipstreamCache.c_CacheableHeadersLower}
+
+
+    # If the cached body for the url has the same hash, this updates the entry's headers and returns True.
+    # This allows the caller to skip compressing a body that we already have.
+    # The index is only written if one of the cacheable headers changed.
+    def TryRefreshIfBodyHashMatches(self, url:str, bodyHash:str, statusCode:int, headers:Dict[str, str]) -> bool:
+        headers = SlipstreamCache.GetCacheableHeaders(headers)
+        with self.Lock:
+            entry = self.Entries.get(url, None)
+            if entry is None or entry.BodyHash != bodyHash:
+                return False
+            self.HashMatchRefreshes += 1
+            if entry.Headers == headers and entry.StatusCode == statusCode:
+                return True
+            entry.Headers = headers
+            entry.StatusCode = statusCode
+            if entry.Result is not None:
+                entry.Result = self._BuildResult(entry, entry.Result.FullBodyBuffer)
+            self._SaveIndexLocked()
+            return True
+
+
+    # Stores a cache ready result, the full body buffer must be set and should already be compressed.
+    # If the cache is full, the least recently used entries are evicted. Returns False if the result can't be stored.
+    def Store(self, url:str, result:HttpResult, bodyHash:str) -> bool:
+        body = result.FullBodyBuffer
+        if body is None or len(body) == 0:
+            return False
+        sizeBytes = len(body)
+        if sizeBytes > self.MaxTotalBytes:
+            self.Logger.info("Slipstream cache refusing to store %s because it's %d bytes and the max is %d bytes.", url, sizeBytes, self.MaxTotalBytes)
+            return False
+
+        headers = SlipstreamCache.GetCacheableHeaders(result.Headers)
+        fileName = SlipstreamCache._GetFileName(url, bodyHash)
+        entry = _SlipstreamCacheEntry(url, fileName, result.StatusCode, headers, result.BodyBufferCompressionType, result.BodyBufferPreCompressSize, sizeBytes, bodyHash)
+        # Build the result from the kept headers, so what's served from memory matches what's served after a restart.
+        entry.Result = self._BuildResult(entry, body)
+
+        # If the body hasn't changed, the file on disk is already correct.
+        with self.Lock:
+            existing = self.Entries.get(url, None)
+            isSameBody = existing is not None and existing.FileName == fileName
+
+        # Write the body before the index references it. If it fails, the entry is still cached in memory.
+        isOnDisk = (isSameBody and self.FolderPath is not None) or self._WriteBody(fileName, body)
+
+        with self.Lock:
+            # If the body changed, the old body file isn't needed anymore.
+            self._RemoveLocked(url, deleteFile=isSameBody is False)
+            while self.TotalBytes + sizeBytes > self.MaxTotalBytes and len(self.Entries) > 0:
+                evictedUrl, evictedEntry = self.Entries.popitem(last=False)
+                self.Logger.debug("Slipstream cache evicted %s", evictedUrl)
+                self._OnRemovedLocked(evictedEntry)
+                self.Evictions += 1
+            self.Entries[url] = entry
+            self.TotalBytes += sizeBytes
+            if isOnDisk:
+                self._SaveIndexLocked()
+        return True
+
+
+    def Remove(self, url:str) -> None:
+        with self.Lock:
+            if self._RemoveLocked(url):
+                self._SaveIndexLocked()
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        with self.Lock:
+            return {
+                "Entries": len(self.Entries),
+                "TotalBytes": self.TotalBytes,
+                "MaxTotalBytes": self.MaxTotalBytes,
+                "InMemory": sum(1 for e in self.Entries.values() if e.Result is not None),
+                "Hits": self.Hits,
+                "DiskLoads": self.DiskLoads,
+                "Misses": self.Misses,
+                "Evictions": self.Evictions,
+                "NotModifiedRefreshes": self.NotModifiedRefreshes,
+                "HashMatchRefreshes": self.HashMatchRefreshes,
+            }
+
+
+    # Compresses the body of a cache ready result with the precompress level.
+    # Returns the compressed buffer, its compression type, and the original size.
+    @staticmethod
+    def Precompress(logger:logging.Logger, body:Buffer) -> Tuple[Buffer, int, int]:
+        compression = Compression.Get()
+        with CompressionContext(logger) as compressionContext:
+            # It's important to set the full compression size, because the compression system will use
+            # it to better optimize the compression and know that we will be sending the full data.
+            compressionContext.SetTotalCompressedSizeOfData(len(body))
+            compressionContext.SetCompressionPolicy(compression.Policies.GetPrecompressedPolicy())
+            compressResult = compression.Compress(compressionContext, body)
+        return (compressResult.Bytes, compressResult.CompressionType, len(body))
+
+
+    # Removes the entry, returns True if it was removed.
+    def _RemoveLocked(self, url:str, deleteFile:bool=True) -> bool:
+        entry = self.Entries.pop(url, None)
+        if entry is None:
+            return False
+        self._OnRemovedLocked(entry, deleteFile)
+        return True
+
+
+    def _OnRemovedLocked(self, entry:_SlipstreamCacheEntry, deleteFile:bool=True) -> None:
+        self.TotalBytes -= entry.SizeBytes
+        entry.Result = None
+        if deleteFile is False or self.FolderPath is None:
+            return
+        try:
+            filePath = os.path.join(self.FolderPath, entry.FileName)
+            if os.path.exists(filePath):
+                os.remove(filePath)
+        except Exception as e:
+            self.Logger.warning(f"Slipstream cache failed to delete {entry.FileName}. {e}")
+
+
+    def _BuildResult(self, entry:_SlipstreamCacheEntry, body:Optional[Buffer]) -> HttpResult:
+        result = HttpResult(entry.StatusCode, dict(entry.Headers), entry.Url, False)
+        if body is not None:
+            result.SetFullBodyBuffer(body, entry.CompressionType, entry.PreCompressSizeBytes)
+        return result
+
+
+    def _LoadResultFromDisk(self, entry:_SlipstreamCacheEntry) -> HttpResultOrNone:
+        if self.FolderPath is None:
+            return None
+        try:
+            with open(os.path.join(self.FolderPath, entry.FileName), "rb") as f:
+                body = f.read()
+            if len(body) != entry.SizeBytes:
+                self.Logger.warning(f"Slipstream cache file for {entry.Url} is {len(body)} bytes but it should be {entry.SizeBytes}, dropping it.")
+                return None
+            return self._BuildResult(entry, Buffer(body))
+        except Exception as e:
+            self.Logger.warning(f"Slipstream cache failed to load {entry.Url} from disk. {e}")
+        return None
+
+
+    def _WriteBody(self, fileName:str, body:Buffer) -> bool:
+        if self.FolderPath is None:
+            return False
+        try:
+            os.makedirs(self.FolderPath, exist_ok=True)
+            filePath = os.path.join(self.FolderPath, fileName)
+            # Write to a temp file and then move it, so a crash never leaves a partial body behind.
+            tempPath = filePath + ".tmp"
+            with open(tempPath, "wb") as f:
+                f.write(body.GetBytesLike())
+            os.replace(tempPath, filePath)
+            return True
+        except Exception as e:
+            self.Logger.warning(f"Slipstream cache failed to write {fileName} to disk. {e}")
+        return False
+
+
+    # Writes the index in the least recently used order, so the order is kept across restarts.
+    # Note that the order is only written when the cache changes, we don't write on every cache hit.
+    def _SaveIndexLocked(self) -> None:
+        if self.FolderPath is None:
+            return
+        try:
+            os.makedirs(self.FolderPath, exist_ok=True)
+            data = {
+                "FormatVersion": SlipstreamCache.c_FormatVersion,
+                "FormatId": SlipstreamCache._GetFormatId(),
+                "Updated": time.time(),
+                "Entries": [e.ToDict() for e in self.Entries.values()],
+            }
+            indexPath = os.path.join(self.FolderPath, SlipstreamCache.c_IndexFileName)
+            tempPath = indexPath + ".tmp"
+            with open(tempPath, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tempPath, indexPath)
+        except Exception as e:
+            self.Logger.warning(f"Slipstream cache failed to write the index. {e}")
+
+
+    def _LoadIndex(self) -> None:
+        if self.FolderPath is None:
+            return
+        indexPath = os.path.join(self.FolderPath, SlipstreamCache.c_IndexFileName)
+        try:
+            if os.path.exists(indexPath) is False:
+                return
+            with open(indexPath, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            # If the format or the compression dict changed, the bodies can't be used.
+            if data.get("FormatVersion", None) != SlipstreamCache.c_FormatVersion or data.get("FormatId", None) != SlipstreamCache._GetFormatId():
+                self.Logger.info("Slipstream cache format changed, dropping the disk cache.")
+                self._DeleteAllFiles()
+                return
+            with self.Lock:
+                for d in data.get("Entries", []):
+                    entry = _SlipstreamCacheEntry.FromDict(d)
+                    if os.path.exists(os.path.join(self.FolderPath, entry.FileName)) is False:
+                        continue
+                    if self.TotalBytes + entry.SizeBytes > self.MaxTotalBytes:
+                        continue
+                    self.Entries[entry.Url] = entry
+                    self.TotalBytes += entry.SizeBytes
+            self.Logger.info("Slipstream cache loaded %d entries, %d bytes from disk.", len(self.Entries), self.TotalBytes)
+        except Exception as e:
+            Sentry.OnException("Slipstream cache failed to load the disk index.", e)
+            self._DeleteAllFiles()
+
+
+    def _DeleteAllFiles(self) -> None:
+        if self.FolderPath is None:
+            return
+        try:
+            for name in os.listdir(self.FolderPath):
+                filePath = os.path.join(self.FolderPath, name)
+                if os.path.isfile(filePath):
+                    os.remove(filePath)
+        except Exception as e:
+            self.Logger.warning(f"Slipstream cache failed to clear the disk cache. {e}")
+
+
+    # The bodies are compressed with the zstandard dict, so if that changes they can't be used.
+    @staticmethod
+    def _GetFormatId() -> str:
+        compression = Compression.Get()
+        if compression is None or compression.CanUseZStandardLib is False:
+            return str(DataCompression.Zlib)
+        preTrainedDict = ZStandardDictionary.Get().PreTrainedDict
+        return f"{DataCompression.ZStandard}-{preTrainedDict.dict_id() if preTrainedDict is not None else 0}"
+
+
+    # The file is keyed by the url and the body hash, so a changed body never reuses the old file.
+    @staticmethod
+    def _GetFileName(url:str, bodyHash:str) -> str:
+        return hashlib.sha256((url + "|" + bodyHash).encode("utf-8")).hexdigest()[:40] + ".bin"
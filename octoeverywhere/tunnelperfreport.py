@@ -0,0 +1,52 @@
+import threading
+from typing import Any, Dict
+
+from .sentry import Sentry
+from .sendbufferpool import SendBufferPool, SendCopyStats
+from .compression import Compression
+from .compressibility import Compressibility
+from .compressionscheduler import CompressionScheduler
+from .httpsessions import HttpSessions
+from .sendscheduler import SendScheduler
+from .httprouteselector import HttpRouteSelector
+from .httpstreamaccumulationreader import HttpStreamAccumulationReader
+from .tunnelperfstats import TunnelPerfStats
+from .WebStream.webstreamworkerpool import WebStreamWorkerPool
+from .WebStream.asyncwebstreamengine import AsyncWebStreamEngine
+from .Webcam.quickcam import QuickCamManager
+from .Webcam.snapshotservice import SnapshotService
+
+
+# Builds the full tunnel perf report, which is served by the local web api and the OctoPrint plugin api.
+# This is kept apart from TunnelPerfStats, since it reads the counters of the web stream modules, and they record into TunnelPerfStats.
+class TunnelPerfReport:
+
+    # Returns the TunnelPerfStats stats plus the counters of the other tunnel parts.
+    # Each part is added on its own, so one failing doesn't break the report.
+    @staticmethod
+    def GetReport() -> Dict[str, Any]:
+        report = TunnelPerfStats.GetStats()
+        report["UptimeSec"] = TunnelPerfStats.GetUptimeSec()
+        report["Threads"] = threading.active_count()
+        sources = {
+            "SendQueue": SendScheduler.GetStats,
+            "HttpSessions": HttpSessions.GetStats,
+            "HttpRoutes": HttpRouteSelector.GetStats,
+            "AccumulationReader": HttpStreamAccumulationReader.GetStats,
+            "SendCopies": SendCopyStats.GetStats,
+            "SendBufferPool": lambda: None if SendBufferPool.Get() is None else SendBufferPool.Get().GetStats(), #pyright: ignore[reportOptionalMemberAccess]
+            "Compression": lambda: None if Compression.Get() is None else Compression.Get().GetPolicyStats(),
+            "Compressibility": Compressibility.GetStats,
+            "CompressionScheduler": lambda: None if CompressionScheduler.Get() is None else CompressionScheduler.Get().GetStats(),
+            "WorkerPool": lambda: None if WebStreamWorkerPool.GetIfEnabled() is None else WebStreamWorkerPool.GetIfEnabled().GetStats(), #pyright: ignore[reportOptionalMemberAccess]
+            "AsyncEngine": lambda: None if AsyncWebStreamEngine.GetIfEnabled() is None else AsyncWebStreamEngine.GetIfEnabled().GetStats(), #pyright: ignore[reportOptionalMemberAccess]
+            "QuickCam": lambda: None if QuickCamManager.Get() is None else QuickCamManager.Get().GetStats(),
+            "Snapshots": lambda: None if SnapshotService.Get() is None else SnapshotService.Get().GetStats(),
+        }
+        for name, getStats in sources.items():
+            try:
+                report[name] = getStats()
+            except Exception as e:
+                Sentry.OnException(f"TunnelPerfReport failed to get the {name} stats.", e)
+                report[name] = None
+        return report
@@ -0,0 +1,225 @@
+import os
+import time
+import ipaddress
+import threading
+from urllib.parse import urlsplit
+from typing import Any, Dict, Optional, Set, Tuple
+
+from .latencyhistogram import LatencyHistogram
+
+
+# The histograms for one backend and content type.
+class _RequestHistograms:
+
+    def __init__(self) -> None:
+        self.HeaderLatency = LatencyHistogram()
+        self.BodyRead = LatencyHistogram()
+        self.Compression = LatencyHistogram()
+        self.SendWait = LatencyHistogram()
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        return {
+            "HeaderLatency": self.HeaderLatency.GetStats(),
+            "BodyRead": self.BodyRead.GetStats(),
+            "Compression": self.Compression.GetStats(),
+            "SendWait": self.SendWait.GetStats(),
+        }
+
+
+#
+# Always on perf counters for the tunnel, which can be scraped from the local web api or the OctoPrint plugin api.
+#
+# Before this, the only per request timing was a log line in the http helper that's only made when debug logging is on.
+# Now each http web stream adds its timings to fixed bucket histograms, split by the backend and the kind of content:
+#   HeaderLatency - From when the request was made until the local server returned the response headers.
+#   BodyRead      - The time spent reading the response body from the local server.
+#   Compression   - The time spent compressing the body.
+#   SendWait      - The time spent waiting to hand the messages to the websocket, which is how backed up the send queue was.
+#
+# Adding a sample is a few compares and a lock, so this is cheap enough to leave on. The backends and content types are
+# bucketed, so the number of histograms stays small no matter how many urls are requested.
+#
+# The web stream modules record into this class, so it must not import any of them. The full report, with the counters
+# of the other tunnel parts, is built by TunnelPerfReport.
+#
+class TunnelPerfStats:
+
+    # Allows the stats to be turned off, in which case nothing is recorded.
+    Enabled = os.environ.get("OCTO_TUNNEL_PERF_STATS", "1") == "1"
+
+    # Past this many backends, new backends are counted as other.
+    c_MaxBackends = 16
+    c_OtherBackend = "other"
+    # Used for responses that didn't come from a http server, like command and cached responses.
+    c_InternalBackend = "internal"
+
+    # The content type buckets, checked in order. The first that's found in the content type is used.
+    c_ContentClasses = [
+        ("multipart/x-mixed-replace", "mjpeg"),
+        ("text/event-stream", "event-stream"),
+        ("text/html", "html"),
+        ("javascript", "javascript"),
+        ("text/css", "css"),
+        ("json", "json"),
+        ("image/", "image"),
+        ("video/", "video"),
+        ("font", "font"),
+        ("text/", "text"),
+        ("application/octet-stream", "binary"),
+    ]
+    c_ContentClassNone = "none"
+    c_ContentClassOther = "other"
+
+    _Lock = threading.Lock()
+    _Requests:Dict[Tuple[str, str], _RequestHistograms] = {}
+    _Backends:Set[str] = set()
+    _ActiveStreams = 0
+    _PeakActiveStreams = 0
+    _TotalStreams = 0
+    _StartSec = time.time()
+
+
+    @staticmethod
+    def SetEnabled(enabled:bool) -> None:
+        TunnelPerfStats.Enabled = enabled
+
+
+    # Returns the bucket name for the content type.
+    @staticmethod
+    def GetContentClass(contentTypeLower:Optional[str]) -> str:
+        if contentTypeLower is None or len(contentTypeLower) == 0:
+            return TunnelPerfStats.c_ContentClassNone
+        for match, name in TunnelPerfStats.c_ContentClasses:
+            if contentTypeLower.find(match) != -1:
+                return name
+        return TunnelPerfStats.c_ContentClassOther
+
+
+    # Returns the backend name for a request url, which is the host and port.
+    # Only the host and port are used, so any user info in the url (like webcam credentials) never ends up in the report.
+    @staticmethod
+    def GetBackendName(url:Optional[str]) -> str:
+        if url is None or len(url) == 0:
+            return TunnelPerfStats.c_InternalBackend
+        try:
+            parts = urlsplit(url)
+            hostname = parts.hostname
+            port = parts.port
+        except ValueError:
+            return TunnelPerfStats.c_OtherBackend
+        if hostname is None or len(hostname) == 0:
+            return TunnelPerfStats.c_InternalBackend
+        if hostname.find(":") != -1:
+            hostname = f"[{hostname}]"
+        if port is None:
+            return hostname
+        return f"{hostname}:{port}"
+
+
+    # Returns true if the remote address of a caller is on this device.
+    # The perf report shows the backends and traffic of the plugin, so it's only served to callers on this device or authed callers.
+    @staticmethod
+    def IsLocalCaller(remoteAddress:Optional[str]) -> bool:
+        if remoteAddress is None or len(remoteAddress) == 0:
+            return False
+        try:
+            ip = ipaddress.ip_address(remoteAddress)
+        except ValueError:
+            return False
+        # An IPv4 address can be mapped into an IPv6 one, like ::ffff:127.0.0.1, when the server is bound to an IPv6 address.
+        if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+            return ip.ipv4_mapped.is_loopback
+        return ip.is_loopback
+
+
+    # Called when the response headers are back from the backend.
+    @staticmethod
+    def OnResponseHeaders(url:Optional[str], contentTypeLower:Optional[str], headerLatencySec:float) -> None:
+        if TunnelPerfStats.Enabled is False:
+            return
+        TunnelPerfStats._GetHistograms(url, contentTypeLower).HeaderLatency.Add(headerLatencySec)
+
+
+    # Called when the response is done. Times that weren't measured for the response are None.
+    @staticmethod
+    def OnResponseComplete(url:Optional[str], contentTypeLower:Optional[str], bodyReadSec:Optional[float], compressionSec:Optional[float], sendWaitSec:Optional[float]) -> None:
+        if TunnelPerfStats.Enabled is False:
+            return
+        histograms = TunnelPerfStats._GetHistograms(url, contentTypeLower)
+        if bodyReadSec is not None:
+            histograms.BodyRead.Add(bodyReadSec)
+        # Only count the compression time if the body was compressed.
+        if compressionSec is not None and compressionSec >= 0:
+            histograms.Compression.Add(compressionSec)
+        if sendWaitSec is not None:
+            histograms.SendWait.Add(sendWaitSec)
+
+
+    @staticmethod
+    def OnStreamOpened() -> None:
+        with TunnelPerfStats._Lock:
+            TunnelPerfStats._ActiveStreams += 1
+            TunnelPerfStats._TotalStreams += 1
+            if TunnelPerfStats._ActiveStreams > TunnelPerfStats._PeakActiveStreams:
+                TunnelPerfStats._PeakActiveStreams = TunnelPerfStats._ActiveStreams
+
+
+    @staticmethod
+    def OnStreamClosed() -> None:
+        with TunnelPerfStats._Lock:
+            TunnelPerfStats._ActiveStreams = max(0, TunnelPerfStats._ActiveStreams - 1)
+
+
+    # Returns the request histograms, by backend and then content type.
+    @staticmethod
+    def GetStats() -> Dict[str, Any]:
+        with TunnelPerfStats._Lock:
+            requests = list(TunnelPerfStats._Requests.items())
+            streams = {
+                "Active": TunnelPerfStats._ActiveStreams,
+                "Peak": TunnelPerfStats._PeakActiveStreams,
+                "Total": TunnelPerfStats._TotalStreams,
+            }
+        http:Dict[str, Dict[str, Any]] = {}
+        for (backend, contentClass), histograms in requests:
+            http.setdefault(backend, {})[contentClass] = histograms.GetStats()
+        return {
+            "Enabled": TunnelPerfStats.Enabled,
+            "Streams": streams,
+            "Http": http,
+        }
+
+
+    @staticmethod
+    def GetUptimeSec() -> int:
+        return int(time.time() - TunnelPerfStats._StartSec)
+
+
+    @staticmethod
+    def Reset() -> None:
+        with TunnelPerfStats._Lock:
+            TunnelPerfStats._Requests = {}
+            TunnelPerfStats._Backends = set()
+            TunnelPerfStats._PeakActiveStreams = TunnelPerfStats._ActiveStreams
+            TunnelPerfStats._TotalStreams = 0
+
+
+    @staticmethod
+    def _GetHistograms(url:Optional[str], contentTypeLower:Optional[str]) -> _RequestHistograms:
+        backend = TunnelPerfStats.GetBackendName(url)
+        key = (backend, TunnelPerfStats.GetContentClass(contentTypeLower))
+        with TunnelPerfStats._Lock:
+            histograms = TunnelPerfStats._Requests.get(key, None)
+            if histograms is not None:
+                return histograms
+            if backend not in TunnelPerfStats._Backends:
+                if len(TunnelPerfStats._Backends) >= TunnelPerfStats.c_MaxBackends:
+                    key = (TunnelPerfStats.c_OtherBackend, key[1])
+                else:
+                    TunnelPerfStats._Backends.add(backend)
+            histograms = TunnelPerfStats._Requests.get(key, None)
+            if histograms is None:
+                histograms = _RequestHistograms()
+                TunnelPerfStats._Requests[key] = histograms
+            return histograms
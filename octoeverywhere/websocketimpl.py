@@ -1,4 +1,3 @@
-import queue
 import ssl
 import weakref
 import socket
@@ -14,8 +13,11 @@ from octowebsocket import WebSocketApp
 
 from .interfaces import WebSocketOpCode, IWebSocketClient
 from .buffer import Buffer, BufferOrNone
+from .sendbufferpool import SendCopyStats
 from .weakcallback import WeakCallback
 from .sentry import Sentry
+from .sendscheduler import SendScheduler
+from .Proto.MessagePriority import MessagePriority
 
 
 # This class gives a bit of an abstraction over the normal ws
@@ -32,6 +34,9 @@ class Client(IWebSocketClient):
     c_SocketSendBufferBytes = 512 * 1024
     c_SocketReceiveBufferBytes = 512 * 1024
     c_SendQueueBackpressureLogIntervalSec = 5.0
+    # When the send queue is full, a stream that has less than this queued can still queue messages.
+    # This keeps a big transfer that fills the queue from blocking the small messages of other streams.
+    c_MinFlowQueueSizeBytes = 64 * 1024
 
 
     # Allows us to still enable the websocket debug logs if we want.
@@ -76,7 +81,8 @@ class Client(IWebSocketClient):
 
         # We use a send queue thread because it allows us to process downloads about 2x faster.
         # This is because the downstream work of the WS can be made faster if it's done in parallel
-        self.SendQueue:queue.Queue[SendQueueContext] = queue.Queue()
+        # The send queue is a fair scheduler, so big transfers don't delay the small messages of other streams.
+        self.SendQueue = SendScheduler()
         self.SendQueueLock = threading.Lock()
         self.SendQueueDataSizeBytes = 0
         self.SendQueueOpen = True
@@ -279,8 +285,8 @@ class Client(IWebSocketClient):
 
         # Always ensure we close the send queue.
         try:
-            # Push an empty buffer to the send queue, which will close it.
-            self.SendQueue.put(SendQueueContext(None))
+            # Closing the send queue stops the send thread. Any messages that were still queued will never be sent, so let the owners know.
+            self._ReleaseDroppedSends(self.SendQueue.Close())
         except Exception as e:
             Sentry.OnException("Exception while trying to close the send queue.", e)
 
@@ -356,17 +362,18 @@ class Client(IWebSocketClient):
         self._Close()
 
 
-    def Send(self, buffer:Buffer, msgStartOffsetBytes:Optional[int]=None, msgSize:Optional[int]=None, isData:bool=True) -> None:
+    def Send(self, buffer:Buffer, msgStartOffsetBytes:Optional[int]=None, msgSize:Optional[int]=None, isData:bool=True, streamId:int=0, priority:int=MessagePriority.Normal) -> None:
         if isData:
-            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, WebSocketOpCode.BINARY)
+            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, WebSocketOpCode.BINARY, streamId, priority)
         else:
-            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, WebSocketOpCode.TEXT)
+            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, WebSocketOpCode.TEXT, streamId, priority)
 
 
     # Sends a buffer, with an optional message start offset and size.
     # If the message start offset and size are not provided, it's assumed the buffer starts at 0 and the size is the full buffer.
     # Providing a bytearray with room in the front allows the system to avoid copying the buffer.
-    def SendWithOptCode(self, buffer:Buffer, msgStartOffsetBytes:Optional[int]=None, msgSize:Optional[int]=None, optCode=WebSocketOpCode.BINARY) -> None:
+    # The stream id and priority are used by the send scheduler, messages of the same stream and priority are always sent in order.
+    def SendWithOptCode(self, buffer:Buffer, msgStartOffsetBytes:Optional[int]=None, msgSize:Optional[int]=None, optCode=WebSocketOpCode.BINARY, streamId:int=0, priority:int=MessagePriority.Normal) -> None:
         try:
             # Make sure we have a buffer, this is invalid and it will also shutdown our send thread.
             if buffer is None:
@@ -375,7 +382,7 @@ class Client(IWebSocketClient):
             queuedDataSizeBytes = self._GetQueuedDataSizeBytes(buffer, msgStartOffsetBytes, msgSize)
 
             with self.SendQueueLock:
-                while self.SendQueueOpen and self.SendQueueDataSizeBytes > self.c_MaxSendQueueSizeBytes:
+                while self.SendQueueOpen and self.SendQueueDataSizeBytes > self.c_MaxSendQueueSizeBytes and self._MustWaitForSendQueue(streamId, priority):
                     # If the send queue is too large, we will block until it goes down. This is to prevent out of memory issues if the producer is producing data faster than the websocket can send it.
                     # We will check every second, so if the consumer is very slow, we won't be adding more and more data to the queue and eventually run out of memory.
                     # This also provides back pressure to the producer, which can be useful to prevent it from producing too much data in the first place.
@@ -390,13 +397,19 @@ class Client(IWebSocketClient):
                     self.SendQueueLock.acquire() #pylint: disable=consider-using-with
 
                 # Ensure the send queue is still open.
+                # If not, the buffer will never be sent, so let the owner know it can be reused.
                 if not self.SendQueueOpen:
+                    buffer.OnSendComplete()
                     return
 
                 # We are going to send, add this to the size.
                 self.SendQueueDataSizeBytes += queuedDataSizeBytes
 
-            self.SendQueue.put(SendQueueContext(buffer, msgStartOffsetBytes, msgSize, optCode, queuedDataSizeBytes))
+            if self.SendQueue.Put(SendQueueContext(buffer, msgStartOffsetBytes, msgSize, optCode, queuedDataSizeBytes), queuedDataSizeBytes, streamId, priority) is False:
+                # The send queue closed, so the buffer will never be sent.
+                with self.SendQueueLock:
+                    self.SendQueueDataSizeBytes = max(0, self.SendQueueDataSizeBytes - queuedDataSizeBytes)
+                buffer.OnSendComplete()
         except Exception as e:
             # If any exception happens during sending, we want to report the error
             # and shutdown the entire websocket.
@@ -414,14 +427,11 @@ class Client(IWebSocketClient):
                 # Wait on something to send with a timeout to allow periodic closed check.
                 # This prevents the thread from hanging indefinitely if isClosed is set
                 # after the check but before the get() call.
-                try:
-                    context:SendQueueContext = self.SendQueue.get(timeout=1.0)
-                except Exception:
-                    # Timeout occurred, loop back to check isClosed
+                context:Optional[SendQueueContext] = self.SendQueue.Get(timeoutSec=1.0)
+                if context is None:
+                    # Timeout occurred or the queue was closed, loop back to check isClosed
                     continue
-
-                # If it's None, that means we are shutting down.
-                if context is None or context.Buffer is None:
+                if context.Buffer is None:
                     return
 
                 dataToSend:Any = context.Buffer.Get()
@@ -433,7 +443,14 @@ class Client(IWebSocketClient):
                 # Important! We don't want to use the frame mask because it adds about 30% CPU usage on low end devices.
                 # The frame masking was only need back when websockets were used over the internet without SSL.
                 # Our server, OctoPrint, and Moonraker all accept unmasked frames, so its safe to do this for all WS.
+                if self._FrameNeedsCopy(dataToSend, context.MsgStartOffsetBytes, context.MsgSize):
+                    SendCopyStats.OnCopy(len(dataToSend) if context.MsgSize is None else context.MsgSize)
+                sendStartSec = time.perf_counter()
                 ws.send(dataToSend, context.OptCode.ToWsLibInt(), False, context.MsgStartOffsetBytes, context.MsgSize)
+                SendScheduler.OnSendComplete(context.QueuedSizeBytes, time.perf_counter() - sendStartSec)
+
+                # The buffer has been written to the socket, so let the owner know it can be reused.
+                context.Buffer.OnSendComplete()
 
                 # Remove the size of this message from the total size, now that it's sent.
                 with self.SendQueueLock:
@@ -456,12 +473,30 @@ class Client(IWebSocketClient):
 
             # Be sure to clear the send queue to prevent any potential memory leaks.
             try:
-                while not self.SendQueue.empty():
-                    self.SendQueue.get_nowait()
+                self._ReleaseDroppedSends(self.SendQueue.Close())
             except Exception:
                 pass
 
 
+    # Returns the send scheduler stats, like the queueing delay of each priority class.
+    def GetSendStats(self) -> Dict[str, Any]:
+        return self.SendQueue.GetSchedulerStats()
+
+
+    # When the send queue is full, returns true if this message must wait for it to drain.
+    # Critical messages and streams that only have a little queued don't wait, so they aren't stuck behind a big transfer.
+    def _MustWaitForSendQueue(self, streamId:int, priority:int) -> bool:
+        if SendScheduler.GetPriorityClass(priority) == SendScheduler.c_ClassCritical:
+            return False
+        return self.SendQueue.GetFlowQueuedBytes(streamId, priority) >= self.c_MinFlowQueueSizeBytes
+
+
+    def _ReleaseDroppedSends(self, contexts:List["SendQueueContext"]) -> None:
+        for context in contexts:
+            if context.Buffer is not None:
+                context.Buffer.OnSendComplete()
+
+
     # Support using with:
     def __enter__(self):
         return self
@@ -483,6 +518,23 @@ class Client(IWebSocketClient):
             pass
 
 
+    # The websocket lib writes the frame header and mask key in front of the message if there's room in the buffer, otherwise it copies the message into a new buffer.
+    # This returns True if that copy will happen, so it can be counted.
+    def _FrameNeedsCopy(self, data:Any, msgStartOffsetBytes:Optional[int], msgSize:Optional[int]) -> bool:
+        if isinstance(data, bytes):
+            return True
+        if msgStartOffsetBytes is None:
+            return True
+        size = len(data) if msgSize is None else msgSize
+        frameHeaderBytes = 2
+        if size >= 65536:
+            frameHeaderBytes = 10
+        elif size >= 126:
+            frameHeaderBytes = 4
+        # The mask key is always sent, even though we don't mask the data.
+        return msgStartOffsetBytes < frameHeaderBytes + 4
+
+
     def _GetQueuedDataSizeBytes(self, buffer:Buffer, msgStartOffsetBytes:Optional[int], msgSize:Optional[int]) -> int:
         # If the message size or start offset is not provided, we assume the full buffer is being sent.
         if msgSize is None or msgStartOffsetBytes is None:
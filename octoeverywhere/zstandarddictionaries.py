@@ -0,0 +1,10 @@
+from typing import List, Tuple
+
+#
+# The trained zstandard dictionaries for each platform and traffic class.
+#
+# THIS FILE IS GENERATED by developer/benchmarks/dictionarybuilder.py, don't edit it by hand.
+# Each entry is (dict id, platform, traffic class, base64 dict data). Only dictionaries that beat the default dictionary in the
+# builder's evaluation are written here, and every dict id must also be known by the service, or it won't accept it in the handshake.
+#
+c_TrainedDictionaries:List[Tuple[int, str, str, str]] = []
@@ -3,10 +3,22 @@ import glob
 import random
 import base64
 import logging
-from typing import List
+import threading
+from typing import AbstractSet, Any, Dict, List, Optional, Set, Tuple
+
+from .Proto.ServerHost import ServerHost
+from .zstandarddictionaries import c_TrainedDictionaries
 
 # A helper classed used for training the zstandard lib pre made dictionary.
 # This is only used for training the dictionary, so it's not used in the main code.
+#
+# It also holds the trained dictionaries for each platform and traffic class, which are built by developer/benchmarks/dictionarybuilder.py.
+# The traffic of each platform is quite different (OctoPrint sockjs json, Moonraker json-rpc, Bambu mqtt reports, Elegoo sdcp json) so a dictionary
+# trained on one platform compresses it better than the shared pre-trained dict. The service must have the same dictionary to decompress, so the
+# dict ids we have for the platform are advertised in the handshake syn, and a trained dict is only used once the service accepts its id in the ack.
+# Everything else, and everything on older servers, uses the pre-trained dict. The dict id is in each zstandard frame header, which is how the
+# service knows which dict to decompress a stream with.
+#
 class ZStandardDictionary:
 
     _Instance:"ZStandardDictionary" = None #pyright: ignore[reportAssignmentType]
@@ -15,6 +27,34 @@ class ZStandardDictionary:
     _TrainingPath = "/home/pi/zstandard-training-samples"
     _OutputDictFilePath = "/home/pi/zstandard-gen-dict-base64.data"
 
+    # The dict id of the pre-trained dict, the service always has it.
+    c_DefaultDictId = 1
+
+    # The platforms the trained dicts are built for.
+    c_PlatformOctoPrint = "octoprint"
+    c_PlatformMoonraker = "moonraker"
+    c_PlatformBambu = "bambu"
+    c_PlatformElegoo = "elegoo"
+    c_PlatformPrusaLink = "prusalink"
+    c_ServerHostPlatforms = {
+        ServerHost.OctoPrint: c_PlatformOctoPrint,
+        ServerHost.Moonraker: c_PlatformMoonraker,
+        ServerHost.Bambu: c_PlatformBambu,
+        ServerHost.Elegoo: c_PlatformElegoo,
+        ServerHost.Elegoo2: c_PlatformElegoo,
+        ServerHost.PrusaLink: c_PlatformPrusaLink,
+    }
+
+    # The traffic classes the trained dicts are built for.
+    # Json is api responses and websocket messages, web is the html, js, and css of the frontends.
+    c_TrafficClassJson = "json"
+    c_TrafficClassWeb = "web"
+    c_TrafficClassWebMatches = ("text/html", "javascript", "text/css")
+
+    # If enabled, the trained dicts are advertised to the service.
+    # This is on by default, it can be turned off with the setter or the OCTO_ZSTD_TRAINED_DICTS=0 env var.
+    Enabled = os.environ.get("OCTO_ZSTD_TRAINED_DICTS", "1") == "1"
+
 
     @staticmethod
     def Init(logger:logging.Logger):
@@ -26,6 +66,24 @@ class ZStandardDictionary:
         return ZStandardDictionary._Instance
 
 
+    @staticmethod
+    def SetEnabled(enabled:bool) -> None:
+        ZStandardDictionary.Enabled = enabled
+
+
+    # Returns the traffic class for the content type, or None if there are no trained dicts for it.
+    @staticmethod
+    def GetTrafficClass(contentTypeLower:Optional[str]) -> Optional[str]:
+        if contentTypeLower is None:
+            return None
+        if contentTypeLower.find("json") != -1:
+            return ZStandardDictionary.c_TrafficClassJson
+        for match in ZStandardDictionary.c_TrafficClassWebMatches:
+            if contentTypeLower.find(match) != -1:
+                return ZStandardDictionary.c_TrafficClassWeb
+        return None
+
+
     def __init__(self, logger:logging.Logger) -> None:
         self.Logger = logger
         self.TrainingDataNamePrefix:str = None #pyright: ignore[reportAttributeAccessIssue]
@@ -33,6 +91,20 @@ class ZStandardDictionary:
         # This will be None if we aren't using zstandard in this runtime.
         self.PreTrainedDict = None
 
+        # Copies of the dicts that are precomputed for other compression params, by (dict id, level, window log).
+        self.PrecomputedDicts:Dict[Tuple[int, int, Optional[int]], Any] = {}
+        self.PrecomputedDictsLock = threading.Lock()
+        # Copies of the dicts that aren't precomputed, by dict id, created on first use.
+        self.NotPrecomputedDicts:Dict[int, Any] = {}
+
+        # The trained dicts for this platform, by traffic class, and their data by dict id.
+        # These are replaced rather than changed, so they can be read without the lock.
+        self.Platform:Optional[str] = None
+        self.TrainedDictIds:Dict[str, int] = {}
+        self.TrainedDictData:Dict[int, bytes] = {}
+        # The number of compression contexts that used each dict, for stats.
+        self.DictUses:Dict[int, int] = {}
+
 
     # The check for zstandard lib must be made before we can call this, but if we are using zstandard, we must load this dict.
     def InitPreComputedDict(self) -> None:
@@ -56,6 +128,114 @@ class ZStandardDictionary:
         self.Logger.info(f"ZStandard Dict Training loaded. Data Length:{len(self.PreTrainedDict.as_bytes())} DictID:{self.PreTrainedDict.dict_id()}")
 
 
+    # A precomputed dict pins the compression params it was computed with, so any level given to a compressor using it is ignored.
+    # This returns the dict precomputed for the given level and window log, so compressors can use other levels.
+    # The dict data is the same, so anything compressed with these can still be decompressed with the normal dict.
+    def GetPreTrainedDictForParams(self, level:int, windowLog:Optional[int]=None, dictId:int=c_DefaultDictId) -> Any:
+        if self.PreTrainedDict is None:
+            raise Exception("ZStandardDictionary tried to get a precomputed dict before the pre-trained dict was loaded.")
+        if level == 3 and windowLog is None and dictId == ZStandardDictionary.c_DefaultDictId:
+            return self.PreTrainedDict
+        key = (dictId, level, windowLog)
+        with self.PrecomputedDictsLock:
+            localDict = self.PrecomputedDicts.get(key, None)
+            if localDict is not None:
+                return localDict
+
+            #pylint: disable=import-outside-toplevel
+            import zstandard as zstd
+            localDict = zstd.ZstdCompressionDict(self._GetDictData(dictId), dict_type=zstd.DICT_TYPE_FULLDICT)
+            if windowLog is None:
+                localDict.precompute_compress(level=level) #pyright: ignore[reportUnknownMemberType]
+            else:
+                localDict.precompute_compress(compression_params=zstd.ZstdCompressionParameters.from_level(level, window_log=windowLog)) #pyright: ignore[reportUnknownMemberType]
+            self.PrecomputedDicts[key] = localDict
+            return localDict
+
+
+    # Returns the dict without any precomputed params, so compressors using it use their own params.
+    # The dict is loaded into the compressor on each use, which is slower, but it avoids holding a precomputed dict for a level that's rarely used.
+    # The higher levels are the main reason to use this, since their precomputed dicts are very large.
+    def GetPreTrainedDictNotPrecomputed(self, dictId:int=c_DefaultDictId) -> Any:
+        if self.PreTrainedDict is None:
+            raise Exception("ZStandardDictionary tried to get the not precomputed dict before the pre-trained dict was loaded.")
+        with self.PrecomputedDictsLock:
+            localDict = self.NotPrecomputedDicts.get(dictId, None)
+            if localDict is None:
+                #pylint: disable=import-outside-toplevel
+                import zstandard as zstd
+                localDict = zstd.ZstdCompressionDict(self._GetDictData(dictId), dict_type=zstd.DICT_TYPE_FULLDICT)
+                self.NotPrecomputedDicts[dictId] = localDict
+            return localDict
+
+
+    # Returns the trained dict ids to advertise in the handshake syn, loading the trained dicts for the platform if needed.
+    def GetSupportedDictIds(self, serverHost:int) -> List[int]:
+        if ZStandardDictionary.Enabled is False or self.PreTrainedDict is None:
+            return []
+        platform = ZStandardDictionary.c_ServerHostPlatforms.get(serverHost, None)
+        if platform != self.Platform:
+            self.Platform = platform
+            self.TrainedDictIds = {}
+            self.TrainedDictData = {}
+            for dictId, dictPlatform, trafficClass, dictBase64 in c_TrainedDictionaries:
+                if dictPlatform == platform:
+                    self.AddTrainedDict(dictId, trafficClass, base64.b64decode(dictBase64))
+        return sorted(self.TrainedDictIds.values())
+
+
+    # Adds a trained dict for a traffic class of this platform.
+    def AddTrainedDict(self, dictId:int, trafficClass:str, data:bytes) -> None:
+        if dictId == ZStandardDictionary.c_DefaultDictId:
+            raise Exception("ZStandardDictionary can't add a trained dict with the default dict id.")
+        trainedDictIds = dict(self.TrainedDictIds)
+        trainedDictIds[trafficClass] = dictId
+        trainedDictData = dict(self.TrainedDictData)
+        trainedDictData[dictId] = data
+        self.TrainedDictData = trainedDictData
+        self.TrainedDictIds = trainedDictIds
+
+
+    # Called for every handshake ack, with the trained dict ids the service accepted, and returns the ones we have.
+    # The result is kept by the session, since each connection can be to a service that accepts different dicts.
+    # Older servers don't send any, which means only the pre-trained dict is used.
+    def OnHandshakeAck(self, acceptedDictIds:List[int]) -> Set[int]:
+        accepted = set(acceptedDictIds) & set(self.TrainedDictIds.values())
+        if len(accepted) > 0:
+            self.Logger.info(f"ZStandard using the trained dicts {sorted(accepted)} for platform {self.Platform}")
+        return accepted
+
+
+    # Returns the dict id a compression context should use for the traffic class, given the trained dict ids its session's service accepted.
+    # If there's no trained dict for it, or the service didn't accept it, this is the pre-trained dict.
+    def GetDictIdForTrafficClass(self, trafficClass:Optional[str], acceptedDictIds:AbstractSet[int]) -> int:
+        dictId = ZStandardDictionary.c_DefaultDictId
+        if trafficClass is not None and ZStandardDictionary.Enabled:
+            trainedDictId = self.TrainedDictIds.get(trafficClass, None)
+            if trainedDictId is not None and trainedDictId in acceptedDictIds:
+                dictId = trainedDictId
+        # This is only for stats, so it's fine if an increment is lost.
+        self.DictUses[dictId] = self.DictUses.get(dictId, 0) + 1
+        return dictId
+
+
+    def GetStats(self) -> Dict[str, Any]:
+        return {
+            "Platform": self.Platform,
+            "TrainedDictIds": dict(self.TrainedDictIds),
+            "Uses": {str(k): v for k, v in dict(self.DictUses).items()},
+        }
+
+
+    def _GetDictData(self, dictId:int) -> bytes:
+        if dictId == ZStandardDictionary.c_DefaultDictId:
+            return base64.b64decode(ZStandardDictionary.c_Dict1)
+        data = self.TrainedDictData.get(dictId, None)
+        if data is None:
+            raise Exception(f"ZStandardDictionary doesn't have the dict id {dictId}")
+        return data
+
+
     # DEV ONLY
     # Used only in dev builds to init training data samples.
     # You must also add SubmitData into the Compression class to get the samples submitted.
@@ -72,7 +252,9 @@ class ZStandardDictionary:
     # This should be called by everything that's compressing data to sample it.
     # The training data file should include as much data as we can from all platforms.
     # To start training, add this to the Compression.Compress and Compress.Decompress functions if we are using zstandard.
-    def SubmitData(self, data:bytes) -> None:
+    # Use the platform name as the prefix, the samples are written as <prefix>/<traffic class>/<file>, which is the layout
+    # developer/benchmarks/dictionarybuilder.py reads to build the trained dicts.
+    def SubmitData(self, data:bytes, trafficClass:Optional[str]=None) -> None:
         # Check state to see if we are training.
         if self.TrainingDataNamePrefix is None:
             self.Logger.warning("ZStandardDictionary.SubmitData was called but we aren't training!")
@@ -85,7 +267,9 @@ class ZStandardDictionary:
             self.Logger.info(f"Writing {len(data)} bytes to the training file: {fileName}")
 
             # Write the data.
-            with open(os.path.join(ZStandardDictionary._TrainingPath, fileName), "w", encoding="utf-8") as f:
+            folderPath = os.path.join(ZStandardDictionary._TrainingPath, self.TrainingDataNamePrefix, trafficClass or "other")
+            os.makedirs(folderPath, exist_ok=True)
+            with open(os.path.join(folderPath, fileName), "w", encoding="utf-8") as f:
                 f.write(data.decode("utf-8"))
 
         except Exception as e:
@@ -101,8 +285,10 @@ class ZStandardDictionary:
             # Train a new dict.
             # Collect all of the samples that are in the samples folder.
             inputSamples:List[bytes] = []
-            searchStr = os.path.join(ZStandardDictionary._TrainingPath, "*")
-            for file in glob.glob(searchStr):
+            searchStr = os.path.join(ZStandardDictionary._TrainingPath, "**", "*")
+            for file in glob.glob(searchStr, recursive=True):
+                if os.path.isfile(file) is False:
+                    continue
                 with open(file, "rb") as f:
                     inputSamples.append(f.read())
 
@@ -10,6 +10,7 @@ import flask
 import octoprint.plugin
 from octoprint.printer import PrinterInterface
 from octoprint.access.users import User
+from octoprint.access.permissions import Permissions
 from octoprint.plugin import PluginSettings
 
 from octoeverywhere.Webcam.webcamhelper import WebcamHelper
@@ -17,6 +18,8 @@ from octoeverywhere.octoeverywhereimpl import OctoEverywhere
 from octoeverywhere.octohttprequest import OctoHttpRequest
 from octoeverywhere.notificationshandler import NotificationsHandler
 from octoeverywhere.httpsessions import HttpSessions
+from octoeverywhere.tunnelperfstats import TunnelPerfStats
+from octoeverywhere.tunnelperfreport import TunnelPerfReport
 from octoeverywhere.sentry import Sentry
 from octoeverywhere.hostcommon import HostCommon
 from octoeverywhere.linkhelper import LinkHelper
@@ -319,6 +322,12 @@ class OctoeverywherePlugin(octoprint.plugin.StartupPlugin,
         # This API is used by apps and other system to identify the printer
         # for communication with the service. Thus these values should not be
         # modified or deleted.
+        # If the perf arg is set, this returns the tunnel perf report instead.
+        # Since this API isn't protected, the report is only returned to admin users or callers on this device.
+        if "perf" in request.args:
+            if TunnelPerfStats.IsLocalCaller(request.remote_addr) is False and Permissions.ADMIN.can() is False: #pyright: ignore[reportUnknownMemberType] octoprint has no typing
+                flask.abort(403)
+            return flask.jsonify(TunnelPerfReport.GetReport())
         return flask.jsonify(
             PluginVersion=self._plugin_version,
             PrinterId=self.EnsureAndGetPrinterId()
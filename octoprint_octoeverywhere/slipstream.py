@@ -1,7 +1,7 @@
 import time
 import logging
 import threading
-from typing import Dict, Optional
+from typing import Optional
 
 from octoeverywhere.sentry import Sentry
 from octoeverywhere.compat import Compat
@@ -10,8 +10,9 @@ from octoeverywhere.interfaces import ISlipstreamHandler
 from octoeverywhere.octohttprequest import OctoHttpRequest
 from octoeverywhere.WebStream.octoheaderimpl import HeaderHelper
 from octoeverywhere.WebStream.octoheaderimpl import BaseProtocol
-from octoeverywhere.httpresult import HttpResult, HttpResultOrNone
+from octoeverywhere.httpresult import HttpResultOrNone
 from octoeverywhere.octostreammsgbuilder import OctoStreamMsgBuilder
+from octoeverywhere.slipstreamcache import SlipstreamCache
 from octoeverywhere.compression import Compression, CompressionContext
 from octoeverywhere.Proto.HttpInitialContext import HttpInitialContext
 
@@ -29,6 +30,8 @@ from .localauth import LocalAuth
 #
 # We also pre-compress the response, so we can use a better compression quality and we don't have to compress it in realtime.
 #
+# The cache is also kept on disk by the SlipstreamCache, so after a restart the cache can be served right away while it's refreshed in the background.
+#
 # This class has also been expanded to cache static resources required by the index that are large.
 class Slipstream(ISlipstreamHandler):
     # A const that defines the common cache path for the index.
@@ -69,7 +72,6 @@ class Slipstream(ISlipstreamHandler):
 
     MaxCacheFileSizeBytes = 20 * 1024 * 1024
     MaxCachedBodySendBytes = 20 * 1024 * 1024
-    MaxTotalCacheBytes = 100 * 1024 * 1024
 
 
     # Logic for a static singleton
@@ -93,7 +95,8 @@ class Slipstream(ISlipstreamHandler):
 
         self.Lock = threading.Lock()
         self.IsRefreshing = False
-        self.Cache:Dict[str, HttpResult] = {}
+        # This loads anything cached on disk from the last run, so it can be served before the refresh below finishes.
+        self.Cache = SlipstreamCache(logger, Compression.Get().LocalFileStoragePath)
 
         # Kick off a thread to grab the initial index, no delay we build the cache ASAP.
         # Note on server boot this index cache call can take a long time (25-30s)
@@ -147,16 +150,13 @@ class Slipstream(ISlipstreamHandler):
                 self.Logger.info("Slipstream got an index request but there's no OctoPrint session cookie found, so we aren't returning a cached index.")
                 return None
 
-        # We have our path, check if it's in the map
-        with self.Lock:
-            if path in self.Cache:
-                # We must make a copy of the returned object because the HTTP system will call free on it when it's done, which clears the buffer.
-                # This copy is a new HttpResult object, but it shares a pointer to the same buffer, so there's no much overhead.
-                self.Logger.debug("Slipstream returning cached content for %s", path)
-                return self.Cache[path].CreateReplayCopy()
-
-        # Otherwise return cache miss.
-        return None
+        # We have our path, check if it's in the cache.
+        # The cache returns a copy of the result because the HTTP system will call free on it when it's done, which clears the buffer.
+        # This copy is a new HttpResult object, but it shares a pointer to the same buffer, so there's no much overhead.
+        result = self.Cache.Get(path)
+        if result is not None:
+            self.Logger.debug("Slipstream returning cached content for %s", path)
+        return result
 
 
     # Starts a async thread to update the index cache.
@@ -214,9 +214,6 @@ class Slipstream(ISlipstreamHandler):
                 self.Logger.error("Slipstream index got successfully but there's no body buffer?")
                 return
 
-            # Add the index to the cache so it's ready now.
-            self._TryStoreCacheResult(Slipstream.IndexCachePath, indexResult)
-
             # It's no ideal that we need to de-compress this, but it's fine since we are in the background.
             with CompressionContext(self.Logger) as compressionContext:
                 # For decompression, we give the pre-compressed size and the compression type. The True indicates this it the only message, so it's all here.
@@ -241,18 +238,16 @@ class Slipstream(ISlipstreamHandler):
             result = self._GetCacheReadyOctoHttpResult(fullPath)
             if result is None:
                 continue
-
-            # Add it to our cache.
-            with result:
-                self._TryStoreCacheResult(fullPath, result)
+            result.Free()
 
         self.Logger.info("Slipstream took "+str(time.time()-start)+" to fully update the cache")
 
 
-    # On success returns the fully ready OctoHttpResult object.
+    # On success, stores the fully ready OctoHttpResult object in the cache and returns a copy of it.
     # On failure, returns None
     def _GetCacheReadyOctoHttpResult(self, url: str) -> HttpResultOrNone:
         success = False
+        removeCacheOnFailure = True
         octoHttpResult:HttpResultOrNone = None
         try:
             # Take the starting time.
@@ -271,11 +266,27 @@ class Slipstream(ISlipstreamHandler):
                 return None
             localAuth.AddAuthHeader(headers)
 
+            # If we have this cached, send the validators we have, so if it hasn't changed we don't need to read or compress it again.
+            headers.update(self.Cache.GetRevalidationHeaders(url))
+
             # Make the call using our helper.
             octoHttpResult = OctoHttpRequest.MakeHttpCall(self.Logger, url, PathTypes.Relative, "GET", headers)
 
+            # If the server can't be reached, like while it's still starting, keep anything we loaded from disk.
+            if octoHttpResult is None:
+                self.Logger.error("Slipstream failed to make the http request for "+url)
+                removeCacheOnFailure = False
+                return None
+
+            # If the server says the file hasn't changed, the cached result is still good.
+            if octoHttpResult.StatusCode == 304 and self.Cache.OnNotModified(url):
+                self.Logger.debug("Slipstream cache is still valid for %s", url)
+                cacheResult = self.Cache.Get(url)
+                success = cacheResult is not None
+                return cacheResult
+
             # Check for success
-            if octoHttpResult is None or octoHttpResult.StatusCode != 200:
+            if octoHttpResult.StatusCode != 200:
                 self.Logger.error("Slipstream failed to make the http request for "+url)
                 return None
 
@@ -324,22 +335,24 @@ class Slipstream(ISlipstreamHandler):
                 self.Logger.error("Slipstream read a a body of different size then the content length. url:"+url+" body:"+str(len(buffer))+" cl:"+str(contentLength))
                 return None
 
+            # If the body is the same as the one we have cached, there's no need to compress it again.
+            bodyHash = SlipstreamCache.GetBodyHash(buffer)
+            if self.Cache.TryRefreshIfBodyHashMatches(url, bodyHash, octoHttpResult.StatusCode, dict(octoHttpResult.Headers)):
+                self.Logger.debug("Slipstream cache body is unchanged for %s", url)
+                cacheResult = self.Cache.Get(url)
+                success = cacheResult is not None
+                return cacheResult
+
             # Do the compression.
-            ogSize = len(buffer)
+            # Since this is done once in the background and sent many times, this uses the higher precompress level.
             compressStart = time.time()
-            compressResult = None
-            with CompressionContext(self.Logger) as compressionContext:
-                # It's important to set the full compression size, because the compression system will use
-                # it to better optimize the compression and know that we will be sending the full data.
-                compressionContext.SetTotalCompressedSizeOfData(len(buffer))
-                compressResult = Compression.Get().Compress(compressionContext, buffer)
-                buffer = compressResult.Bytes
+            buffer, compressionType, ogSize = SlipstreamCache.Precompress(self.Logger, buffer)
             if len(buffer) > Slipstream.MaxCachedBodySendBytes:
                 self.Logger.info("Slipstream refusing to cache %s because the compressed body is %d bytes and the max is %d bytes.", url, len(buffer), Slipstream.MaxCachedBodySendBytes)
                 return None
 
             # Set the buffer into the response so the http request logic can use it.
-            octoHttpResult.SetFullBodyBuffer(buffer, compressResult.CompressionType, ogSize)
+            octoHttpResult.SetFullBodyBuffer(buffer, compressionType, ogSize)
 
             # Create a buffer, headers, and status code copy of this result that we can cache and return to callers.
             # But this will allow the actual http result and possible pending socket to be freeded.
@@ -357,7 +370,8 @@ class Slipstream(ISlipstreamHandler):
                 url,
             )
 
-            # Return the result on success.
+            # Store it, which also writes it to disk, and return the result on success.
+            self.Cache.Store(url, cacheResult, bodyHash)
             success = True
             return cacheResult
 
@@ -371,40 +385,13 @@ class Slipstream(ISlipstreamHandler):
             except Exception:
                 pass
             # On all exits, if not successful, remove this entry from the cache so it doesn't get stale.
-            if success is False:
+            if success is False and removeCacheOnFailure:
                 self.RemoveCacheIfExists(url)
         return None
 
 
     def RemoveCacheIfExists(self, url:str) -> None:
-        with self.Lock:
-            if url in self.Cache:
-                del self.Cache[url]
-
-
-    def _TryStoreCacheResult(self, url:str, result:HttpResult) -> bool:
-        # Figure out how big this new result is.
-        bodySize = self._GetCachedBodySize(result)
-        if bodySize == 0:
-            return False
-        with self.Lock:
-            # Accumulate the current cache size EXCEPT this URL.
-            currentSize = 0
-            for key, value in self.Cache.items():
-                if key == url:
-                    continue
-                currentSize += self._GetCachedBodySize(value)
-            if currentSize + bodySize > Slipstream.MaxTotalCacheBytes:
-                self.Logger.info("Slipstream refusing to store %s because cache would grow to %d bytes; max is %d bytes.", url, currentSize + bodySize, Slipstream.MaxTotalCacheBytes)
-                return False
-            # Always cache a copy of the reply so it doesn't hang open any underlying request connections.
-            self.Cache[url] = result.CreateReplayCopy()
-        return True
-
-
-    def _GetCachedBodySize(self, result:HttpResult) -> int:
-        buffer = result.FullBodyBuffer
-        return 0 if buffer is None else len(buffer)
+        self.Cache.Remove(url)
 
 
     # Given the full index body and some fragment of a URL, this will try to find the entire URL and return it.
@@ -0,0 +1,204 @@
+# ruff: noqa: E402
+import logging
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer
+from octoeverywhere.compat import Compat
+from octoeverywhere.octohttprequest import OctoHttpRequest
+from octoeverywhere.WebStream.asyncwebstreamengine import AsyncWebStreamEngine, _AsyncResponseSender
+from octoeverywhere.Proto.PathTypes import PathTypes
+from tests.webstreamfakes import FakeOctoSession
+
+
+class _BodyRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Serves /body/<size> as an image, anything else is a 404.
+    def do_GET(self) -> None:
+        if self.path.startswith("/body/") is False:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b"o" * int(self.path[len("/body/"):])
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format:str, *args:Any) -> None: #pylint: disable=redefined-builtin
+        pass
+
+
+class FakeHttpInitialContext:
+    def __init__(self, path:str) -> None:
+        self.PathStr = path
+
+
+    def Path(self) -> bytes:
+        return self.PathStr.encode("utf-8")
+
+
+    def Method(self) -> bytes:
+        return b"GET"
+
+
+    def OctoHost(self) -> bytes:
+        return b"test.octoeverywhere.com"
+
+
+    def PathType(self) -> int:
+        return PathTypes.Relative
+
+
+    def HeadersLength(self) -> int:
+        return 0
+
+
+    def UseOctoeverywhereAuth(self) -> int:
+        return 0
+
+
+class FakeOpenMsg:
+    def __init__(self, path:str) -> None:
+        self.Context = FakeHttpInitialContext(path)
+
+
+    def IsOpenMsg(self) -> bool:
+        return True
+
+
+    def IsCloseMsg(self) -> bool:
+        return False
+
+
+    def IsWebsocketStream(self) -> bool:
+        return False
+
+
+    def IsControlFlagsOnly(self) -> bool:
+        return False
+
+
+    def IsDataTransmissionDone(self) -> bool:
+        return True
+
+
+    def MsgPriority(self) -> int:
+        return 10
+
+
+    def DataLength(self) -> int:
+        return 0
+
+
+    def HttpInitialContext(self) -> FakeHttpInitialContext:
+        return self.Context
+
+
+def _WaitFor(condition, timeoutSec:float=10.0) -> bool: #pyright: ignore[reportMissingParameterType]
+    endSec = time.time() + timeoutSec
+    while time.time() < endSec:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestAsyncWebStreamEngine(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_asyncwebstreamengine")
+        self.Server = ThreadingHTTPServer(("127.0.0.1", 0), _BodyRequestHandler)
+        self.Server.daemon_threads = True
+        threading.Thread(target=self.Server.serve_forever, daemon=True).start()
+        self.OldPort = OctoHttpRequest.GetLocalOctoPrintPort()
+        self.OldAddress = OctoHttpRequest.GetLocalhostAddress()
+        OctoHttpRequest.SetLocalOctoPrintPort(self.Server.server_address[1])
+        OctoHttpRequest.SetLocalHostAddress("127.0.0.1")
+
+        # The flatbuffer messages can't be built with the test stubs, so record what would have been sent.
+        self.Sent:List[Tuple[int, int, int, bool]] = []
+        self.OldBuildMessage = _AsyncResponseSender._BuildMessage
+        sent = self.Sent
+        def recordBuildMessage(sender:_AsyncResponseSender, dataBuffer:Optional[Buffer], nonCompressedSize:int, isLastMessage:bool) -> Any:
+            sent.append((sender.Stream.Id, 0 if dataBuffer is None else len(dataBuffer), sender.StatusCode, isLastMessage))
+            return (Buffer(b"x"), 0, 1)
+        _AsyncResponseSender._BuildMessage = recordBuildMessage #type: ignore[method-assign]
+        self.Engine = AsyncWebStreamEngine(self.Logger)
+
+
+    def tearDown(self) -> None:
+        _AsyncResponseSender._BuildMessage = self.OldBuildMessage #type: ignore[method-assign]
+        OctoHttpRequest.SetLocalOctoPrintPort(self.OldPort)
+        OctoHttpRequest.SetLocalHostAddress(self.OldAddress)
+        self.Server.shutdown()
+        self.Server.server_close()
+
+
+    def test_full_bodies_are_streamed_on_the_loop(self) -> None:
+        bodySize = 200 * 1024
+        streamCount = 20
+        streams = []
+        for i in range(streamCount):
+            stream = self.Engine.CreateWebStream(self.Logger, i + 1, FakeOctoSession()) #pyright: ignore[reportArgumentType]
+            stream.OnIncomingServerMessage(FakeOpenMsg("/body/"+str(bodySize))) #pyright: ignore[reportArgumentType]
+            streams.append(stream)
+        self.assertTrue(_WaitFor(lambda: self.Engine.GetStats()["TotalAsyncRequests"] == streamCount and self.Engine.GetStats()["ActiveStreams"] == 0))
+        for stream in streams:
+            msgs = [m for m in self.Sent if m[0] == stream.Id]
+            self.assertEqual(sum(m[1] for m in msgs), bodySize)
+            self.assertEqual(msgs[0][2], 200)
+            # Only the final message is flagged as the last message.
+            self.assertEqual([m[3] for m in msgs], [False] * (len(msgs) - 1) + [True])
+            self.assertTrue(stream.IsClosed)
+            # The threaded stream should never have been started.
+            self.assertFalse(stream.Stream.is_alive())
+        self.assertEqual(self.Engine.GetStats()["TotalHandedOff"], 0)
+
+
+    def test_relative_not_found_is_handed_off(self) -> None:
+        stream = self.Engine.CreateWebStream(self.Logger, 1, FakeOctoSession()) #pyright: ignore[reportArgumentType]
+        # Record the hand off rather than starting the threaded stream, which needs a real flatbuffer message.
+        handedOff:List[Any] = []
+        stream._HandOff = handedOff.append #type: ignore[method-assign] #pylint: disable=protected-access
+        stream.OnIncomingServerMessage(FakeOpenMsg("/missing")) #pyright: ignore[reportArgumentType]
+        self.assertTrue(_WaitFor(lambda: self.Engine.GetStats()["TotalHandedOff"] == 1))
+        self.assertEqual(len(handedOff), 1)
+        self.assertEqual(len(self.Sent), 0)
+
+
+    def test_relay_detector_runs_once_and_headers_are_handed_off(self) -> None:
+        detected:List[str] = []
+        class CountingDetector:
+            def OnIncomingRelayRequest(self, relativeOrAbsolutePath:str, headers:Dict[str, str]) -> None:
+                detected.append(relativeOrAbsolutePath)
+                headers["x-detected"] = "true"
+        oldDetector = Compat.GetRelayWebcamStreamDetector()
+        Compat.SetRelayWebcamStreamDetector(CountingDetector()) #pyright: ignore[reportArgumentType]
+        try:
+            stream = self.Engine.CreateWebStream(self.Logger, 1, FakeOctoSession()) #pyright: ignore[reportArgumentType]
+            handedOff:List[Any] = []
+            stream._HandOff = handedOff.append #type: ignore[method-assign] #pylint: disable=protected-access
+            stream.OnIncomingServerMessage(FakeOpenMsg("/missing")) #pyright: ignore[reportArgumentType]
+            self.assertTrue(_WaitFor(lambda: self.Engine.GetStats()["TotalHandedOff"] == 1))
+            self.assertEqual(detected, ["/missing"])
+            # The threaded engine gets the headers the detector already changed, so it doesn't run the detector again.
+            self.assertIsNotNone(stream.PreparedSendHeaders)
+            self.assertEqual(stream.PreparedSendHeaders["x-detected"], "true") #pyright: ignore[reportOptionalSubscript]
+        finally:
+            Compat._RelayWebcamStreamDetector = oldDetector #pylint: disable=protected-access
+
+
+if __name__ == "__main__":
+    unittest.main()
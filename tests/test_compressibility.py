@@ -0,0 +1,70 @@
+# ruff: noqa: E402
+import os
+import json
+import zlib
+import unittest
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.compressibility import Compressibility
+
+
+def _MakeJson(sizeBytes:int) -> bytes:
+    items = []
+    i = 0
+    while sum(len(x) for x in items) < sizeBytes:
+        items.append(json.dumps({"path": f"gcodes/part_{i}.gcode", "size": 1000 + i * 17, "modified": 1700000000 + i}))
+        i += 1
+    return ("[" + ",".join(items) + "]").encode("utf-8")
+
+
+class TestCompressibility(unittest.TestCase):
+
+    def setUp(self) -> None:
+        Compressibility.SetEnabled(True)
+        Compressibility.Reset()
+
+
+    def tearDown(self) -> None:
+        Compressibility.SetEnabled(True)
+        Compressibility.Reset()
+
+
+    def test_compressed_formats_are_skipped(self) -> None:
+        text = _MakeJson(64 * 1024)
+        self.assertEqual(Compressibility.GetCompressedFormat(zlib.compress(text)[2:]), None)
+        self.assertEqual(Compressibility.GetCompressedFormat(b"\x1f\x8b\x08\x00" + text), "gzip")
+        self.assertEqual(Compressibility.GetCompressedFormat(b"PK\x03\x04" + text), "zip")
+        self.assertEqual(Compressibility.GetCompressedFormat(b"\x89PNG\r\n\x1a\n" + text), "png")
+        self.assertEqual(Compressibility.GetCompressedFormat(b"RIFF\x00\x00\x00\x00WEBPVP8 " + text), "webp")
+        self.assertEqual(Compressibility.GetCompressedFormat(memoryview(b"\x00\x00\x00\x18ftypmp42" + text)), "mp4")
+        # Even text content types are skipped when the magic bytes say it's compressed.
+        self.assertFalse(Compressibility.IsCompressible(b"\x1f\x8b\x08\x00" + text, "text/plain"))
+        self.assertTrue(Compressibility.IsCompressible(text, "application/json"))
+
+
+    def test_sampled_trial_compression(self) -> None:
+        randomData = os.urandom(256 * 1024)
+        text = _MakeJson(256 * 1024)
+        self.assertFalse(Compressibility.IsCompressible(randomData, "application/octet-stream"))
+        self.assertFalse(Compressibility.IsCompressible(bytearray(os.urandom(500))))
+        self.assertTrue(Compressibility.IsCompressible(memoryview(text), "application/octet-stream"))
+        self.assertTrue(Compressibility.IsCompressible(text, None))
+
+        stats = Compressibility.GetStats()
+        self.assertEqual(stats["Checks"], 4)
+        self.assertEqual(stats["Skipped"], 2)
+        self.assertEqual(stats["SkippedBytes"], len(randomData) + 500)
+        self.assertEqual(stats["SkippedByFormat"], {"sampled": 2})
+
+
+    def test_disabled_allows_everything(self) -> None:
+        Compressibility.SetEnabled(False)
+        self.assertTrue(Compressibility.IsCompressible(os.urandom(4096)))
+        self.assertEqual(Compressibility.GetStats()["Checks"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,197 @@
+# ruff: noqa: E402
+import gzip
+import logging
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, List, Optional, Tuple
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer
+from octoeverywhere.compressionpassthrough import CompressionPassThrough
+from octoeverywhere.negotiatedfeatures import NegotiatedFeatures
+from octoeverywhere.octohttprequest import OctoHttpRequest
+from octoeverywhere.WebStream.asyncwebstreamengine import AsyncWebStreamEngine, _AsyncResponseSender
+from octoeverywhere.WebStream.octoheaderimpl import BaseProtocol, HeaderHelper
+from octoeverywhere.Proto.FeatureFlags import FeatureFlags
+from octoeverywhere.Proto.PathTypes import PathTypes
+from tests.test_asyncwebstreamengine import FakeOpenMsg, _WaitFor
+from tests.webstreamfakes import FakeOctoSession
+
+
+c_Body = b"".join(b"console.log(%d);\n" % i for i in range(20000))
+c_GzipBody = gzip.compress(c_Body)
+
+
+class _GzipRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    # Like a server with pre-compressed static files, this only encodes the body if it's allowed.
+    def do_GET(self) -> None:
+        body = c_Body
+        self.send_response(200)
+        self.send_header("Content-Type", "application/javascript")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = c_GzipBody
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format:str, *args:Any) -> None: #pylint: disable=redefined-builtin
+        pass
+
+
+class _FakeHeader:
+    def __init__(self, key:str, value:str) -> None:
+        self.KeyStr = key
+        self.ValueStr = value
+
+
+    def Key(self) -> bytes:
+        return self.KeyStr.encode("utf-8")
+
+
+    def Value(self) -> bytes:
+        return self.ValueStr.encode("utf-8")
+
+
+class _FakeHttpInitialContextWithHeaders:
+    def __init__(self, headers:List[_FakeHeader]) -> None:
+        self.HeaderList = headers
+
+
+    def OctoHost(self) -> bytes:
+        return b"test.octoeverywhere.com"
+
+
+    def PathType(self) -> int:
+        return PathTypes.Relative
+
+
+    def HeadersLength(self) -> int:
+        return len(self.HeaderList)
+
+
+    def Headers(self, i:int) -> _FakeHeader:
+        return self.HeaderList[i]
+
+
+class TestCompressionPassThrough(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_compressionpassthrough")
+        CompressionPassThrough.SetEnabled(True)
+        self.NotNegotiated = NegotiatedFeatures()
+        self.Negotiated = NegotiatedFeatures(FeatureFlags.CompressionPassThrough)
+
+
+    def tearDown(self) -> None:
+        CompressionPassThrough.SetEnabled(True)
+
+
+    def test_negotiation(self) -> None:
+        self.assertEqual(CompressionPassThrough.GetSupportedFeatureFlags(), FeatureFlags.CompressionPassThrough)
+        # Older servers don't set any flags.
+        self.assertFalse(CompressionPassThrough.IsActive(self.NotNegotiated))
+        self.assertFalse(CompressionPassThrough.IsActive(None))
+        self.assertTrue(CompressionPassThrough.IsActive(self.Negotiated))
+        # Disabling it locally turns it off and stops advertising it.
+        CompressionPassThrough.SetEnabled(False)
+        self.assertFalse(CompressionPassThrough.IsActive(self.Negotiated))
+        self.assertEqual(CompressionPassThrough.GetSupportedFeatureFlags(), FeatureFlags.None_)
+
+
+    def test_accept_encoding(self) -> None:
+        clientValue = "gzip, deflate, br;q=0.9, zstd"
+        self.assertEqual(CompressionPassThrough.GetAcceptEncodingHeaderValue(clientValue, self.NotNegotiated), "identity")
+        self.assertFalse(CompressionPassThrough.IsPassThroughContentEncoding("gzip", self.NotNegotiated))
+        # Only the encodings the client also accepts are asked for.
+        self.assertEqual(CompressionPassThrough.GetAcceptEncodingHeaderValue(clientValue, self.Negotiated), "gzip, br")
+        self.assertEqual(CompressionPassThrough.GetAcceptEncodingHeaderValue("br", self.Negotiated), "br")
+        self.assertEqual(CompressionPassThrough.GetAcceptEncodingHeaderValue("deflate", self.Negotiated), "identity")
+        self.assertEqual(CompressionPassThrough.GetAcceptEncodingHeaderValue(None, self.Negotiated), "identity")
+        self.assertTrue(CompressionPassThrough.IsPassThroughContentEncoding("gzip", self.Negotiated))
+        self.assertFalse(CompressionPassThrough.IsPassThroughContentEncoding("deflate", self.Negotiated))
+        self.assertFalse(CompressionPassThrough.IsPassThroughContentEncoding(None, self.Negotiated))
+
+
+    def test_gathered_headers(self) -> None:
+        context = _FakeHttpInitialContextWithHeaders([_FakeHeader("Accept-Encoding", "gzip, deflate, br")])
+        headers = HeaderHelper.GatherRequestHeaders(self.Logger, context, BaseProtocol.Http) #pyright: ignore[reportArgumentType]
+        self.assertEqual(headers["Accept-Encoding"], "identity")
+        headers = HeaderHelper.GatherRequestHeaders(self.Logger, context, BaseProtocol.Http, self.Negotiated) #pyright: ignore[reportArgumentType]
+        self.assertEqual(headers["Accept-Encoding"], "gzip, br")
+
+
+    def test_sessions_are_negotiated_separately(self) -> None:
+        # A secondary connection to a server that doesn't accept the feature must not change what the primary session does.
+        primary = FakeOctoSession()
+        primary.NegotiatedFeatures = self.Negotiated
+        secondary = FakeOctoSession()
+        self.assertTrue(CompressionPassThrough.IsActive(primary.GetNegotiatedFeatures()))
+        self.assertFalse(CompressionPassThrough.IsActive(secondary.GetNegotiatedFeatures()))
+        context = _FakeHttpInitialContextWithHeaders([_FakeHeader("Accept-Encoding", "gzip")])
+        self.assertEqual(HeaderHelper.GatherRequestHeaders(self.Logger, context, BaseProtocol.Http, primary.GetNegotiatedFeatures())["Accept-Encoding"], "gzip") #pyright: ignore[reportArgumentType]
+        self.assertEqual(HeaderHelper.GatherRequestHeaders(self.Logger, context, BaseProtocol.Http, secondary.GetNegotiatedFeatures())["Accept-Encoding"], "identity") #pyright: ignore[reportArgumentType]
+
+
+class TestAsyncCompressionPassThrough(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_compressionpassthrough")
+        CompressionPassThrough.SetEnabled(True)
+        self.Server = ThreadingHTTPServer(("127.0.0.1", 0), _GzipRequestHandler)
+        self.Server.daemon_threads = True
+        threading.Thread(target=self.Server.serve_forever, daemon=True).start()
+        self.OldPort = OctoHttpRequest.GetLocalOctoPrintPort()
+        self.OldAddress = OctoHttpRequest.GetLocalhostAddress()
+        OctoHttpRequest.SetLocalOctoPrintPort(self.Server.server_address[1])
+        OctoHttpRequest.SetLocalHostAddress("127.0.0.1")
+
+        # The flatbuffer messages can't be built with the test stubs, so record what would have been sent.
+        self.Sent:List[Tuple[int, bool, bool]] = []
+        self.OldBuildMessage = _AsyncResponseSender._BuildMessage
+        sent = self.Sent
+        def recordBuildMessage(sender:_AsyncResponseSender, dataBuffer:Optional[Buffer], nonCompressedSize:int, isLastMessage:bool) -> Any:
+            sent.append((0 if dataBuffer is None else len(dataBuffer), sender.CompressBody, sender.IsContentEncodingPassThrough))
+            return (Buffer(b"x"), 0, 1)
+        _AsyncResponseSender._BuildMessage = recordBuildMessage #type: ignore[method-assign]
+        self.Engine = AsyncWebStreamEngine(self.Logger)
+
+
+    def tearDown(self) -> None:
+        _AsyncResponseSender._BuildMessage = self.OldBuildMessage #type: ignore[method-assign]
+        OctoHttpRequest.SetLocalOctoPrintPort(self.OldPort)
+        OctoHttpRequest.SetLocalHostAddress(self.OldAddress)
+        self.Server.shutdown()
+        self.Server.server_close()
+
+
+    def test_encoded_body_is_forwarded_as_is(self) -> None:
+        # The fake open message has no client headers, so force the gathered value.
+        oldGather = HeaderHelper.GatherRequestHeaders
+        def gatherWithGzip(*args:Any) -> Any:
+            headers = oldGather(*args)
+            headers["Accept-Encoding"] = "gzip"
+            return headers
+        HeaderHelper.GatherRequestHeaders = gatherWithGzip #type: ignore[method-assign]
+        try:
+            session = FakeOctoSession()
+            session.NegotiatedFeatures = NegotiatedFeatures(FeatureFlags.CompressionPassThrough)
+            stream = self.Engine.CreateWebStream(self.Logger, 1, session) #pyright: ignore[reportArgumentType]
+            stream.OnIncomingServerMessage(FakeOpenMsg("/app.js")) #pyright: ignore[reportArgumentType]
+            self.assertTrue(_WaitFor(lambda: self.Engine.GetStats()["TotalAsyncRequests"] == 1 and self.Engine.GetStats()["ActiveStreams"] == 0))
+        finally:
+            HeaderHelper.GatherRequestHeaders = oldGather #type: ignore[method-assign]
+        # The gzip body is sent as is, it's not decompressed or compressed again.
+        self.assertEqual(sum(m[0] for m in self.Sent), len(c_GzipBody))
+        self.assertTrue(all(m[1] is False and m[2] is True for m in self.Sent))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+# ruff: noqa: E402
+import logging
+import tempfile
+import unittest
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer
+from octoeverywhere.compression import Compression, CompressionContext
+from octoeverywhere.compressionpolicy import CompressionPolicyManager
+from octoeverywhere.sendscheduler import SendScheduler
+from octoeverywhere.Proto.DataCompression import DataCompression
+
+try:
+    import zstandard # noqa: F401 - Only used to check if the tests can run.
+    _HasZStandard = True
+except ImportError:
+    _HasZStandard = False
+
+
+class TestCompressionPolicy(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_compressionpolicy")
+        CompressionPolicyManager.SetEnabled(True)
+
+
+    def tearDown(self) -> None:
+        CompressionPolicyManager.SetEnabled(True)
+
+
+    def test_buckets(self) -> None:
+        policies = CompressionPolicyManager(self.Logger, 4)
+        self.assertEqual(policies.GetPolicy("application/json", 300).Bucket, CompressionPolicyManager.c_BucketSmall)
+        self.assertEqual(policies.GetPolicy(None, None).Bucket, CompressionPolicyManager.c_BucketStream)
+        self.assertEqual(policies.GetPolicy("text/html", 100 * 1024).Bucket, CompressionPolicyManager.c_BucketText)
+        largeText = policies.GetPolicy("application/javascript", 4 * 1024 * 1024)
+        self.assertEqual(largeText.Bucket, CompressionPolicyManager.c_BucketLargeText)
+        self.assertEqual(largeText.Threads, 4)
+        binary = policies.GetPolicy("application/octet-stream", 100 * 1024)
+        self.assertEqual(binary.Bucket, CompressionPolicyManager.c_BucketBinary)
+        # Multiple threads only help for large payloads.
+        self.assertEqual(binary.Threads, 1)
+        self.assertEqual(policies.GetPolicy("text/html", 100 * 1024).Threads, 1)
+
+
+    def test_disabled_uses_fixed_policy(self) -> None:
+        CompressionPolicyManager.SetEnabled(False)
+        policies = CompressionPolicyManager(self.Logger, 2)
+        policy = policies.GetPolicy("application/javascript", 4 * 1024 * 1024)
+        self.assertEqual(policy.Bucket, CompressionPolicyManager.c_BucketFixed)
+        self.assertEqual(policy.Level, 3)
+        self.assertEqual(policy.Threads, 2)
+        self.assertEqual(policy.ZlibLevel, 3)
+
+
+    def test_level_drops_when_cpu_bound_and_recovers(self) -> None:
+        policies = CompressionPolicyManager(self.Logger, 4)
+        policy = policies.GetPolicy("text/html", 100 * 1024)
+        self.assertEqual(policy.Level, 3)
+        sampleBytes = 1024 * 1024
+        # Compress slower than the target, which should drop the level.
+        slowSec = (sampleBytes / (1024 * 1024)) / (CompressionPolicyManager.c_TargetMBps / 2)
+        for _ in range(CompressionPolicyManager.c_EvaluateWindowBytes // sampleBytes):
+            policies.OnCompressed(policy, sampleBytes, sampleBytes // 4, slowSec)
+        policy = policies.GetPolicy("text/html", 100 * 1024)
+        self.assertEqual(policy.Level, 2)
+        self.assertEqual(policy.ZlibLevel, 2)
+
+        # Samples from the old level are ignored.
+        oldPolicy = policies.GetPolicy("text/html", 100 * 1024)
+        oldPolicy.Level = 3
+        for _ in range(10):
+            policies.OnCompressed(oldPolicy, sampleBytes, sampleBytes // 4, slowSec)
+        self.assertEqual(policies.GetPolicy("text/html", 100 * 1024).Level, 2)
+
+        # With lots of headroom, it goes back up, but not past the default.
+        fastSec = (sampleBytes / (1024 * 1024)) / (CompressionPolicyManager.c_TargetMBps * CompressionPolicyManager.c_RaiseLevelHeadroom * 2)
+        for _ in range(10):
+            policies.OnCompressed(policies.GetPolicy("text/html", 100 * 1024), sampleBytes, sampleBytes // 4, fastSec)
+        self.assertEqual(policies.GetPolicy("text/html", 100 * 1024).Level, 3)
+
+        stats = policies.GetStats()["Buckets"][CompressionPolicyManager.c_BucketText]
+        self.assertEqual(stats["LevelDrops"], 1)
+        self.assertEqual(stats["LevelRaises"], 1)
+        self.assertEqual(stats["Ratio"], 4.0)
+        self.assertGreater(stats["MBps"], 0)
+
+
+    def test_level_steps_skip_zero(self) -> None:
+        policies = CompressionPolicyManager(self.Logger, 4)
+        policy = policies.GetPolicy("application/octet-stream", 4 * 1024 * 1024)
+        self.assertEqual(policy.Level, 1)
+        sampleBytes = 1024 * 1024
+        slowSec = (sampleBytes / (1024 * 1024)) / (CompressionPolicyManager.c_TargetMBps / 2)
+        for _ in range(CompressionPolicyManager.c_EvaluateWindowBytes // sampleBytes):
+            policies.OnCompressed(policy, sampleBytes, sampleBytes, slowSec)
+        self.assertEqual(policies.GetPolicy("application/octet-stream", 4 * 1024 * 1024).Level, -1)
+
+
+    def test_small_samples_do_not_adapt(self) -> None:
+        policies = CompressionPolicyManager(self.Logger, 4)
+        policy = policies.GetPolicy(None, None)
+        for _ in range(100000):
+            policies.OnCompressed(policy, 300, 100, 0.001)
+        self.assertEqual(policies.GetPolicy(None, None).Level, 3)
+
+
+    def test_slow_device_starts_at_the_slow_device_levels(self) -> None:
+        policies = CompressionPolicyManager(self.Logger, 4)
+        policies.OnCalibrated(CompressionPolicyManager.c_TargetMBps / 2)
+        self.assertEqual(policies.GetPolicy("text/html", 100 * 1024).Level, 1)
+        # Only the measured throughput can take a bucket below the slow device level.
+        self.assertEqual(policies.GetPolicy("application/javascript", 4 * 1024 * 1024).Level, 1)
+        self.assertEqual(policies.GetPolicy("application/octet-stream", 4 * 1024 * 1024).Level, 1)
+        # The small bucket always uses the default level.
+        self.assertEqual(policies.GetPolicy("application/json", 300).Level, 3)
+
+
+    def test_pi_class_device_keeps_the_default_levels(self) -> None:
+        # A Pi 4 compresses json at a few times the target on one core, which must not be treated as a slow device.
+        policies = CompressionPolicyManager(self.Logger, 4)
+        policies.OnCalibrated(CompressionPolicyManager.c_TargetMBps * 2)
+        self.assertEqual(policies.GetPolicy("application/javascript", 4 * 1024 * 1024).Level, 3)
+        self.assertEqual(policies.GetPolicy("application/octet-stream", 4 * 1024 * 1024).Level, 1)
+
+
+    def test_slow_send_rate_lowers_the_target(self) -> None:
+        oldSendMBps = SendScheduler._SendMBps #pylint: disable=protected-access
+        try:
+            SendScheduler._SendMBps = None #pylint: disable=protected-access
+            self.assertEqual(CompressionPolicyManager.GetTargetMBps(), CompressionPolicyManager.c_TargetMBps)
+            # Measure a 2 MB/s connection.
+            sampleBytes = 1024 * 1024
+            for _ in range(SendScheduler.c_SendRateWindowBytes // sampleBytes):
+                SendScheduler.OnSendComplete(sampleBytes, 0.5)
+            self.assertAlmostEqual(CompressionPolicyManager.GetTargetMBps(), 2.0)
+
+            # Compression that would be too slow for a fast connection keeps up with this one, so the level isn't dropped.
+            policies = CompressionPolicyManager(self.Logger, 4)
+            policy = policies.GetPolicy("text/html", 100 * 1024)
+            slowSec = (sampleBytes / (1024 * 1024)) / (CompressionPolicyManager.c_TargetMBps / 2)
+            for _ in range(CompressionPolicyManager.c_EvaluateWindowBytes // sampleBytes):
+                policies.OnCompressed(policy, sampleBytes, sampleBytes // 4, slowSec)
+            self.assertEqual(policies.GetPolicy("text/html", 100 * 1024).Level, 3)
+        finally:
+            SendScheduler._SendMBps = oldSendMBps #pylint: disable=protected-access
+
+
+    @unittest.skipIf(_HasZStandard is False, "zstandard isn't installed")
+    def test_other_levels_decompress_with_the_default_dict(self) -> None:
+        Compression.Init(self.Logger, tempfile.mkdtemp())
+        compression = Compression.Get()
+        self.assertTrue(compression.CanUseZStandardLib)
+        data = b"".join(b'{"toolhead":{"position":[%d,%d,%d]}},' % (i, i * 2, i * 3) for i in range(60000))
+        for level in (-1, 1, 3):
+            compression.Policies.Buckets[CompressionPolicyManager.c_BucketLargeText].CurrentLevel = level
+            with CompressionContext(self.Logger) as compressContext:
+                compressContext.SetTotalCompressedSizeOfData(len(data))
+                compressContext.SetContentType("application/json")
+                result = compression.Compress(compressContext, Buffer(data))
+                self.assertEqual(compressContext.GetCompressionPolicy().Level, level)
+            self.assertEqual(result.CompressionType, DataCompression.ZStandard)
+            with CompressionContext(self.Logger) as decompressContext:
+                out = compression.Decompress(decompressContext, result.Bytes, len(data), True, result.CompressionType)
+            self.assertEqual(bytes(out.Get()), data)
+        self.assertIn(CompressionPolicyManager.c_BucketLargeText, compression.GetPolicyStats()["Buckets"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+# ruff: noqa: E402
+import time
+import logging
+import threading
+import unittest
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.compressionscheduler import CompressionScheduler
+
+
+class TestCompressionScheduler(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_compressionscheduler")
+        CompressionScheduler.SetEnabled(True)
+        CompressionScheduler.SetIsPrintActiveCallback(None)
+
+
+    def tearDown(self) -> None:
+        CompressionScheduler.SetEnabled(True)
+        CompressionScheduler.SetIsPrintActiveCallback(None)
+
+
+    def test_pick_threads(self) -> None:
+        scheduler = CompressionScheduler(self.Logger, 4)
+        self.assertEqual(scheduler.PickThreads(1), 1)
+        self.assertEqual(scheduler.PickThreads(4), 4)
+        self.assertEqual(scheduler.PickThreads(8), 4)
+
+        # If the budget is busy, the compressor only gets one thread.
+        scheduler.ThreadsInUse = 2
+        self.assertEqual(scheduler.PickThreads(4), 1)
+        scheduler.ThreadsInUse = 0
+
+        # While printing, new compressors are always single threaded.
+        CompressionScheduler.SetIsPrintActiveCallback(lambda: True)
+        scheduler = CompressionScheduler(self.Logger, 4)
+        self.assertEqual(scheduler.PickThreads(4), 1)
+        self.assertEqual(scheduler.GetStats()["DowngradedCompressors"], 1)
+
+        CompressionScheduler.SetEnabled(False)
+        self.assertEqual(scheduler.PickThreads(4), 4)
+
+
+    def test_jobs_are_bounded_by_the_budget(self) -> None:
+        scheduler = CompressionScheduler(self.Logger, 2)
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def work() -> int:
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+            return 7
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(scheduler.Run(1, 1024 * 1024, work))) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [7] * 6)
+        self.assertEqual(running[1], 2)
+        stats = scheduler.GetStats()
+        self.assertEqual(stats["ThreadsInUse"], 0)
+        self.assertEqual(stats["QueueWait"]["Count"], 6)
+        self.assertGreater(stats["QueueWait"]["MaxMs"], 0)
+
+        # A job that wants more threads than the budget still runs, with the whole budget.
+        self.assertEqual(scheduler.Run(8, 1024 * 1024, lambda: scheduler.ThreadsInUse), 2)
+
+        # Small jobs don't wait for the budget.
+        scheduler.ThreadsInUse = 2
+        self.assertEqual(scheduler.Run(1, 100, lambda: 3), 3)
+        self.assertEqual(scheduler.GetStats()["SmallJobs"], 1)
+
+
+    def test_print_active_jobs_run_on_low_priority_workers(self) -> None:
+        CompressionScheduler.SetIsPrintActiveCallback(lambda: True)
+        scheduler = CompressionScheduler(self.Logger, 2)
+        if scheduler.CanLowerThreadPriority is False:
+            self.skipTest("Thread priorities can't be set on this platform")
+        callerThread = threading.current_thread()
+        self.assertIsNot(scheduler.Run(1, 1024 * 1024, threading.current_thread), callerThread)
+        self.assertEqual(scheduler.GetStats()["LowPriorityJobs"], 1)
+
+        def fail() -> None:
+            raise ValueError("bad data")
+        with self.assertRaises(ValueError):
+            scheduler.Run(1, 1024 * 1024, fail)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+# ruff: noqa: E402
+import time
+import logging
+import threading
+import unittest
+from typing import Dict, List, Optional
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.httpresult import HttpResult
+from octoeverywhere.httprouteselector import HttpRoute, HttpRouteSelector
+
+
+# Acts like the routes of a request, with a status code and delay per route.
+class _FakeRoutes:
+    def __init__(self, behavior:Dict[str, tuple]) -> None:
+        self.Behavior = behavior
+        self.Calls:List[str] = []
+        self.Freed:List[str] = []
+        self.Lock = threading.Lock()
+
+
+    def GetRoutes(self) -> List[HttpRoute]:
+        return [HttpRoute(name, i != 0, lambda name=name: "http://" + name) for i, name in enumerate(self.Behavior.keys())]
+
+
+    def Attempt(self, route:HttpRoute) -> Optional[HttpResult]:
+        statusCode, delaySec = self.Behavior[route.Name]
+        with self.Lock:
+            self.Calls.append(route.Name)
+        time.sleep(delaySec)
+        if statusCode is None:
+            return None
+        result = HttpResult(statusCode, {}, route.Url, route.IsFallback)
+        freed = self.Freed
+        def free() -> None:
+            freed.append(route.Name)
+        result.Free = free #type: ignore[method-assign]
+        return result
+
+
+class TestHttpRouteSelector(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_httprouteselector")
+        HttpRouteSelector.SetEnabled(True)
+        HttpRouteSelector.ClearWinners()
+        HttpRouteSelector.ResetStats()
+
+
+    def tearDown(self) -> None:
+        HttpRouteSelector.SetEnabled(True)
+        HttpRouteSelector.ClearWinners()
+        HttpRouteSelector.ResetStats()
+
+
+    def test_route_key(self) -> None:
+        self.assertEqual(HttpRouteSelector.GetRouteKey("127.0.0.1:5000", "/webcam/?action=stream"), ("127.0.0.1:5000", "/webcam"))
+        self.assertEqual(HttpRouteSelector.GetRouteKey("Host", "/api?x=/a/b"), ("host", "/api"))
+        self.assertEqual(HttpRouteSelector.GetRouteKey("host", "/"), ("host", "/"))
+        self.assertEqual(HttpRouteSelector.GetRouteKey("host", ""), ("host", "/"))
+
+
+    def test_failure_starts_the_next_route_and_the_winner_is_remembered(self) -> None:
+        # The main route can't connect, so the proxy is tried right after and wins.
+        fake = _FakeRoutes({"main": (None, 0.0), "proxy": (200, 0.0), "localip": (200, 0.0)})
+        key = ("host", "/webcam")
+        result = HttpRouteSelector.Run(self.Logger, key, fake.GetRoutes(), fake.Attempt)
+        self.assertIsNotNone(result)
+        assert result is not None
+        self.assertEqual(result.Url, "http://proxy")
+        self.assertEqual(fake.Calls, ["main", "proxy"])
+        self.assertEqual(HttpRouteSelector.GetWinner(key), "proxy")
+
+        # The next request goes right to the winner.
+        fake.Calls.clear()
+        result = HttpRouteSelector.Run(self.Logger, key, fake.GetRoutes(), fake.Attempt)
+        assert result is not None
+        self.assertEqual(result.Url, "http://proxy")
+        self.assertEqual(fake.Calls, ["proxy"])
+        stats = HttpRouteSelector.GetStats()
+        self.assertEqual(stats["proxy"]["MemoHits"], 1)
+        self.assertEqual(stats["proxy"]["Wins"], 2)
+
+
+    def test_slow_route_is_not_sent_to_another_route(self) -> None:
+        # The routes usually reach the same backend, so a slow response must not start the request on the next route.
+        fake = _FakeRoutes({"main": (200, 0.4), "proxy": (200, 0.0)})
+        result = HttpRouteSelector.Run(self.Logger, ("host", "/api"), fake.GetRoutes(), fake.Attempt)
+        assert result is not None
+        self.assertEqual(result.Url, "http://main")
+        self.assertEqual(fake.Calls, ["main"])
+
+
+    def test_connect_timeout(self) -> None:
+        self.assertIsNone(HttpRouteSelector.GetConnectTimeoutSec(1))
+        self.assertEqual(HttpRouteSelector.GetConnectTimeoutSec(3), HttpRouteSelector.c_ConnectTimeoutSec)
+        HttpRouteSelector.SetEnabled(False)
+        self.assertIsNone(HttpRouteSelector.GetConnectTimeoutSec(3))
+
+
+    def test_failed_winner_is_forgotten(self) -> None:
+        key = ("host", "/api")
+        fake = _FakeRoutes({"main": (404, 0.0), "proxy": (200, 0.0)})
+        HttpRouteSelector.Run(self.Logger, key, fake.GetRoutes(), fake.Attempt)
+        self.assertEqual(HttpRouteSelector.GetWinner(key), "proxy")
+        # The main 404 isn't returned, so it's freed.
+        self.assertIn("main", fake.Freed)
+
+        # Now the proxy fails, so the main route is used again.
+        fake.Behavior = {"main": (200, 0.0), "proxy": (None, 0.0)}
+        fake.Calls.clear()
+        result = HttpRouteSelector.Run(self.Logger, key, fake.GetRoutes(), fake.Attempt)
+        assert result is not None
+        self.assertEqual(result.Url, "http://main")
+        self.assertEqual(fake.Calls, ["proxy", "main"])
+        self.assertEqual(HttpRouteSelector.GetWinner(key), "main")
+
+
+    def test_main_response_is_returned_if_everything_fails(self) -> None:
+        fake = _FakeRoutes({"main": (404, 0.0), "proxy": (None, 0.0), "localip": (404, 0.0)})
+        result = HttpRouteSelector.Run(self.Logger, ("host", "/missing"), fake.GetRoutes(), fake.Attempt)
+        assert result is not None
+        self.assertEqual(result.Url, "http://main")
+        self.assertEqual(result.StatusCode, 404)
+        self.assertEqual(fake.Freed, ["localip"])
+        self.assertIsNone(HttpRouteSelector.GetWinner(("host", "/missing")))
+
+
+    def test_disabled_does_not_remember(self) -> None:
+        HttpRouteSelector.SetEnabled(False)
+        fake = _FakeRoutes({"main": (404, 0.0), "proxy": (200, 0.0)})
+        result = HttpRouteSelector.Run(self.Logger, ("host", "/webcam"), fake.GetRoutes(), fake.Attempt)
+        assert result is not None
+        self.assertEqual(result.Url, "http://proxy")
+        self.assertIsNone(HttpRouteSelector.GetWinner(("host", "/webcam")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+# ruff: noqa: E402
+import os
+import time
+import logging
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, List
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+import requests
+
+from octoeverywhere.httpresult import HttpResult
+from octoeverywhere.httpstreamaccumulationreader import HttpStreamAccumulationReader
+from octoeverywhere.httpstreamreadloop import ChunkedBodyDecoder
+
+
+# Sends chunked bodies, like an event stream or a large download with no content length.
+class _ChunkedHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    BulkBody = os.urandom(3 * 1024 * 1024)
+
+    def do_GET(self) -> None:
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        if self.path == "/events":
+            for i in range(5):
+                self._WriteChunk(b"data: %d\n\n" % i)
+                time.sleep(0.05)
+        elif self.path == "/bulk":
+            body = _ChunkedHandler.BulkBody
+            for i in range(0, len(body), 100 * 1024):
+                self._WriteChunk(body[i:i + 100 * 1024])
+        elif self.path == "/hang":
+            self._WriteChunk(b"data: hello\n\n")
+            time.sleep(2)
+        self.wfile.write(b"0\r\n\r\n")
+
+
+    def _WriteChunk(self, data:bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+    def log_message(self, format:str, *args:Any) -> None: #pylint: disable=redefined-builtin
+        pass
+
+
+class TestHttpStreamAccumulationReader(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_httpstreamaccumulationreader")
+        HttpStreamAccumulationReader.SetReadLoopEnabled(True)
+        self.Server = ThreadingHTTPServer(("127.0.0.1", 0), _ChunkedHandler)
+        self.Server.daemon_threads = True
+        threading.Thread(target=self.Server.serve_forever, daemon=True).start()
+        self.Host = f"http://127.0.0.1:{self.Server.server_address[1]}"
+
+
+    def tearDown(self) -> None:
+        HttpStreamAccumulationReader.SetReadLoopEnabled(False)
+        self.Server.shutdown()
+        self.Server.server_close()
+
+
+    def _Open(self, path:str, accumulationTimeSec:float, maxPendingBufferSizeBytes:Any=None) -> HttpStreamAccumulationReader:
+        url = self.Host + path
+        response = requests.get(url, stream=True, timeout=5)
+        return HttpStreamAccumulationReader(self.Logger, 1, HttpResult.BuildFromRequestLibResponse(response, url, False), accumulationTimeSec, maxPendingBufferSizeBytes=maxPendingBufferSizeBytes)
+
+
+    def _ReadAll(self, reader:HttpStreamAccumulationReader) -> List[bytes]:
+        buffers:List[bytes] = []
+        while True:
+            buffer = reader.Read()
+            if buffer is None:
+                return buffers
+            buffers.append(bytes(buffer.GetBytesLike()))
+
+
+    def test_events_are_returned_on_message_boundaries(self) -> None:
+        for useLoop in (True, False):
+            HttpStreamAccumulationReader.SetReadLoopEnabled(useLoop)
+            # A long accumulation time shows that the events don't wait for it.
+            reader = self._Open("/events", accumulationTimeSec=1.0)
+            self.assertEqual(reader.ReadLoop is not None, useLoop)
+            start = time.time()
+            buffers = self._ReadAll(reader)
+            reader.CloseAsync()
+            self.assertLess(time.time() - start, 0.9)
+            self.assertEqual(buffers, [b"data: %d\n\n" % i for i in range(5)])
+            stats = reader.GetStreamStats()
+            self.assertEqual(stats["FlushReasons"].get("Boundary"), 5)
+            self.assertEqual(stats["AddedLatency"]["Count"], 5)
+            self.assertLess(stats["AddedLatency"]["MaxMs"], 100)
+
+
+    def test_bulk_body_with_back_pressure(self) -> None:
+        # The small pending max makes the loop pause and resume the stream.
+        reader = self._Open("/bulk", accumulationTimeSec=0.010, maxPendingBufferSizeBytes=256 * 1024)
+        self.assertIsNotNone(reader.ReadLoop)
+        buffers:List[bytes] = []
+        while True:
+            buffer = reader.Read()
+            if buffer is None:
+                break
+            buffers.append(bytes(buffer.GetBytesLike()))
+            time.sleep(0.001)
+        reader.CloseAsync()
+        self.assertEqual(b"".join(buffers), _ChunkedHandler.BulkBody)
+        self.assertEqual(reader.TotalBytesRead, len(_ChunkedHandler.BulkBody))
+        self.assertGreater(HttpStreamAccumulationReader.GetStats()["AddedLatency"]["Count"], 0)
+
+
+    def test_chunked_decoder_handles_split_frames(self) -> None:
+        raw = b"5;ext=1\r\nhello\r\n1a\r\n" + b"b" * 26 + b"\r\n0\r\nTrailer: x\r\n\r\nextra"
+        # Feed it one byte at a time, so every frame is split.
+        decoder = ChunkedBodyDecoder()
+        body = b"".join(decoder.Feed(raw[i:i + 1]) for i in range(len(raw)))
+        self.assertEqual(body, b"hello" + b"b" * 26)
+        self.assertTrue(decoder.IsDone)
+        decoder = ChunkedBodyDecoder()
+        self.assertEqual(decoder.Feed(raw), b"hello" + b"b" * 26)
+        self.assertTrue(decoder.IsDone)
+        with self.assertRaises(ValueError):
+            ChunkedBodyDecoder().Feed(b"zz\r\n")
+
+
+    def test_close_while_the_stream_is_idle(self) -> None:
+        reader = self._Open("/hang", accumulationTimeSec=0.010)
+        buffer = reader.Read()
+        self.assertIsNotNone(buffer)
+        # Nothing is pending, so a read with a timeout returns None.
+        self.assertIsNone(reader.Read(timeoutSec=0.005))
+        closed = threading.Event()
+        def read() -> None:
+            self.assertIsNone(reader.Read())
+            closed.set()
+        threading.Thread(target=read, daemon=True).start()
+        time.sleep(0.05)
+        reader.CloseAsync()
+        self.assertTrue(closed.wait(1.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from octoeverywhere.latencyhistogram import LatencyHistogram
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_buckets_and_percentiles(self) -> None:
+        h = LatencyHistogram([10, 100, 1000])
+        self.assertEqual(h.GetStats()["P50Ms"], 0.0)
+        for _ in range(90):
+            h.Add(0.005)
+        for _ in range(9):
+            h.Add(0.050)
+        h.Add(3.0)
+        stats = h.GetStats()
+        self.assertEqual(stats["Count"], 100)
+        self.assertEqual(stats["Buckets"], {"<=10ms": 90, "<=100ms": 9, "<=1000ms": 0, ">1000ms": 1})
+        self.assertEqual(stats["P50Ms"], 10)
+        self.assertEqual(stats["P90Ms"], 10)
+        self.assertEqual(stats["P99Ms"], 100)
+        self.assertEqual(h.GetPercentileMs(100), 3000.0)
+        self.assertEqual(stats["MaxMs"], 3000.0)
+        h.Reset()
+        self.assertEqual(h.GetStats()["Count"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+# ruff: noqa: E402
+import os
+import logging
+import unittest
+from typing import List
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer
+from octoeverywhere.Webcam.mjpegframeextractor import MjpegFrameExtractor
+from octoeverywhere.Webcam.webcamutil import WebcamUtil
+
+
+def _MakeJpeg(sizeBytes:int) -> bytes:
+    # Random data can't have any 0xff bytes, otherwise it could look like a marker.
+    body = os.urandom(sizeBytes).replace(b"\xff", b"\x00")
+    return b"\xff\xd8\xff\xfe\x00\x10" + body + b"\xff\xd9"
+
+
+class _StreamReader:
+    def __init__(self, data:bytes, chunkSizes:List[int]) -> None:
+        self.Data = data
+        self.Pos = 0
+        self.ChunkSizes = chunkSizes
+        self.Reads = 0
+
+    def ReadInto(self, arena:bytearray, offset:int, size:int) -> int:
+        chunk = self.ChunkSizes[self.Reads % len(self.ChunkSizes)]
+        self.Reads += 1
+        count = min(size, chunk, len(self.Data) - self.Pos)
+        arena[offset:offset + count] = self.Data[self.Pos:self.Pos + count]
+        self.Pos += count
+        return count
+
+
+class TestMjpegFrameExtractor(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_mjpegframeextractor")
+
+
+    def _ReadAllMarkerFrames(self, extractor:MjpegFrameExtractor, reader:_StreamReader, readSize:int) -> List[bytes]:
+        frames = []
+        while True:
+            frame = extractor.TakeMarkerFrame()
+            if frame is not None:
+                frames.append(bytes(frame.Get()))
+                continue
+            if extractor.ReadInto(reader.ReadInto, readSize) == 0:
+                return frames
+
+
+    def test_marker_frames_split_across_reads(self) -> None:
+        jpegs = [_MakeJpeg(1000 + i * 37) for i in range(40)]
+        reader = _StreamReader(b"".join(jpegs), [1, 7, 300, 4096, 2])
+        extractor = MjpegFrameExtractor(self.Logger, 64 * 1024, arenaSizeBytes=8 * 1024, startOfImage=b"\xff\xd8\xff\xfe\x00\x10")
+        self.assertEqual(self._ReadAllMarkerFrames(extractor, reader, 4096), jpegs)
+        stats = extractor.GetStats()
+        self.assertEqual(stats["Frames"], 40)
+        self.assertEqual(stats["FrameBytes"], sum(len(j) for j in jpegs))
+        # Only the partial frames are copied when the arena is compacted, never the whole frames.
+        self.assertLess(stats["CopiedBytes"], stats["FrameBytes"])
+
+
+    def test_junk_and_oversized_frames_resync(self) -> None:
+        jpegs = [_MakeJpeg(500), _MakeJpeg(600)]
+        # Junk before the first frame, a frame with no end that's over the max, and then a good frame.
+        noEnd = b"\xff\xd8\xff\xfe\x00\x10" + os.urandom(3000).replace(b"\xff", b"\x00")
+        data = b"junk\xff" + jpegs[0] + noEnd + jpegs[1]
+        reader = _StreamReader(data, [256])
+        extractor = MjpegFrameExtractor(self.Logger, 2048, arenaSizeBytes=16 * 1024, startOfImage=b"\xff\xd8\xff\xfe\x00\x10")
+        self.assertEqual(self._ReadAllMarkerFrames(extractor, reader, 256), jpegs)
+        self.assertEqual(extractor.GetStats()["Resyncs"], 1)
+
+
+    def test_live_frames_are_never_overwritten(self) -> None:
+        jpegs = [_MakeJpeg(3000 + i) for i in range(30)]
+        reader = _StreamReader(b"".join(jpegs), [2500])
+        extractor = MjpegFrameExtractor(self.Logger, 64 * 1024, arenaSizeBytes=8 * 1024)
+        held:List[Buffer] = []
+        frameCount = 0
+        while frameCount < len(jpegs):
+            frame = extractor.TakeMarkerFrame()
+            if frame is not None:
+                # Only hold on to the last two frames, like the current image and a frame being sent.
+                held.append(frame)
+                if len(held) > 2:
+                    held.pop(0)
+                frameCount += 1
+                for i, f in enumerate(held):
+                    self.assertEqual(bytes(f.Get()), jpegs[frameCount - len(held) + i])
+                continue
+            self.assertGreater(extractor.ReadInto(reader.ReadInto, 2500), 0)
+        # The old arenas are reused once their frames are released.
+        stats = extractor.GetStats()
+        self.assertGreater(stats["ArenasRecycled"], 0)
+        self.assertLess(stats["ArenasAllocated"], 6)
+
+
+    def test_length_framed_stream(self) -> None:
+        jpegs = [_MakeJpeg(2000 + i * 100) for i in range(10)]
+        data = b"".join(len(j).to_bytes(3, "little") + b"\x00" * 13 + j for j in jpegs)
+        reader = _StreamReader(data, [999])
+        extractor = MjpegFrameExtractor(self.Logger, WebcamUtil.c_MaxSnapshotFrameSizeBytes, arenaSizeBytes=4 * 1024)
+        for jpeg in jpegs:
+            while extractor.PendingSize() < 16:
+                extractor.ReadInto(reader.ReadInto, 16 - extractor.PendingSize())
+            size = int.from_bytes(extractor.GetBytes(16)[0:3], "little")
+            extractor.Consume(16)
+            frame = extractor.TakeFrame(size)
+            while frame is None:
+                extractor.ReadInto(reader.ReadInto, size - extractor.PendingSize())
+                frame = extractor.TakeFrame(size)
+            self.assertIsInstance(frame.Get(), memoryview)
+            self.assertEqual(bytes(frame.Get()), jpeg)
+
+
+    def test_parse_multipart_frame_headers(self) -> None:
+        headers = b"\r\n--boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: \r\ncontent-length: 48861--boundary\r\n\r\n"
+        self.assertEqual(WebcamUtil.ParseMultipartFrameHeaders(headers), (48861, "image/jpeg"))
+        self.assertEqual(WebcamUtil.ParseMultipartFrameHeaders(b"--b\r\nX-Timestamp: 1\r\n\r\n"), (0, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 import unittest
 
 from octoeverywhere.octohttprequest import OctoHttpRequest
+from octoeverywhere.Proto.PathTypes import PathTypes
 
 
 class TestOctoHttpRequest(unittest.TestCase):
@@ -20,5 +21,14 @@ class TestOctoHttpRequest(unittest.TestCase):
         self.assertEqual(OctoHttpRequest.ParseOutPath("https://example.com?query=value"), "/")
 
 
+    def test_primary_url_is_the_first_url_of_the_call(self) -> None:
+        urls = OctoHttpRequest.GetHttpCallUrls("/webcam?action=stream", PathTypes.Relative)
+        self.assertEqual(urls.PathOrUrl, "/webcam/?action=stream")
+        self.assertEqual(OctoHttpRequest.GetPrimaryUrl("/webcam?action=stream", PathTypes.Relative), urls.Url)
+        self.assertTrue(urls.Url.endswith(":" + str(OctoHttpRequest.GetLocalOctoPrintPort()) + "/webcam/?action=stream"))
+        self.assertIsNotNone(urls.FallbackUrl)
+        self.assertEqual(urls.FallbackWebcamUrl, "http://" + OctoHttpRequest.GetLocalhostAddress() + ":8080/?action=stream")
+
+
 if __name__ == "__main__":
     unittest.main()
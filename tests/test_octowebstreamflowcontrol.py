@@ -0,0 +1,194 @@
+# ruff: noqa: E402
+import json
+import logging
+import queue
+import threading
+import time
+import unittest
+from typing import Any, Dict, List, Optional
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.memorymanager import MemoryManager
+from octoeverywhere.WebStream.octowebstream import OctoWebStream
+from tests.webstreamfakes import FakeOctoSession
+
+
+class FakeIncomingMsg:
+    def __init__(self, streamIndex:int, dataLength:int) -> None:
+        self.StreamIndex = streamIndex
+        self.Length = dataLength
+        self.ArrivedSec = 0.0
+
+
+    def IsCloseMsg(self) -> bool:
+        return False
+
+
+    def DataLength(self) -> int:
+        return self.Length
+
+
+def _Percentile(values:List[float], percent:float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * percent / 100.0))
+    return values[index]
+
+
+# Pushes interleaved messages across many web streams from a single simulated receive thread, where one or more streams are slow to process
+# their messages. Returns the head-of-line latency stats for the streams that are NOT congested, which is the time from when a message arrived
+# on the simulated socket until its stream picked it up.
+def RunHeadOfLineHarness(useOverflowCutoff:bool, streamCount:int=10, congestedStreamCount:int=1, messageCount:int=1000, messageSizeBytes:int=1024, arrivalIntervalSec:float=0.0002, congestedProcessTimeSec:float=0.010) -> Dict[str, Any]:
+    logger = logging.getLogger("test_octowebstreamflowcontrol")
+    session = FakeOctoSession()
+    oldMode = OctoWebStream.GetUseIncomingOverflowCutoff()
+    OctoWebStream.SetUseIncomingOverflowCutoff(useOverflowCutoff)
+    try:
+        streams:List[OctoWebStream] = []
+        for i in range(streamCount):
+            streams.append(OctoWebStream(name="FlowControlHarness", args=(logger, i + 1, session)))
+
+        # Start a consumer for each stream, the congested ones take a while to process each message.
+        latencyLock = threading.Lock()
+        latenciesSec:List[float] = []
+        stopEvent = threading.Event()
+        expectedFastMessages = 0
+        fastMessagesDone = threading.Event()
+        fastMessagesConsumed = [0]
+
+        def consumerWorker(stream:OctoWebStream, isCongested:bool) -> None:
+            while stopEvent.is_set() is False:
+                msg:Optional[FakeIncomingMsg] = stream.getNextIncomingMessage(0.05) #pyright: ignore[reportAssignmentType]
+                if msg is None:
+                    continue
+                if isCongested:
+                    time.sleep(congestedProcessTimeSec)
+                    continue
+                with latencyLock:
+                    latenciesSec.append(time.time() - msg.ArrivedSec)
+                    fastMessagesConsumed[0] += 1
+                    if fastMessagesConsumed[0] >= expectedFastMessages:
+                        fastMessagesDone.set()
+
+        consumers:List[threading.Thread] = []
+        for i, stream in enumerate(streams):
+            t = threading.Thread(target=consumerWorker, args=(stream, i < congestedStreamCount), daemon=True)
+            t.start()
+            consumers.append(t)
+
+        # Build the interleaved messages, round robin across all of the streams.
+        messages:List[FakeIncomingMsg] = []
+        for i in range(messageCount):
+            streamIndex = i % streamCount
+            messages.append(FakeIncomingMsg(streamIndex, messageSizeBytes))
+            if streamIndex >= congestedStreamCount:
+                expectedFastMessages += 1
+
+        # The socket thread "receives" messages at a fixed rate, and the receive thread dispatches them to the streams.
+        socketQueue:queue.Queue[Optional[FakeIncomingMsg]] = queue.Queue()
+
+        def socketWorker() -> None:
+            for msg in messages:
+                msg.ArrivedSec = time.time()
+                socketQueue.put(msg)
+                time.sleep(arrivalIntervalSec)
+            socketQueue.put(None)
+
+        receiveBusySec = [0.0]
+
+        def receiveWorker() -> None:
+            while True:
+                msg = socketQueue.get()
+                if msg is None:
+                    return
+                start = time.time()
+                streams[msg.StreamIndex].OnIncomingServerMessage(msg) #pyright: ignore[reportArgumentType]
+                receiveBusySec[0] += time.time() - start
+
+        startSec = time.time()
+        socketThread = threading.Thread(target=socketWorker, daemon=True)
+        receiveThread = threading.Thread(target=receiveWorker, daemon=True)
+        socketThread.start()
+        receiveThread.start()
+        receiveThread.join(timeout=60)
+        fastMessagesDone.wait(timeout=60)
+        durationSec = time.time() - startSec
+
+        stopEvent.set()
+        for t in consumers:
+            t.join(timeout=5)
+        closedStreams = 0
+        for stream in streams:
+            if stream.IsClosed:
+                closedStreams += 1
+            stream.Close()
+
+        return {
+            "mode": "cutoff" if useOverflowCutoff else "legacy",
+            "streams": streamCount,
+            "congested_streams": congestedStreamCount,
+            "messages": messageCount,
+            "fast_messages_delivered": len(latenciesSec),
+            "duration_sec": round(durationSec, 3),
+            "receive_thread_busy_sec": round(receiveBusySec[0], 3),
+            "streams_closed_by_cutoff": closedStreams,
+            "parked_messages": sum(s.IncomingParkedMessageCount for s in streams),
+            "overflow_cutoffs": sum(s.IncomingOverflowCutoffCount for s in streams),
+            "hol_latency_ms_p50": round(_Percentile(latenciesSec, 50) * 1000.0, 3),
+            "hol_latency_ms_p95": round(_Percentile(latenciesSec, 95) * 1000.0, 3),
+            "hol_latency_ms_p99": round(_Percentile(latenciesSec, 99) * 1000.0, 3),
+            "hol_latency_ms_max": round(max(latenciesSec, default=0.0) * 1000.0, 3),
+        }
+    finally:
+        OctoWebStream.SetUseIncomingOverflowCutoff(oldMode)
+
+
+class TestOctoWebStreamFlowControl(unittest.TestCase):
+
+    def test_overflow_cutoff_does_not_block_other_streams(self) -> None:
+        legacy = RunHeadOfLineHarness(False)
+        cutoff = RunHeadOfLineHarness(True)
+
+        # All of the fast stream messages must be delivered in both modes.
+        self.assertEqual(legacy["fast_messages_delivered"], cutoff["fast_messages_delivered"])
+
+        # The legacy mode sleeps the receive thread in 100ms steps when the congested stream is full, which all other streams wait behind.
+        self.assertGreaterEqual(legacy["hol_latency_ms_max"], 90.0)
+        # The cutoff mode parks the congested stream's messages and never blocks the receive thread.
+        self.assertEqual(cutoff["overflow_cutoffs"], 0)
+        self.assertGreater(cutoff["parked_messages"], 0)
+        self.assertLess(cutoff["hol_latency_ms_p99"], legacy["hol_latency_ms_p99"])
+        self.assertEqual(cutoff["streams_closed_by_cutoff"], 0)
+
+
+    def test_overflow_cutoff_closes_without_blocking(self) -> None:
+        oldMode = OctoWebStream.GetUseIncomingOverflowCutoff()
+        OctoWebStream.SetUseIncomingOverflowCutoff(True)
+        try:
+            stream = OctoWebStream(name="FlowControlTest", args=(logging.getLogger("test"), 1, FakeOctoSession()))
+            # Fill the message count limit and then the rest of the cutoff with one large message.
+            for _ in range(OctoWebStream.c_MaxIncomingMessagesQueued):
+                stream.OnIncomingServerMessage(FakeIncomingMsg(0, 1)) #pyright: ignore[reportArgumentType]
+            remainingCutoffBytes = MemoryManager.OctoWebStream_IncomingOverflowCutoffBytes - OctoWebStream.c_MaxIncomingMessagesQueued
+            stream.OnIncomingServerMessage(FakeIncomingMsg(0, remainingCutoffBytes)) #pyright: ignore[reportArgumentType]
+            self.assertEqual(stream.IncomingParkedMessageCount, 1)
+            self.assertFalse(stream.IsClosed)
+
+            # The next message doesn't fit, so the stream is closed right away rather than blocking the receive thread.
+            startSec = time.time()
+            stream.OnIncomingServerMessage(FakeIncomingMsg(0, 1)) #pyright: ignore[reportArgumentType]
+            self.assertLess(time.time() - startSec, 0.05)
+            self.assertEqual(stream.IncomingOverflowCutoffCount, 1)
+            self.assertTrue(stream.IsClosed)
+        finally:
+            OctoWebStream.SetUseIncomingOverflowCutoff(oldMode)
+
+
+if __name__ == "__main__":
+    # Run the full size harness and print the results, so the two modes can be compared.
+    for useOverflowCutoff in (False, True):
+        print(json.dumps(RunHeadOfLineHarness(useOverflowCutoff, streamCount=50, messageCount=10000, arrivalIntervalSec=0.0001)))
@@ -0,0 +1,159 @@
+# ruff: noqa: E402
+import logging
+import threading
+import time
+import unittest
+from typing import List, Tuple
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer
+from octoeverywhere.WebStream.octowebstreamhttppipeline import HttpBodyPipeline, PipelineStageTimer
+
+
+class FakeWebStream:
+    def __init__(self, sendDelaySec:float=0.0) -> None:
+        self.SendDelaySec = sendDelaySec
+        self.Sent:List[Tuple[bytes, bool]] = []
+        self.Lock = threading.Lock()
+        self.ClosedCalled = False
+
+
+    def SendToOctoStream(self, buffer:Buffer, msgStartOffsetBytes:int, msgSize:int, isCloseFlagSet:bool=False, silentlyFail:bool=False) -> None:
+        if self.SendDelaySec > 0:
+            time.sleep(self.SendDelaySec)
+        data = bytes(buffer.GetBytesLike()[msgStartOffsetBytes:msgStartOffsetBytes + msgSize])
+        with self.Lock:
+            self.Sent.append((data, isCloseFlagSet))
+
+
+    def Close(self) -> None:
+        self.ClosedCalled = True
+
+
+    def SetClosedDueToFailedRequestConnection(self) -> None:
+        pass
+
+
+class FakeBody:
+    def __init__(self, data:bytes, readDelaySec:float=0.0) -> None:
+        self.Data = data
+        self.Offset = 0
+        self.ReadDelaySec = readDelaySec
+
+
+    def ReadInto(self, targetBuffer:bytearray, offset:int, readSize:int) -> int:
+        if self.ReadDelaySec > 0:
+            time.sleep(self.ReadDelaySec)
+        readSize = min(readSize, len(self.Data) - self.Offset)
+        targetBuffer[offset:offset + readSize] = self.Data[self.Offset:self.Offset + readSize]
+        self.Offset += readSize
+        return readSize
+
+
+class TestHttpBodyPipeline(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_octowebstreamhttppipeline")
+
+
+    def _RunPipeline(self, pipeline:HttpBodyPipeline, processDelaySec:float=0.0) -> int:
+        # Acts like the web stream thread, taking each read, "compressing" it, and queueing it to be sent.
+        chunkCount = 0
+        while True:
+            result = pipeline.Read()
+            isLast = result is None
+            data = b""
+            if result is not None:
+                buffer, size = result
+                data = bytes(buffer[0:size])
+                pipeline.ReturnReadBuffer(buffer)
+                if processDelaySec > 0:
+                    time.sleep(processDelaySec)
+            pipeline.QueueSend(Buffer(data), 0, len(data), isLast)
+            chunkCount += 1
+            if isLast:
+                break
+        pipeline.WaitForSendsComplete()
+        pipeline.CloseAsync()
+        return chunkCount
+
+
+    def test_pipeline_keeps_order_and_reads_full_body(self) -> None:
+        data = bytes(i % 251 for i in range(100 * 1024 + 17))
+        body = FakeBody(data)
+        webStream = FakeWebStream()
+        pipeline = HttpBodyPipeline(self.Logger, 1, webStream, body.ReadInto, len(data), 4096, maxStageBufferedBytes=16 * 1024) #pyright: ignore[reportArgumentType]
+        self._RunPipeline(pipeline)
+
+        sentData = b"".join(d for d, _ in webStream.Sent)
+        self.assertEqual(sentData, data)
+        # Only the last message should have the close flag.
+        self.assertTrue(webStream.Sent[-1][1])
+        self.assertFalse(any(isClose for _, isClose in webStream.Sent[:-1]))
+
+
+    def test_pipeline_read_buffers_are_bounded(self) -> None:
+        data = bytes(64 * 1024)
+        body = FakeBody(data)
+        webStream = FakeWebStream()
+        pipeline = HttpBodyPipeline(self.Logger, 2, webStream, body.ReadInto, len(data), 4096, maxStageBufferedBytes=8 * 1024) #pyright: ignore[reportArgumentType]
+        self._RunPipeline(pipeline, processDelaySec=0.001)
+        self.assertLessEqual(pipeline.ReadBuffersCreated, 2)
+        self.assertEqual(len(b"".join(d for d, _ in webStream.Sent)), len(data))
+
+
+    def test_pipeline_stages_overlap(self) -> None:
+        data = bytes(40 * 1024)
+        body = FakeBody(data, readDelaySec=0.005)
+        webStream = FakeWebStream(sendDelaySec=0.005)
+        pipeline = HttpBodyPipeline(self.Logger, 3, webStream, body.ReadInto, len(data), 4096, maxStageBufferedBytes=32 * 1024) #pyright: ignore[reportArgumentType]
+        self._RunPipeline(pipeline, processDelaySec=0.005)
+        timer = pipeline.Timer
+        self.assertGreater(timer.BusyTimeSec[PipelineStageTimer.StageRead], 0)
+        self.assertGreater(timer.OverlappedTimeSec[PipelineStageTimer.StageRead], 0)
+        self.assertGreater(timer.OverlappedTimeSec[PipelineStageTimer.StageSend], 0)
+        self.assertIn("read:", pipeline.GetStatsStr())
+
+
+    def test_close_unblocks_reader(self) -> None:
+        data = bytes(64 * 1024)
+        body = FakeBody(data)
+        webStream = FakeWebStream()
+        pipeline = HttpBodyPipeline(self.Logger, 4, webStream, body.ReadInto, len(data), 4096, maxStageBufferedBytes=8 * 1024) #pyright: ignore[reportArgumentType]
+        # Only take one chunk, the read thread will fill its buffers and block until we close.
+        self.assertIsNotNone(pipeline.Read())
+        time.sleep(0.05)
+        pipeline.CloseAsync()
+        # The compress stage the read started is ended by the close, like when the request throws before sending it.
+        self.assertFalse(pipeline.Timer.IsBusy[PipelineStageTimer.StageCompress])
+        pipeline.ReadThread.join(timeout=2)
+        pipeline.SendThread.join(timeout=2)
+        self.assertFalse(pipeline.ReadThread.is_alive())
+        self.assertFalse(pipeline.SendThread.is_alive())
+        self.assertIsNone(pipeline.Read())
+
+
+    def test_read_failure_closes_the_stream(self) -> None:
+        data = bytes(64 * 1024)
+        body = FakeBody(data)
+        def readInto(targetBuffer:bytearray, offset:int, readSize:int) -> int:
+            if body.Offset >= 8 * 1024:
+                raise Exception("connection reset")
+            return body.ReadInto(targetBuffer, offset, readSize)
+        webStream = FakeWebStream()
+        pipeline = HttpBodyPipeline(self.Logger, 5, webStream, readInto, len(data), 4096, maxStageBufferedBytes=32 * 1024) #pyright: ignore[reportArgumentType]
+        pipeline.ReadThread.join(timeout=2)
+        # The stream is closed and the caller doesn't get the partial body as a complete one.
+        self.assertTrue(webStream.ClosedCalled)
+        self.assertIsNotNone(pipeline.ReadException)
+        self.assertIsNone(pipeline.Read())
+        pipeline.QueueSend(Buffer(b"last"), 0, 4, True)
+        pipeline.WaitForSendsComplete()
+        self.assertFalse(any(isClose for _, isClose in webStream.Sent))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -648,17 +648,15 @@ class TestOctoWebStreamUploadBody(unittest.TestCase):
         session = RecordingSession([FakeResponse(431), FakeResponse(200)])
 
         with patch("octoeverywhere.octohttprequest.HttpSessions.GetSession", return_value=session):
-            ret = OctoHttpRequest.MakeHttpCallAttempt(self.logger, "test", "POST", "http://example.local/api", {"X-Test": "1"}, body, None, False, None)
+            response = OctoHttpRequest._MakeRequest(self.logger, "test", "POST", "http://example.local/api", {"X-Test": "1"}, body)
 
-        self.assertTrue(ret.IsChainDone)
-        self.assertIsNotNone(ret.Result)
-        self.assertEqual(ret.Result.StatusCode, 200)
+        self.assertIsNotNone(response)
+        self.assertEqual(response.status_code, 200)
         self.assertEqual(len(session.Calls), 2)
         self.assertEqual(session.Calls[0]["body"], payload)
         self.assertEqual(session.Calls[1]["body"], payload)
         self.assertEqual(session.Calls[0]["headers"], {"X-Test": "1"})
         self.assertEqual(session.Calls[1]["headers"], {})
-        ret.Result.Free()
 
 
     def test_command_path_parsing_allows_no_post_body(self) -> None:
@@ -0,0 +1,132 @@
+# ruff: noqa: E402
+import io
+import logging
+import unittest
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer
+from octoeverywhere.sendbufferpool import SendBufferPool, SendCopyStats
+
+
+class TestSendBufferPool(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_sendbufferpool")
+
+
+    def test_class_sizes(self) -> None:
+        minSize = SendBufferPool.c_MinClassSizeBytes
+        self.assertEqual(SendBufferPool.GetClassSizeBytes(1), minSize)
+        self.assertEqual(SendBufferPool.GetClassSizeBytes(minSize), minSize)
+        # Sizes are rounded up to the next quarter step of their power of two.
+        self.assertEqual(SendBufferPool.GetClassSizeBytes(minSize + 1), minSize + minSize // 4)
+        self.assertEqual(SendBufferPool.GetClassSizeBytes(1024 * 1024), 1024 * 1024)
+        self.assertEqual(SendBufferPool.GetClassSizeBytes(1024 * 1024 + 1), 1024 * 1024 + 256 * 1024)
+        # A class size always maps to itself, so returned buffers can be reused.
+        for size in (minSize + 1, 300 * 1024, 5 * 1024 * 1024 + 7):
+            classSize = SendBufferPool.GetClassSizeBytes(size)
+            self.assertGreaterEqual(classSize, size)
+            self.assertLessEqual(classSize, size + size // 4)
+            self.assertEqual(SendBufferPool.GetClassSizeBytes(classSize), classSize)
+
+
+    def test_returned_buffers_are_reused(self) -> None:
+        pool = SendBufferPool(self.Logger, maxPooledBytes=1024 * 1024)
+        first = pool.Rent(100 * 1024)
+        firstData = first.Get()
+        pool.Return(first)
+        # A similar size is in the same class, so it's a hit.
+        second = pool.Rent(110 * 1024)
+        self.assertIs(second.Get(), firstData)
+        # A different class is a miss.
+        third = pool.Rent(200 * 1024)
+        self.assertIsNot(third.Get(), firstData)
+        stats = pool.GetStats()
+        self.assertEqual(stats["Hits"], 1)
+        self.assertEqual(stats["Misses"], 2)
+        self.assertEqual(stats["PooledBytes"], 0)
+        self.assertEqual(stats["Outstanding"], 2)
+        self.assertEqual(stats["OutstandingBytes"], len(second) + len(third))
+        pool.Return(second)
+        pool.Return(third)
+        stats = pool.GetStats()
+        self.assertEqual(stats["Outstanding"], 0)
+        self.assertEqual(stats["OutstandingBytes"], 0)
+
+
+    def test_pooled_bytes_are_capped(self) -> None:
+        classSize = SendBufferPool.c_MinClassSizeBytes
+        pool = SendBufferPool(self.Logger, maxPooledBytes=classSize * 2 + 1)
+        buffers = [pool.Rent(classSize) for _ in range(3)]
+        for b in buffers:
+            pool.Return(b)
+        stats = pool.GetStats()
+        # The last one would go over the cap, so it's dropped.
+        self.assertEqual(stats["PooledBuffers"], 2)
+        self.assertEqual(stats["PooledBytes"], classSize * 2)
+        self.assertEqual(stats["Dropped"], 1)
+
+
+    def test_large_buffers_are_not_pooled(self) -> None:
+        pool = SendBufferPool(self.Logger, maxPooledBytes=64 * 1024 * 1024)
+        size = SendBufferPool.c_MaxClassSizeBytes + 1
+        buffer = pool.Rent(size)
+        self.assertEqual(len(buffer), size)
+        pool.Return(buffer)
+        stats = pool.GetStats()
+        self.assertEqual(stats["Unpooled"], 1)
+        self.assertEqual(stats["Dropped"], 1)
+        self.assertEqual(stats["PooledBuffers"], 0)
+        self.assertEqual(stats["Outstanding"], 0)
+
+
+    def test_send_complete_returns_the_buffer_once(self) -> None:
+        pool = SendBufferPool(self.Logger, maxPooledBytes=1024 * 1024)
+        pooledBuffer = pool.Rent(100 * 1024)
+        buffer = Buffer(pooledBuffer.Get())
+        buffer.SetOnSendComplete(lambda: pool.Return(pooledBuffer))
+        buffer.OnSendComplete()
+        buffer.OnSendComplete()
+        stats = pool.GetStats()
+        self.assertEqual(stats["PooledBuffers"], 1)
+        self.assertEqual(stats["Returns"], 1)
+
+
+    def test_upload_copy_uses_the_pool(self) -> None:
+        # pylint: disable=import-outside-toplevel
+        from octoeverywhere.WebStream.uploadbody import UploadBody
+        pool = SendBufferPool(self.Logger, maxPooledBytes=8 * 1024 * 1024)
+        oldInstance = SendBufferPool.Get()
+        SendBufferPool._Instance = pool #pylint: disable=protected-access
+        try:
+            data = bytes(range(256)) * 8 * 1024
+            source = io.BytesIO(data)
+            target = io.BytesIO()
+            uploadBody = UploadBody.__new__(UploadBody)
+            copied = uploadBody._CopyBytes(source, target, len(data)) #pylint: disable=protected-access
+            self.assertEqual(copied, len(data))
+            self.assertEqual(target.getvalue(), data)
+            stats = pool.GetStats()
+            self.assertEqual(stats["Outstanding"], 0)
+            self.assertEqual(stats["PooledBuffers"], 1)
+        finally:
+            SendBufferPool._Instance = oldInstance #pylint: disable=protected-access
+
+
+    def test_copy_stats(self) -> None:
+        SendCopyStats.Reset()
+        SendCopyStats.OnCopy(10)
+        SendCopyStats.OnZeroCopy(20)
+        SendCopyStats.OnZeroCopy(30)
+        stats = SendCopyStats.GetStats()
+        self.assertEqual(stats["Copies"], 1)
+        self.assertEqual(stats["BytesCopied"], 10)
+        self.assertEqual(stats["ZeroCopies"], 2)
+        self.assertEqual(stats["BytesZeroCopied"], 50)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+# ruff: noqa: E402
+import threading
+import unittest
+from typing import List, Tuple
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.sendscheduler import SendScheduler
+from octoeverywhere.Proto.MessagePriority import MessagePriority
+
+
+class TestSendScheduler(unittest.TestCase):
+
+    def _GetAll(self, scheduler:SendScheduler) -> List[Tuple[int, int]]:
+        items:List[Tuple[int, int]] = []
+        while True:
+            item = scheduler.Get(timeoutSec=0)
+            if item is None:
+                return items
+            items.append(item)
+
+
+    def test_small_messages_interleave_with_a_big_transfer(self) -> None:
+        scheduler = SendScheduler()
+        # A big download is queued first, then a small json-rpc response and a webcam frame from other streams.
+        for i in range(40):
+            scheduler.Put((1, i), 256 * 1024, streamId=1)
+        scheduler.Put((2, 0), 300, streamId=2)
+        scheduler.Put((3, 0), 40 * 1024, streamId=3, priority=MessagePriority.High)
+        items = self._GetAll(scheduler)
+        self.assertEqual(len(items), 42)
+        # The small messages don't wait for the whole download.
+        self.assertLess(items.index((2, 0)), 3)
+        self.assertLess(items.index((3, 0)), 3)
+        # Each stream's messages are still in order.
+        self.assertEqual([i for i in items if i[0] == 1], [(1, i) for i in range(40)])
+        stats = scheduler.GetSchedulerStats()
+        self.assertEqual(stats["QueuedBytes"], 0)
+        self.assertEqual(stats["QueueDelay"]["Normal"]["Count"], 41)
+        self.assertEqual(stats["QueueDelay"]["High"]["Count"], 1)
+        self.assertEqual(stats["SentBytes"]["High"], 40 * 1024)
+
+
+    def test_critical_first_and_weighted_classes(self) -> None:
+        scheduler = SendScheduler()
+        for i in range(30):
+            scheduler.Put((1, i), 64 * 1024, streamId=1, priority=MessagePriority.Normal)
+            scheduler.Put((2, i), 64 * 1024, streamId=2, priority=MessagePriority.High)
+        scheduler.Put((0, 0), 100, priority=MessagePriority.Critical)
+        self.assertEqual(scheduler.Get(timeoutSec=0), (0, 0))
+        # While both streams are busy, the high class gets twice the bytes of the normal class.
+        first = [scheduler.Get(timeoutSec=0) for _ in range(18)]
+        highCount = len([i for i in first if i is not None and i[0] == 2])
+        self.assertEqual(highCount, 12)
+        self.assertEqual(len(self._GetAll(scheduler)), 60 - 18)
+
+
+    def test_close_returns_queued_items_and_wakes_getters(self) -> None:
+        scheduler = SendScheduler()
+        scheduler.Put("a", 10, streamId=1)
+        self.assertEqual(scheduler.GetFlowQueuedBytes(1, MessagePriority.Normal), 10)
+        results:List[object] = []
+        other = SendScheduler()
+        thread = threading.Thread(target=lambda: results.append(other.Get()), daemon=True)
+        thread.start()
+        self.assertEqual(other.Close(), [])
+        thread.join(1)
+        self.assertEqual(results, [None])
+        self.assertEqual(scheduler.Close(), ["a"])
+        self.assertFalse(scheduler.Put("b", 10))
+        self.assertIsNone(scheduler.Get(timeoutSec=0))
+
+
+if __name__ == "__main__":
+    unittest.main()
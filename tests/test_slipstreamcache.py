@@ -0,0 +1,135 @@
+# ruff: noqa: E402
+import os
+import json
+import shutil
+import logging
+import tempfile
+import unittest
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer
+from octoeverywhere.compression import Compression, CompressionContext
+from octoeverywhere.httpresult import HttpResult
+from octoeverywhere.slipstreamcache import SlipstreamCache
+
+
+class TestSlipstreamCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_slipstreamcache")
+        self.StorageDir = tempfile.mkdtemp()
+        Compression.Init(self.Logger, self.StorageDir)
+
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.StorageDir, ignore_errors=True)
+
+
+    def _BuildResult(self, url:str, body:bytes, headers:dict) -> HttpResult:
+        compressed, compressionType, ogSize = SlipstreamCache.Precompress(self.Logger, Buffer(body))
+        result = HttpResult(200, headers, url, False)
+        result.SetFullBodyBuffer(compressed, compressionType, ogSize)
+        return result
+
+
+    def _Decompress(self, result:HttpResult) -> bytes:
+        body = result.FullBodyBuffer
+        self.assertIsNotNone(body)
+        with CompressionContext(self.Logger) as compressionContext:
+            return bytes(Compression.Get().Decompress(compressionContext, body, result.BodyBufferPreCompressSize, True, result.BodyBufferCompressionType).GetBytesLike()) #pyright: ignore[reportArgumentType]
+
+
+    def test_warm_start_from_disk(self) -> None:
+        body = b"".join(b"<div class=\"row\">%d</div>\n" % i for i in range(5000))
+        cache = SlipstreamCache(self.Logger, self.StorageDir)
+        self.assertTrue(cache.Store("/", self._BuildResult("/", body, {"ETag": "\"abc\"", "Content-Type": "text/html"}), SlipstreamCache.GetBodyHash(Buffer(body))))
+
+        # A new cache, like after a restart, loads the index but only reads the body once it's used.
+        restarted = SlipstreamCache(self.Logger, self.StorageDir)
+        self.assertEqual(restarted.GetUrls(), ["/"])
+        self.assertEqual(restarted.GetStats()["InMemory"], 0)
+        result = restarted.Get("/")
+        self.assertIsNotNone(result)
+        assert result is not None
+        self.assertEqual(self._Decompress(result), body)
+        self.assertEqual(result.Headers["content-type"], "text/html")
+        self.assertEqual(restarted.GetStats()["DiskLoads"], 1)
+        self.assertIsNone(restarted.Get("/missing"))
+
+
+    def test_revalidation_and_hash_refresh(self) -> None:
+        body = b"var a = 1;\n" * 1000
+        bodyHash = SlipstreamCache.GetBodyHash(Buffer(body))
+        cache = SlipstreamCache(self.Logger, self.StorageDir)
+        self.assertEqual(cache.GetRevalidationHeaders("/app.js"), {})
+        cache.Store("/app.js", self._BuildResult("/app.js", body, {"ETag": "\"v1\"", "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"}), bodyHash)
+        self.assertEqual(cache.GetRevalidationHeaders("/app.js"), {"If-None-Match": "\"v1\"", "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT"})
+        self.assertTrue(cache.OnNotModified("/app.js"))
+        self.assertFalse(cache.OnNotModified("/other.js"))
+
+        # The same body with new headers is refreshed without storing it again.
+        self.assertFalse(cache.TryRefreshIfBodyHashMatches("/app.js", "other-hash", 200, {}))
+        self.assertTrue(cache.TryRefreshIfBodyHashMatches("/app.js", bodyHash, 200, {"ETag": "\"v2\""}))
+        self.assertEqual(cache.GetRevalidationHeaders("/app.js"), {"If-None-Match": "\"v2\""})
+        restarted = SlipstreamCache(self.Logger, self.StorageDir)
+        self.assertEqual(restarted.GetRevalidationHeaders("/app.js"), {"If-None-Match": "\"v2\""})
+
+
+    def test_only_cacheable_headers_are_kept(self) -> None:
+        body = b"var b = 2;\n" * 1000
+        bodyHash = SlipstreamCache.GetBodyHash(Buffer(body))
+        cache = SlipstreamCache(self.Logger, self.StorageDir)
+        headers = {"Content-Type": "application/javascript", "ETag": "\"v1\"", "Set-Cookie": "session=secret", "Date": "Wed, 21 Oct 2015 07:28:00 GMT"}
+        cache.Store("/app.js", self._BuildResult("/app.js", body, headers), bodyHash)
+        indexPath = os.path.join(self.StorageDir, SlipstreamCache.c_FolderName, SlipstreamCache.c_IndexFileName)
+        with open(indexPath, "r", encoding="utf-8") as f:
+            self.assertNotIn("secret", f.read())
+        result = cache.Get("/app.js")
+        assert result is not None
+        self.assertEqual(sorted(k.lower() for k in result.Headers.keys()), ["content-type", "etag"])
+
+        # A refresh where only the volatile headers changed doesn't rewrite the index.
+        os.utime(indexPath, ns=(0, 0))
+        refreshHeaders = {"Content-Type": "application/javascript", "ETag": "\"v1\"", "Set-Cookie": "session=other", "Date": "Thu, 22 Oct 2015 07:28:00 GMT", "Expires": "Thu, 22 Oct 2015 08:28:00 GMT"}
+        self.assertTrue(cache.TryRefreshIfBodyHashMatches("/app.js", bodyHash, 200, refreshHeaders))
+        self.assertEqual(os.stat(indexPath).st_mtime_ns, 0)
+
+
+    def test_lru_eviction_by_budget(self) -> None:
+        bodies = {f"/{i}.js": os.urandom(4000) for i in range(3)}
+        results = {url: self._BuildResult(url, body, {}) for url, body in bodies.items()}
+        budget = sum(len(r.FullBodyBuffer) for r in results.values()) - 1 #pyright: ignore[reportArgumentType]
+        cache = SlipstreamCache(self.Logger, self.StorageDir, budget)
+        cache.Store("/0.js", results["/0.js"], SlipstreamCache.GetBodyHash(Buffer(bodies["/0.js"])))
+        cache.Store("/1.js", results["/1.js"], SlipstreamCache.GetBodyHash(Buffer(bodies["/1.js"])))
+        # Using /0.js makes /1.js the least recently used, so it's evicted.
+        self.assertIsNotNone(cache.Get("/0.js"))
+        cache.Store("/2.js", results["/2.js"], SlipstreamCache.GetBodyHash(Buffer(bodies["/2.js"])))
+        self.assertEqual(sorted(cache.GetUrls()), ["/0.js", "/2.js"])
+        self.assertLessEqual(cache.GetStats()["TotalBytes"], budget)
+        self.assertEqual(cache.GetStats()["Evictions"], 1)
+        # The evicted body file is deleted too.
+        folder = os.path.join(self.StorageDir, SlipstreamCache.c_FolderName)
+        self.assertEqual(len([f for f in os.listdir(folder) if f.endswith(".bin")]), 2)
+        cache.Remove("/0.js")
+        self.assertEqual(SlipstreamCache(self.Logger, self.StorageDir, budget).GetUrls(), ["/2.js"])
+
+
+    def test_format_change_drops_the_cache(self) -> None:
+        body = b"body {}\n" * 100
+        cache = SlipstreamCache(self.Logger, self.StorageDir)
+        cache.Store("/a.css", self._BuildResult("/a.css", body, {}), SlipstreamCache.GetBodyHash(Buffer(body)))
+        indexPath = os.path.join(self.StorageDir, SlipstreamCache.c_FolderName, SlipstreamCache.c_IndexFileName)
+        with open(indexPath, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        data["FormatId"] = "some-other-dict"
+        with open(indexPath, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        self.assertEqual(SlipstreamCache(self.Logger, self.StorageDir).GetUrls(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+# ruff: noqa: E402
+import time
+import logging
+import threading
+import unittest
+from typing import List
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer
+from octoeverywhere.httpresult import HttpResult, HttpResultOrNone
+from octoeverywhere.Webcam.quickcam import QuickCam, QuickCamManager
+from octoeverywhere.Webcam.snapshotservice import SnapshotService
+from octoeverywhere.Webcam.webcamsettingitem import WebcamSettingItem
+
+
+class TestSnapshotService(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_snapshotservice")
+        self.Service = SnapshotService(self.Logger)
+        self.Camera = WebcamSettingItem("cam", "http://127.0.0.1/snapshot", "http://127.0.0.1/stream")
+        self.Fetches = 0
+        self.FetchStatus = 200
+        self.FetchDelaySec = 0.0
+        self.OldQuickCamManager = QuickCamManager.Get()
+        QuickCamManager.Init(self.Logger, None) #pyright: ignore[reportArgumentType]
+
+
+    def tearDown(self) -> None:
+        QuickCamManager._Instance = self.OldQuickCamManager #pyright: ignore[reportPrivateUsage]
+
+
+    def _Fetch(self) -> HttpResultOrNone:
+        self.Fetches += 1
+        time.sleep(self.FetchDelaySec)
+        if self.FetchStatus != 200:
+            return HttpResult.Error(self.FetchStatus, "http://127.0.0.1/snapshot")
+        return HttpResult(200, {"Content-Type": "image/jpeg"}, "http://127.0.0.1/snapshot", False, fullBodyBuffer=Buffer(b"\xff\xd8snap\xff\xd9"))
+
+
+    def test_concurrent_requests_are_coalesced(self) -> None:
+        self.FetchDelaySec = 0.2
+        results:List[HttpResultOrNone] = []
+        threads = [threading.Thread(target=lambda: results.append(self.Service.GetSnapshot(self.Camera, self._Fetch))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.Fetches, 1)
+        self.assertEqual(len(results), 5)
+        for result in results:
+            self.assertEqual(result.StatusCode, 200) #pyright: ignore[reportOptionalMemberAccess]
+            self.assertEqual(result.FullBodyBuffer.Get(), b"\xff\xd8snap\xff\xd9") #pyright: ignore[reportOptionalMemberAccess]
+        # Each caller gets its own result, since they dispose them and change the headers.
+        self.assertEqual(len(set(id(r) for r in results)), 5)
+        stats = self.Service.GetStats()
+        self.assertEqual(stats["Misses"], 1)
+        self.assertEqual(stats["Coalesced"] + stats["Hits"], 4)
+
+
+    def test_cache_ttl(self) -> None:
+        with self.Service.GetSnapshot(self.Camera, self._Fetch): #pyright: ignore[reportOptionalContextManager]
+            pass
+        self.assertIsNotNone(self.Service.GetSnapshot(self.Camera, self._Fetch))
+        self.assertEqual(self.Fetches, 1)
+        self.assertEqual(self.Service.GetStats()["Hits"], 1)
+        # Once the snapshot is older than the TTL, it's fetched again.
+        for entry in self.Service.Entries.values():
+            entry.FetchedSec -= SnapshotService.c_CacheTtlSec
+        self.Service.GetSnapshot(self.Camera, self._Fetch)
+        self.assertEqual(self.Fetches, 2)
+        # Other cameras have their own snapshot.
+        self.Service.GetSnapshot(WebcamSettingItem("other", "http://127.0.0.2/snapshot"), self._Fetch)
+        self.assertEqual(self.Fetches, 3)
+
+
+    def test_failures_are_not_cached(self) -> None:
+        self.FetchStatus = 404
+        self.assertEqual(self.Service.GetSnapshot(self.Camera, self._Fetch).StatusCode, 404) #pyright: ignore[reportOptionalMemberAccess]
+        self.FetchStatus = 200
+        self.assertEqual(self.Service.GetSnapshot(self.Camera, self._Fetch).StatusCode, 200) #pyright: ignore[reportOptionalMemberAccess]
+        self.assertEqual(self.Fetches, 2)
+        self.assertEqual(self.Service.GetStats()["Failures"], 1)
+
+
+    def test_running_quickcam_frame_is_preferred(self) -> None:
+        camera = WebcamSettingItem("qc", None, "rtsp://127.0.0.1/live")
+        qc = QuickCam(self.Logger, "rtsp://127.0.0.1/live", None) #pyright: ignore[reportArgumentType]
+        QuickCamManager.Get().QuickCamMap["rtsp://127.0.0.1/live"] = qc
+        # If the capture thread isn't running, the snapshot is fetched.
+        self.Service.GetSnapshot(camera, self._Fetch)
+        self.assertEqual(self.Fetches, 1)
+        # If it is, its latest frame is used.
+        qc.IsCaptureThreadRunning = True
+        qc.CurrentImage = Buffer(b"\xff\xd8frame\xff\xd9")
+        result = self.Service.GetSnapshot(camera, self._Fetch)
+        self.assertEqual(result.FullBodyBuffer.Get(), b"\xff\xd8frame\xff\xd9") #pyright: ignore[reportOptionalMemberAccess]
+        self.assertEqual(self.Fetches, 1)
+        self.assertEqual(self.Service.GetStats()["QuickCamFrames"], 1)
+
+
+    def test_disabled(self) -> None:
+        SnapshotService.SetEnabled(False)
+        try:
+            self.Service.GetSnapshot(self.Camera, self._Fetch)
+            self.Service.GetSnapshot(self.Camera, self._Fetch)
+        finally:
+            SnapshotService.SetEnabled(True)
+        self.assertEqual(self.Fetches, 2)
+        self.assertEqual(self.Service.GetStats()["Requests"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
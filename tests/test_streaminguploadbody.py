@@ -0,0 +1,236 @@
+# ruff: noqa: E402
+import os
+import time
+import hashlib
+import logging
+import threading
+import unittest
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, List, Optional
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.compression import CompressionContext
+from octoeverywhere.httpresult import HttpResult
+from octoeverywhere.httpsessions import HttpSessions
+from octoeverywhere.octohttprequest import OctoHttpRequest
+from octoeverywhere.Proto.DataCompression import DataCompression
+from octoeverywhere.WebStream.uploadbody import StreamingUploadBody, UploadBody
+
+from tests.test_octowebstreamuploadbody import FakeWebStreamMsg
+
+
+# Reads the upload and returns how it was sent and the hash of the body.
+# The /nochunk path refuses chunked uploads, like some embedded servers do, and the /missing path reads the upload and returns a 404.
+class _UploadHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        isChunked = self.headers.get("Transfer-Encoding", "").lower() == "chunked"
+        if isChunked and self.path == "/nochunk":
+            self._Respond(411, b"length required")
+            self.close_connection = True
+            return
+        if isChunked:
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        else:
+            body = bytearray(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path == "/missing":
+            self._Respond(404, b"not found")
+            return
+        mode = b"chunked" if isChunked else b"length"
+        self._Respond(200, mode + b":" + hashlib.sha256(body).hexdigest().encode())
+
+
+    def _Respond(self, status:int, body:bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format:str, *args:Any) -> None: #pylint: disable=redefined-builtin
+        pass
+
+
+class TestStreamingUploadBody(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_streaminguploadbody")
+        HttpSessions.Init(self.Logger)
+        StreamingUploadBody.SetEnabled(True)
+        self.Server = ThreadingHTTPServer(("127.0.0.1", 0), _UploadHandler)
+        self.Server.daemon_threads = True
+        threading.Thread(target=self.Server.serve_forever, daemon=True).start()
+        self.Host = f"http://127.0.0.1:{self.Server.server_address[1]}"
+        self.BackendKey = f"127.0.0.1:{self.Server.server_address[1]}"
+        self.Payload = os.urandom(1024 * 1024 + 123)
+
+
+    def tearDown(self) -> None:
+        StreamingUploadBody.SetChunkedSupport(self.BackendKey, None)
+        StreamingUploadBody.SetEnabled(False)
+        self.Server.shutdown()
+        self.Server.server_close()
+
+
+    def _Create(self, knownSize:Optional[int], maxQueuedBytes:int, hasFallbackRoutes:bool=False) -> StreamingUploadBody:
+        uploadBody = UploadBody(self.Logger, 1, knownSize, CompressionContext(self.Logger))
+        return StreamingUploadBody(self.Logger, 1, uploadBody, self.BackendKey, hasFallbackRoutes, maxQueuedBytes=maxQueuedBytes)
+
+
+    # Feeds the payload like the web stream message thread would, with some messages compressed.
+    def _StartFeeding(self, body:StreamingUploadBody) -> threading.Thread:
+        def feed() -> None:
+            msgSize = 64 * 1024
+            for i in range(0, len(self.Payload), msgSize):
+                data = self.Payload[i:i + msgSize]
+                isDone = i + msgSize >= len(self.Payload)
+                if (i // msgSize) % 2 == 0:
+                    body.AppendMessage(FakeWebStreamMsg(data, isDone=isDone))
+                else:
+                    body.AppendMessage(FakeWebStreamMsg(_Zlib(data), DataCompression.Zlib, len(data), isDone))
+        thread = threading.Thread(target=feed, daemon=True)
+        thread.start()
+        return thread
+
+
+    def _Post(self, path:str, body:Any) -> HttpResult:
+        url = self.Host + path
+        response = OctoHttpRequest._MakeRequest(self.Logger, "test", "POST", url, {}, body) #pylint: disable=protected-access
+        self.assertIsNotNone(response)
+        return HttpResult.BuildFromRequestLibResponse(response, url, False)
+
+
+    def _ExpectedBody(self, mode:bytes) -> bytes:
+        return mode + b":" + hashlib.sha256(self.Payload).hexdigest().encode()
+
+
+    def test_known_size_upload_streams_with_back_pressure(self) -> None:
+        self.assertTrue(StreamingUploadBody.ShouldStream("POST", 4 * 1024 * 1024, self.BackendKey))
+        self.assertFalse(StreamingUploadBody.ShouldStream("GET", 4 * 1024 * 1024, self.BackendKey))
+        self.assertFalse(StreamingUploadBody.ShouldStream("POST", 1024, self.BackendKey))
+
+        body = self._Create(len(self.Payload), maxQueuedBytes=128 * 1024)
+        self.assertFalse(body.IsSpooling)
+        feeder = self._StartFeeding(body)
+        # Until the request starts reading, the appends are blocked instead of queuing the whole upload.
+        time.sleep(0.2)
+        self.assertTrue(feeder.is_alive())
+        with self._Post("/upload", body) as result:
+            self.assertEqual(result.StatusCode, 200)
+            self.assertEqual(result.ResponseForBodyRead.content, self._ExpectedBody(b"length"))
+        feeder.join(5)
+        self.assertGreater(body.BackpressureTimeSec, 0.1)
+        self.assertEqual(body.Position, len(self.Payload))
+        self.assertEqual(body.UploadBody.UploadBytesReceivedSoFar, 0)
+
+
+    def test_chunked_upload_falls_back_to_spooled_body_when_refused(self) -> None:
+        body = self._Create(None, maxQueuedBytes=128 * 1024)
+        self.assertTrue(body.IsSpooling)
+        feeder = self._StartFeeding(body)
+        calls:List[Any] = []
+        def makeRequest(uploadBody:UploadBody) -> HttpResult:
+            calls.append(uploadBody)
+            return self._Post("/nochunk", uploadBody)
+        with body.OnRequestResult(self._Post("/nochunk", body), makeRequest) as result:
+            self.assertEqual(result.StatusCode, 200)
+            self.assertEqual(result.ResponseForBodyRead.content, self._ExpectedBody(b"length"))
+        feeder.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertFalse(StreamingUploadBody.GetChunkedSupport(self.BackendKey))
+        # Now that the backend is known to refuse chunked uploads, uploads with an unknown size aren't streamed.
+        self.assertFalse(StreamingUploadBody.ShouldStream("POST", None, self.BackendKey))
+
+
+    def test_chunked_upload_stops_spooling_once_supported(self) -> None:
+        body = self._Create(None, maxQueuedBytes=128 * 1024)
+        feeder = self._StartFeeding(body)
+        with body.OnRequestResult(self._Post("/upload", body), lambda b: self.fail("should not retry")) as result:
+            self.assertEqual(result.ResponseForBodyRead.content, self._ExpectedBody(b"chunked"))
+        feeder.join(5)
+        self.assertTrue(StreamingUploadBody.GetChunkedSupport(self.BackendKey))
+        body.UploadBody.Cleanup()
+
+        body = self._Create(None, maxQueuedBytes=128 * 1024)
+        self.assertFalse(body.IsSpooling)
+        feeder = self._StartFeeding(body)
+        with self._Post("/upload", body) as result:
+            self.assertEqual(result.ResponseForBodyRead.content, self._ExpectedBody(b"chunked"))
+        feeder.join(5)
+        self.assertEqual(body.UploadBody.UploadBytesReceivedSoFar, 0)
+
+
+    def test_known_size_upload_is_resent_when_the_route_fails(self) -> None:
+        # With fallback routes, the upload is spooled, so if the route it streamed to 404s, it can still be sent to the others.
+        body = self._Create(len(self.Payload), maxQueuedBytes=128 * 1024, hasFallbackRoutes=True)
+        self.assertTrue(body.IsSpooling)
+        feeder = self._StartFeeding(body)
+        calls:List[Any] = []
+        def makeRequest(uploadBody:UploadBody) -> HttpResult:
+            calls.append(uploadBody)
+            return self._Post("/upload", uploadBody)
+        with body.OnRequestResult(self._Post("/missing", body), makeRequest) as result:
+            self.assertEqual(result.StatusCode, 200)
+            self.assertEqual(result.ResponseForBodyRead.content, self._ExpectedBody(b"length"))
+        feeder.join(5)
+        self.assertEqual(len(calls), 1)
+        body.UploadBody.Cleanup()
+
+        # Without fallback routes, the 404 is the result.
+        body = self._Create(len(self.Payload), maxQueuedBytes=128 * 1024)
+        feeder = self._StartFeeding(body)
+        with body.OnRequestResult(self._Post("/missing", body), lambda b: self.fail("should not retry")) as result:
+            self.assertEqual(result.StatusCode, 404)
+        feeder.join(5)
+
+
+    def test_finish_after_an_early_response_is_a_no_op(self) -> None:
+        # The request finished before all of the upload arrived, so the request thread aborted the upload.
+        body = self._Create(10, maxQueuedBytes=1024)
+        body.AppendMessage(FakeWebStreamMsg(b"12345"))
+        body.Abort()
+        body.AppendMessage(FakeWebStreamMsg(b"67890", isDone=True))
+        body.Finish()
+        self.assertFalse(body.IsFinished)
+
+        # If the upload wasn't aborted, a short upload is still an error.
+        body = self._Create(10, maxQueuedBytes=1024)
+        body.AppendMessage(FakeWebStreamMsg(b"12345"))
+        with self.assertRaisesRegex(Exception, "haven't gotten all of the upload payload"):
+            body.Finish()
+        self.assertTrue(body.IsAborted)
+
+
+    def test_abort_unblocks_append_and_read(self) -> None:
+        body = self._Create(len(self.Payload), maxQueuedBytes=64 * 1024)
+        feeder = self._StartFeeding(body)
+        time.sleep(0.05)
+        # Nothing is reading, so the feeder is blocked on the full queue.
+        self.assertTrue(feeder.is_alive())
+        body.Abort()
+        feeder.join(1)
+        self.assertFalse(feeder.is_alive())
+        with self.assertRaisesRegex(Exception, "aborted"):
+            body.read(1024)
+        self.assertFalse(body.CanSend())
+
+
+def _Zlib(data:bytes) -> bytes:
+    compressor = zlib.compressobj(3)
+    return compressor.compress(data) + compressor.flush()
+
+
+if __name__ == "__main__":
+    unittest.main()
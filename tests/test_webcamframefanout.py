@@ -0,0 +1,104 @@
+# ruff: noqa: E402
+import logging
+import unittest
+from typing import Callable, List
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer, BufferOrNone
+from octoeverywhere.interfaces import IQuickCam
+from octoeverywhere.Webcam.webcamframefanout import WebcamFrameFanout
+from octoeverywhere.Webcam.webcamquality import WebcamQuality
+from octoeverywhere.Webcam.webcamstreaminstance import WebcamStreamInstance
+
+
+class _FakeQuickCam(IQuickCam):
+    def __init__(self, logger:logging.Logger) -> None:
+        self.CurrentImage:BufferOrNone = Buffer(b"\xff\xd8first\xff\xd9")
+        self.Callbacks:List[Callable[[Buffer], None]] = []
+        self.FrameFanout = WebcamFrameFanout(logger)
+
+    def GetCurrentImage(self) -> BufferOrNone:
+        return self.CurrentImage
+
+    def AttachImageStreamCallback(self, callback:Callable[[Buffer], None]) -> None:
+        self.Callbacks.append(callback)
+
+    def DetachImageStreamCallback(self, callback:Callable[[Buffer], None]):
+        if callback in self.Callbacks:
+            self.Callbacks.remove(callback)
+
+    def GetFrameFanout(self) -> WebcamFrameFanout:
+        return self.FrameFanout
+
+    def SetNewImage(self, img:Buffer) -> None:
+        self.CurrentImage = img
+        for callback in self.Callbacks:
+            callback(img)
+
+
+class TestWebcamFrameFanout(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_webcamframefanout")
+
+
+    def _StartViewer(self, cam:_FakeQuickCam) -> WebcamStreamInstance:
+        viewer = WebcamStreamInstance(self.Logger, cam)
+        self.assertIsNotNone(viewer.StartWebRequest())
+        return viewer
+
+
+    def test_frames_are_built_once_per_camera(self) -> None:
+        camA = _FakeQuickCam(self.Logger)
+        camB = _FakeQuickCam(self.Logger)
+        viewersA = [self._StartViewer(camA) for _ in range(3)]
+        viewersB = [self._StartViewer(camB) for _ in range(2)]
+
+        # The first send is the frame twice in a row, and it's the same shared frame both times.
+        first = viewersA[0]._CustomBodyStreamRead() #pyright: ignore[reportPrivateUsage]
+        repeat = viewersA[0]._CustomBodyStreamRead() #pyright: ignore[reportPrivateUsage]
+        self.assertIs(repeat.Get(), first.Get()) #pyright: ignore[reportOptionalMemberAccess]
+        self.assertEqual(first.Get(), b"--oestreamboundary\r\nContent-Type: image/jpeg\r\nContent-Length: 9\r\n\r\n\xff\xd8first\xff\xd9\r\n") #pyright: ignore[reportOptionalMemberAccess]
+        repeat.OnSendComplete() #pyright: ignore[reportOptionalMemberAccess]
+        for viewer in viewersA[1:] + viewersB:
+            viewer._CustomBodyStreamRead() #pyright: ignore[reportPrivateUsage]
+            viewer._CustomBodyStreamRead().OnSendComplete() #pyright: ignore[reportPrivateUsage, reportOptionalMemberAccess]
+
+        # Both cameras stream at the same time, and they don't evict each other's frames.
+        for i in range(5):
+            imgA = Buffer(b"\xff\xd8A" + bytes([i]) + b"\xff\xd9")
+            imgB = Buffer(b"\xff\xd8B" + bytes([i]) + b"\xff\xd9")
+            camA.SetNewImage(imgA)
+            camB.SetNewImage(imgB)
+            framesA = [v._CustomBodyStreamRead() for v in viewersA] #pyright: ignore[reportPrivateUsage]
+            framesB = [v._CustomBodyStreamRead() for v in viewersB] #pyright: ignore[reportPrivateUsage]
+            self.assertTrue(all(f.Get() is framesA[0].Get() for f in framesA)) #pyright: ignore[reportOptionalMemberAccess]
+            self.assertTrue(bytes(framesB[0].Get()).find(b"B" + bytes([i])) != -1) #pyright: ignore[reportOptionalMemberAccess]
+            for f in framesA + framesB:
+                f.OnSendComplete() #pyright: ignore[reportOptionalMemberAccess]
+
+        statsA = camA.FrameFanout.GetStats()
+        self.assertEqual(statsA["Viewers"], 3)
+        self.assertEqual(statsA["Tiers"]["Full"]["FrameBuilds"], 6)
+        self.assertEqual(statsA["Tiers"]["Full"]["Deliveries"], 18)
+        self.assertEqual(camB.FrameFanout.GetStats()["Tiers"]["Full"]["FrameBuilds"], 6)
+        self.assertEqual([p["Delivered"] for p in statsA["ViewerPacing"]], [6, 6, 6])
+
+        # A viewer closing on one camera doesn't clear the other camera's frame.
+        viewersA[0]._CustomBodyStreamClosed() #pyright: ignore[reportPrivateUsage]
+        viewersA[0]._CustomBodyStreamClosed() #pyright: ignore[reportPrivateUsage]
+        self.assertEqual(camA.FrameFanout.GetStats()["Viewers"], 2)
+        self.assertIsNotNone(camB.FrameFanout.Tiers[WebcamQuality.Full].CachedFrame)
+
+        # Once the last viewer leaves, the frame is released.
+        for viewer in viewersA[1:]:
+            viewer._CustomBodyStreamClosed() #pyright: ignore[reportPrivateUsage]
+        self.assertNotIn(WebcamQuality.Full, camA.FrameFanout.Tiers)
+        self.assertEqual(len(camA.Callbacks), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
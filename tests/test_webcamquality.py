@@ -0,0 +1,98 @@
+# ruff: noqa: E402
+import io
+import logging
+import unittest
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer
+from octoeverywhere.Webcam.webcamquality import WebcamDownscaler, WebcamQuality
+from octoeverywhere.Webcam.webcamstreaminstance import WebcamStreamInstance
+from tests.test_webcamframefanout import _FakeQuickCam
+
+
+def _MakeJpeg(width:int, height:int, shade:int) -> Buffer:
+    from PIL import Image # pylint: disable=import-outside-toplevel
+    img = Image.new("RGB", (width, height))
+    # A gradient, so the jpeg isn't trivially small.
+    img.putdata([((x * 7 + shade) % 256, (y * 3) % 256, (x + y) % 256) for y in range(height) for x in range(width)])
+    out = io.BytesIO()
+    img.save(out, format="JPEG", quality=90)
+    return Buffer(out.getvalue())
+
+
+def _GetJpegSize(frame:Buffer):
+    from PIL import Image # pylint: disable=import-outside-toplevel
+    data = bytes(frame.Get())
+    jpeg = data[data.find(b"\r\n\r\n") + 4:-2]
+    with Image.open(io.BytesIO(jpeg)) as img:
+        return img.size
+
+
+class TestWebcamQuality(unittest.TestCase):
+
+    def test_parse_quality(self) -> None:
+        self.assertEqual(WebcamQuality.FromString("720p"), WebcamQuality.HD720)
+        self.assertEqual(WebcamQuality.FromString(" 480 "), WebcamQuality.SD480)
+        self.assertEqual(WebcamQuality.FromString("Full"), WebcamQuality.Full)
+        self.assertIsNone(WebcamQuality.FromString("1080p"))
+        self.assertIsNone(WebcamQuality.FromString(None))
+
+
+    @unittest.skipIf(WebcamDownscaler.IsAvailable() is False, "PIL isn't installed.")
+    def test_downscale(self) -> None:
+        jpeg = _MakeJpeg(1600, 1200, 0)
+        scaled, cpuSec = WebcamDownscaler.Downscale(jpeg, 480)
+        self.assertIsNotNone(scaled)
+        self.assertLess(len(scaled), len(jpeg)) #pyright: ignore[reportArgumentType]
+        self.assertGreaterEqual(cpuSec, 0.0)
+        # Images that already fit the tier aren't changed.
+        self.assertIsNone(WebcamDownscaler.Downscale(_MakeJpeg(320, 240, 0), 480)[0])
+
+
+    @unittest.skipIf(WebcamDownscaler.IsAvailable() is False, "PIL isn't installed.")
+    def test_smaller_tiers_save_more_bytes(self) -> None:
+        jpeg = _MakeJpeg(1280, 960, 0)
+        hd, _ = WebcamDownscaler.Downscale(jpeg, WebcamQuality.HD720.value)
+        sd, _ = WebcamDownscaler.Downscale(jpeg, WebcamQuality.SD480.value)
+        self.assertIsNotNone(hd)
+        self.assertIsNotNone(sd)
+        self.assertLess(len(hd), len(jpeg)) #pyright: ignore[reportArgumentType]
+        self.assertLess(len(sd), len(hd)) #pyright: ignore[reportArgumentType]
+
+
+    @unittest.skipIf(WebcamDownscaler.IsAvailable() is False, "PIL isn't installed.")
+    def test_tiers_are_built_once_and_only_while_subscribed(self) -> None:
+        logger = logging.getLogger("test_webcamquality")
+        cam = _FakeQuickCam(logger)
+        cam.CurrentImage = _MakeJpeg(1280, 960, 0)
+        viewers = [WebcamStreamInstance(logger, cam, q) for q in (WebcamQuality.SD480, WebcamQuality.SD480, WebcamQuality.Full)]
+        for viewer in viewers:
+            self.assertIsNotNone(viewer.StartWebRequest())
+            viewer._CustomBodyStreamRead() #pyright: ignore[reportPrivateUsage]
+            viewer._CustomBodyStreamRead().OnSendComplete() #pyright: ignore[reportPrivateUsage, reportOptionalMemberAccess]
+
+        cam.SetNewImage(_MakeJpeg(1280, 960, 50))
+        frames = [v._CustomBodyStreamRead() for v in viewers] #pyright: ignore[reportPrivateUsage]
+        self.assertIs(frames[0].Get(), frames[1].Get()) #pyright: ignore[reportOptionalMemberAccess]
+        self.assertEqual(_GetJpegSize(frames[0]), (640, 480)) #pyright: ignore[reportArgumentType]
+        self.assertEqual(_GetJpegSize(frames[2]), (1280, 960)) #pyright: ignore[reportArgumentType]
+        self.assertLess(len(frames[0]), len(frames[2])) #pyright: ignore[reportArgumentType]
+
+        stats = cam.FrameFanout.GetStats()["Tiers"]
+        self.assertEqual(stats["SD480"]["FrameBuilds"], 2)
+        self.assertEqual(stats["SD480"]["Downscales"], 2)
+        self.assertGreater(stats["SD480"]["BytesSavedPerFrame"], 0)
+        self.assertEqual(stats["Full"]["Downscales"], 0)
+
+        # Once the tier has no viewers, it's removed and nothing is scaled for it.
+        viewers[0]._CustomBodyStreamClosed() #pyright: ignore[reportPrivateUsage]
+        viewers[1]._CustomBodyStreamClosed() #pyright: ignore[reportPrivateUsage]
+        self.assertNotIn(WebcamQuality.SD480, cam.FrameFanout.Tiers)
+        viewers[2]._CustomBodyStreamClosed() #pyright: ignore[reportPrivateUsage]
+
+
+if __name__ == "__main__":
+    unittest.main()
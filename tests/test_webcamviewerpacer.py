@@ -0,0 +1,118 @@
+# ruff: noqa: E402
+import time
+import logging
+import unittest
+from typing import List
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer
+from octoeverywhere.sendscheduler import SendScheduler
+from octoeverywhere.Webcam.webcamviewerpacer import WebcamBandwidthBudget, WebcamViewerPacer
+from tests.test_webcamframefanout import _FakeQuickCam
+from octoeverywhere.Webcam.webcamstreaminstance import WebcamStreamInstance
+
+
+class TestWebcamViewerPacer(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_webcamviewerpacer")
+        self.Wakes:List[int] = []
+        self.BudgetEnabled = WebcamBandwidthBudget.Enabled
+        WebcamBandwidthBudget.SetEnabled(False)
+
+
+    def tearDown(self) -> None:
+        WebcamBandwidthBudget.SetEnabled(self.BudgetEnabled)
+
+
+    def test_one_frame_in_flight(self) -> None:
+        pacer = WebcamViewerPacer(lambda: self.Wakes.append(1))
+        self.assertEqual(pacer.GetWaitSec(), 0.0)
+        tracked = pacer.OnFrameSending(Buffer(b"frame"), 5)
+        self.assertEqual(tracked.Get(), b"frame")
+        # While the frame is in flight, the next one has to wait.
+        self.assertGreater(pacer.GetWaitSec(), 0.0)
+        tracked.OnSendComplete()
+        self.assertEqual(len(self.Wakes), 1)
+        self.assertEqual(pacer.GetWaitSec(), 0.0)
+
+
+    def test_slow_sends_lower_the_frame_rate(self) -> None:
+        pacer = WebcamViewerPacer(lambda: None)
+        pacer.AverageSendSec = 0.05
+        self.assertEqual(pacer.GetFrameIntervalSec(), 0.0)
+        pacer.AverageSendSec = 0.3
+        self.assertAlmostEqual(pacer.GetFrameIntervalSec(), 0.6)
+        # The frame rate never goes below the min.
+        pacer.AverageSendSec = 10.0
+        self.assertAlmostEqual(pacer.GetFrameIntervalSec(), 1.0 / WebcamViewerPacer.c_MinFps)
+        pacer.OnFrameSending(Buffer(b"frame"), 5).OnSendComplete()
+        self.assertGreater(pacer.GetWaitSec(), 0.0)
+
+
+    def test_late_send_complete_is_ignored(self) -> None:
+        pacer = WebcamViewerPacer(lambda: self.Wakes.append(1))
+        first = pacer.OnFrameSending(Buffer(b"a"), 1)
+        # Stop waiting on the first frame, like it timed out, and send another.
+        pacer.InFlightSinceSec = time.time() - WebcamViewerPacer.c_MaxInFlightSec - 0.1
+        # The slow send lowers the frame rate, so the viewer waits for the interval rather than the frame.
+        self.assertLessEqual(pacer.GetWaitSec(), 1.0 / WebcamViewerPacer.c_MinFps)
+        self.assertIsNone(pacer.InFlightSinceSec)
+        pacer.OnFrameSending(Buffer(b"b"), 1)
+        first.OnSendComplete()
+        self.assertEqual(len(self.Wakes), 0)
+        self.assertGreater(pacer.GetWaitSec(), 0.0)
+
+
+    def test_slow_viewer_gets_the_newest_frame(self) -> None:
+        cam = _FakeQuickCam(self.Logger)
+        viewer = WebcamStreamInstance(self.Logger, cam)
+        self.assertIsNotNone(viewer.StartWebRequest())
+        viewer._CustomBodyStreamRead() #pyright: ignore[reportPrivateUsage]
+        inFlight = viewer._CustomBodyStreamRead() #pyright: ignore[reportPrivateUsage]
+        # New images come in while the frame is still being sent, only the newest is sent next.
+        for i in range(4):
+            cam.SetNewImage(Buffer(b"\xff\xd8" + bytes([i]) + b"\xff\xd9"))
+        inFlight.OnSendComplete() #pyright: ignore[reportOptionalMemberAccess]
+        nextFrame = viewer._CustomBodyStreamRead() #pyright: ignore[reportPrivateUsage]
+        self.assertTrue(bytes(nextFrame.Get()).find(b"\xff\xd8\x03\xff\xd9") != -1) #pyright: ignore[reportOptionalMemberAccess]
+        stats = viewer.Pacer.GetStats()
+        self.assertEqual(stats["Dropped"], 3)
+        self.assertEqual(stats["Delivered"], 2)
+        viewer._CustomBodyStreamClosed() #pyright: ignore[reportPrivateUsage]
+
+
+    def test_budget_only_throttles_when_other_traffic_is_queued(self) -> None:
+        WebcamBandwidthBudget.SetEnabled(True)
+        sent = [0]
+        queued = [0]
+        oldSent = SendScheduler.GetTotalSentBytes
+        oldQueued = SendScheduler.GetTotalQueuedBytes
+        SendScheduler.GetTotalSentBytes = staticmethod(lambda: sent[0]) #type: ignore[method-assign]
+        SendScheduler.GetTotalQueuedBytes = staticmethod(lambda: queued[0]) #type: ignore[method-assign]
+        try:
+            # Start a new window.
+            WebcamBandwidthBudget._WindowStartSec = 0.0 #pyright: ignore[reportPrivateUsage]
+            self.assertEqual(WebcamBandwidthBudget.GetWaitSec(), 0.0)
+            # The webcam is all of the tunnel's traffic, but nothing else is waiting.
+            WebcamBandwidthBudget.OnFrameSending(1000)
+            sent[0] = 1000
+            queued[0] = 1000
+            self.assertEqual(WebcamBandwidthBudget.GetWaitSec(), 0.0)
+            # Now other traffic is waiting, so the webcam is held back.
+            queued[0] = 5000
+            self.assertGreater(WebcamBandwidthBudget.GetWaitSec(), 0.0)
+            # Once the other traffic has been sent, the webcam's share is under the max.
+            WebcamBandwidthBudget.OnFrameSent(1000)
+            sent[0] = 5000
+            self.assertEqual(WebcamBandwidthBudget.GetWaitSec(), 0.0)
+        finally:
+            SendScheduler.GetTotalSentBytes = oldSent #type: ignore[method-assign]
+            SendScheduler.GetTotalQueuedBytes = oldQueued #type: ignore[method-assign]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,200 @@
+# ruff: noqa: E402
+import logging
+import threading
+import time
+import unittest
+from typing import List
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.WebStream.octowebstream import OctoWebStream
+from octoeverywhere.WebStream.webstreamworkerpool import WebStreamWorkerPool
+from tests.webstreamfakes import FakeOctoSession
+
+
+class FakeIncomingMsg:
+    def __init__(self, index:int, isOpen:bool=False, priority:int=5) -> None:
+        self.Index = index
+        self.IsOpen = isOpen
+        self.Priority = priority
+
+
+    def IsOpenMsg(self) -> bool:
+        return self.IsOpen
+
+
+    def IsCloseMsg(self) -> bool:
+        return False
+
+
+    def MsgPriority(self) -> int:
+        return self.Priority
+
+
+    def DataLength(self) -> int:
+        return 10
+
+
+# A web stream that records the messages it processes rather than making http calls.
+class RecordingWebStream(OctoWebStream):
+    def __init__(self, streamId:int, processDelaySec:float=0.0) -> None:
+        super().__init__(name="RecordingWebStream", args=(logging.getLogger("test_webstreamworkerpool"), streamId, FakeOctoSession()))
+        self.Processed:List[int] = []
+        self.ProcessDelaySec = processDelaySec
+        self.ActiveRuns = 0
+        self.MaxConcurrentRuns = 0
+        self.RunLock = threading.Lock()
+
+
+    def processIncomingMessage(self, webStreamMsg) -> bool: #pyright: ignore[reportMissingParameterType]
+        with self.RunLock:
+            self.ActiveRuns += 1
+            self.MaxConcurrentRuns = max(self.MaxConcurrentRuns, self.ActiveRuns)
+        if self.ProcessDelaySec > 0:
+            time.sleep(self.ProcessDelaySec)
+        self.Processed.append(webStreamMsg.Index)
+        with self.RunLock:
+            self.ActiveRuns -= 1
+        return False
+
+
+def _WaitFor(condition, timeoutSec:float=10.0) -> bool: #pyright: ignore[reportMissingParameterType]
+    endSec = time.time() + timeoutSec
+    while time.time() < endSec:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestWebStreamWorkerPool(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_webstreamworkerpool")
+
+
+    def test_worker_count_is_bounded(self) -> None:
+        pool = WebStreamWorkerPool(self.Logger, maxWorkers=4)
+        doneLock = threading.Lock()
+        done = [0]
+
+        def work() -> None:
+            time.sleep(0.002)
+            with doneLock:
+                done[0] += 1
+
+        for _ in range(500):
+            pool.Schedule(5, work)
+        self.assertTrue(_WaitFor(lambda: done[0] == 500))
+        stats = pool.GetStats()
+        self.assertLessEqual(stats["PeakWorkers"], 4)
+        self.assertLessEqual(stats["TotalWorkersCreated"], 4)
+        self.assertEqual(stats["TotalTasks"], 500)
+
+
+    def test_high_priority_runs_first(self) -> None:
+        pool = WebStreamWorkerPool(self.Logger, maxWorkers=1)
+        release = threading.Event()
+        order:List[str] = []
+        pool.Schedule(5, release.wait)
+        # Give the worker time to pick up the blocking task.
+        self.assertTrue(_WaitFor(lambda: len(pool.RunningTasks) == 1))
+        pool.Schedule(5, lambda: order.append("normal-1"))
+        pool.Schedule(5, lambda: order.append("normal-2"))
+        pool.Schedule(1, lambda: order.append("high"))
+        release.set()
+        self.assertTrue(_WaitFor(lambda: len(order) == 3))
+        self.assertEqual(order, ["high", "normal-1", "normal-2"])
+
+
+    def test_long_running_tasks_do_not_starve_the_pool(self) -> None:
+        oldLongRunningSec = WebStreamWorkerPool.c_LongRunningTaskSec
+        WebStreamWorkerPool.c_LongRunningTaskSec = 0.1
+        try:
+            pool = WebStreamWorkerPool(self.Logger, maxWorkers=1)
+            release = threading.Event()
+            ran = threading.Event()
+            pool.Schedule(5, release.wait)
+            self.assertTrue(_WaitFor(lambda: len(pool.RunningTasks) == 1))
+            pool.Schedule(5, ran.set)
+            # The monitor should add a worker once the first task is long running.
+            self.assertTrue(ran.wait(5.0))
+            self.assertLessEqual(pool.GetStats()["PeakWorkers"], pool.MaxWorkers)
+            release.set()
+        finally:
+            WebStreamWorkerPool.c_LongRunningTaskSec = oldLongRunningSec
+
+
+    def test_new_work_runs_while_many_long_tasks_are_running(self) -> None:
+        oldLongRunningSec = WebStreamWorkerPool.c_LongRunningTaskSec
+        WebStreamWorkerPool.c_LongRunningTaskSec = 0.1
+        release = threading.Event()
+        try:
+            pool = WebStreamWorkerPool(self.Logger, maxWorkers=1)
+            # More long running streams than four times the worker limit, which used to be the hard cap.
+            longTasks = 5
+            for _ in range(longTasks):
+                pool.Schedule(5, release.wait)
+            self.assertTrue(_WaitFor(lambda: len(pool.RunningTasks) == longTasks))
+            ran = threading.Event()
+            pool.Schedule(1, ran.set)
+            self.assertTrue(ran.wait(5.0))
+            stats = pool.GetStats()
+            self.assertEqual(stats["DetachedWorkers"], longTasks)
+            self.assertLessEqual(stats["PeakWorkers"], pool.MaxWorkers)
+            # When the long tasks are done, only the pool's workers are kept.
+            release.set()
+            self.assertTrue(_WaitFor(lambda: pool.GetStats()["DetachedWorkers"] == 0))
+            self.assertLessEqual(pool.GetStats()["Workers"], pool.MaxWorkers)
+        finally:
+            release.set()
+            WebStreamWorkerPool.c_LongRunningTaskSec = oldLongRunningSec
+
+
+    def test_detached_workers_are_bounded(self) -> None:
+        oldLongRunningSec = WebStreamWorkerPool.c_LongRunningTaskSec
+        WebStreamWorkerPool.c_LongRunningTaskSec = 0.1
+        release = threading.Event()
+        try:
+            pool = WebStreamWorkerPool(self.Logger, maxWorkers=1, maxDetachedWorkers=2)
+            for _ in range(4):
+                pool.Schedule(5, release.wait)
+            # Two long tasks are detached and the third holds the only worker, so the last one has to wait.
+            self.assertTrue(_WaitFor(lambda: len(pool.RunningTasks) == 3))
+            ran = threading.Event()
+            pool.Schedule(1, ran.set)
+            self.assertFalse(ran.wait(1.5))
+            stats = pool.GetStats()
+            self.assertEqual(stats["DetachedWorkers"], 2)
+            self.assertEqual(len(pool.RunningTasks), 3)
+            self.assertEqual(stats["QueuedTasks"], 2)
+            # Once the long tasks are done, the queued work runs.
+            release.set()
+            self.assertTrue(ran.wait(5.0))
+        finally:
+            release.set()
+            WebStreamWorkerPool.c_LongRunningTaskSec = oldLongRunningSec
+
+
+    def test_streams_run_on_pool_in_order_without_overlap(self) -> None:
+        pool = WebStreamWorkerPool(self.Logger, maxWorkers=3)
+        streams = [RecordingWebStream(i + 1, processDelaySec=0.001) for i in range(20)]
+        for s in streams:
+            s.StartOnWorkerPool(pool)
+        messagesPerStream = 10
+        for i in range(messagesPerStream):
+            for s in streams:
+                s.OnIncomingServerMessage(FakeIncomingMsg(i, isOpen=(i == 0))) #pyright: ignore[reportArgumentType]
+        self.assertTrue(_WaitFor(lambda: all(len(s.Processed) == messagesPerStream for s in streams)))
+        for s in streams:
+            self.assertEqual(s.Processed, list(range(messagesPerStream)))
+            # A stream must never be run by two workers at once.
+            self.assertEqual(s.MaxConcurrentRuns, 1)
+            self.assertFalse(s.is_alive())
+        self.assertLessEqual(pool.GetStats()["PeakWorkers"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
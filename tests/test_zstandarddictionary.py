@@ -0,0 +1,108 @@
+# ruff: noqa: E402
+import json
+import logging
+import tempfile
+import unittest
+from typing import Optional
+
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer
+from octoeverywhere.compression import Compression, CompressionContext
+from octoeverywhere.negotiatedfeatures import NegotiatedFeatures
+from octoeverywhere.zstandarddictionary import ZStandardDictionary
+from octoeverywhere.Proto.ServerHost import ServerHost
+
+try:
+    import zstandard as zstd
+    _HasZStandard = True
+except ImportError:
+    _HasZStandard = False
+
+
+def _MakeJsonRpcFrames(count:int) -> list:
+    frames = []
+    for i in range(count):
+        status = {"toolhead": {"position": [i % 250, (i * 7) % 250, i % 10, i * 3]}, "extruder": {"temperature": 200 + i % 11, "target": 210.0}}
+        frames.append(json.dumps({"jsonrpc": "2.0", "method": "notify_status_update", "params": [status, 1000 + i]}).encode("utf-8"))
+    return frames
+
+
+class TestZStandardDictionary(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.Logger = logging.getLogger("test_zstandarddictionary")
+        ZStandardDictionary.SetEnabled(True)
+
+
+    def tearDown(self) -> None:
+        ZStandardDictionary.SetEnabled(True)
+
+
+    def test_traffic_classes(self) -> None:
+        self.assertEqual(ZStandardDictionary.GetTrafficClass("application/json; charset=utf-8"), ZStandardDictionary.c_TrafficClassJson)
+        self.assertEqual(ZStandardDictionary.GetTrafficClass("application/javascript"), ZStandardDictionary.c_TrafficClassWeb)
+        self.assertEqual(ZStandardDictionary.GetTrafficClass("text/html"), ZStandardDictionary.c_TrafficClassWeb)
+        self.assertIsNone(ZStandardDictionary.GetTrafficClass("image/jpeg"))
+        self.assertIsNone(ZStandardDictionary.GetTrafficClass(None))
+
+
+    @unittest.skipIf(_HasZStandard is False, "zstandard isn't installed")
+    def test_trained_dict_is_only_used_once_accepted(self) -> None:
+        Compression.Init(self.Logger, tempfile.mkdtemp())
+        compression = Compression.Get()
+        dictionary = ZStandardDictionary.Get()
+        self.assertEqual(dictionary.GetSupportedDictIds(ServerHost.Moonraker), [])
+        trainedDict = zstd.train_dictionary(16 * 1024, _MakeJsonRpcFrames(2000), dict_id=1021, level=3)
+        dictionary.AddTrainedDict(1021, ZStandardDictionary.c_TrafficClassJson, trainedDict.as_bytes())
+        self.assertEqual(dictionary.GetSupportedDictIds(ServerHost.Moonraker), [1021])
+        body = Buffer(_MakeJsonRpcFrames(1)[0])
+
+        def compressDictId(contentType:str, negotiatedFeatures:Optional[NegotiatedFeatures]=None) -> int:
+            with CompressionContext(self.Logger) as context:
+                context.SetTotalCompressedSizeOfData(len(body))
+                context.SetContentType(contentType)
+                context.SetNegotiatedFeatures(negotiatedFeatures)
+                result = compression.Compress(context, body)
+            return zstd.get_frame_parameters(bytes(result.Bytes.Get())).dict_id
+
+        # Until the server accepts it, the pre-trained dict is used.
+        self.assertEqual(compressDictId("application/json"), ZStandardDictionary.c_DefaultDictId)
+        accepted = NegotiatedFeatures(acceptedZStandardDictIds=dictionary.OnHandshakeAck([1021, 5000]))
+        self.assertEqual(accepted.AcceptedZStandardDictIds, {1021})
+        self.assertEqual(compressDictId("application/json", accepted), 1021)
+        self.assertEqual(compressDictId("text/html", accepted), ZStandardDictionary.c_DefaultDictId)
+
+        # Websocket messages set the traffic class, and the stream's first frame has the dict id the server decompresses with.
+        frames = _MakeJsonRpcFrames(20)
+        decompressor = zstd.ZstdDecompressor(dict_data=zstd.ZstdCompressionDict(trainedDict.as_bytes())).decompressobj()
+        with CompressionContext(self.Logger) as context:
+            context.SetTrafficClass(ZStandardDictionary.c_TrafficClassJson)
+            context.SetNegotiatedFeatures(accepted)
+            for i, frame in enumerate(frames):
+                result = compression.Compress(context, Buffer(frame))
+                if i == 0:
+                    self.assertEqual(zstd.get_frame_parameters(bytes(result.Bytes.Get())).dict_id, 1021)
+                self.assertEqual(decompressor.decompress(bytes(result.Bytes.Get())), frame)
+
+        # The precompressed data is kept across connections, so it always uses the pre-trained dict.
+        with CompressionContext(self.Logger) as context:
+            context.SetContentType("application/json")
+            context.SetCompressionPolicy(compression.Policies.GetPrecompressedPolicy())
+            context.SetNegotiatedFeatures(accepted)
+            self.assertEqual(context.GetDictId(), ZStandardDictionary.c_DefaultDictId)
+
+        # Older servers don't send the ids, which turns the trained dicts off for that session, but not for the others.
+        olderServer = NegotiatedFeatures(acceptedZStandardDictIds=dictionary.OnHandshakeAck([]))
+        self.assertEqual(compressDictId("application/json", olderServer), ZStandardDictionary.c_DefaultDictId)
+        self.assertEqual(compressDictId("application/json", accepted), 1021)
+        self.assertIn("Dictionaries", compression.GetPolicyStats())
+
+        ZStandardDictionary.SetEnabled(False)
+        self.assertEqual(dictionary.GetSupportedDictIds(ServerHost.Moonraker), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+# ruff: noqa: E402
+from tests.test_dependency_stubs import InstallTestDependencyStubs
+
+InstallTestDependencyStubs()
+
+from octoeverywhere.buffer import Buffer
+from octoeverywhere.negotiatedfeatures import NegotiatedFeatures
+from octoeverywhere.Proto.MessagePriority import MessagePriority
+
+
+# Stands in for the OctoSession the web streams are created on. Sent messages are dropped.
+class FakeOctoSession:
+    def __init__(self) -> None:
+        self.SessionErrors = 0
+        self.NegotiatedFeatures = NegotiatedFeatures()
+
+
+    def WebStreamClosed(self, streamId:int) -> None:
+        pass
+
+
+    def OnSessionError(self, backoffModifierSec:int) -> None:
+        self.SessionErrors += 1
+
+
+    def GetNegotiatedFeatures(self) -> NegotiatedFeatures:
+        return self.NegotiatedFeatures
+
+
+    def Send(self, buffer:Buffer, msgStartOffsetBytes:int, msgSize:int, streamId:int=0, priority:int=MessagePriority.Normal) -> None:
+        pass